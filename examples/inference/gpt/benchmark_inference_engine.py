@@ -0,0 +1,337 @@
+# Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+"""Benchmarks the latency and throughput of the megatron core inference engine with dynamic batching
+
+Replays a trace of requests against an MCoreEngine serving a small randomly initialized GPT model,
+in real time: each request joins the scheduler at its arrival time, while the engine runs dynamic
+batching steps. The trace is either synthetic (Poisson arrivals, log-normal prompt and output
+lengths) or read from a JSON lines file with the arrival time in seconds, prompt length and output
+length of each request. Reports the time to first token, inter token latency and end to end latency
+percentiles, the throughput and the batch occupancy.
+
+Example, on one GPU:
+    torchrun --nproc-per-node 1 examples/inference/gpt/benchmark_inference_engine.py \\
+        --num-requests 200 --request-rate 20 --max-batch-size 16 --max-tokens-per-step 256
+"""
+import argparse
+import json
+import math
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import torch
+
+from megatron.core import parallel_state
+from megatron.core.inference.common_inference_params import CommonInferenceParams
+from megatron.core.inference.engines.mcore_engine import MCoreEngine
+from megatron.core.inference.model_inference_wrappers.gpt.gpt_inference_wrapper import (
+    GPTInferenceWrapper,
+)
+from megatron.core.inference.model_inference_wrappers.inference_wrapper_config import (
+    InferenceWrapperConfig,
+)
+from megatron.core.inference.scheduler import SCHEDULING_POLICIES
+from megatron.core.inference.text_generation_controllers.simple_text_generation_controller import (
+    SimpleTextGenerationController,
+)
+from megatron.core.models.gpt.gpt_layer_specs import get_gpt_layer_local_spec
+from megatron.core.models.gpt.gpt_model import GPTModel
+from megatron.core.tensor_parallel.random import model_parallel_cuda_manual_seed
+from megatron.core.transformer.transformer_config import TransformerConfig
+
+
+@dataclass
+class TraceRequest:
+    arrival_time: float
+    prompt_length: int
+    output_length: int
+
+
+@dataclass
+class RequestTimes:
+    """The arrival time of a request, and the time at which each of its tokens was generated"""
+
+    arrival_time: float
+    token_times: List[float] = field(default_factory=list)
+    completion_time: float = None
+
+
+class RandomTokenizer:
+    """Detokenizes to the token ids. The end of document id is the last id of the model vocabulary, which is never sampled since sampled ids are clamped to the tokenizer vocabulary, so that the requests generate all their tokens."""
+
+    def __init__(self, vocab_size: int):
+        self.vocab_size = vocab_size
+        self.eod = vocab_size
+
+    def tokenize(self, prompt: str) -> List[int]:
+        return [int(token) for token in prompt.split()]
+
+    def detokenize(self, tokens: List[int]) -> str:
+        return " ".join(str(token) for token in tokens)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    group = parser.add_argument_group(title='trace')
+    group.add_argument("--trace", type=str, default=None,
+                       help='JSON lines file with the "arrival_time" (in seconds from the start), '
+                       '"prompt_length" and "output_length" of each request. Defaults to a synthetic trace.')
+    group.add_argument("--save-trace", type=str, default=None,
+                       help='Writes the replayed trace to this JSON lines file.')
+    group.add_argument("--num-requests", type=int, default=100)
+    group.add_argument("--request-rate", type=float, default=math.inf,
+                       help='Requests per second of the Poisson arrivals of the synthetic trace. '
+                       'Defaults to all the requests arriving at the start.')
+    group.add_argument("--prompt-length-mean", type=float, default=128)
+    group.add_argument("--output-length-mean", type=float, default=64)
+    group.add_argument("--length-sigma", type=float, default=0.5,
+                       help='Sigma of the log-normal distributions of the prompt and output lengths.')
+    group.add_argument("--seed", type=int, default=1234)
+
+    group = parser.add_argument_group(title='model')
+    group.add_argument("--num-layers", type=int, default=4)
+    group.add_argument("--hidden-size", type=int, default=256)
+    group.add_argument("--num-attention-heads", type=int, default=8)
+    group.add_argument("--vocab-size", type=int, default=1024)
+    group.add_argument("--bf16", action='store_true')
+
+    group = parser.add_argument_group(title='engine')
+    group.add_argument("--max-batch-size", type=int, default=8)
+    group.add_argument("--max-sequence-length", type=int, default=1024,
+                       help='Maximum prompt plus output length. Longer requests are truncated.')
+    group.add_argument("--num-kv-cache-blocks", type=int, default=None)
+    group.add_argument("--kv-cache-block-size", type=int, default=16)
+    group.add_argument("--enable-prefix-caching", action='store_true')
+    group.add_argument("--max-tokens-per-step", type=int, default=None)
+    group.add_argument("--scheduling-policy", type=str, default='fifo', choices=SCHEDULING_POLICIES)
+    group.add_argument("--max-kv-cache-tokens", type=int, default=None)
+    group.add_argument("--output-json", type=str, default=None,
+                       help='Writes the metrics to this JSON file.')
+    return parser.parse_args()
+
+
+def get_trace(args) -> List[TraceRequest]:
+    """Reads the trace file, or draws a synthetic trace. Lengths are clipped to fit in the maximum sequence length."""
+    if args.trace is not None:
+        with open(args.trace) as f:
+            trace = [TraceRequest(**json.loads(line)) for line in f if line.strip()]
+    else:
+        rng = random.Random(args.seed)
+
+        def get_length(mean):
+            # Log-normal with the given mean
+            mu = math.log(mean) - args.length_sigma**2 / 2
+            return max(1, round(rng.lognormvariate(mu, args.length_sigma)))
+
+        trace = []
+        arrival_time = 0.0
+        for _ in range(args.num_requests):
+            if args.request_rate != math.inf:
+                arrival_time += rng.expovariate(args.request_rate)
+            trace.append(
+                TraceRequest(
+                    arrival_time,
+                    get_length(args.prompt_length_mean),
+                    get_length(args.output_length_mean),
+                )
+            )
+
+    for request in trace:
+        request.prompt_length = min(request.prompt_length, args.max_sequence_length - 1)
+        request.output_length = min(
+            request.output_length, args.max_sequence_length - request.prompt_length
+        )
+    trace.sort(key=lambda request: request.arrival_time)
+
+    if args.save_trace is not None and torch.distributed.get_rank() == 0:
+        with open(args.save_trace, "w") as f:
+            for request in trace:
+                f.write(json.dumps(request.__dict__) + "\n")
+    return trace
+
+
+def get_engine(args) -> MCoreEngine:
+    """An engine serving a randomly initialized GPT model"""
+    # One more id than the tokenizer vocabulary, for the end of document id
+    padded_vocab_size = args.vocab_size + 1
+    params_dtype = torch.bfloat16 if args.bf16 else torch.float32
+    transformer_config = TransformerConfig(
+        num_layers=args.num_layers,
+        hidden_size=args.hidden_size,
+        num_attention_heads=args.num_attention_heads,
+        use_cpu_initialization=True,
+        params_dtype=params_dtype,
+        bf16=args.bf16,
+    )
+    model = GPTModel(
+        config=transformer_config,
+        transformer_layer_spec=get_gpt_layer_local_spec(),
+        vocab_size=padded_vocab_size,
+        max_sequence_length=args.max_sequence_length,
+        position_embedding_type='rope',
+    ).cuda()
+    if args.bf16:
+        model = model.bfloat16()
+
+    inference_wrapper_config = InferenceWrapperConfig(
+        hidden_size=args.hidden_size,
+        inference_batch_times_seqlen_threshold=-1,
+        params_dtype=params_dtype,
+        padded_vocab_size=padded_vocab_size,
+    )
+    text_generation_controller = SimpleTextGenerationController(
+        inference_wrapped_model=GPTInferenceWrapper(model, inference_wrapper_config),
+        tokenizer=RandomTokenizer(args.vocab_size),
+    )
+    return MCoreEngine(
+        text_generation_controller=text_generation_controller,
+        max_batch_size=args.max_batch_size,
+        max_sequence_length=args.max_sequence_length,
+        num_kv_cache_blocks=args.num_kv_cache_blocks,
+        kv_cache_block_size=args.kv_cache_block_size,
+        enable_prefix_caching=args.enable_prefix_caching,
+        max_tokens_per_step=args.max_tokens_per_step,
+        scheduling_policy=args.scheduling_policy,
+        max_kv_cache_tokens=args.max_kv_cache_tokens,
+    )
+
+
+def replay_trace(engine: MCoreEngine, trace: List[TraceRequest], vocab_size: int) -> Dict:
+    """Runs the engine in real time, adding each request of the trace at its arrival time
+
+    Returns:
+        Dict: The times of each request, the active requests and new tokens of each step, and the total duration
+    """
+    controller = engine.text_generation_controller
+    scheduler = engine.scheduler
+    rng = random.Random(0)
+    prompts = [
+        [rng.randrange(vocab_size) for _ in range(request.prompt_length)] for request in trace
+    ]
+    engine.prep_for_dynamic_generation()
+
+    request_times: Dict[str, RequestTimes] = {}
+    num_generated_tokens: Dict[str, int] = {}
+    step_batch_sizes: List[int] = []
+    step_new_tokens: List[int] = []
+    next_request = 0
+    start_time = time.time()
+    while next_request < len(trace) or scheduler.have_requests_pending():
+        now = time.time()
+        while next_request < len(trace) and start_time + trace[next_request].arrival_time <= now:
+            trace_request = trace[next_request]
+            arrival_time = start_time + trace_request.arrival_time
+            request_id = scheduler.add_request(
+                prompt=controller.tokenizer.detokenize(prompts[next_request]),
+                prompt_tokens=prompts[next_request],
+                inference_parameters=CommonInferenceParams(
+                    top_k=1, num_tokens_to_generate=trace_request.output_length
+                ),
+                arrival_time=arrival_time,
+            )
+            request_times[request_id] = RequestTimes(arrival_time)
+            next_request += 1
+        if not scheduler.have_requests_pending():
+            time.sleep(max(0.0, start_time + trace[next_request].arrival_time - time.time()))
+            continue
+
+        step_batch_sizes.append(len(scheduler.active_request_pool))
+        result_dict = engine.run_engine_step(dynamic_generation=True)
+        step_time = time.time()
+        new_tokens = 0
+        for request_id, request in result_dict.items():
+            num_tokens = len(controller.get_dynamic_batch_generated_tokens(request))
+            times = request_times[request_id]
+            # All the tokens of a step are generated at the end of the step
+            times.token_times += [step_time] * (num_tokens - num_generated_tokens.get(request_id, 0))
+            new_tokens += num_tokens - num_generated_tokens.get(request_id, 0)
+            num_generated_tokens[request_id] = num_tokens
+            if request.status.name == "COMPLETED":
+                times.completion_time = step_time
+        step_new_tokens.append(new_tokens)
+
+    return {
+        "request_times": request_times,
+        "step_batch_sizes": step_batch_sizes,
+        "step_new_tokens": step_new_tokens,
+        "duration": time.time() - start_time,
+    }
+
+
+def get_percentiles(values: List[float]) -> Dict[str, float]:
+    values = sorted(values) or [0.0]
+    percentiles = {"mean": sum(values) / len(values)}
+    for name, quantile in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        percentiles[name] = values[min(int(quantile * len(values)), len(values) - 1)]
+    percentiles["max"] = values[-1]
+    return percentiles
+
+
+def get_metrics(engine: MCoreEngine, trace: List[TraceRequest], replay: Dict) -> Dict:
+    """The latency percentiles in seconds, the throughputs in tokens per second, and the occupancy of the batch"""
+    request_times = replay["request_times"].values()
+    time_to_first_token = [
+        times.token_times[0] - times.arrival_time for times in request_times if times.token_times
+    ]
+    inter_token_latency = [
+        (times.token_times[-1] - times.token_times[0]) / (len(times.token_times) - 1)
+        for times in request_times
+        if len(times.token_times) > 1
+    ]
+    end_to_end_latency = [
+        times.completion_time - times.arrival_time
+        for times in request_times
+        if times.completion_time is not None
+    ]
+    num_output_tokens = sum(len(times.token_times) for times in request_times)
+    num_prompt_tokens = sum(request.prompt_length for request in trace)
+    duration = replay["duration"]
+    step_batch_sizes = replay["step_batch_sizes"]
+    num_steps = max(len(step_batch_sizes), 1)
+    return {
+        "num_requests": len(trace),
+        "num_steps": len(step_batch_sizes),
+        "duration": duration,
+        "time_to_first_token": get_percentiles(time_to_first_token),
+        "inter_token_latency": get_percentiles(inter_token_latency),
+        "end_to_end_latency": get_percentiles(end_to_end_latency),
+        "queue_time": engine.scheduler.get_queue_time_metrics(),
+        "output_tokens_per_second": num_output_tokens / duration,
+        "total_tokens_per_second": (num_output_tokens + num_prompt_tokens) / duration,
+        "requests_per_second": len(end_to_end_latency) / duration,
+        "mean_batch_size": sum(step_batch_sizes) / num_steps,
+        "batch_occupancy": sum(step_batch_sizes) / num_steps / engine.scheduler.max_batch_size,
+        "mean_output_tokens_per_step": sum(replay["step_new_tokens"]) / num_steps,
+    }
+
+
+def main():
+    args = get_args()
+    torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    torch.distributed.init_process_group()
+    parallel_state.initialize_model_parallel()
+    model_parallel_cuda_manual_seed(args.seed)
+
+    trace = get_trace(args)
+    engine = get_engine(args)
+    metrics = get_metrics(engine, trace, replay_trace(engine, trace, args.vocab_size))
+
+    if torch.distributed.get_rank() == 0:
+        def format_value(value):
+            return f"{value:.4f}" if isinstance(value, float) else str(value)
+
+        for name, value in metrics.items():
+            if isinstance(value, dict):
+                value = ", ".join(f"{key} {format_value(value)}" for key, value in value.items())
+            print(f"{name}: {format_value(value)}")
+        if args.output_json is not None:
+            with open(args.output_json, "w") as f:
+                json.dump(metrics, f, indent=2)
+
+    torch.distributed.destroy_process_group()
+
+
+if __name__ == "__main__":
+    main()
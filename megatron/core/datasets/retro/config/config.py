@@ -45,17 +45,20 @@ class RetroPreprocessingConfig(TransformerConfig):
         retro_bert_vocab_file (str): Bert vocab file.
         retro_bert_batch_size (int): Micro-batch size for processing Bert embeddings.
         retro_bert_max_chunk_length (int): Maximum sequence length for Bert embeddings. (Named 'chunk' here in reference to these Bert sequences being converted from GPT chunks.)
-        retro_index_type (str): A 'faiss-base' index is a simple, un-optimized wrapper around a Faiss index. A 'faiss-par-add' index optimizes the 'add()' method by making it multi-node and multi-process, but with bit-wise equivalent results.
+        retro_index_type (str): A 'faiss-base' index is a simple, un-optimized wrapper around a Faiss index. A 'faiss-par-add' index optimizes the 'add()' method by making it multi-node and multi-process, but with bit-wise equivalent results. A 'faiss-sharded' index adds like 'faiss-par-add', but partitions the IVF lists of the populated index into on-disk shards, which are memory mapped and searched in parallel during querying.
         retro_index_str (str): Index string used for calling faiss.index_factory(). For example, 'IVF262144_HNSW32,Flat' or 'OPQ32_256,IVF4194304_HNSW32,PQ32'.
         retro_index_ntrain (int): Number of database chunks to use for training the index. This value must be less or equal to the total number of chunks in the database.
         retro_index_train_load_fraction (float): Fraction of sampled chunks to use for training the index. Useful when our total sampled embeddings use too much memory; lowering the load fraction is less costly than re-embedding a new sampled dataset from scratch.
         retro_index_add_load_fraction (float): Fraction of database chunks to use for adding to the index. Useful when our total index size would use too much memory; lowering the load fraction is less costly than re-designing our token datasets.
         retro_index_delete_training_embeddings (bool): Delete training embeddings for the search index. Useful for debugging.
         retro_index_delete_added_codes (bool): Delete added codes for the search index. Useful for debugging.
+        retro_index_num_shards (int): Number of shards of IVF lists when using a 'faiss-sharded' index.
+        retro_index_incremental (bool): Incrementally update an existing populated index. Chunks appended to the chunk database since the index was populated (detected via the index's manifest) are encoded and added to the index, and when querying, only neighbor blocks that are missing or that were queried against an older chunk database are updated. Requires new data to be appended to the data blend as new datasets. The codes of an update are kept once added, since querying merges stale neighbor blocks with the neighbors among the appended chunks using them.
         retro_query_ef_search (int): Index ef-search parameter for Hierarchical Navigable Small Worlds (HNSW) during querying.
         retro_query_nprobe (int): Index nprobe parameter for Inverted File (IVF) during querying.
         retro_query_num_neighbors_query (int): Number of neighbors to retrieve when calling index.search().
         retro_query_num_neighbors_save (int): Number of neighbors to save to disk after the index's returned neighbors. If longer than target value, neighbors truncated; and if shorter than target value, neighbors are padded with -1's.
+        retro_query_num_shard_threads (int): Number of threads for searching index shards in parallel when using a 'faiss-sharded' index.
         retro_bert_embedders (RetroBertEmbedders): Set of Bert embedders used for embedding chunks. Contains entries: 1) 'mem' for an in-memory embedder, and 2) 'disk' for an embedder that saves results in blocks to disk.
         retro_gpt_chunk_datasets (RetroGPTChunkDatasets): GPT datasets for 'train', 'valid', and 'test'.
         retro_tokenizers (RetroTokenizers): GPT ('gpt') and Bert ('bert') tokenizers.
@@ -98,12 +101,15 @@ class RetroPreprocessingConfig(TransformerConfig):
     retro_index_add_load_fraction: float = 1.0
     retro_index_delete_training_embeddings: bool = True
     retro_index_delete_added_codes: bool = True
+    retro_index_num_shards: int = 16
+    retro_index_incremental: bool = False
 
     # Query.
     retro_query_ef_search: int = 256
     retro_query_nprobe: int = 65536
     retro_query_num_neighbors_query: int = 200
     retro_query_num_neighbors_save: int = 20
+    retro_query_num_shard_threads: int = 8
 
     # Tools.
     retro_bert_embedders: RetroBertEmbedders = None
@@ -8,8 +8,11 @@ Constructing an index generally happens in two phases:
   - index.add(): Add vectors to an index, to be available for retrieval.
 """
 
+import glob
+import json
 import os
 import shutil
+from typing import Dict, List, Optional
 
 import numpy as np
 import torch
@@ -17,14 +20,18 @@ from tqdm import tqdm
 
 from megatron.core.datasets.retro.config import RetroPreprocessingConfig
 from megatron.core.datasets.retro.db.utils import (
+    get_indexed_dataset_infos,
     get_merged_sampled_dataset,
     get_merged_train_dataset,
 )
 from megatron.core.datasets.retro.external_libs import h5py
-from megatron.core.datasets.retro.utils import GPTToTextDataset
+from megatron.core.datasets.retro.utils import GPTToTextDataset, log_retro_rank_0
 
 from .factory import IndexFactory
+from .indexes import FaissParallelAddIndex
 from .utils import (
+    get_added_codes_update_dir,
+    get_added_index_manifest_path,
     get_training_data_block_dir,
     get_training_data_block_paths,
     get_training_data_merged_path,
@@ -248,6 +255,57 @@ def get_text_dataset_for_adding(config: RetroPreprocessingConfig) -> GPTToTextDa
     return text_dataset
 
 
+def get_db_manifest_datasets(config: RetroPreprocessingConfig) -> List[Dict]:
+    """Get the per-dataset chunk counts of the 'train' chunk database.
+
+    The merged 'train' chunk database is the concatenation of each dataset's
+    training chunks, in data blend order. Therefore, new chunks are only
+    appended to the end of the database when datasets are appended to the data
+    blend, and the existing datasets are unchanged.
+
+    Args:
+        config (RetroPreprocessingConfig): Retro preprocessing config.
+
+    Returns:
+        List of dicts containing each dataset's 'prefix' and 'n_chunks_train'.
+    """
+    return [
+        {"prefix": info["prefix"], "n_chunks_train": info["n_chunks_train"]}
+        for info in get_indexed_dataset_infos(config.retro_project_dir)
+    ]
+
+
+def get_added_index_manifest(config: RetroPreprocessingConfig) -> Optional[Dict]:
+    """Load the manifest of chunks added to the index.
+
+    Args:
+        config (RetroPreprocessingConfig): Retro preprocessing config.
+
+    Returns:
+        The manifest, containing 'n_chunks' (number of chunks in the index), 'datasets' (see `get_db_manifest_datasets()`), 'updates' (list of [start, end) chunk ranges added incrementally), and optionally 'pending_update' (see `_apply_pending_update()`). None, if the manifest does not exist.
+    """
+    path = get_added_index_manifest_path(config)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_added_index_manifest(config: RetroPreprocessingConfig, manifest: Dict) -> None:
+    """Save the manifest of chunks added to the index (rank 0).
+
+    Args:
+        config (RetroPreprocessingConfig): Retro preprocessing config.
+        manifest (Dict): Manifest (see `get_added_index_manifest()`).
+    """
+    if torch.distributed.get_rank() == 0:
+        path = get_added_index_manifest_path(config)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(path + ".tmp", path)
+    torch.distributed.barrier()
+
+
 def _add_to_index(config: RetroPreprocessingConfig) -> str:
     """Add DB chunks to index.
 
@@ -264,12 +322,155 @@ def _add_to_index(config: RetroPreprocessingConfig) -> str:
     # Get text dataset.
     text_dataset = get_text_dataset_for_adding(config)
 
+    # Check for the manifest before adding. Rank 0 only saves it after the
+    # barrier in 'index.add()', so all ranks make the same decision, and call
+    # the barrier of 'save_added_index_manifest()' together.
+    has_manifest = get_added_index_manifest(config) is not None
+
     # Add to index.
     output_index_path = index.add(config, text_dataset)
 
+    # Record chunk database state, for later incremental updates.
+    if not has_manifest:
+        save_added_index_manifest(
+            config,
+            {
+                "n_chunks": len(text_dataset),
+                "datasets": get_db_manifest_datasets(config),
+                "updates": [],
+            },
+        )
+
     return output_index_path
 
 
+def _apply_pending_update(
+    config: RetroPreprocessingConfig, index: FaissParallelAddIndex, manifest: Dict
+) -> Dict:
+    """Add the encoded codes of a pending incremental update to the index.
+
+    The pending update is recorded in the manifest before the index is
+    modified, with the update's chunk range, the datasets of the chunk
+    database, and the number of vectors in each index file (i.e., the index,
+    or each shard) before the update. Index files are replaced atomically, so
+    each file either has all of the update's codes or none, and only files that
+    still have their size from before the update are updated. Re-running an
+    interrupted update therefore never adds the same codes twice.
+
+    The update's codes are kept after adding, since querying builds the index
+    of the appended chunks from them (see `get_delta_index()`).
+
+    Args:
+        config (RetroPreprocessingConfig): Retro preprocessing config.
+        index (FaissParallelAddIndex): Index to which the codes are added.
+        manifest (Dict): Manifest with a 'pending_update' (see `get_added_index_manifest()`).
+
+    Returns:
+        The manifest after the update.
+    """
+    pending_update = manifest["pending_update"]
+    start_idx, end_idx = pending_update["range"]
+    codes_dir = get_added_codes_update_dir(config, start_idx, end_idx)
+
+    # Add codes to index.
+    log_retro_rank_0("add chunks [%d, %d) to index." % (start_idx, end_idx))
+    index.add_codes_incremental(
+        config, sorted(glob.glob(codes_dir + "/*.hdf5")), pending_update["ntotals"]
+    )
+
+    # Wait for adding to complete.
+    torch.distributed.barrier()
+
+    # Record update.
+    manifest = {
+        "n_chunks": end_idx,
+        "datasets": pending_update["datasets"],
+        "updates": manifest["updates"] + [[start_idx, end_idx]],
+    }
+    save_added_index_manifest(config, manifest)
+
+    return manifest
+
+
+def _add_to_index_incremental(config: RetroPreprocessingConfig) -> str:
+    """Add DB chunks appended since the previous add to the existing index.
+
+    The manifest saved with the populated index is compared against the
+    current chunk database. Existing datasets must be unchanged, and only the
+    chunks of newly appended datasets are encoded and added.
+
+    Args:
+        config (RetroPreprocessingConfig): Retro preprocessing config.
+
+    Returns:
+        Path to the populated index.
+    """
+
+    # Get index.
+    index = IndexFactory.get_index(config.retro_index_type)
+    assert isinstance(
+        index, FaissParallelAddIndex
+    ), "incremental add requires index type 'faiss-par-add' or 'faiss-sharded'."
+    assert (
+        config.retro_index_add_load_fraction == 1.0
+    ), "incremental add requires '--retro-index-add-load-fraction 1.0'."
+
+    # Fall back to full add, if index not yet populated.
+    manifest = get_added_index_manifest(config)
+    if manifest is None:
+        assert not os.path.exists(
+            index.get_added_index_path(config)
+        ), "populated index has no manifest; re-run a full add to enable incremental updates."
+        return _add_to_index(config)
+
+    # Finish an interrupted update.
+    if "pending_update" in manifest:
+        log_retro_rank_0("resume interrupted update.")
+        manifest = _apply_pending_update(config, index, manifest)
+
+    # Validate that the DB has only been appended to.
+    datasets = get_db_manifest_datasets(config)
+    n_datasets = len(manifest["datasets"])
+    assert datasets[:n_datasets] == manifest["datasets"], (
+        "incremental add requires existing datasets to be unchanged, and new datasets to be "
+        "appended to the data blend."
+    )
+
+    # Get text dataset.
+    text_dataset = get_text_dataset_for_adding(config)
+    start_idx = manifest["n_chunks"]
+    end_idx = len(text_dataset)
+    assert end_idx >= start_idx
+
+    # Add new chunks to index.
+    if end_idx == start_idx:
+        log_retro_rank_0("index up to date, %d chunks." % end_idx)
+    else:
+        # Encode new chunks.
+        log_retro_rank_0("encode chunks [%d, %d)." % (start_idx, end_idx))
+        index.encode(
+            config, text_dataset, get_added_codes_update_dir(config, start_idx, end_idx), start_idx
+        )
+
+        # Record the update as pending, before modifying the index.
+        save_added_index_manifest(
+            config,
+            dict(
+                manifest,
+                pending_update={
+                    "range": [start_idx, end_idx],
+                    "datasets": datasets,
+                    "ntotals": index.get_added_index_ntotals(config),
+                },
+            ),
+        )
+
+        # Add new codes to index. (Reload the manifest saved by rank 0, so all ranks agree.)
+        _apply_pending_update(config, index, get_added_index_manifest(config))
+
+    return index.get_added_index_path(config)
+
+
 def add_to_index(config: RetroPreprocessingConfig) -> None:
     """Entry point for adding to the index.
 
@@ -279,9 +480,12 @@ def add_to_index(config: RetroPreprocessingConfig) -> None:
         config (RetroPreprocessingConfig): Retro preprocessing config.
     """
 
-    # Add to new index.
+    # Add to new index (or update existing index).
     if config.retro_task_validate is None:
-        _add_to_index(config)
+        if config.retro_index_incremental:
+            _add_to_index_incremental(config)
+        else:
+            _add_to_index(config)
 
     # Validate existing encodings.
     else:
@@ -300,7 +504,8 @@ def build_index(config: RetroPreprocessingConfig) -> None:
 
     Building index involves sequentially running stages above:
     - Train index (on sampled training chunks).
-    - Add to index (on all training chunks).
+    - Add to index (on all training chunks, or with '--retro-index-incremental',
+      only on training chunks appended since the previous add).
 
     Args:
         config (RetroPreprocessingConfig): Retro preprocessing config.
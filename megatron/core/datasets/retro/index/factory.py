@@ -4,7 +4,7 @@
 
 from megatron.core.datasets.retro.index.index import Index
 
-from .indexes import FaissBaseIndex, FaissParallelAddIndex
+from .indexes import FaissBaseIndex, FaissParallelAddIndex, FaissShardedIndex
 
 
 class IndexFactory:
@@ -18,19 +18,23 @@ class IndexFactory:
         """Get an index class, given a type string.
 
         Args:
-            index_type (str): One of 'faiss-base' (naive Faiss index wrapper) or 'faiss-par-add' (Faiss index wrapper with near embarrassingly parallel index.add().
+            index_type (str): One of 'faiss-base' (naive Faiss index wrapper), 'faiss-par-add' (Faiss index wrapper with near embarrassingly parallel index.add()), or 'faiss-sharded' (same as 'faiss-par-add', with the populated index split into on-disk shards of IVF lists).
 
         Returns:
             An `Index` sub-type corresponding to the `index_type`.
         """
-        return {"faiss-base": FaissBaseIndex, "faiss-par-add": FaissParallelAddIndex}[index_type]
+        return {
+            "faiss-base": FaissBaseIndex,
+            "faiss-par-add": FaissParallelAddIndex,
+            "faiss-sharded": FaissShardedIndex,
+        }[index_type]
 
     @classmethod
     def get_index(cls, index_type: str) -> Index:
         """Construct an index from an index type string.
 
         Args:
-            index_type (str): One of 'faiss-base' (naive Faiss index wrapper) or 'faiss-par-add' (Faiss index wrapper with near embarrassingly parallel index.add().
+            index_type (str): One of 'faiss-base' (naive Faiss index wrapper), 'faiss-par-add' (Faiss index wrapper with near embarrassingly parallel index.add()), or 'faiss-sharded' (same as 'faiss-par-add', with the populated index split into on-disk shards of IVF lists).
 
         Returns:
             An `Index` instance corresponding to the `index_type`.
@@ -14,7 +14,7 @@ pattern:
 
 import abc
 import os
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 import numpy as np
 import torch
@@ -88,16 +88,38 @@ class Index(abc.ABC):
             % (config.retro_index_train_load_fraction, config.retro_index_add_load_fraction),
         )
 
-    def get_added_index(self, config: RetroPreprocessingConfig) -> faiss.Index:
+    def get_search_params(self, config: RetroPreprocessingConfig) -> Dict[str, int]:
+        """Get Faiss search parameters used during querying.
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+
+        Returns:
+            Dict mapping Faiss parameter names to values.
+        """
+        return {"efSearch": config.retro_query_ef_search, "nprobe": config.retro_query_nprobe}
+
+    def get_added_index(
+        self, config: RetroPreprocessingConfig, ondisk: bool = False
+    ) -> faiss.Index:
         """Get index that has been populated with vectors.
 
         Args:
             config (RetroPreprocessingConfig): Retro preprocessing config.
+            ondisk (bool): If `ondisk = True`, memory map the index.
 
         Returns:
-            'Added' (i.e., populated) Faiss index, loaded from storage.
+            'Added' (i.e., populated) Faiss index, loaded from storage, with search parameters set.
         """
-        return faiss.read_index(self.get_added_index_path(config))
+        if ondisk:
+            index = faiss.read_index(self.get_added_index_path(config), faiss.IO_FLAG_MMAP)
+        else:
+            index = faiss.read_index(self.get_added_index_path(config))
+
+        for key, value in self.get_search_params(config).items():
+            faiss.ParameterSpace().set_index_parameter(index, key, value)
+
+        return index
 
     @abc.abstractmethod
     def train(self, config: RetroPreprocessingConfig) -> None:
@@ -4,7 +4,9 @@
 Exports:
 - FaissBaseIndex: Unoptimized Faiss index wrapper
 - FaissParallelAddIndex: Optimized index.add() for Faiss index.
+- FaissShardedIndex: Optimized index.add(), with on-disk shards of IVF lists.
 """
 
 from .faiss_base import FaissBaseIndex
 from .faiss_par_add import FaissParallelAddIndex
+from .faiss_sharded import FaissShardedIndex
@@ -10,7 +10,7 @@ the vast majority of the computational effort is embarrassingly parallel.
 
 import os
 import shutil
-from typing import Tuple
+from typing import List, Tuple
 
 import numpy as np
 import psutil
@@ -81,15 +81,24 @@ class FaissParallelAddIndex(FaissBaseIndex):
         with h5py.File(block["path"], "w") as f:
             f.create_dataset("data", data=codes)
 
-    def encode(self, config: RetroPreprocessingConfig, text_dataset: GPTToTextDataset) -> None:
+    def encode(
+        self,
+        config: RetroPreprocessingConfig,
+        text_dataset: GPTToTextDataset,
+        codes_dir: str = None,
+        start_idx: int = 0,
+    ) -> None:
         """Encode text dataset, to be later added to index.
 
         Args:
             config (RetroPreprocessingConfig): Retro preprocessing config.
             text_dataset (GPTToTextDataset): Text dataset to be encoded by the index.
+            codes_dir (str): Directory for saving encoding blocks. Defaults to the added codes directory.
+            start_idx (int): First sample index to encode. Samples before this index are assumed to already be in the index.
         """
 
-        codes_dir = get_added_codes_dir(config)
+        if codes_dir is None:
+            codes_dir = get_added_codes_dir(config)
         retro_makedir(config, codes_dir)
 
         # Index.
@@ -108,7 +117,11 @@ class FaissParallelAddIndex(FaissBaseIndex):
             assert len(f["data"].shape) == 2
 
         blocks = get_blocks_by_rank(
-            codes_dir, len(text_dataset), config.retro_block_size, validate=validate
+            codes_dir,
+            len(text_dataset),
+            config.retro_block_size,
+            validate=validate,
+            start_idx=start_idx,
         )
 
         # Encode each block.
@@ -130,28 +143,19 @@ class FaissParallelAddIndex(FaissBaseIndex):
             log_retro_rank_0(" > waiting for other ranks to finish block.")
             torch.distributed.barrier()
 
-    def add_codes(self, config: RetroPreprocessingConfig) -> None:
-        """Read codes from disk, and add them to the index.
+    def add_code_paths(
+        self, config: RetroPreprocessingConfig, index: faiss.Index, code_paths: List[str]
+    ) -> None:
+        """Read blocks of codes from disk, and add them to an index.
 
         Args:
             config (RetroPreprocessingConfig): Retro preprocessing config.
+            index (faiss.Index): Trained index, to which codes are added in place.
+            code_paths (List[str]): Paths of code blocks, named '{start_idx}-{end_idx}.hdf5'.
         """
 
-        if torch.distributed.get_rank() != 0:
-            return
-
-        added_index_path = self.get_added_index_path(config)
-        if os.path.exists(added_index_path):
-            return
-
-        # Index.
-        log_retro_rank_0("read empty index.")
-        index = self.get_empty_index(config)
         index_ivf = faiss.extract_index_ivf(index)
 
-        # Add codes.
-        log_retro_rank_0("add codes.")
-        code_paths = get_added_code_paths(config)
         pbar = tqdm(code_paths)
         for code_path in pbar:
             pbar.set_description(
@@ -169,10 +173,81 @@ class FaissParallelAddIndex(FaissBaseIndex):
         # Update index's ntotal.
         index.ntotal = index_ivf.ntotal
 
+    def add_codes(self, config: RetroPreprocessingConfig) -> None:
+        """Read codes from disk, and add them to the index.
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+        """
+
+        if torch.distributed.get_rank() != 0:
+            return
+
+        added_index_path = self.get_added_index_path(config)
+        if os.path.exists(added_index_path):
+            return
+
+        # Index.
+        log_retro_rank_0("read empty index.")
+        index = self.get_empty_index(config)
+
+        # Add codes.
+        log_retro_rank_0("add codes.")
+        self.add_code_paths(config, index, get_added_code_paths(config))
+
         # Write index.
         log_retro_rank_0("write added index.")
         faiss.write_index(index, added_index_path)
 
+    def get_added_index_ntotals(self, config: RetroPreprocessingConfig) -> List[int]:
+        """Get the number of vectors in each file of the populated index.
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+
+        Returns:
+            A single-item list, with the number of vectors in the populated index.
+        """
+        return [faiss.read_index(self.get_added_index_path(config), faiss.IO_FLAG_MMAP).ntotal]
+
+    def add_codes_incremental(
+        self, config: RetroPreprocessingConfig, code_paths: List[str], ntotals: List[int]
+    ) -> None:
+        """Read new codes from disk, and add them to the existing populated index.
+
+        The updated index is written to a temporary file, and then moved over
+        the existing index, so an interrupted update leaves the index intact.
+        The index is only updated if it still has its size from before the
+        update, so that re-running an interrupted update never adds the same
+        codes twice.
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+            code_paths (List[str]): Paths of code blocks to add.
+            ntotals (List[int]): Number of vectors in the index before the update (see `get_added_index_ntotals()`).
+        """
+
+        if torch.distributed.get_rank() != 0:
+            return
+
+        added_index_path = self.get_added_index_path(config)
+
+        # Index.
+        log_retro_rank_0("read added index.")
+        index = faiss.read_index(added_index_path)
+        if index.ntotal != ntotals[0]:
+            log_retro_rank_0("codes already added to index.")
+            return
+
+        # Add codes.
+        log_retro_rank_0("add codes.")
+        self.add_code_paths(config, index, code_paths)
+
+        # Write index.
+        log_retro_rank_0("write added index.")
+        faiss.write_index(index, added_index_path + ".tmp")
+        os.replace(added_index_path + ".tmp", added_index_path)
+
     def remove_codes(self, config: RetroPreprocessingConfig) -> None:
         """Remove added codes after adding to index.
 
@@ -0,0 +1,436 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+
+"""Sharded, on-disk version of FaissParallelAddIndex.
+
+This class inherits from FaissParallelAddIndex, and partitions the inverted
+lists of the trained IVF index into K shards that are written as separate
+index files. Each shard holds only the codes assigned to its range of lists.
+During querying, shards are memory mapped lazily, only when a query batch
+probes one of their lists, and a query batch is fanned out across the probed
+shards in a thread pool. The per-shard top-k results are then merged. This
+avoids loading the full populated index into every querying process.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+import psutil
+import torch
+from tqdm import tqdm
+
+from megatron.core.datasets.retro.config import RetroPreprocessingConfig
+from megatron.core.datasets.retro.external_libs import faiss, h5py
+from megatron.core.datasets.retro.index.utils import get_added_code_paths, get_index_dir
+from megatron.core.datasets.retro.utils import log_retro_rank_0, retro_makedir
+
+from .faiss_par_add import FaissParallelAddIndex
+
+
+def get_list_nos_from_codes(index_ivf: faiss.IndexIVF, codes: np.ndarray) -> np.ndarray:
+    """Decode the inverted list number of each standalone code.
+
+    Codes produced by index.sa_encode() for an IVF index are prefixed by the
+    coarse (list number) code, stored as a little-endian integer of
+    `coarse_code_size()` bytes.
+
+    Args:
+        index_ivf (faiss.IndexIVF): IVF index that produced the codes.
+        codes (np.ndarray): Array of uint8 codes, with shape (n, code_size).
+
+    Returns:
+        Array of list numbers, with shape (n,).
+    """
+    coarse_code_size = index_ivf.coarse_code_size()
+    list_nos = np.zeros(len(codes), dtype="int64")
+    for byte_idx in range(coarse_code_size):
+        list_nos |= codes[:, byte_idx].astype("int64") << (8 * byte_idx)
+    return list_nos
+
+
+def get_shard_ids_from_list_nos(list_nos: np.ndarray, nlist: int, num_shards: int) -> np.ndarray:
+    """Map inverted list numbers to shard IDs.
+
+    Lists are partitioned into `num_shards` contiguous ranges of (nearly)
+    equal size.
+
+    Args:
+        list_nos (np.ndarray): Inverted list numbers. Negative values (i.e., unused probes) map to -1.
+        nlist (int): Total number of inverted lists in the IVF index.
+        num_shards (int): Number of shards.
+
+    Returns:
+        Array of shard IDs, with the same shape as `list_nos`.
+    """
+    return np.where(list_nos >= 0, (list_nos * num_shards) // nlist, -1)
+
+
+def merge_search_results(
+    distances: List[np.ndarray], labels: List[np.ndarray], k: int, metric_type: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge per-shard search results into a single top-k result.
+
+    Args:
+        distances (List[np.ndarray]): Per-shard distances, each with shape (n, k).
+        labels (List[np.ndarray]): Per-shard neighbor IDs, each with shape (n, k). Missing results are -1.
+        k (int): Number of neighbors to keep.
+        metric_type (int): Faiss metric type, used to decide whether smaller (L2) or larger (inner product) distances are better.
+
+    Returns:
+        A tuple of merged (distances, labels), each with shape (n, k).
+    """
+    distances = np.concatenate(distances, axis=1)
+    labels = np.concatenate(labels, axis=1)
+
+    # Sort such that better results come first, and missing results come last.
+    sort_keys = -distances if metric_type == faiss.METRIC_INNER_PRODUCT else distances.copy()
+    sort_keys[labels < 0] = np.inf
+    order = np.argsort(sort_keys, axis=1, kind="stable")[:, :k]
+
+    return (np.take_along_axis(distances, order, axis=1), np.take_along_axis(labels, order, axis=1))
+
+
+class FaissShardedIndexSearcher:
+    """Search interface over the shards of a sharded index.
+
+    This object mimics the subset of the faiss.Index interface used during
+    querying (i.e., `ntotal` and `search()`). The coarse quantizer (and any
+    pre-transform) is read from the empty index, which is small. Shards are
+    only read from storage the first time a query probes one of their lists.
+
+    Args:
+        empty_index (faiss.Index): Trained, but unpopulated, index.
+        shard_paths (List[str]): Paths to populated index shards.
+        ntotal (int): Total number of vectors across all shards.
+        ondisk (bool): If `ondisk = True`, memory map shards rather than loading them into memory.
+        num_threads (int): Number of threads used to search shards concurrently.
+        search_params (Dict[str, int]): Faiss search parameters (e.g., 'nprobe', 'efSearch') applied to each index.
+    """
+
+    def __init__(
+        self,
+        empty_index: faiss.Index,
+        shard_paths: List[str],
+        ntotal: int,
+        ondisk: bool,
+        num_threads: int,
+        search_params: Dict[str, int],
+    ):
+        self.empty_index = empty_index
+        self.empty_index_ivf = faiss.extract_index_ivf(empty_index)
+        self.shard_paths = shard_paths
+        self.shards = [None] * len(shard_paths)
+        self.ntotal = ntotal
+        self.ondisk = ondisk
+        self.num_threads = num_threads
+        self.search_params = search_params
+
+        for key, value in self.search_params.items():
+            faiss.ParameterSpace().set_index_parameter(self.empty_index, key, value)
+
+    def get_shard(self, shard_id: int) -> faiss.Index:
+        """Get shard, reading it from storage if not yet loaded.
+
+        Args:
+            shard_id (int): Shard ID.
+
+        Returns:
+            Populated index containing only the lists of this shard.
+        """
+        if self.shards[shard_id] is None:
+            shard_path = self.shard_paths[shard_id]
+            if self.ondisk:
+                shard = faiss.read_index(shard_path, faiss.IO_FLAG_MMAP)
+            else:
+                shard = faiss.read_index(shard_path)
+            for key, value in self.search_params.items():
+                faiss.ParameterSpace().set_index_parameter(shard, key, value)
+            self.shards[shard_id] = shard
+        return self.shards[shard_id]
+
+    def get_probed_list_nos(self, x: np.ndarray) -> np.ndarray:
+        """Compute the inverted lists probed by each query.
+
+        Args:
+            x (np.ndarray): Query vectors, with shape (n, d).
+
+        Returns:
+            Array of list numbers, with shape (n, nprobe).
+        """
+        if isinstance(self.empty_index, faiss.IndexPreTransform):
+            for transform_idx in range(self.empty_index.chain.size()):
+                x = self.empty_index.chain.at(transform_idx).apply_py(x)
+        _, list_nos = self.empty_index_ivf.quantizer.search(x, self.empty_index_ivf.nprobe)
+        return list_nos
+
+    def search(self, x: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Search shards, and merge results.
+
+        Args:
+            x (np.ndarray): Query vectors, with shape (n, d).
+            k (int): Number of neighbors to return.
+
+        Returns:
+            A tuple of (distances, labels), each with shape (n, k).
+        """
+
+        x = np.ascontiguousarray(x, dtype="f4")
+        n = len(x)
+        num_shards = len(self.shard_paths)
+
+        # Shards probed by each query.
+        list_nos = self.get_probed_list_nos(x)
+        shard_ids = get_shard_ids_from_list_nos(list_nos, self.empty_index_ivf.nlist, num_shards)
+        probed_shard_ids = [s for s in range(num_shards) if (shard_ids == s).any()]
+
+        def search_shard(shard_id: int) -> Tuple[np.ndarray, np.ndarray]:
+            """Search a single shard, using only the queries that probe it."""
+            query_mask = (shard_ids == shard_id).any(axis=1)
+            shard_distances = np.full((n, k), np.nan, dtype="f4")
+            shard_labels = np.full((n, k), -1, dtype="int64")
+            shard_distances[query_mask], shard_labels[query_mask] = self.get_shard(shard_id).search(
+                x[query_mask], k
+            )
+            return shard_distances, shard_labels
+
+        if len(probed_shard_ids) == 0:
+            return np.full((n, k), np.nan, dtype="f4"), np.full((n, k), -1, dtype="int64")
+
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            results = list(executor.map(search_shard, probed_shard_ids))
+
+        return merge_search_results(
+            [r[0] for r in results], [r[1] for r in results], k, self.empty_index.metric_type
+        )
+
+
+class FaissShardedIndex(FaissParallelAddIndex):
+    """
+    This class encodes vectors exactly as FaissParallelAddIndex, but rather
+    than adding all codes to a single index, the inverted lists are partitioned
+    into `config.retro_index_num_shards` shards, and each shard is written as
+    a separate index file. Shards are built in parallel across ranks.
+    """
+
+    def get_added_index_shard_dir(self, config: RetroPreprocessingConfig) -> str:
+        """Get directory of populated index shards.
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+
+        Returns:
+            Path to the directory containing the populated index shards.
+        """
+        return os.path.join(
+            get_index_dir(config),
+            "added_%.3f_%.3f_shards"
+            % (config.retro_index_train_load_fraction, config.retro_index_add_load_fraction),
+        )
+
+    def get_added_index_shard_paths(self, config: RetroPreprocessingConfig) -> List[str]:
+        """Get file paths to populated index shards.
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+
+        Returns:
+            File paths of all populated index shards.
+        """
+        num_shards = config.retro_index_num_shards
+        n_digits = len(str(num_shards))
+        return [
+            os.path.join(
+                self.get_added_index_shard_dir(config),
+                "%s-of-%s.faissindex" % (str(i).zfill(n_digits), str(num_shards).zfill(n_digits)),
+            )
+            for i in range(num_shards)
+        ]
+
+    def add_code_paths_to_shard(
+        self,
+        config: RetroPreprocessingConfig,
+        index: faiss.Index,
+        code_paths: List[str],
+        shard_id: int,
+    ) -> None:
+        """Read blocks of codes from disk, and add the codes that belong to a shard.
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+            index (faiss.Index): Trained index (or shard), to which codes are added in place.
+            code_paths (List[str]): Paths of code blocks, named '{start_idx}-{end_idx}.hdf5'.
+            shard_id (int): Shard ID.
+        """
+
+        index_ivf = faiss.extract_index_ivf(index)
+
+        pbar = tqdm(code_paths)
+        for code_path in pbar:
+            pbar.set_description(
+                "add codes, shard %d, mem %.3f gb, %.1f%%"
+                % (shard_id, psutil.virtual_memory()[3] / 1024**3, psutil.virtual_memory()[2])
+            )
+            with h5py.File(code_path) as f:
+
+                nload = int(config.retro_index_add_load_fraction * f["data"].shape[0])
+                offset = int(os.path.basename(code_path).split("-")[0])
+                xids = np.arange(offset, offset + nload)
+                codes = np.copy(f["data"][:nload])
+
+                # Keep only codes assigned to this shard's lists.
+                shard_ids = get_shard_ids_from_list_nos(
+                    get_list_nos_from_codes(index_ivf, codes),
+                    index_ivf.nlist,
+                    config.retro_index_num_shards,
+                )
+                shard_mask = shard_ids == shard_id
+                index_ivf.add_sa_codes(
+                    np.ascontiguousarray(codes[shard_mask]), np.ascontiguousarray(xids[shard_mask])
+                )
+
+        # Update index's ntotal.
+        index.ntotal = index_ivf.ntotal
+
+    def save_shard_metadata(self, config: RetroPreprocessingConfig) -> None:
+        """Save the number of shards and total number of vectors (rank 0).
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+        """
+        if torch.distributed.get_rank() != 0:
+            return
+        shard_paths = self.get_added_index_shard_paths(config)
+        ntotal = sum(faiss.read_index(p, faiss.IO_FLAG_MMAP).ntotal for p in shard_paths)
+        added_index_path = self.get_added_index_path(config)
+        with h5py.File(added_index_path + ".tmp", "w") as f:
+            f.create_dataset("num_shards", data=len(shard_paths))
+            f.create_dataset("ntotal", data=ntotal)
+        os.replace(added_index_path + ".tmp", added_index_path)
+
+    def add_codes(self, config: RetroPreprocessingConfig) -> None:
+        """Read codes from disk, and add them to the index shards.
+
+        Shards are interleaved across ranks, so each rank builds
+        `num_shards / world_size` shards.
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+        """
+
+        if os.path.exists(self.get_added_index_path(config)):
+            return
+
+        shard_dir = self.get_added_index_shard_dir(config)
+        retro_makedir(config, shard_dir)
+        torch.distributed.barrier()
+
+        rank = torch.distributed.get_rank()
+        world_size = torch.distributed.get_world_size()
+        shard_paths = self.get_added_index_shard_paths(config)
+        code_paths = get_added_code_paths(config)
+        for shard_id in range(rank, len(shard_paths), world_size):
+            shard_path = shard_paths[shard_id]
+            if os.path.exists(shard_path):
+                continue
+            log_retro_rank_0("add codes, shard %d / %d." % (shard_id, len(shard_paths)))
+            index = self.get_empty_index(config)
+            self.add_code_paths_to_shard(config, index, code_paths, shard_id)
+            faiss.write_index(index, shard_path)
+
+        # Wait for all shards, then write shard metadata.
+        torch.distributed.barrier()
+        self.save_shard_metadata(config)
+
+    def get_added_index_ntotals(self, config: RetroPreprocessingConfig) -> List[int]:
+        """Get the number of vectors in each populated index shard.
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+
+        Returns:
+            Number of vectors in each shard.
+        """
+        return [
+            faiss.read_index(p, faiss.IO_FLAG_MMAP).ntotal
+            for p in self.get_added_index_shard_paths(config)
+        ]
+
+    def add_codes_incremental(
+        self, config: RetroPreprocessingConfig, code_paths: List[str], ntotals: List[int]
+    ) -> None:
+        """Read new codes from disk, and add them to the existing index shards.
+
+        Each rank updates its interleaved subset of shards. Updated shards are
+        written to temporary files, and then moved over the existing shards.
+        Shards whose size differs from their size before the update already
+        have the codes, so re-running an interrupted update skips them.
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+            code_paths (List[str]): Paths of code blocks to add.
+            ntotals (List[int]): Number of vectors in each shard before the update (see `get_added_index_ntotals()`).
+        """
+
+        rank = torch.distributed.get_rank()
+        world_size = torch.distributed.get_world_size()
+        shard_paths = self.get_added_index_shard_paths(config)
+        for shard_id in range(rank, len(shard_paths), world_size):
+            shard_path = shard_paths[shard_id]
+            index = faiss.read_index(shard_path)
+            if index.ntotal != ntotals[shard_id]:
+                log_retro_rank_0(
+                    "codes already added, shard %d / %d." % (shard_id, len(shard_paths))
+                )
+                continue
+            log_retro_rank_0("add codes, shard %d / %d." % (shard_id, len(shard_paths)))
+            self.add_code_paths_to_shard(config, index, code_paths, shard_id)
+            faiss.write_index(index, shard_path + ".tmp")
+            os.replace(shard_path + ".tmp", shard_path)
+
+        # Wait for all shards, then update shard metadata.
+        torch.distributed.barrier()
+        self.save_shard_metadata(config)
+
+    def get_added_index_path(self, config: RetroPreprocessingConfig) -> str:
+        """Get file path to the sharded index metadata.
+
+        The metadata file's existence marks that all shards have been written.
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+
+        Returns:
+            File path to the sharded index metadata.
+        """
+        return os.path.join(self.get_added_index_shard_dir(config), "shards.hdf5")
+
+    def get_added_index(
+        self, config: RetroPreprocessingConfig, ondisk: bool = False
+    ) -> FaissShardedIndexSearcher:
+        """Get searcher over the populated index shards.
+
+        Args:
+            config (RetroPreprocessingConfig): Retro preprocessing config.
+            ondisk (bool): If `ondisk = True`, memory map each shard when it is first probed.
+
+        Returns:
+            Searcher that lazily loads shards, and merges per-shard results.
+        """
+        with h5py.File(self.get_added_index_path(config)) as f:
+            num_shards = int(f["num_shards"][()])
+            ntotal = int(f["ntotal"][()])
+        assert (
+            num_shards == config.retro_index_num_shards
+        ), "index has %d shards, but retro_index_num_shards == %d." % (
+            num_shards,
+            config.retro_index_num_shards,
+        )
+        return FaissShardedIndexSearcher(
+            empty_index=self.get_empty_index(config),
+            shard_paths=self.get_added_index_shard_paths(config),
+            ntotal=ntotal,
+            ondisk=ondisk,
+            num_threads=config.retro_query_num_shard_threads,
+            search_params=self.get_search_params(config),
+        )
@@ -124,3 +124,35 @@ def get_added_code_paths(config: RetroPreprocessingConfig) -> List[str]:
         Paths of all vector encoding blocks, for adding to the index.
     """
     return sorted(glob.glob(get_added_codes_dir(config) + "/*.hdf5"))
+
+
+def get_added_codes_update_dir(
+    config: RetroPreprocessingConfig, start_idx: int, end_idx: int
+) -> str:
+    """Get directory of encodings saved during an incremental update.
+
+    Args:
+        config (RetroPreprocessingConfig): Retro preprocessing config.
+        start_idx (int): First chunk index of the update (i.e., the number of chunks in the index before the update).
+        end_idx (int): Last chunk index (exclusive) of the update.
+
+    Returns:
+        Path to the directory containing the vector encodings of chunks appended to the chunk database since the previous update.
+    """
+    return os.path.join(get_added_codes_dir(config), "update_%d_%d" % (start_idx, end_idx))
+
+
+def get_added_index_manifest_path(config: RetroPreprocessingConfig) -> str:
+    """Get path to the manifest of chunks added to the index.
+
+    Args:
+        config (RetroPreprocessingConfig): Retro preprocessing config.
+
+    Returns:
+        Path to the JSON manifest that records the chunk database state (i.e., number of chunks, and per-dataset chunk counts) that the populated index was built from.
+    """
+    return os.path.join(
+        get_index_dir(config),
+        "added_%.3f_%.3f_manifest.json"
+        % (config.retro_index_train_load_fraction, config.retro_index_add_load_fraction),
+    )
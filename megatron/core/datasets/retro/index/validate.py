@@ -14,6 +14,7 @@ separately. The following high-level checks are supported:
       `--no-retro-index-delete-added-codes` must be used.)
 """
 
+import os
 import typing
 
 import numpy as np
@@ -28,9 +29,13 @@ from megatron.core.datasets.retro.utils import (
     log_retro_rank_0,
 )
 
-from .build import get_text_dataset_for_adding, get_text_dataset_for_training
+from .build import (
+    get_added_index_manifest,
+    get_text_dataset_for_adding,
+    get_text_dataset_for_training,
+)
 from .factory import IndexFactory
-from .utils import get_added_codes_dir, get_training_data_block_dir
+from .utils import get_added_codes_dir, get_added_codes_update_dir, get_training_data_block_dir
 
 ##################################################
 # Validate trained index.
@@ -109,6 +114,9 @@ def validate_added_encodings(config: RetroPreprocessingConfig) -> None:
     - Encode each block.
     - Compare against saved encodings.
 
+    With '--retro-index-incremental', only the blocks encoded during the most
+    recent incremental update are sampled.
+
     Args:
         config (RetroPreprocessingConfig): Retro preprocessing config.
     """
@@ -129,12 +137,27 @@ def validate_added_encodings(config: RetroPreprocessingConfig) -> None:
         """
         assert len(f["data"].shape) == 2
 
+    # Codes directory (full add, or most recent incremental update).
+    codes_dir = get_added_codes_dir(config)
+    start_idx = 0
+    if config.retro_index_incremental:
+        manifest = get_added_index_manifest(config)
+        assert manifest is not None, "missing index manifest."
+        if len(manifest["updates"]) > 0:
+            start_idx, end_idx = manifest["updates"][-1]
+            assert end_idx == len(text_dataset)
+            codes_dir = get_added_codes_update_dir(config, start_idx, end_idx)
+            if not os.path.isdir(codes_dir):
+                log_retro_rank_0("update codes deleted; skipping validation of added encodings.")
+                return
+
     blocks = get_blocks_by_rank(
-        dirname=get_added_codes_dir(config),
+        dirname=codes_dir,
         n_samples=len(text_dataset),
         block_size=config.retro_block_size,
         validate=validate,
         sample=config.retro_task_validate,
+        start_idx=start_idx,
     )
 
     assert blocks.n_missing_world == 0
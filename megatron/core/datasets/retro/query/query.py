@@ -10,6 +10,7 @@ Querying involves:
       during pretraining.
 """
 
+import glob
 import os
 import time
 import typing
@@ -25,9 +26,11 @@ from megatron.core.datasets.retro.db.utils import (
     get_merged_train_dataset as get_db_merged_train_dataset,
 )
 from megatron.core.datasets.retro.external_libs import faiss, h5py
+from megatron.core.datasets.retro.index.build import get_added_index_manifest
 from megatron.core.datasets.retro.index.factory import IndexFactory
 from megatron.core.datasets.retro.index.index import Index
-from megatron.core.datasets.retro.index.utils import get_index_dir
+from megatron.core.datasets.retro.index.indexes.faiss_sharded import merge_search_results
+from megatron.core.datasets.retro.index.utils import get_added_codes_update_dir
 from megatron.core.datasets.retro.query.gpt_chunk_dataset import GPTChunkDataset
 from megatron.core.datasets.retro.utils import (
     GPTToTextDataset,
@@ -44,24 +47,15 @@ def get_index(config: RetroPreprocessingConfig, ondisk: bool = False) -> faiss.I
 
     Args:
         config (RetroPreprocessingConfig): Retro preprocessing config.
-        ondisk (bool): If `ondisk = True`, memory map the index. (For debugging purposes only; very non-performant.)
+        ondisk (bool): If `ondisk = True`, memory map the index. (For non-sharded indexes, this is for debugging purposes only; very non-performant.)
 
     Returns:
-        A Faiss index, loaded from storage.
+        A Faiss index (or, for 'faiss-sharded', a searcher over index shards), loaded from storage.
     """
 
-    # Load index.
+    # Load index, and set search parameters.
     index_wrapper = IndexFactory.get_index(config.retro_index_type)
-    index_dir = get_index_dir(config)
-    added_index_path = index_wrapper.get_added_index_path(config)
-    if ondisk:
-        index = faiss.read_index(added_index_path, faiss.IO_FLAG_MMAP)
-    else:
-        index = faiss.read_index(added_index_path)
-
-    # Search parameters.
-    faiss.ParameterSpace().set_index_parameter(index, "efSearch", config.retro_query_ef_search)
-    faiss.ParameterSpace().set_index_parameter(index, "nprobe", config.retro_query_nprobe)
+    index = index_wrapper.get_added_index(config, ondisk=ondisk)
 
     return index
 
@@ -94,7 +88,7 @@ def query_embeddings(
     sample_map: dict,
     n_chunks_per_sample: int,
     verbose: bool = True,
-) -> typing.Tuple[np.ndarray, np.ndarray]:
+) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """Query neighbors of a block of embeddings.
 
     Querying includes:
@@ -112,7 +106,7 @@ def query_embeddings(
         verbose (bool): Log querying progress.
 
     Returns:
-        A tuple of original (unfiltered) neighbor IDs, and filtered (by document ID) neighbor IDs.
+        A tuple of original (unfiltered) neighbor IDs, filtered (by document ID) neighbor IDs, and the distances of the filtered neighbors.
     """
 
     # Query neighbor ids.
@@ -120,7 +114,9 @@ def query_embeddings(
         log_retro_rank_0("search.")
     t = time.time()
     assert index.ntotal > 0, "check we don't accidentally have an empty index."
-    _, query_neighbor_ids = index.search(embeddings, config.retro_query_num_neighbors_query)
+    query_neighbor_distances, query_neighbor_ids = index.search(
+        embeddings, config.retro_query_num_neighbors_query
+    )
     if verbose:
         log_retro_rank_0("  time : %.3f sec." % (time.time() - t))
 
@@ -132,6 +128,11 @@ def query_embeddings(
         fill_value=-1,
         dtype="int64",
     )
+    filtered_neighbor_distances = np.full(
+        shape=(len(query_neighbor_ids), config.retro_query_num_neighbors_save),
+        fill_value=np.nan,
+        dtype="f4",
+    )
     min_chunk_id, max_chunk_id = chunk_id_range
     for chunk_id in range(min_chunk_id, max_chunk_id):
 
@@ -142,19 +143,30 @@ def query_embeddings(
         sample_doc_tuples = [(sample_dataset_idx, d) for d in sample_doc_ids]
 
         # Get valid neighbors (!= -1).
-        query_row = [i for i in query_neighbor_ids[chunk_id - min_chunk_id] if i >= 0]
+        query_row = [
+            (i, d)
+            for i, d in zip(
+                query_neighbor_ids[chunk_id - min_chunk_id],
+                query_neighbor_distances[chunk_id - min_chunk_id],
+            )
+            if i >= 0
+        ]
 
         # Filter row.
         filtered_row = [
-            i
-            for i in query_row
+            (i, d)
+            for i, d in query_row
             if tuple(db_dataset.doc_tuples[i].tolist()) not in sample_doc_tuples
         ]
         filtered_row = filtered_row[: config.retro_query_num_neighbors_save]
-        filtered_row += [-1] * (config.retro_query_num_neighbors_save - len(filtered_row))
-        filtered_neighbor_ids[chunk_id - min_chunk_id] = filtered_row
+        filtered_neighbor_ids[chunk_id - min_chunk_id, : len(filtered_row)] = [
+            i for i, _ in filtered_row
+        ]
+        filtered_neighbor_distances[chunk_id - min_chunk_id, : len(filtered_row)] = [
+            d for _, d in filtered_row
+        ]
 
-    return query_neighbor_ids, filtered_neighbor_ids
+    return query_neighbor_ids, filtered_neighbor_ids, filtered_neighbor_distances
 
 
 def query_embedding_block(
@@ -165,7 +177,7 @@ def query_embedding_block(
     chunk_id_range: range,
     sample_map: dict,
     n_chunks_per_sample: int,
-) -> typing.Tuple[np.ndarray, np.ndarray]:
+) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """Query a block of embeddings.
 
     The block is broken into smaller sub-blocks, for easier tracking of progress.
@@ -182,11 +194,12 @@ def query_embedding_block(
         n_chunks_per_sample (int): Number of chunks per sample (e.g., sequence_length / chunk_length).
 
     Returns:
-        A tuple of original (unfiltered) neighbor IDs, and filtered (by document ID) neighbor IDs.
+        A tuple of original (unfiltered) neighbor IDs, filtered (by document ID) neighbor IDs, and the distances of the filtered neighbors.
     """
 
     query_neighbor_ids = []
     filtered_neighbor_ids = []
+    filtered_neighbor_distances = []
 
     # Query in sub-blocks.
     partial_block_size = 1000
@@ -202,7 +215,11 @@ def query_embedding_block(
             chunk_id_range[0] + partial_start_idx,
             chunk_id_range[0] + partial_end_idx,
         )
-        partial_query_neighbor_ids, partial_filtered_neighbor_ids = query_embeddings(
+        (
+            partial_query_neighbor_ids,
+            partial_filtered_neighbor_ids,
+            partial_filtered_neighbor_distances,
+        ) = query_embeddings(
             config,
             db_dataset,
             index,
@@ -214,12 +231,63 @@ def query_embedding_block(
         )
         query_neighbor_ids.append(partial_query_neighbor_ids)
         filtered_neighbor_ids.append(partial_filtered_neighbor_ids)
+        filtered_neighbor_distances.append(partial_filtered_neighbor_distances)
 
     # Concatenate.
     query_neighbor_ids = np.concatenate(query_neighbor_ids, axis=0)
     filtered_neighbor_ids = np.concatenate(filtered_neighbor_ids, axis=0)
+    filtered_neighbor_distances = np.concatenate(filtered_neighbor_distances, axis=0)
+
+    return query_neighbor_ids, filtered_neighbor_ids, filtered_neighbor_distances
+
+
+def get_block_sample_map(query_dataset: GPTChunkDataset, block: dict) -> dict:
+    """Get mapping of sample_idx to dataset_idx and document_ids, for a block of chunks.
+
+    Args:
+        query_dataset (GPTChunkDataset): GPT chunk dataset to be queried.
+        block (dict): Range information containing start/end indices for querying GPT chunk dataset.
+
+    Returns:
+        Mapping of sample_idx to dataset_idx and document_ids. Used for document filtering.
+    """
+    n_chunks_per_sample = query_dataset.n_chunks_per_sample
+    sample_ids = sorted(
+        list(set(chunk_id // n_chunks_per_sample for chunk_id in range(*block["range"])))
+    )
+    sample_map = {}
+    for i in sample_ids:
+        sample = query_dataset.sample_dataset[i]
+        sample_map[i] = {"dataset_idx": sample["dataset_id"], "doc_ids": sample["document_ids"]}
+    return sample_map
+
+
+def save_block_neighbors(
+    config: RetroPreprocessingConfig,
+    db_dataset: DBDataset,
+    block: dict,
+    neighbor_ids: np.ndarray,
+    neighbor_distances: np.ndarray,
+) -> None:
+    """Save neighbors of a block.
+
+    Along with the neighbor IDs, the neighbor distances and the number of
+    chunks in the chunk database are saved, which allows for later
+    incremental updates when chunks are appended to the database.
 
-    return query_neighbor_ids, filtered_neighbor_ids
+    Args:
+        config (RetroPreprocessingConfig): Retro preprocessing config.
+        db_dataset (DBDataset): Dataset containing chunk database entries.
+        block (dict): Range information containing start/end indices, and output path.
+        neighbor_ids (np.ndarray): Filtered neighbor IDs.
+        neighbor_distances (np.ndarray): Distances of filtered neighbors.
+    """
+    log_retro_rank_0("save neighbors.")
+    retro_makedir(config, os.path.dirname(block["path"]))
+    with h5py.File(block["path"], "w") as f:
+        f.create_dataset("neighbors", data=neighbor_ids)
+        f.create_dataset("distances", data=neighbor_distances)
+        f.attrs["n_db_chunks"] = len(db_dataset)
 
 
 def query_block_neighbors(
@@ -242,29 +310,21 @@ def query_block_neighbors(
     n_chunks_per_sample = query_dataset.n_chunks_per_sample
 
     # Sample map.
-    sample_ids = sorted(
-        list(set(chunk_id // n_chunks_per_sample for chunk_id in range(*block["range"])))
-    )
-    sample_map = {}
-    for i in sample_ids:
-        sample = query_dataset.sample_dataset[i]
-        sample_map[i] = {"dataset_idx": sample["dataset_id"], "doc_ids": sample["document_ids"]}
+    sample_map = get_block_sample_map(query_dataset, block)
 
     # Embed block.
     embeddings = embed_block(config, query_dataset, block)
 
     # Query embeddings.
-    _, filtered_neighbor_ids = query_embedding_block(
+    _, filtered_neighbor_ids, filtered_neighbor_distances = query_embedding_block(
         config, db_dataset, index, embeddings, block["range"], sample_map, n_chunks_per_sample
     )
 
     if config.retro_task_validate is None:
         # Save neighbors.
-        log_retro_rank_0("save neighbors.")
-        retro_makedir(config, os.path.dirname(block["path"]))
-        f = h5py.File(block["path"], "w")
-        f.create_dataset("neighbors", data=filtered_neighbor_ids)
-        f.close()
+        save_block_neighbors(
+            config, db_dataset, block, filtered_neighbor_ids, filtered_neighbor_distances
+        )
 
     else:
         # Validate neighbors.
@@ -273,6 +333,99 @@ def query_block_neighbors(
             assert np.array_equal(existing_neighbor_ids, filtered_neighbor_ids)
 
 
+def update_block_neighbors(
+    config: RetroPreprocessingConfig,
+    db_dataset: DBDataset,
+    query_dataset: GPTChunkDataset,
+    index: Index,
+    delta_index: faiss.Index,
+    delta_range: typing.Tuple[int, int],
+    block: dict,
+) -> None:
+    """Update saved neighbors of a block, after chunks are appended to the database.
+
+    If the saved neighbors were queried against the database as it was prior
+    to the most recent incremental update (i.e., with `delta_range[0]`
+    chunks), only the appended chunks can change the result. In that case, the
+    block is queried against the small 'delta' index of appended chunks, and
+    the results are merged with the saved neighbors by distance. Otherwise, the
+    block is fully re-queried.
+
+    Args:
+        config (RetroPreprocessingConfig): Retro preprocessing config.
+        db_dataset (DBDataset): Dataset containing chunk database entries.
+        query_dataset (GPTChunkDataset): GPT chunk dataset to be queried.
+        index (Index): Vector index populated with all chunk database indices.
+        delta_index (faiss.Index): Vector index populated with only the appended chunk database indices.
+        delta_range (Tuple[int, int]): Start/end chunk indices of the appended chunks.
+        block (dict): Range information containing start/end indices for querying GPT chunk dataset.
+    """
+
+    # Load saved neighbors.
+    with h5py.File(block["path"]) as f:
+        n_db_chunks = f.attrs.get("n_db_chunks", None)
+        if n_db_chunks != delta_range[0] or "distances" not in f:
+            existing_neighbor_ids = None
+        else:
+            existing_neighbor_ids = np.copy(f["neighbors"])
+            existing_neighbor_distances = np.copy(f["distances"])
+
+    # Re-query entire block, if saved neighbors can't be merged.
+    if existing_neighbor_ids is None:
+        query_block_neighbors(config, db_dataset, query_dataset, index, block)
+        return
+
+    # Query appended chunks.
+    n_chunks_per_sample = query_dataset.n_chunks_per_sample
+    sample_map = get_block_sample_map(query_dataset, block)
+    embeddings = embed_block(config, query_dataset, block)
+    _, delta_neighbor_ids, delta_neighbor_distances = query_embedding_block(
+        config, db_dataset, delta_index, embeddings, block["range"], sample_map, n_chunks_per_sample
+    )
+
+    # Merge with saved neighbors.
+    filtered_neighbor_distances, filtered_neighbor_ids = merge_search_results(
+        [existing_neighbor_distances, delta_neighbor_distances],
+        [existing_neighbor_ids, delta_neighbor_ids],
+        config.retro_query_num_neighbors_save,
+        delta_index.metric_type,
+    )
+
+    # Save neighbors.
+    save_block_neighbors(
+        config, db_dataset, block, filtered_neighbor_ids, filtered_neighbor_distances
+    )
+
+
+def get_delta_index(config: RetroPreprocessingConfig) -> typing.Tuple[faiss.Index, tuple]:
+    """Build an in-memory index of the chunks added by the most recent incremental update.
+
+    Args:
+        config (RetroPreprocessingConfig): Retro preprocessing config.
+
+    Returns:
+        A tuple of the 'delta' index (None, if no incremental update has been run, or if its codes were deleted), and the start/end chunk indices of the update.
+    """
+    manifest = get_added_index_manifest(config)
+    if manifest is None or len(manifest["updates"]) == 0:
+        return None, None
+
+    # Codes of the update are kept once added, unless deleted manually.
+    start_idx, end_idx = manifest["updates"][-1]
+    codes_dir = get_added_codes_update_dir(config, start_idx, end_idx)
+    if not os.path.isdir(codes_dir):
+        log_retro_rank_0("update codes deleted; stale neighbor blocks will be re-queried in full.")
+        return None, None
+
+    index_wrapper = IndexFactory.get_index(config.retro_index_type)
+    delta_index = index_wrapper.get_empty_index(config)
+    index_wrapper.add_code_paths(config, delta_index, sorted(glob.glob(codes_dir + "/*.hdf5")))
+    for key, value in index_wrapper.get_search_params(config).items():
+        faiss.ParameterSpace().set_index_parameter(delta_index, key, value)
+
+    return delta_index, (start_idx, end_idx)
+
+
 def query_dataset_neighbors(
     config: RetroPreprocessingConfig,
     db_dataset: DBDataset,
@@ -281,9 +434,15 @@ def query_dataset_neighbors(
     prefix: str,
     neighbor_dir: str,
     index: Index,
+    delta_index: faiss.Index = None,
+    delta_range: typing.Tuple[int, int] = None,
 ) -> None:
     """Query neighbors of each chunk within a dataset.
 
+    With '--retro-index-incremental', existing neighbor blocks that were
+    queried against an older chunk database are also updated (see
+    `update_block_neighbors()`), in addition to querying missing blocks.
+
     Args:
         config (RetroPreprocessingConfig): Retro preprocessing config.
         db_dataset (DBDataset): Dataset containing chunk database entries.
@@ -292,6 +451,8 @@ def query_dataset_neighbors(
         prefix (str): Extra string for logging progress.
         neighbor_dir (str): File path to directory for saving neighbor IDs.
         index (Index): Vector index populated with chunk database indices.
+        delta_index (faiss.Index): Vector index populated with only the chunks appended by the most recent incremental update.
+        delta_range (Tuple[int, int]): Start/end chunk indices of the appended chunks.
     """
 
     def validate(f: h5py.File) -> None:
@@ -313,6 +474,24 @@ def query_dataset_neighbors(
             neighbor_dir, num_active_chunks, config.retro_block_size, validate=validate
         )
         active_blocks = blocks.missing
+
+        # Existing blocks queried against an older chunk database.
+        if config.retro_index_incremental:
+
+            def is_stale(block: dict) -> bool:
+                """Check if block was queried against an older chunk database."""
+                with h5py.File(block["path"]) as f:
+                    return f.attrs.get("n_db_chunks", None) != len(db_dataset)
+
+            stale_blocks = [b if b is not None and is_stale(b) else None for b in blocks.existing]
+            log_retro_rank_0(
+                " > incremental, %d missing blocks, %d stale blocks (rank 0)."
+                % (
+                    len([b for b in blocks.missing if b is not None]),
+                    len([b for b in stale_blocks if b is not None]),
+                )
+            )
+            active_blocks = active_blocks + stale_blocks
     else:
         blocks = get_blocks_by_rank(
             neighbor_dir,
@@ -344,7 +523,15 @@ def query_dataset_neighbors(
             )
 
             # Query block neighbors.
-            query_block_neighbors(config, db_dataset, query_dataset, index, block)
+            if os.path.exists(block["path"]) and config.retro_task_validate is None:
+                if delta_index is None:
+                    query_block_neighbors(config, db_dataset, query_dataset, index, block)
+                else:
+                    update_block_neighbors(
+                        config, db_dataset, query_dataset, index, delta_index, delta_range, block
+                    )
+            else:
+                query_block_neighbors(config, db_dataset, query_dataset, index, block)
 
         # Synchronize progress across all ranks. (for easier observation)
         log_retro_rank_0(" > waiting for other ranks to finish block.")
@@ -372,7 +559,13 @@ def query_neighbors(config: RetroPreprocessingConfig) -> None:
 
     # Load index.
     log_retro_rank_0(" > get index.")
-    index = get_index(config)
+    index = get_index(config, ondisk=config.retro_index_type == "faiss-sharded")
+
+    # Load index of appended chunks.
+    delta_index, delta_range = None, None
+    if config.retro_index_incremental:
+        log_retro_rank_0(" > get delta index.")
+        delta_index, delta_range = get_delta_index(config)
 
     # Query each (i.e., train, valid, test) dataset.
     log_retro_rank_0(" > query.")
@@ -390,4 +583,6 @@ def query_neighbors(config: RetroPreprocessingConfig) -> None:
             prefix,
             info["neighbor_dir"],
             index,
+            delta_index,
+            delta_range,
         )
@@ -110,7 +110,7 @@ class GPTToTextDataset(torch.utils.data.Dataset):
 
 
 def get_blocks(
-    dirname: str, n_samples: int, block_size: int, validate: Callable = None
+    dirname: str, n_samples: int, block_size: int, validate: Callable = None, start_idx: int = 0
 ) -> SimpleNamespace:
     """Divide range [0, num_samples) to sequence of block ranges.
 
@@ -126,15 +126,16 @@ def get_blocks(
         n_samples (int): Ideal number of samples. The total number of saved block data is <=n_samples.
         block_size (int): Max number of samples per block file (e.g., 100000).
         validate (Callable): Method for validating each block file during load.
+        start_idx (int): First sample index of the range. Blocks cover [start_idx, n_samples), which is used when only processing samples appended since a previous run.
 
     Returns:
-        A namespace consisting of 2 lists: existing blocks, and missing blocks. The total number of samples between the existing and missing blocks should equal n_samples above.
+        A namespace consisting of 2 lists: existing blocks, and missing blocks. The total number of samples between the existing and missing blocks should equal (n_samples - start_idx) above.
     """
 
     assert os.path.isdir(dirname), "missing directory '%s.'" % dirname
 
     # Block ranges.
-    block_start_idxs = list(range(0, n_samples, block_size))
+    block_start_idxs = list(range(start_idx, n_samples, block_size))
     block_end_idxs = [min(n_samples, i + block_size) for i in block_start_idxs]
     block_ranges = list(zip(block_start_idxs, block_end_idxs))
 
@@ -194,6 +195,7 @@ def get_blocks_by_rank(
     block_size: int,
     validate: Callable = None,
     sample: Optional[float] = None,
+    start_idx: int = 0,
 ) -> SimpleNamespace:
     """Divide existing and missing blocks evenly across all ranks.
 
@@ -208,13 +210,14 @@ def get_blocks_by_rank(
         block_size (int): Max number of samples per block file (e.g., 100000).
         validate (Callable): Method for validating each block file during load.
         sample (Optional[float]): If provided, sample a random subset of the blocks. Used for validating preprocessing correctness.
+        start_idx (int): First sample index of the range (see 'get_blocks()').
 
     Returns:
         A namespace consisting of 2 lists: existing blocks, and missing blocks. Each of these two lists is potentially a sub-sample of the total set of existing and missing blocks, depending on whether sampling is used. Additionally, the attributes n_existing_world and n_missing_world are the total number of existing and missing blocks, independent of samples. Therefore, (n_existing_world + n_missing_world) * block_size == n_samples.
     """
 
     # Get world blocks.
-    blocks = get_blocks(dirname, n_samples, block_size, validate)
+    blocks = get_blocks(dirname, n_samples, block_size, validate, start_idx)
 
     # This rank's existing and missing files.
     data_parallel_rank = parallel_state.get_data_parallel_rank()
@@ -1,12 +1,18 @@
 # Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
 from dataclasses import dataclass
 
+from megatron.core.inference.logits_processors import LogitsProcessor
+
 
 @dataclass
 class CommonInferenceParams:
     """Inference parameters sent along with the prompts
 
     For an explanation of these parameters refer to this blog https://ivibudh.medium.com/a-guide-to-controlling-llm-model-output-exploring-top-k-top-p-and-temperature-parameters-ed6a31313910
+
+    The priority and the deadline (a time.time() timestamp) order the admission of the waiting requests with dynamic batching, see Scheduler.
+
+    The logits processor modifies the logits of each step of the request before sampling, (e.g) a RegexLogitsProcessor or a JSONSchemaLogitsProcessor constrains the generated text, see LogitsProcessor.
     """
 
     temperature: float = 1.0
@@ -14,6 +20,10 @@ class CommonInferenceParams:
     top_p: float = 0.0
     return_log_probs: bool = False
     num_tokens_to_generate: int = 30
+    seed: int = None
+    priority: int = 0
+    deadline: float = None
+    logits_processor: LogitsProcessor = None
 
     def add_attributes(self, attribute_value_pair: dict):
         """Utility to add more attributes to inference params
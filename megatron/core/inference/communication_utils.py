@@ -48,3 +48,53 @@ def send_to_next_pipeline_rank(tensor=None):
         req.wait()
     # To protect against race condition when using batch_isend_irecv().
     torch.cuda.synchronize()
+
+
+def send_recv_pipeline_stages_(
+    tensor_send_next=None, tensor_recv_prev=None, tensor_send_first=None, tensor_recv_last=None
+):
+    """Run the sends and receives of a pipeline stage in a single batch of
+    p2p operations, and update the receive buffers inplace.
+
+    Besides the activations between consecutive stages, the last stage can
+    send a small tensor (e.g. the sampled tokens) back to the first stage."""
+    ops = []
+    if tensor_send_next is not None:
+        ops.append(
+            torch.distributed.P2POp(
+                torch.distributed.isend,
+                tensor_send_next,
+                parallel_state.get_pipeline_model_parallel_next_rank(),
+            )
+        )
+    if tensor_recv_prev is not None:
+        ops.append(
+            torch.distributed.P2POp(
+                torch.distributed.irecv,
+                tensor_recv_prev,
+                parallel_state.get_pipeline_model_parallel_prev_rank(),
+            )
+        )
+    if tensor_send_first is not None:
+        ops.append(
+            torch.distributed.P2POp(
+                torch.distributed.isend,
+                tensor_send_first,
+                parallel_state.get_pipeline_model_parallel_first_rank(),
+            )
+        )
+    if tensor_recv_last is not None:
+        ops.append(
+            torch.distributed.P2POp(
+                torch.distributed.irecv,
+                tensor_recv_last,
+                parallel_state.get_pipeline_model_parallel_last_rank(),
+            )
+        )
+    if len(ops) == 0:
+        return
+    reqs = torch.distributed.batch_isend_irecv(ops)
+    for req in reqs:
+        req.wait()
+    # To protect against race condition when using batch_isend_irecv().
+    torch.cuda.synchronize()
@@ -0,0 +1,104 @@
+# Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+
+@dataclass
+class IncrementalDetokenizationState:
+    """The tokens of a request, and the offsets of the tokens already detokenized"""
+
+    tokens: List[int] = field(default_factory=list)
+    prefix_offset: int = 0
+    """The start of the tokens that are detokenized again as context of the new tokens"""
+    read_offset: int = 0
+    """The end of the tokens whose text was already returned"""
+
+
+class IncrementalDetokenizer:
+    """Detokenizes the generated tokens of requests incrementally"""
+
+    def __init__(self, tokenizer):
+        """Detokenizes the tokens of requests as they are generated, decoding only the new tokens
+
+        For each request, the new tokens are detokenized together with the tokens since the previous text returned (the prefix), and the new text is the difference with the text of the prefix alone. The prefix gives the new tokens the context that some tokenizers need (e.g) for the leading space of a word, while keeping the cost of each call proportional to the number of new tokens instead of the length of the sequence. A text ending with a replacement character is held back until the next tokens, since byte level tokenizers can split a multi byte character across tokens.
+
+        Args:
+            tokenizer (_type_): Tokenizer used for detokenizing the tokens
+        """
+        self.tokenizer = tokenizer
+        self.states: Dict[str, IncrementalDetokenizationState] = {}
+
+    def get_new_text(self, state: IncrementalDetokenizationState, flush: bool) -> str:
+        """The text of the tokens after the read offset, and advances the offsets if there is one"""
+        prefix_text = self.tokenizer.detokenize(
+            state.tokens[state.prefix_offset : state.read_offset]
+        )
+        text = self.tokenizer.detokenize(state.tokens[state.prefix_offset :])
+        if len(text) <= len(prefix_text) or (not flush and text.endswith('\ufffd')):
+            return ''
+        state.prefix_offset = state.read_offset
+        state.read_offset = len(state.tokens)
+        return text[len(prefix_text) :]
+
+    def add_tokens(self, request_id: str, tokens: List[int]) -> str:
+        """Adds the new tokens of a request
+
+        Args:
+            request_id (str): The request id
+            tokens (List[int]): The tokens generated since the previous call for this request
+
+        Returns:
+            str: The text completed by the new tokens. It may be empty, when the new tokens end with a partial multi byte character.
+        """
+        state = self.states.setdefault(request_id, IncrementalDetokenizationState())
+        state.tokens.extend(tokens)
+        return self.get_new_text(state, flush=False)
+
+    def finish(self, request_id: str) -> str:
+        """Forgets a request, once all its tokens were added
+
+        Args:
+            request_id (str): The request id
+
+        Returns:
+            str: The rest of the text of the request, including a partial multi byte character if it ends with one
+        """
+        state = self.states.pop(request_id, None)
+        if state is None:
+            return ''
+        return self.get_new_text(state, flush=True)
+
+
+class DetokenizationWorker:
+    """Runs detokenization jobs on a background thread"""
+
+    def __init__(self):
+        """A worker thread that runs detokenization jobs in submission order
+
+        Detokenizing on the worker overlaps it with the next forward step of the main thread, instead of running it as a serial tail after each step. Jobs must only read data that the main thread does not modify afterwards (e.g) lists of tokens copied from the generation state.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="detokenization")
+        self.pending_jobs: List[Future] = []
+
+    def submit(self, job: Callable, *args) -> Future:
+        """Runs job(*args) on the worker thread, after the jobs submitted before it
+
+        Returns:
+            Future: The future of the result of the job
+        """
+        # Keep the failed jobs, so that synchronize raises their exceptions
+        self.pending_jobs = [
+            future
+            for future in self.pending_jobs
+            if not future.done() or future.exception() is not None
+        ]
+        future = self.executor.submit(job, *args)
+        self.pending_jobs.append(future)
+        return future
+
+    def synchronize(self):
+        """Waits for all the submitted jobs, and raises the exception of the first one that failed"""
+        pending_jobs, self.pending_jobs = self.pending_jobs, []
+        for future in pending_jobs:
+            future.result()
@@ -0,0 +1,316 @@
+# Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+import asyncio
+from concurrent.futures import Future
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+
+import torch
+
+from megatron.core.inference.common_inference_params import CommonInferenceParams
+from megatron.core.inference.engines.mcore_engine import MCoreEngine
+from megatron.core.inference.inference_request import (
+    InferenceRequest,
+    InferenceRequestDelta,
+    Status,
+)
+
+
+class AsyncMCoreEngine:
+    """Serves concurrent asyncio requests with the dynamic batching steps of a single engine loop"""
+
+    def __init__(self, engine: MCoreEngine):
+        """Asyncio front end of the Megatron core engine, for serving concurrent requests
+
+        Requests are queued by coroutines running on the event loop, and a single engine loop (See run_engine_loop) adds them to the scheduler of the engine and runs dynamic batching steps, so that all the requests queued at a given time are batched together. Each request resolves its own future as soon as it completes, or streams its outputs through its own queue. If the engine loop fails, the futures and the streams of all the requests get its exception, and new requests are rejected.
+
+        With model parallelism, the engine loop runs on global rank 0, and the other ranks run run_worker_loop. Before each step, rank 0 broadcasts the requests queued since the previous step, so that all the ranks add the same requests to their schedulers and run the same steps.
+
+        Args:
+            engine (MCoreEngine): The engine. Its max_sequence_length must be set, since the kv cache is allocated before the requests arrive.
+        """
+        assert (
+            engine.max_sequence_length is not None
+        ), "The engine needs a max_sequence_length to serve requests as they arrive"
+        self.engine = engine
+        # Requests queued since the previous step, as (prompt, prompt_tokens, inference_parameters)
+        self.queued_requests: List[Tuple[str, List[int], CommonInferenceParams]] = []
+        # The future or the stream of each queued request, in the same order
+        self.queued_outputs: List[Tuple[Optional[asyncio.Future], Optional[asyncio.Queue]]] = []
+        self.request_futures: Dict[str, asyncio.Future] = {}
+        self.request_streams: Dict[str, asyncio.Queue] = {}
+        self.has_queued_requests: asyncio.Event = None
+        self.is_stopped = False
+        # The exception that stopped the engine loop, if it failed
+        self.error: Optional[BaseException] = None
+
+    def broadcast_queued_requests(
+        self, queued_requests: Optional[List[Tuple[str, List[int], CommonInferenceParams]]]
+    ) -> Optional[List[Tuple[str, List[int], CommonInferenceParams]]]:
+        """Broadcasts the requests queued since the previous step from rank 0 to the other ranks
+
+        Args:
+            queued_requests (Optional[List[Tuple[str, List[int], CommonInferenceParams]]]): The queued requests on rank 0, or None to stop the worker loops. Ignored on the other ranks.
+
+        Returns:
+            Optional[List[Tuple[str, List[int], CommonInferenceParams]]]: The queued requests of rank 0, or None to stop
+        """
+        if not torch.distributed.is_initialized() or torch.distributed.get_world_size() == 1:
+            return queued_requests
+        objects = [queued_requests]
+        torch.distributed.broadcast_object_list(objects, src=0)
+        return objects[0]
+
+    def add_queued_requests(
+        self, queued_requests: List[Tuple[str, List[int], CommonInferenceParams]]
+    ) -> List[str]:
+        """Adds the queued requests to the scheduler of the engine
+
+        Args:
+            queued_requests (List[Tuple[str, List[int], CommonInferenceParams]]): The requests queued since the previous step
+
+        Returns:
+            List[str]: The request ids, which are the same on all the ranks
+        """
+        return [
+            self.engine.scheduler.add_request(
+                prompt=prompt,
+                prompt_tokens=prompt_tokens,
+                inference_parameters=inference_parameters,
+            )
+            for prompt, prompt_tokens, inference_parameters in queued_requests
+        ]
+
+    def tokenize_prompts(
+        self, prompts: List[str], common_inference_params: CommonInferenceParams
+    ) -> List[List[int]]:
+        """Tokenizes prompts, and checks that each of them fits in the maximum sequence length of the engine
+
+        Args:
+            prompts (List[str]): The prompts
+            common_inference_params (CommonInferenceParams): The inference parameters of the requests
+
+        Raises:
+            ValueError: If a prompt plus the tokens to generate do not fit in the maximum sequence length
+
+        Returns:
+            List[List[int]]: The tokens of each prompt
+        """
+        prompts_tokens = []
+        for prompt in prompts:
+            prompt_tokens = self.engine.text_generation_controller.tokenize_prompt(prompt)
+            if (
+                len(prompt_tokens) + common_inference_params.num_tokens_to_generate
+                > self.engine.max_sequence_length
+            ):
+                raise ValueError(
+                    f"The prompt plus the tokens to generate do not fit in the maximum sequence length {self.engine.max_sequence_length}"
+                )
+            prompts_tokens.append(prompt_tokens)
+        return prompts_tokens
+
+    def queue_requests(
+        self,
+        prompts: List[str],
+        common_inference_params: CommonInferenceParams,
+        futures: Optional[List[asyncio.Future]] = None,
+        streams: Optional[List[asyncio.Queue]] = None,
+    ):
+        """Queues requests, which join the batch at the next step of the engine loop
+
+        All the prompts are validated before any of them is queued, so that either all of them are queued or none.
+
+        Args:
+            prompts (List[str]): The prompts
+            common_inference_params (CommonInferenceParams): The inference parameters of the requests
+            futures (Optional[List[asyncio.Future]], optional): The future resolved with each completed request. Defaults to None.
+            streams (Optional[List[asyncio.Queue]], optional): The queue of the deltas of each request (See generate_stream). Defaults to None.
+
+        Raises:
+            ValueError: If a prompt does not fit in the maximum sequence length (See tokenize_prompts)
+            RuntimeError: If the engine loop is stopped, or failed
+        """
+        if self.error is not None:
+            raise RuntimeError("The engine loop failed") from self.error
+        if self.is_stopped:
+            raise RuntimeError("The engine loop is stopped")
+        prompts_tokens = self.tokenize_prompts(prompts, common_inference_params)
+        for index, (prompt, prompt_tokens) in enumerate(zip(prompts, prompts_tokens)):
+            self.queued_requests.append((prompt, prompt_tokens, common_inference_params))
+            self.queued_outputs.append(
+                (
+                    None if futures is None else futures[index],
+                    None if streams is None else streams[index],
+                )
+            )
+        self.get_has_queued_requests().set()
+
+    def queue_request(
+        self,
+        prompt: str,
+        common_inference_params: CommonInferenceParams,
+        future: Optional[asyncio.Future] = None,
+        stream: Optional[asyncio.Queue] = None,
+    ):
+        """Queues a request, which joins the batch at the next step of the engine loop (See queue_requests)"""
+        self.queue_requests(
+            [prompt],
+            common_inference_params,
+            futures=None if future is None else [future],
+            streams=None if stream is None else [stream],
+        )
+
+    def get_has_queued_requests(self) -> asyncio.Event:
+        """The event set when requests are queued, created in the event loop of the engine loop on first use"""
+        if self.has_queued_requests is None:
+            self.has_queued_requests = asyncio.Event()
+        return self.has_queued_requests
+
+    def fail_requests(self, error: BaseException):
+        """Sets the exception of the engine loop on the futures and the streams of all the queued and pending requests
+
+        Args:
+            error (BaseException): The exception that stopped the engine loop
+        """
+        self.error = error
+        outputs = self.queued_outputs
+        outputs += [(future, None) for future in self.request_futures.values()]
+        outputs += [(None, stream) for stream in self.request_streams.values()]
+        self.queued_requests, self.queued_outputs = [], []
+        self.request_futures, self.request_streams = {}, {}
+        for future, stream in outputs:
+            if future is not None and not future.done():
+                future.set_exception(error)
+            if stream is not None:
+                stream.put_nowait(error)
+
+    async def generate(
+        self, prompt: str, common_inference_params: CommonInferenceParams
+    ) -> InferenceRequest:
+        """Generates a prompt, batched with the other requests of the engine loop
+
+        Args:
+            prompt (str): The prompt
+            common_inference_params (CommonInferenceParams): The inference parameters of the request
+
+        Returns:
+            InferenceRequest: The completed request
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.queue_request(prompt, common_inference_params, future=future)
+        return await future
+
+    async def generate_stream(
+        self, prompt: str, common_inference_params: CommonInferenceParams
+    ) -> AsyncGenerator[InferenceRequestDelta, None]:
+        """Generates a prompt, batched with the other requests of the engine loop, and streams the generated tokens as they are sampled
+
+        Args:
+            prompt (str): The prompt
+            common_inference_params (CommonInferenceParams): The inference parameters of the request
+
+        Yields:
+            InferenceRequestDelta: The tokens generated since the previous delta (See MCoreEngine.get_request_deltas). The last delta has the status COMPLETED.
+        """
+        stream = asyncio.Queue()
+        self.queue_request(prompt, common_inference_params, stream=stream)
+        while True:
+            delta = await stream.get()
+            # The engine loop failed
+            if isinstance(delta, BaseException):
+                raise delta
+            yield delta
+            if delta.status == Status.COMPLETED:
+                return
+
+    async def run_engine_loop(self):
+        """The engine loop, which runs on global rank 0 until stop is called
+
+        It waits for queued requests, and then runs dynamic batching steps while there are pending requests, adding the requests queued in the meantime before each step. It gives control back to the event loop after each step, so that coroutines can queue new requests and consume the outputs. If a step fails, the exception is set on all the requests (See fail_requests) and raised.
+        """
+        try:
+            await self.run_engine_steps()
+        except Exception as error:
+            self.fail_requests(error)
+            raise
+
+    async def run_engine_steps(self):
+        """The steps of the engine loop (See run_engine_loop)"""
+        self.engine.prep_for_dynamic_generation()
+        scheduler = self.engine.scheduler
+        has_queued_requests = self.get_has_queued_requests()
+        # With detokenize_in_background, the outputs of a step are detokenized during the next step
+        pending_step: Optional[Tuple[Dict[str, InferenceRequest], Future]] = None
+        while True:
+            if not scheduler.have_requests_pending() and len(self.queued_requests) == 0:
+                if pending_step is not None:
+                    await self.publish_step_outputs(*pending_step)
+                    pending_step = None
+                    continue
+                if self.is_stopped:
+                    self.broadcast_queued_requests(None)
+                    break
+                has_queued_requests.clear()
+                await has_queued_requests.wait()
+                continue
+
+            queued_requests, self.queued_requests = self.queued_requests, []
+            queued_outputs, self.queued_outputs = self.queued_outputs, []
+            request_ids = self.add_queued_requests(self.broadcast_queued_requests(queued_requests))
+            for request_id, (future, stream) in zip(request_ids, queued_outputs):
+                if future is not None:
+                    self.request_futures[request_id] = future
+                if stream is not None:
+                    self.request_streams[request_id] = stream
+
+            result_dict = self.engine.run_engine_step(dynamic_generation=True)
+            if pending_step is not None:
+                await self.publish_step_outputs(*pending_step)
+            streamed_results = {
+                request_id: request
+                for request_id, request in result_dict.items()
+                if request_id in self.request_streams
+            }
+            pending_step = (result_dict, self.engine.get_request_deltas_async(streamed_results))
+            if pending_step[1].done():
+                await self.publish_step_outputs(*pending_step)
+                pending_step = None
+            await asyncio.sleep(0)
+
+    async def publish_step_outputs(
+        self, result_dict: Dict[str, InferenceRequest], request_deltas: Future
+    ):
+        """Streams the deltas of a step, and resolves the futures of the requests that completed in the step
+
+        Args:
+            result_dict (Dict[str, InferenceRequest]): The requests of the step (See MCoreEngine.run_engine_step)
+            request_deltas (Future): The future of the deltas of the streamed requests of the step (See MCoreEngine.get_request_deltas_async), which is done once the generated texts of the completed requests are set
+        """
+        for delta in await asyncio.wrap_future(request_deltas):
+            self.request_streams[delta.request_id].put_nowait(delta)
+        for request_id, request in result_dict.items():
+            if request.status != Status.COMPLETED:
+                continue
+            # The completed requests are only kept by their futures
+            self.engine.scheduler.completed_request_pool.pop(request_id)
+            self.request_streams.pop(request_id, None)
+            future = self.request_futures.pop(request_id, None)
+            if future is not None and not future.cancelled():
+                future.set_result(request)
+
+    def run_worker_loop(self):
+        """The engine loop of the ranks other than global rank 0, which runs the same steps until rank 0 stops"""
+        self.engine.prep_for_dynamic_generation()
+        scheduler = self.engine.scheduler
+        while True:
+            queued_requests = self.broadcast_queued_requests(None)
+            if queued_requests is None:
+                break
+            self.add_queued_requests(queued_requests)
+            result_dict = self.engine.run_engine_step(dynamic_generation=True)
+            for request_id, request in result_dict.items():
+                if request.status == Status.COMPLETED:
+                    scheduler.completed_request_pool.pop(request_id)
+
+    def stop(self):
+        """Stops the engine loop, and the worker loops of the other ranks, once the pending requests complete"""
+        self.is_stopped = True
+        self.get_has_queued_requests().set()
@@ -1,11 +1,18 @@
 # Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
-from typing import Dict, List
+import asyncio
+from concurrent.futures import Future
+from typing import AsyncGenerator, Dict, List, Tuple
 
 import torch
 
 from megatron.core.inference.common_inference_params import CommonInferenceParams
+from megatron.core.inference.detokenizer import IncrementalDetokenizer
 from megatron.core.inference.engines.abstract_engine import AbstractEngine
-from megatron.core.inference.inference_request import InferenceRequest
+from megatron.core.inference.inference_request import (
+    InferenceRequest,
+    InferenceRequestDelta,
+    Status,
+)
 from megatron.core.inference.scheduler import Scheduler
 from megatron.core.inference.text_generation_controllers.simple_text_generation_controller import (
     SimpleTextGenerationController,
@@ -18,6 +25,15 @@ class MCoreEngine(AbstractEngine):
         text_generation_controller: SimpleTextGenerationController,
         max_batch_size,
         random_seed: int = None,
+        max_sequence_length: int = None,
+        num_kv_cache_blocks: int = None,
+        kv_cache_block_size: int = 16,
+        enable_prefix_caching: bool = False,
+        max_cached_prefix_blocks: int = None,
+        max_tokens_per_step: int = None,
+        num_pipelined_decode_steps: int = None,
+        scheduling_policy: str = "fifo",
+        max_kv_cache_tokens: int = None,
     ):
         """The Megatron core backend constructor
 
@@ -27,13 +43,41 @@ class MCoreEngine(AbstractEngine):
             text_generation_controller (SimpleTextGenerationController): A text generation controller that will be used to define how to preprocess prompts, generate outputs and detokenizer the output tokens.
             max_batch_size : The maxinum number of requests to process at once
             random_seed (int, optional): Use a random seed if you want deterministic results. Defaults to None.
+            max_sequence_length (int, optional): The maximum number of prompt plus generated tokens of a request, used to size the kv cache with dynamic batching. Defaults to None, in which case it is computed from the pending requests when the engine starts.
+            num_kv_cache_blocks (int, optional): If set, dynamic batching uses a paged kv cache with this number of blocks shared by all the requests, so that the kv cache memory is proportional to the number of tokens of the active requests. Defaults to None, in which case each request gets a dense kv cache of max_sequence_length tokens.
+            kv_cache_block_size (int, optional): The number of tokens per block of the paged kv cache. Defaults to 16.
+            enable_prefix_caching (bool, optional): With the paged kv cache, reuse the kv cache of the prompt prefixes shared across requests, so that the prefill of a request starts after its longest cached prefix. Defaults to False.
+            max_cached_prefix_blocks (int, optional): The maximum number of cached prefix blocks kept when no request uses them, evicted in least recently used order. Defaults to None, in which case they are only evicted when the pool runs out.
+            max_tokens_per_step (int, optional): If set, dynamic batching uses chunked prefill: each step generates one token for each running request, and prefills chunks of the new prompts within the rest of this token budget, in the same forward pass. This bounds the inter token latency of running requests while long prompts are admitted. Defaults to None.
+            num_pipelined_decode_steps (int, optional): If set, with a pipeline parallel model and a dense kv cache, dynamic batching generates up to this number of tokens per request at once when there is nothing to prefill, with groups of requests in flight on all the pipeline stages instead of a single batch going through the stages one after the other. New requests join the batch between these pipelined steps. Defaults to None.
+            scheduling_policy (str, optional): The order in which waiting requests of the same priority join the batch: "fifo", "earliest_deadline" or "shortest_remaining_work" (See Scheduler). Defaults to "fifo".
+            max_kv_cache_tokens (int, optional): If set, waiting requests only join the batch while the prompt lengths plus numbers of tokens to generate of the active requests fit in this number of kv cache tokens, instead of only while there are free slots. Defaults to None.
         """
 
         self.text_generation_controller = text_generation_controller
         self.random_seed = random_seed
-        self.scheduler = Scheduler(max_batch_size=max_batch_size)
+        self.max_sequence_length = max_sequence_length
+        self.num_kv_cache_blocks = num_kv_cache_blocks
+        self.kv_cache_block_size = kv_cache_block_size
+        self.enable_prefix_caching = enable_prefix_caching
+        self.max_cached_prefix_blocks = max_cached_prefix_blocks
+        self.max_tokens_per_step = max_tokens_per_step
+        self.num_pipelined_decode_steps = num_pipelined_decode_steps
+        self.scheduler = Scheduler(
+            max_batch_size=max_batch_size,
+            scheduling_policy=scheduling_policy,
+            max_kv_cache_tokens=max_kv_cache_tokens,
+        )
+        # The number of tokens already streamed for each request, and their text (See get_request_deltas)
+        self.streamed_lengths: Dict[str, int] = {}
+        self.stream_detokenizer = IncrementalDetokenizer(text_generation_controller.tokenizer)
 
-    def generate(self, prompts: List[str], common_inference_params: CommonInferenceParams) -> dict:
+    def generate(
+        self,
+        prompts: List[str],
+        common_inference_params: CommonInferenceParams,
+        dynamic_generation: bool = False,
+    ) -> dict:
         """The megatron core inference backend generate function
 
         This backend returns the output generations as a dictionary. It returns the prompt tokens along with the generated tokens, the prompt plus the generated string and the output log probabilities if requested
@@ -41,6 +85,7 @@ class MCoreEngine(AbstractEngine):
         Args:
             prompts (List[str]): All the prompts as a list of strings
             common_inference_params (CommonInferenceParams): The inference parameters
+            dynamic_generation (bool, optional): Set this to True to use dynamic batching. Defaults to False.
 
         Returns:
             List[InferenceRequest]: The output is list of inference requests containing the generated tokens, texts and log probs if required
@@ -49,44 +94,219 @@ class MCoreEngine(AbstractEngine):
         if self.random_seed:
             torch.random.manual_seed(self.random_seed)
 
+        request_ids: List[str] = []
         for prompt in prompts:
             prompt_tokens = self.text_generation_controller.tokenize_prompt(prompt)
-            self.scheduler.add_request(
+            request_id = self.scheduler.add_request(
                 prompt=prompt,
                 prompt_tokens=prompt_tokens,
                 inference_parameters=common_inference_params,
             )
+            request_ids.append(request_id)
 
-        self.run_engine()
+        self.run_engine(dynamic_generation=dynamic_generation)
 
-        result: List[InferenceRequest] = self.scheduler.completed_request_pool.values()
+        # With dynamic batching requests complete out of order, so return them in the order of the prompts
+        result: List[InferenceRequest] = [
+            self.scheduler.completed_request_pool[request_id] for request_id in request_ids
+        ]
         return result
 
-    def run_engine(self):
-        """Main functionality to run inference
+    def get_max_sequence_length(self) -> int:
+        """The maximum sequence length used to size the kv cache for dynamic batching
 
-        Runs the engine until there are no requests in the queue.
+        Returns:
+            int: The max_sequence_length passed to the constructor, or else the maximum of the prompt length plus the number of tokens to generate over the pending requests.
+        """
+        if self.max_sequence_length is not None:
+            return self.max_sequence_length
+
+        pending_requests = list(self.scheduler.active_request_pool.values()) + list(
+            self.scheduler.waiting_request_pool.values()
+        )
+        return max(
+            len(request.prompt_tokens) + request.inference_parameters.num_tokens_to_generate
+            for request in pending_requests
+        )
+
+    def prep_for_dynamic_generation(self):
+        """Prepares the text generation controller for dynamic batching with the engine settings"""
+        self.text_generation_controller.prep_model_for_dynamic_batch(
+            max_batch_size=self.scheduler.max_batch_size,
+            max_sequence_length=self.get_max_sequence_length(),
+            num_kv_cache_blocks=self.num_kv_cache_blocks,
+            kv_cache_block_size=self.kv_cache_block_size,
+            enable_prefix_caching=self.enable_prefix_caching,
+            max_cached_prefix_blocks=self.max_cached_prefix_blocks,
+            max_tokens_per_step=self.max_tokens_per_step,
+            num_pipelined_decode_steps=self.num_pipelined_decode_steps,
+        )
+
+    def run_engine_step(self, dynamic_generation: bool = False) -> Dict[int, InferenceRequest]:
+        """Runs the active requests, and updates the request pools
 
         Args:
-            dynamic_generation (bool, optional): Set this to True, if you want to enable dynamic batching. Mainly used with an inference server. Defaults to False.
+            dynamic_generation (bool, optional): If True, runs one forward step of the dynamic batch. Otherwise generates all the tokens of the active requests. Defaults to False.
+
+        Returns:
+            Dict[int, InferenceRequest]: The active requests before the step, with their updated status
         """
-        while self.scheduler.have_requests_pending():
-            active_requests: Dict[int, InferenceRequest] = self.scheduler.active_request_pool.copy()
+        active_requests: Dict[int, InferenceRequest] = self.scheduler.active_request_pool.copy()
+        if dynamic_generation:
+            # One forward step, after which completed requests leave the batch and waiting requests join it
+            result_dict: Dict[int, InferenceRequest] = (
+                self.text_generation_controller.generate_output_tokens_dynamic_batch(
+                    active_requests
+                )
+            )
+        else:
             result_dict: Dict[int, InferenceRequest] = (
                 self.text_generation_controller.generate_all_output_tokens_static_batch(
                     active_requests
                 )
             )
 
-            self.scheduler.update_requests_pools(result_dict=result_dict)
+        self.scheduler.update_requests_pools(result_dict=result_dict)
+        return result_dict
 
-        # TODO: Later for dynamic batching we will do something like this
-        """ 
-            if dynamic_batching:
-                result_dict: Dict[
-                    int, InferenceRequest
-                ] = self.text_generation_controller.generate_output_tokens_one_step_dynamic_batch(
-                    active_requests
+    def run_engine(self, dynamic_generation: bool = False):
+        """Main functionality to run inference
+
+        Runs the engine until there are no requests in the queue.
+
+        Args:
+            dynamic_generation (bool, optional): Set this to True, if you want to enable dynamic batching. Mainly used with an inference server. Defaults to False.
+        """
+        if dynamic_generation and self.scheduler.have_requests_pending():
+            self.prep_for_dynamic_generation()
+
+        while self.scheduler.have_requests_pending():
+            self.run_engine_step(dynamic_generation=dynamic_generation)
+        self.text_generation_controller.synchronize_detokenization()
+
+    def get_request_deltas(
+        self, result_dict: Dict[int, InferenceRequest]
+    ) -> List[InferenceRequestDelta]:
+        """The outputs of the requests of a dynamic batching step, since their previous deltas
+
+        Args:
+            result_dict (Dict[int, InferenceRequest]): The requests of the step (See run_engine_step)
+
+        Returns:
+            List[InferenceRequestDelta]: A delta for each request that generated tokens or completed in the step
+        """
+        return self.get_request_deltas_async(result_dict).result()
+
+    def get_request_deltas_async(self, result_dict: Dict[int, InferenceRequest]) -> Future:
+        """Same as get_request_deltas, but with detokenize_in_background the new tokens are detokenized on the worker thread of the text generation controller, overlapping with the next steps
+
+        The deltas of the steps must be requested in order. The future of a step is done after the generated texts of the requests that completed in the step are set.
+
+        Args:
+            result_dict (Dict[int, InferenceRequest]): The requests of the step (See run_engine_step)
+
+        Returns:
+            Future: The future of the list of deltas
+        """
+        # The new tokens are copied here, since the next steps append to the generated tokens
+        new_tokens: List[Tuple[str, Status, List[int]]] = []
+        for request_id, request in result_dict.items():
+            generated_tokens = self.text_generation_controller.get_dynamic_batch_generated_tokens(
+                request
+            )
+            streamed_length = self.streamed_lengths.get(request_id, 0)
+            is_completed = request.status == Status.COMPLETED
+            if len(generated_tokens) == streamed_length and not is_completed:
+                continue
+
+            new_tokens.append((request_id, request.status, generated_tokens[streamed_length:]))
+            if is_completed:
+                self.streamed_lengths.pop(request_id, None)
+            else:
+                self.streamed_lengths[request_id] = len(generated_tokens)
+        return self.text_generation_controller.run_detokenization(
+            self.detokenize_request_deltas, new_tokens
+        )
+
+    def detokenize_request_deltas(
+        self, new_tokens: List[Tuple[str, Status, List[int]]]
+    ) -> List[InferenceRequestDelta]:
+        """Detokenizes the new tokens of the requests incrementally, holding back partial multi byte characters until the next tokens
+
+        Args:
+            new_tokens (List[Tuple[str, Status, List[int]]]): The request id, status and new tokens of each request
+
+        Returns:
+            List[InferenceRequestDelta]: The delta of each request
+        """
+        deltas = []
+        for request_id, status, tokens in new_tokens:
+            text = self.stream_detokenizer.add_tokens(request_id, tokens)
+            if status == Status.COMPLETED:
+                text += self.stream_detokenizer.finish(request_id)
+            deltas.append(
+                InferenceRequestDelta(
+                    request_id=request_id,
+                    status=status,
+                    generated_tokens=tokens,
+                    generated_text=text,
                 )
-            self.scheduler.update_requests_pools(result_dict=result_dict)         
+            )
+        return deltas
+
+    async def run_engine_async(self) -> AsyncGenerator[InferenceRequestDelta, None]:
+        """Runs inference with dynamic batching, and streams the outputs of the requests as they are generated
+
+        Runs the engine until there are no requests in the queue. After every step, it yields a delta for each request that generated tokens or completed in the step, and gives control back to the event loop. With detokenize_in_background, the deltas of a step are yielded after the next step, which overlaps with their detokenization.
+
+        Yields:
+            InferenceRequestDelta: The tokens generated by a request since its previous delta, and their text. The last delta of a request has the status COMPLETED, and the request itself is in the completed request pool.
         """
+        if self.scheduler.have_requests_pending():
+            self.prep_for_dynamic_generation()
+
+        pending_deltas = None
+        while self.scheduler.have_requests_pending():
+            result_dict = self.run_engine_step(dynamic_generation=True)
+            # With detokenize_in_background, the deltas of a step are detokenized during the next step
+            if pending_deltas is not None:
+                for delta in await asyncio.wrap_future(pending_deltas):
+                    yield delta
+            pending_deltas = self.get_request_deltas_async(result_dict)
+            if pending_deltas.done():
+                for delta in pending_deltas.result():
+                    yield delta
+                pending_deltas = None
+            await asyncio.sleep(0)
+
+        if pending_deltas is not None:
+            for delta in await asyncio.wrap_future(pending_deltas):
+                yield delta
+
+    async def generate_stream(
+        self, prompts: List[str], common_inference_params: CommonInferenceParams
+    ) -> AsyncGenerator[InferenceRequestDelta, None]:
+        """Generates the prompts with dynamic batching, and streams the generated tokens as they are sampled
+
+        Args:
+            prompts (List[str]): All the prompts as a list of strings
+            common_inference_params (CommonInferenceParams): The inference parameters
+
+        Yields:
+            InferenceRequestDelta: The tokens generated by a request since its previous delta (See run_engine_async). The deltas of the prompts are interleaved, and the request ids are assigned by the scheduler in the order of the prompts.
+        """
+        if self.random_seed:
+            torch.random.manual_seed(self.random_seed)
+
+        request_ids = set()
+        for prompt in prompts:
+            request_id = self.scheduler.add_request(
+                prompt=prompt,
+                prompt_tokens=self.text_generation_controller.tokenize_prompt(prompt),
+                inference_parameters=common_inference_params,
+            )
+            request_ids.add(request_id)
+
+        async for delta in self.run_engine_async():
+            if delta.request_id in request_ids:
+                yield delta
@@ -28,3 +28,15 @@ class InferenceRequest:
     generated_tokens: torch.Tensor = None
     generated_log_probs: torch.Tensor = None
     generated_length: int = 0
+    kv_cache_slot: int = None
+    admission_time: float = None
+
+
+@dataclass
+class InferenceRequestDelta:
+    """The tokens generated by a request since its previous delta, when streaming the outputs"""
+
+    request_id: str
+    status: Status
+    generated_tokens: List[int]
+    generated_text: str
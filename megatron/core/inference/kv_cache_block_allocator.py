@@ -0,0 +1,203 @@
+# Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+from collections import OrderedDict
+from typing import Dict, List
+
+
+class KVCacheBlockAllocator:
+    """Allocates and frees the blocks of a paged kv cache from a free list"""
+
+    def __init__(self, num_blocks: int, block_size: int):
+        """Allocator for the blocks of a paged kv cache
+
+        The paged kv cache of each layer is a pool of num_blocks blocks of block_size tokens, shared by all the requests. Each request holds a block table (i.e) the list of the blocks that store its tokens, so that the kv cache memory used by a request is proportional to its number of tokens rather than to the maximum sequence length.
+
+        Args:
+            num_blocks (int): The number of blocks in the pool
+            block_size (int): The number of tokens per block
+        """
+        assert num_blocks > 0 and block_size > 0
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.free_blocks: List[int] = list(range(num_blocks))
+
+    @property
+    def num_free_blocks(self) -> int:
+        """The number of blocks that can be allocated"""
+        return len(self.free_blocks)
+
+    def get_num_blocks_for_tokens(self, num_tokens: int) -> int:
+        """The number of blocks needed to store num_tokens tokens"""
+        return -(-num_tokens // self.block_size)
+
+    def can_allocate(self, num_blocks: int) -> bool:
+        """Whether num_blocks blocks can be allocated now"""
+        return num_blocks <= len(self.free_blocks)
+
+    def allocate(self, num_blocks: int) -> List[int]:
+        """Allocate blocks from the pool
+
+        Args:
+            num_blocks (int): The number of blocks to allocate
+
+        Returns:
+            List[int]: The allocated block ids
+        """
+        assert self.can_allocate(
+            num_blocks
+        ), f"Cannot allocate {num_blocks} kv cache blocks, only {len(self.free_blocks)} are free"
+        blocks = self.free_blocks[:num_blocks]
+        del self.free_blocks[:num_blocks]
+        return blocks
+
+    def extend_block_table(self, block_table: List[int], num_tokens: int) -> bool:
+        """Allocate blocks at the end of a block table, so that it can store num_tokens tokens
+
+        Args:
+            block_table (List[int]): The block table of a request. It is extended inplace.
+            num_tokens (int): The number of tokens that the block table should be able to store
+
+        Returns:
+            bool: False if there are not enough free blocks, in which case the block table is unchanged.
+        """
+        num_new_blocks = self.get_num_blocks_for_tokens(num_tokens) - len(block_table)
+        if num_new_blocks <= 0:
+            return True
+        if not self.can_allocate(num_new_blocks):
+            return False
+        block_table.extend(self.allocate(num_new_blocks))
+        return True
+
+    def free(self, blocks: List[int]):
+        """Return blocks to the pool
+
+        Args:
+            blocks (List[int]): The block ids to free
+        """
+        self.free_blocks.extend(blocks)
+
+
+class PrefixCachingKVCacheBlockAllocator(KVCacheBlockAllocator):
+    """Allocates the blocks of a paged kv cache, and shares the blocks of common prompt prefixes"""
+
+    def __init__(self, num_blocks: int, block_size: int, max_cached_blocks: int = None):
+        """Allocator for the blocks of a paged kv cache, that reuses the blocks of common prompt prefixes across requests
+
+        Each full block of a prompt is identified by the hash of its tokens and of all the tokens before it. Once the prefill of a request has computed a full block, the block is registered in the prefix cache, and later requests whose prompts start with the same tokens use it instead of recomputing it. Blocks are reference counted, and when no request uses a cached block anymore, it stays in the cache until it is evicted in least recently used order, either to allocate new blocks or to keep at most max_cached_blocks unused blocks.
+
+        Args:
+            num_blocks (int): The number of blocks in the pool
+            block_size (int): The number of tokens per block
+            max_cached_blocks (int, optional): The maximum number of cached blocks that are not used by any request. Defaults to None, in which case they are only evicted when the pool runs out.
+        """
+        super().__init__(num_blocks, block_size)
+        self.max_cached_blocks = max_cached_blocks
+        self.block_ref_counts: Dict[int, int] = {}
+        self.cached_blocks: Dict[int, int] = {}
+        self.block_hashes: Dict[int, int] = {}
+        # Cached blocks that are not used by any request, from the least to the most recently used
+        self.evictable_blocks: OrderedDict[int, None] = OrderedDict()
+
+        self.num_queried_blocks = 0
+        self.num_hit_blocks = 0
+
+    @property
+    def num_free_blocks(self) -> int:
+        """The number of blocks that can be allocated, including the cached blocks that no request uses, which are evicted to allocate them"""
+        return len(self.free_blocks) + len(self.evictable_blocks)
+
+    def can_allocate(self, num_blocks: int) -> bool:
+        """Whether num_blocks blocks can be allocated now"""
+        return num_blocks <= self.num_free_blocks
+
+    def get_block_hashes(self, tokens: List[int]) -> List[int]:
+        """The prefix hashes of the full blocks of a sequence of tokens
+
+        Args:
+            tokens (List[int]): The tokens of the sequence
+
+        Returns:
+            List[int]: The hash of each full block, which depends on the tokens of the block and on all the tokens before it
+        """
+        block_hashes = []
+        prefix_hash = None
+        for start in range(0, len(tokens) - self.block_size + 1, self.block_size):
+            prefix_hash = hash((prefix_hash, tuple(tokens[start : start + self.block_size])))
+            block_hashes.append(prefix_hash)
+        return block_hashes
+
+    def match_prefix(self, block_hashes: List[int]) -> List[int]:
+        """Looks up the longest cached prefix of a sequence, and takes a reference to its blocks
+
+        Args:
+            block_hashes (List[int]): The prefix hashes of the full blocks of the sequence (See get_block_hashes)
+
+        Returns:
+            List[int]: The cached blocks of the longest prefix, which start the block table of the request. They are released with free.
+        """
+        blocks = []
+        for block_hash in block_hashes:
+            block = self.cached_blocks.get(block_hash)
+            if block is None:
+                break
+            blocks.append(block)
+
+        for block in blocks:
+            self.evictable_blocks.pop(block, None)
+            self.block_ref_counts[block] = self.block_ref_counts.get(block, 0) + 1
+
+        self.num_queried_blocks += len(block_hashes)
+        self.num_hit_blocks += len(blocks)
+        return blocks
+
+    def cache_blocks(self, blocks: List[int], block_hashes: List[int]):
+        """Registers computed full blocks in the prefix cache
+
+        Args:
+            blocks (List[int]): The first blocks of the block table of a request, whose kv cache has been computed
+            block_hashes (List[int]): The prefix hashes of these blocks
+        """
+        for block, block_hash in zip(blocks, block_hashes):
+            if block_hash not in self.cached_blocks and block not in self.block_hashes:
+                self.cached_blocks[block_hash] = block
+                self.block_hashes[block] = block_hash
+
+    def evict_block(self) -> int:
+        """Removes the least recently used unused block from the prefix cache
+
+        Returns:
+            int: The evicted block
+        """
+        block, _ = self.evictable_blocks.popitem(last=False)
+        del self.cached_blocks[self.block_hashes.pop(block)]
+        return block
+
+    def allocate(self, num_blocks: int) -> List[int]:
+        assert self.can_allocate(
+            num_blocks
+        ), f"Cannot allocate {num_blocks} kv cache blocks, only {self.num_free_blocks} are free"
+        while len(self.free_blocks) < num_blocks:
+            self.free_blocks.append(self.evict_block())
+        blocks = super().allocate(num_blocks)
+        for block in blocks:
+            self.block_ref_counts[block] = 1
+        return blocks
+
+    def free(self, blocks: List[int]):
+        """Releases blocks. Cached blocks that are not used anymore stay in the prefix cache until they are evicted.
+
+        Args:
+            blocks (List[int]): The block ids to release
+        """
+        for block in blocks:
+            self.block_ref_counts[block] -= 1
+            if self.block_ref_counts[block] > 0:
+                continue
+            del self.block_ref_counts[block]
+            if block in self.block_hashes:
+                self.evictable_blocks[block] = None
+            else:
+                self.free_blocks.append(block)
+
+        if self.max_cached_blocks is not None:
+            while len(self.evictable_blocks) > self.max_cached_blocks:
+                self.free_blocks.append(self.evict_block())
@@ -0,0 +1,283 @@
+# Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+import functools
+import json
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from megatron.core.inference.regex_automaton import RegexAutomaton, json_schema_to_regex
+
+
+class LogitsProcessor(ABC):
+    """Modifies the logits of the last token of requests before sampling (See CommonInferenceParams.logits_processor)
+
+    A logits processor is shared by all the requests that use it, and keeps the state of each request outside of itself: the text generation controller gets the initial state of a request from get_initial_state, passes the states of the rows of the batch to process_logits, and updates the state of a request with each token it generates.
+    """
+
+    def get_initial_state(self) -> Any:
+        """The state of a request before its first generated token"""
+        return None
+
+    @abstractmethod
+    def process_logits(self, logits: torch.Tensor, states: List[Any]) -> torch.Tensor:
+        """Modifies the logits of a batch of requests
+
+        Args:
+            logits (torch.Tensor): The last token logits of the requests. A tensor of size [batch_size, vocab_size], which can be modified inplace
+            states (List[Any]): The state of each request
+
+        Returns:
+            torch.Tensor: The modified logits
+        """
+        pass
+
+    def update_state(self, state: Any, token: int) -> Any:
+        """The state of a request after it generated a token, other than the end of document"""
+        return state
+
+
+@functools.lru_cache(maxsize=4)
+def get_token_strings(tokenizer) -> Tuple[str, ...]:
+    """The text of each token of a tokenizer, detokenized on its own, computed once per tokenizer
+
+    With byte level tokenizers, the tokens that are part of a multi byte character detokenize to a replacement character.
+    """
+    return tuple(tokenizer.detokenize([token]) for token in range(tokenizer.vocab_size))
+
+
+class TokenAutomatonLogitsProcessor(LogitsProcessor):
+    """Masks the tokens that cannot continue a match of a precompiled token level automaton"""
+
+    def __init__(self, automaton: RegexAutomaton, token_strings: Sequence[str], eod: int):
+        """Constrains the generated text to the matches of a regular expression, with a precompiled token level automaton
+
+        The automaton of the regular expression steps one character at a time. It is compiled once to a token level automaton: for each state reachable from the initial state by tokens, the tokens that keep the text a prefix of a match, and the state after each of them. The characters of the vocabulary are grouped into the few classes that the automaton steps the same way, the character level transition table is built over these classes, and all the tokens are then stepped from a state together with numpy, through a trie of their texts as sequences of character classes, one depth at a time. The end of document is allowed in the states that match, and is the only token allowed in the states without any other token.
+
+        Compiling costs a pass over the trie and the tokens for each token level state. A bounded repetition has a state per repetition (e.g) a JSON string with a maxLength of 64 has about 64 states, so compiled processors should be shared by the requests with the same pattern (See get_regex_logits_processor and get_json_schema_logits_processor, which cache them per pattern and tokenizer).
+
+        The allowed tokens of each state are cached as a bitmask of the vocabulary, and the logits of a batch are masked with a single gather of the bitmasks of the states of its rows and a masked fill.
+
+        Args:
+            automaton (RegexAutomaton): The character level automaton
+            token_strings (Sequence[str]): The text of each token (See get_token_strings). Tokens with an empty text are never allowed.
+            eod (int): The end of document token
+        """
+        self.eod = eod
+        self.vocab_size = max(len(token_strings), eod + 1)
+        table, char_classes = self.build_transition_table(automaton, token_strings)
+        dead_state = len(table) - 1
+
+        # The trie of the texts of the tokens as sequences of character classes, which share most of their prefixes since there are few classes. Its nodes are numbered by depth, so that a parent comes before its children.
+        token_nodes, node_parents, node_classes, depth_ends = self.build_class_trie(
+            token_strings, char_classes
+        )
+        has_text = np.array([len(text) > 0 for text in token_strings])
+        text_tokens = np.nonzero(has_text)[0]
+        text_token_nodes = token_nodes[text_tokens]
+
+        # The token level states, and for each of them its allowed tokens (sorted) and the state after each of them
+        self.transitions: List[Tuple[np.ndarray, np.ndarray]] = []
+        state_indices = np.full(len(table), -1, dtype=np.int64)
+        state_indices[automaton.initial_state] = 0
+        automaton_states = [automaton.initial_state]
+        allowed_tokens: List[np.ndarray] = []
+        node_states = np.empty(len(node_parents), dtype=np.int64)
+        while len(self.transitions) < len(automaton_states):
+            automaton_state = automaton_states[len(self.transitions)]
+            # Step the trie one depth at a time. The dead state steps to itself.
+            node_states[0] = automaton_state
+            for start, end in zip(depth_ends[:-1], depth_ends[1:]):
+                node_states[start:end] = table[
+                    node_states[node_parents[start:end]], node_classes[start:end]
+                ]
+            states = node_states[text_token_nodes]
+            is_alive = states != dead_state
+            tokens, states = text_tokens[is_alive], states[is_alive]
+
+            # Number the new token level states
+            is_reached = np.zeros(len(table), dtype=bool)
+            is_reached[states] = True
+            for next_state in np.nonzero(is_reached & (state_indices < 0))[0].tolist():
+                state_indices[next_state] = len(automaton_states)
+                automaton_states.append(next_state)
+            self.transitions.append((tokens, state_indices[states]))
+            if automaton.is_accepting(automaton_state) or len(tokens) == 0:
+                tokens = np.append(tokens, eod)
+            allowed_tokens.append(tokens)
+
+        # A last state in which only the end of document is allowed, for the tokens that are not allowed (e.g) sampled from a row whose logits are all -inf
+        self.end_state = len(self.transitions)
+        self.transitions.append((np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)))
+        allowed_tokens.append(np.array([eod], dtype=np.int64))
+        self.masks = self.pack_masks(allowed_tokens, self.vocab_size)
+        self.device_masks: Optional[torch.Tensor] = None
+
+    @staticmethod
+    def build_transition_table(
+        automaton: RegexAutomaton, token_strings: Sequence[str]
+    ) -> Tuple[np.ndarray, Dict[str, int]]:
+        """The character level transition table of the automaton, over the character classes of the vocabulary
+
+        Returns:
+            Tuple[np.ndarray, Dict[str, int]]: The state after each state and character class, of shape [num_states + 1, num_classes], whose last row is the dead state, the state after a character that no text starting with the characters so far matches. And the class of each character of the vocabulary.
+        """
+        chars = sorted({char for text in token_strings for char in text})
+        char_classes = dict(zip(chars, automaton.get_character_classes(chars)))
+        representatives: Dict[int, str] = {}
+        for char, char_class in char_classes.items():
+            representatives.setdefault(char_class, char)
+
+        # Step every state of the automaton, including the ones it creates while stepping
+        rows = []
+        while len(rows) < len(automaton.states):
+            rows.append(
+                [automaton.step(len(rows), representatives[c]) for c in range(len(representatives))]
+            )
+        dead_state = len(rows)
+        table = np.full((len(rows) + 1, len(representatives)), dead_state, dtype=np.int64)
+        for state, row in enumerate(rows):
+            table[state] = [dead_state if next_state is None else next_state for next_state in row]
+        return table, char_classes
+
+    @staticmethod
+    def build_class_trie(
+        token_strings: Sequence[str], char_classes: Dict[str, int]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[int]]:
+        """A trie of the texts of the tokens as sequences of character classes, with the root as node 0 and the nodes numbered by depth
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, List[int]]: The node of each token, the parent and the character class of each node, and the end of the nodes of each depth, starting with the end of the root
+        """
+        levels: List[Dict[Tuple[int, int], int]] = []
+        token_paths = []
+        for text in token_strings:
+            node = 0
+            for depth, char in enumerate(text):
+                if depth == len(levels):
+                    levels.append({})
+                # Nodes are numbered within their depth first
+                node = levels[depth].setdefault((node, char_classes[char]), len(levels[depth]))
+            token_paths.append((len(text), node))
+
+        # Renumber the nodes by depth
+        depth_ends = [1]
+        for level in levels:
+            depth_ends.append(depth_ends[-1] + len(level))
+        node_parents = np.zeros(depth_ends[-1], dtype=np.int64)
+        node_classes = np.zeros(depth_ends[-1], dtype=np.int64)
+        for depth, level in enumerate(levels):
+            parent_start = depth_ends[depth - 1] if depth > 0 else 0
+            for (parent, char_class), node in level.items():
+                node_parents[depth_ends[depth] + node] = parent_start + parent
+                node_classes[depth_ends[depth] + node] = char_class
+        token_nodes = np.array(
+            [depth_ends[length - 1] + node if length > 0 else 0 for length, node in token_paths],
+            dtype=np.int64,
+        )
+        return token_nodes, node_parents, node_classes, depth_ends
+
+    @staticmethod
+    def pack_masks(allowed_tokens: List[np.ndarray], vocab_size: int) -> torch.Tensor:
+        """The bitmasks of the allowed tokens of each state, as a uint8 tensor of shape [num_states, ceil(vocab_size / 8)]"""
+        num_bytes = -(-vocab_size // 8)
+        masks = torch.zeros((len(allowed_tokens), num_bytes * 8), dtype=torch.bool)
+        for state, tokens in enumerate(allowed_tokens):
+            masks[state, torch.from_numpy(tokens)] = True
+        bit_values = 2 ** torch.arange(8, dtype=torch.int32)
+        return (masks.view(-1, num_bytes, 8).int() * bit_values).sum(-1).to(torch.uint8)
+
+    def get_initial_state(self) -> int:
+        return 0
+
+    def get_allowed_tokens(self, states: List[int], device: torch.device) -> torch.Tensor:
+        """The boolean mask of the allowed tokens of each state, of shape [len(states), vocab_size]"""
+        if self.device_masks is None or self.device_masks.device != torch.device(device):
+            self.device_masks = self.masks.to(device)
+        packed = self.device_masks[torch.tensor(states, device=device)]
+        shifts = torch.arange(8, dtype=torch.uint8, device=device)
+        allowed = (packed.unsqueeze(-1) >> shifts) & 1
+        return allowed.flatten(1).bool()
+
+    def process_logits(self, logits: torch.Tensor, states: List[int]) -> torch.Tensor:
+        allowed = self.get_allowed_tokens(states, logits.device)
+        # The padded vocabulary of the logits can be larger or smaller than the vocabulary of the tokenizer
+        vocab_size = logits.size(1)
+        if allowed.size(1) < vocab_size:
+            allowed = torch.nn.functional.pad(allowed, (0, vocab_size - allowed.size(1)))
+        return logits.masked_fill_(~allowed[:, :vocab_size], float('-inf'))
+
+    def update_state(self, state: int, token: int) -> int:
+        tokens, next_states = self.transitions[state]
+        index = np.searchsorted(tokens, token)
+        if index < len(tokens) and tokens[index] == token:
+            return int(next_states[index])
+        return self.end_state
+
+
+class RegexLogitsProcessor(TokenAutomatonLogitsProcessor):
+    """Masks the tokens that cannot continue a match of a regular expression"""
+
+    def __init__(self, pattern: str, tokenizer, token_strings: Optional[Sequence[str]] = None):
+        """Constrains the generated text to the matches of a regular expression (See RegexParser for the supported syntax)
+
+        Args:
+            pattern (str): The regular expression, which matches the whole generated text
+            tokenizer (_type_): The tokenizer of the model, with a vocab_size, an eod and a detokenize method
+            token_strings (Sequence[str], optional): The text of each token. Defaults to the tokens detokenized on their own (See get_token_strings), which are computed once per tokenizer.
+        """
+        self.pattern = pattern
+        if token_strings is None:
+            token_strings = get_token_strings(tokenizer)
+        super().__init__(RegexAutomaton(pattern), token_strings, tokenizer.eod)
+
+
+class JSONSchemaLogitsProcessor(RegexLogitsProcessor):
+    """Masks the tokens that cannot continue a JSON value of a JSON schema"""
+
+    def __init__(self, schema: dict, tokenizer, token_strings: Optional[Sequence[str]] = None):
+        """Constrains the generated text to the JSON values of a JSON schema (See json_schema_to_regex for the supported schemas)
+
+        Args:
+            schema (dict): The JSON schema
+            tokenizer (_type_): The tokenizer of the model, with a vocab_size, an eod and a detokenize method
+            token_strings (Sequence[str], optional): The text of each token (See RegexLogitsProcessor)
+        """
+        self.schema = schema
+        super().__init__(json_schema_to_regex(schema), tokenizer, token_strings)
+
+
+@functools.lru_cache(maxsize=128)
+def get_regex_logits_processor(pattern: str, tokenizer) -> RegexLogitsProcessor:
+    """The regex logits processor of a pattern and a tokenizer, compiled on first use and then shared
+
+    Args:
+        pattern (str): The regular expression
+        tokenizer (_type_): The tokenizer of the model
+
+    Returns:
+        RegexLogitsProcessor: The cached logits processor
+    """
+    return RegexLogitsProcessor(pattern, tokenizer)
+
+
+@functools.lru_cache(maxsize=128)
+def get_json_schema_logits_processor_from_json(
+    schema_json: str, tokenizer
+) -> JSONSchemaLogitsProcessor:
+    """The JSON schema logits processor of a serialized JSON schema and a tokenizer, compiled on first use and then shared (See get_json_schema_logits_processor)"""
+    return JSONSchemaLogitsProcessor(json.loads(schema_json), tokenizer)
+
+
+def get_json_schema_logits_processor(schema: dict, tokenizer) -> JSONSchemaLogitsProcessor:
+    """The JSON schema logits processor of a JSON schema and a tokenizer, compiled on first use and then shared
+
+    Args:
+        schema (dict): The JSON schema
+        tokenizer (_type_): The tokenizer of the model
+
+    Returns:
+        JSONSchemaLogitsProcessor: The cached logits processor
+    """
+    return get_json_schema_logits_processor_from_json(json.dumps(schema, sort_keys=True), tokenizer)
@@ -62,6 +62,57 @@ class AbstractModelInferenceWrapper(abc.ABC):
         self.prompts_tokens = prompts_tokens
         batch_size, max_sequence_length = self.prompts_tokens.shape
         self.inference_params = InferenceParams(batch_size, max_sequence_length)
+        self._enable_kv_cache_quantization()
+        if self.inference_wrapper_config.kv_cache_window_size is not None:
+            self.inference_params.enable_sliding_window_kv_cache(
+                self.inference_wrapper_config.kv_cache_window_size,
+                self.inference_wrapper_config.kv_cache_num_sink_tokens,
+            )
+
+    def prep_model_for_dynamic_inference(
+        self,
+        max_batch_size: int,
+        max_sequence_length: int,
+        num_kv_cache_blocks: int = None,
+        kv_cache_block_size: int = None,
+        max_padding_length: int = 0,
+    ):
+        """A utility function for preparing model for inference with dynamic batching
+
+        The function gets called once before the dynamic batching loop. Unlike prep_model_for_inference, the inference params are not tied to a fixed batch of prompts. Each request gets its own slot of the kv cache (or its own block table with a paged kv cache), and requests can join and leave the batch at every step.
+
+        Args:
+            max_batch_size (int): The maximum number of requests that are processed at the same time (i.e) The number of kv cache slots.
+            max_sequence_length (int): The maximum number of tokens (prompt plus generated tokens) of a request.
+            num_kv_cache_blocks (int, optional): If set, use a paged kv cache with this number of blocks per layer instead of a dense kv cache of max_batch_size slots of max_sequence_length tokens.
+            kv_cache_block_size (int, optional): The number of tokens per block of the paged kv cache.
+            max_padding_length (int, optional): The maximum number of padding tokens after the end of a sequence, when the rows of a step have different numbers of new tokens. The kv cache and the rotary embeddings get room for them, and their position ids are clipped to max_sequence_length - 1. Defaults to 0.
+        """
+        assert (
+            self.inference_wrapper_config.kv_cache_window_size is None
+        ), "The sliding window kv cache is not supported with dynamic batching"
+        self.model.eval()
+
+        # For TP only model both is_pp_first_stage and _is_pp_last_stage returns True
+        self.model_is_pipeline_parallel = not (
+            parallel_state.is_pipeline_first_stage() and parallel_state.is_pipeline_last_stage()
+        )
+        self.prompts_tokens = None
+        self.max_position_id = max_sequence_length - 1
+        self.inference_params = InferenceParams(
+            max_batch_size, max_sequence_length + max_padding_length
+        )
+        if num_kv_cache_blocks is not None:
+            self.inference_params.enable_paged_kv_cache(num_kv_cache_blocks, kv_cache_block_size)
+        self._enable_kv_cache_quantization()
+
+    def _enable_kv_cache_quantization(self):
+        """Quantizes the kv cache of the inference params if the inference wrapper config asks for it"""
+        if self.inference_wrapper_config.kv_cache_quantization is not None:
+            self.inference_params.enable_kv_cache_quantization(
+                self.inference_wrapper_config.kv_cache_quantization,
+                self.inference_wrapper_config.kv_cache_quantization_block_size,
+            )
 
     @abc.abstractmethod
     def get_batch_for_context_window(self) -> List:
@@ -175,6 +226,12 @@ class AbstractModelInferenceWrapper(abc.ABC):
             end = min(start + micro_batch_size, batch_size)
             tokens2use = tokens[start:end, ...]
             position_ids2use = position_ids[start:end, ...]
+            # The attention mask is either shared by all rows, per row with dynamic batching, or None for decode steps
+            attention_mask2use = (
+                attention_mask[start:end, ...]
+                if attention_mask is not None and attention_mask.size(0) > 1
+                else attention_mask
+            )
             current_micro_batch_size = end - start
 
             # Need to change recv buffer shape for the last partial microbatch (if exists)
@@ -186,7 +243,10 @@ class AbstractModelInferenceWrapper(abc.ABC):
 
             self.model.set_input_tensor(recv_buffer)
             output_tensor = self.model(
-                tokens2use, position_ids2use, attention_mask, inference_params=self.inference_params
+                tokens2use,
+                position_ids2use,
+                attention_mask2use,
+                inference_params=self.inference_params,
             )
 
             if not parallel_state.is_pipeline_last_stage():
@@ -207,6 +267,30 @@ class AbstractModelInferenceWrapper(abc.ABC):
         # NOTE: Only returns the logits on the last pipeline stage
         return logits
 
+    def run_one_pipeline_stage_forward_step(
+        self, inference_input: List, input_tensor: torch.Tensor = None
+    ) -> torch.Tensor:
+        """Runs the forward pass of the layers of this pipeline stage only, without any communication
+
+        Used by schedules that interleave the micro batches of several steps across the pipeline stages, and communicate between the stages themselves (See SimpleTextGenerationController.generate_output_tokens_pipelined_decode).
+
+        Args:
+            inference_input (List): A list containg the inputs for the gpt model [tokens, position ids, attention mask]
+            input_tensor (torch.Tensor, optional): The output of the previous stage of shape [seq_len, batch_size, hidden_size]. None on the first stage.
+
+        Returns:
+            torch.Tensor: The output logits of shape [batch_size, seq_len, padded_vocab_size] on the last stage. The output of shape [seq_len, batch_size, hidden_size] to send to the next stage on the other stages.
+        """
+        tokens, position_ids, attention_mask = inference_input
+        self.model.set_input_tensor(input_tensor)
+        output_tensor = self.model(
+            tokens, position_ids, attention_mask, inference_params=self.inference_params
+        )
+
+        if parallel_state.is_pipeline_last_stage():
+            return tensor_parallel.gather_from_tensor_model_parallel_region(output_tensor)
+        return output_tensor.type(dtype=self.pipeline_communication_dtype)
+
     def run_one_forward_step(self, inference_input: List) -> torch.Tensor:
         """The forward pass of the model for inference
 
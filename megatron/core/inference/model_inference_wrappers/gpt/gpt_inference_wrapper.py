@@ -22,6 +22,13 @@ class GPTInferenceWrapper(AbstractModelInferenceWrapper):
         """
         super().__init__(model, args)
 
+        # Persistent buffers, reused across generations and steps (See _build_attention_mask_and_position_ids and prep_model_for_dynamic_inference)
+        self.causal_attention_mask = None
+        self.arange_position_ids = None
+        self.decode_sequence_offsets = None
+        self.decode_position_ids = None
+        self.decode_attention_mask = None
+
     def prep_model_for_inference(self, prompts_tokens: torch.Tensor):
         """A utility function for preparing model for inference
 
@@ -48,17 +55,19 @@ class GPTInferenceWrapper(AbstractModelInferenceWrapper):
             Tuple[torch.Tensor, torch.Tensor]: The attention mask of shape [1, 1, max_seq_len, max_seq_len] and position ids of shape [batch_size, max_seq_len]
         """
         seq_length = prompts_tokens.size(1)
-        attention_mask = torch.tril(
-            torch.ones((1, seq_length, seq_length), device=prompts_tokens.device)
-        ).view(1, 1, seq_length, seq_length)
-        # Convert to boolean
-        attention_mask = attention_mask < 0.5
-
-        position_ids = (
-            torch.arange(seq_length, dtype=torch.long, device=prompts_tokens.device)
-            .unsqueeze(0)
-            .expand_as(prompts_tokens)
-        )
+        # The mask and position ids of the longest sequence so far are built once, and sliced for shorter sequences
+        if self.causal_attention_mask is None or self.causal_attention_mask.size(-1) < seq_length:
+            attention_mask = torch.tril(
+                torch.ones((1, seq_length, seq_length), device=prompts_tokens.device)
+            ).view(1, 1, seq_length, seq_length)
+            # Convert to boolean
+            self.causal_attention_mask = attention_mask < 0.5
+            self.arange_position_ids = torch.arange(
+                seq_length, dtype=torch.long, device=prompts_tokens.device
+            )
+        attention_mask = self.causal_attention_mask[..., :seq_length, :seq_length]
+
+        position_ids = self.arange_position_ids[:seq_length].unsqueeze(0).expand_as(prompts_tokens)
 
         return attention_mask, position_ids
 
@@ -78,8 +87,145 @@ class GPTInferenceWrapper(AbstractModelInferenceWrapper):
         """
         tokens2use = self.prompts_tokens[:, context_start_position:context_end_position]
         positions2use = self.position_ids[:, context_start_position:context_end_position]
-        attention_mask2use = self.attention_mask[
-            ..., context_start_position:context_end_position, :context_end_position
-        ]
+        if context_end_position - context_start_position == 1:
+            # A single token attends to all the tokens before it, so the decode steps do not need a mask
+            attention_mask2use = None
+        else:
+            attention_mask2use = self.attention_mask[
+                ..., context_start_position:context_end_position, :context_end_position
+            ]
         data_at_step_idx = [tokens2use, positions2use, attention_mask2use]
         return data_at_step_idx
+
+    def prep_model_for_dynamic_inference(
+        self,
+        max_batch_size: int,
+        max_sequence_length: int,
+        num_kv_cache_blocks: int = None,
+        kv_cache_block_size: int = None,
+        max_padding_length: int = 0,
+    ):
+        """A utility function for preparing model for inference with dynamic batching
+
+        Besides the inference params (See AbstractModelInferenceWrapper.prep_model_for_dynamic_inference), it preallocates the inputs of the decode steps, which get_batch_for_dynamic_step updates in place instead of allocating new tensors at every step.
+
+        Args:
+            max_batch_size (int): The maximum number of requests that are processed at the same time
+            max_sequence_length (int): The maximum number of tokens (prompt plus generated tokens) of a request
+            num_kv_cache_blocks (int, optional): If set, use a paged kv cache with this number of blocks per layer
+            kv_cache_block_size (int, optional): The number of tokens per block of the paged kv cache
+            max_padding_length (int, optional): The maximum number of padding tokens after the end of a sequence. Defaults to 0.
+        """
+        super().prep_model_for_dynamic_inference(
+            max_batch_size=max_batch_size,
+            max_sequence_length=max_sequence_length,
+            num_kv_cache_blocks=num_kv_cache_blocks,
+            kv_cache_block_size=kv_cache_block_size,
+            max_padding_length=max_padding_length,
+        )
+        device = torch.cuda.current_device()
+        max_key_length = max_sequence_length + max_padding_length
+        self.key_positions = torch.arange(max_key_length, dtype=torch.long, device=device)
+        self.decode_sequence_offsets = torch.empty(max_batch_size, dtype=torch.long, device=device)
+        self.decode_position_ids = torch.empty((max_batch_size, 1), dtype=torch.long, device=device)
+        self.decode_attention_mask = torch.empty(
+            (max_batch_size, 1, 1, max_key_length), dtype=torch.bool, device=device
+        )
+
+    def get_batch_for_dynamic_decode_step(
+        self,
+        tokens: torch.Tensor,
+        batch_slots: torch.Tensor,
+        sequence_offsets: List[int],
+        block_tables: torch.Tensor = None,
+    ) -> List:
+        """Returns the inference data for a dynamic batching step with one new token per row
+
+        Same as get_batch_for_dynamic_step, but the sequence offsets, position ids and attention mask are written in place into the buffers preallocated by prep_model_for_dynamic_inference. Since each row has a single query, its mask only hides the keys beyond its own sequence, and there is no causal mask to build.
+
+        Args:
+            tokens (torch.Tensor): The input tokens of shape [batch_size, 1]
+            batch_slots (torch.Tensor): Int tensor of shape [batch_size] with the kv cache slot of each row. Not used with a paged kv cache.
+            sequence_offsets (List[int]): The number of tokens of each row already in the kv cache
+            block_tables (torch.Tensor, optional): Int tensor of shape [batch_size, max_blocks] with the kv cache blocks of each row, if the kv cache is paged.
+
+        Returns:
+            List: A list of inputs that will be used by your model in the forward step
+        """
+        batch_size = tokens.size(0)
+        max_sequence_end = max(sequence_offsets) + 1
+        offsets = self.decode_sequence_offsets[:batch_size]
+        offsets.copy_(torch.tensor(sequence_offsets, dtype=torch.long), non_blocking=True)
+        if block_tables is not None:
+            self.inference_params.set_block_tables(block_tables, offsets, max_sequence_end)
+        else:
+            self.inference_params.set_batch_slots(batch_slots, offsets, max_sequence_end)
+
+        # Position ids. [batch_size, 1]
+        positions2use = self.decode_position_ids[:batch_size]
+        torch.clamp(offsets.unsqueeze(1), max=self.max_position_id, out=positions2use)
+
+        # Keys beyond the sequence of each row (True means masked out). [batch_size, 1, 1, max_sequence_end]
+        attention_mask2use = self.decode_attention_mask[:batch_size, :, :, :max_sequence_end]
+        torch.gt(
+            self.key_positions[:max_sequence_end].view(1, 1, 1, -1),
+            offsets.view(-1, 1, 1, 1),
+            out=attention_mask2use,
+        )
+
+        return [tokens, positions2use, attention_mask2use]
+
+    def get_batch_for_dynamic_step(
+        self,
+        tokens: torch.Tensor,
+        batch_slots: torch.Tensor,
+        sequence_offsets: List[int],
+        block_tables: torch.Tensor = None,
+        new_token_lengths: List[int] = None,
+    ) -> List:
+        """Returns the inference data for one step of dynamic batching
+
+        Each row of the batch is a different request, with its own kv cache slot (or block table) and number of tokens already in the kv cache. The position ids and the attention mask are built per row, and the kv cache slots (or block tables) and sequence offsets are set in the inference params.
+
+        Args:
+            tokens (torch.Tensor): The input tokens of shape [batch_size, seq_len]. Rows with less than seq_len new tokens are padded at the end.
+            batch_slots (torch.Tensor): Int tensor of shape [batch_size] with the kv cache slot of each row. Not used with a paged kv cache.
+            sequence_offsets (List[int]): The number of tokens of each row already in the kv cache
+            block_tables (torch.Tensor, optional): Int tensor of shape [batch_size, max_blocks] with the kv cache blocks of each row, if the kv cache is paged.
+            new_token_lengths (List[int], optional): The number of new tokens of each row, for the layers whose state depends on the padding (e.g.) Mamba layers. Defaults to None, in which case the rows are not padded.
+
+        Returns:
+            List: A list of inputs that will be used by your model in the forward step
+        """
+        seq_len = tokens.size(1)
+        if seq_len == 1 and tokens.size(0) <= self.decode_sequence_offsets.size(0):
+            return self.get_batch_for_dynamic_decode_step(
+                tokens, batch_slots, sequence_offsets, block_tables
+            )
+
+        max_sequence_end = max(sequence_offsets) + seq_len
+        sequence_offsets = torch.tensor(sequence_offsets, dtype=torch.long, device=tokens.device)
+        if block_tables is not None:
+            self.inference_params.set_block_tables(block_tables, sequence_offsets, max_sequence_end)
+        else:
+            if new_token_lengths is not None:
+                new_token_lengths = torch.tensor(
+                    new_token_lengths, dtype=torch.long, device=tokens.device
+                )
+            self.inference_params.set_batch_slots(
+                batch_slots, sequence_offsets, max_sequence_end, new_token_lengths
+            )
+
+        # Position ids. [batch_size, seq_len]
+        positions2use = sequence_offsets.unsqueeze(1) + torch.arange(
+            seq_len, dtype=torch.long, device=tokens.device
+        ).unsqueeze(0)
+
+        # Causal mask per row, over the kv cache of the row (True means masked out). [batch_size, 1, seq_len, max_sequence_end]
+        key_positions = self.key_positions[:max_sequence_end]
+        attention_mask2use = key_positions.view(1, 1, 1, -1) > positions2use.view(-1, 1, seq_len, 1)
+
+        # Padding tokens can go beyond the maximum sequence length
+        positions2use = positions2use.clamp(max=self.max_position_id)
+
+        return [tokens, positions2use, attention_mask2use]
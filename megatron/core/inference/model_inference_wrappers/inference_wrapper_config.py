@@ -26,6 +26,18 @@ class InferenceWrapperConfig:
     fp32_residual_connection: bool = False
     """Move residual connections to fp32. Obtained from arguments.py"""
 
+    kv_cache_quantization: str = None
+    """If set, store the kv cache quantized, as "int8" or as "fp8" values stored in int8 (See QuantizedKVCache)"""
+
+    kv_cache_quantization_block_size: int = None
+    """The number of channels per scale of the quantized kv cache. Defaults to the head dim (i.e) one scale per head and token"""
+
+    kv_cache_window_size: int = None
+    """If set, only keep the sink tokens and the last kv_cache_window_size tokens of each sequence in the kv cache, and attend to them only (See InferenceParams.enable_sliding_window_kv_cache). Not supported with dynamic batching"""
+
+    kv_cache_num_sink_tokens: int = 0
+    """The number of first tokens of each sequence always kept in the sliding window kv cache"""
+
     def add_attributes(self, attribute_value_pair: dict):
         """Utility to add more attributes to inference params
 
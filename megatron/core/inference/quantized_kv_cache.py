@@ -0,0 +1,131 @@
+# Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+from typing import Tuple
+
+import torch
+
+# The largest magnitude of the quantized values of each format
+KV_CACHE_QUANTIZATION_MAX = {"int8": 127.0, "fp8": 448.0}
+
+
+def quantize_kv(
+    tensor: torch.Tensor, quantization: str, block_size: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Quantizes keys or values, with one scale per block of block_size channels of each head
+
+    The scale of a block is its largest magnitude divided by the largest quantized value, so that the block uses the full range of the format. Blocks of zeros get a zero scale.
+
+    Args:
+        tensor (torch.Tensor): The keys or values, of shape [..., head_dim]
+        quantization (str): "int8" for int8 values, or "fp8" for float8 (e4m3) values stored in an int8 tensor
+        block_size (int): The number of channels per scale, which divides head_dim
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: The int8 tensor of quantized values, of the same shape as tensor, and the float32 scales of shape [..., head_dim // block_size]
+    """
+    blocks = tensor.float().unflatten(-1, (-1, block_size))
+    scales = blocks.abs().amax(dim=-1) / KV_CACHE_QUANTIZATION_MAX[quantization]
+    blocks = blocks / scales.clamp(min=torch.finfo(torch.float32).tiny).unsqueeze(-1)
+    if quantization == "int8":
+        data = blocks.round_().clamp_(-127, 127).to(torch.int8)
+    else:
+        data = blocks.to(torch.float8_e4m3fn).view(torch.int8)
+    return data.flatten(-2), scales
+
+
+def dequantize_kv(
+    data: torch.Tensor, scales: torch.Tensor, quantization: str, dtype: torch.dtype
+) -> torch.Tensor:
+    """Dequantizes keys or values quantized by quantize_kv
+
+    Args:
+        data (torch.Tensor): The int8 tensor of quantized values, of shape [..., head_dim]
+        scales (torch.Tensor): The float32 scales, of shape [..., head_dim // block_size]
+        quantization (str): The format of the quantized values ("int8" or "fp8")
+        dtype (torch.dtype): The dtype of the dequantized keys or values
+
+    Returns:
+        torch.Tensor: The keys or values, of the same shape as data
+    """
+    if quantization == "int8":
+        blocks = data.float()
+    else:
+        blocks = data.view(torch.float8_e4m3fn).float()
+    blocks = blocks.unflatten(-1, (scales.size(-1), -1)) * scales.unsqueeze(-1)
+    return blocks.flatten(-2).to(dtype)
+
+
+class QuantizedKVCache:
+    """A quantized kv cache tensor, which quantizes on write and dequantizes on read"""
+
+    def __init__(
+        self,
+        shape: Tuple[int, ...],
+        dtype: torch.dtype,
+        quantization: str,
+        block_size: int = None,
+        device: torch.device = None,
+    ):
+        """The kv cache of the keys or the values of a layer, stored quantized
+
+        The keys or values are stored as int8 (or float8 stored in int8), with a float32 scale per block of block_size channels of each head of each token, which halves the kv cache memory of a bfloat16 model (plus 4 bytes per block for the scales). Since each token has its own scales, writing new tokens never requantizes the tokens already in the kv cache.
+
+        Indexing works as for the dense kv cache tensor, on the leading dimensions: assigning keys or values quantizes them (See quantize_kv) and reading them dequantizes them to dtype (See dequantize_kv).
+
+        Args:
+            shape (Tuple[int, ...]): The shape of the kv cache, of which the last dimension is the head dim
+            dtype (torch.dtype): The dtype of the keys and values that are read
+            quantization (str): "int8" for int8 values, or "fp8" for float8 (e4m3) values stored in int8
+            block_size (int, optional): The number of channels per scale. Defaults to the head dim, (i.e) one scale per head and token.
+            device (torch.device, optional): The device of the kv cache
+        """
+        assert (
+            quantization in KV_CACHE_QUANTIZATION_MAX
+        ), f"Unknown kv cache quantization {quantization}, expected one of {list(KV_CACHE_QUANTIZATION_MAX)}"
+        head_dim = shape[-1]
+        if block_size is None:
+            block_size = head_dim
+        assert head_dim % block_size == 0, "The block size must divide the head dim"
+        self.dtype = dtype
+        self.quantization = quantization
+        self.block_size = block_size
+        # Zero initialized, since positions beyond the sequence of a row can be read and masked out
+        self.data = torch.zeros(shape, dtype=torch.int8, device=device)
+        self.scales = torch.zeros(
+            (*shape[:-1], head_dim // block_size), dtype=torch.float32, device=device
+        )
+
+    @property
+    def shape(self) -> torch.Size:
+        """The shape of the kv cache, as the shape of the dense kv cache tensor"""
+        return self.data.shape
+
+    def size(self, dim: int = None):
+        """The size of the kv cache, or of one of its dimensions, as torch.Tensor.size"""
+        return self.data.size() if dim is None else self.data.size(dim)
+
+    def __setitem__(self, indices, value: torch.Tensor):
+        data, scales = quantize_kv(value, self.quantization, self.block_size)
+        self.data[indices] = data
+        self.scales[indices] = scales
+
+    def __getitem__(self, indices) -> torch.Tensor:
+        return dequantize_kv(
+            self.data[indices], self.scales[indices], self.quantization, self.dtype
+        )
+
+    def empty_like(self) -> 'QuantizedKVCache':
+        """A kv cache of the same shape and format"""
+        return QuantizedKVCache(
+            self.data.shape, self.dtype, self.quantization, self.block_size, self.data.device
+        )
+
+    def index_select(self, index: torch.Tensor, sequence_end: int, out: 'QuantizedKVCache'):
+        """Copies rows of the first sequence_end tokens into out, without dequantizing them
+
+        Args:
+            index (torch.Tensor): Int tensor with the row copied to each row of out
+            sequence_end (int): The number of tokens to copy
+            out (QuantizedKVCache): The kv cache to copy to
+        """
+        torch.index_select(self.data[:sequence_end], 1, index, out=out.data[:sequence_end])
+        torch.index_select(self.scales[:sequence_end], 1, index, out=out.scales[:sequence_end])
@@ -0,0 +1,397 @@
+# Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+import json
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class CharacterSet:
+    """A set of characters, given by single characters and inclusive ranges, or its complement"""
+
+    chars: FrozenSet[str] = frozenset()
+    ranges: Tuple[Tuple[str, str], ...] = ()
+    negated: bool = False
+
+    def matches(self, char: str) -> bool:
+        """Whether the character is in the set"""
+        is_in_set = char in self.chars or any(low <= char <= high for low, high in self.ranges)
+        return is_in_set != self.negated
+
+
+DIGITS = CharacterSet(ranges=(('0', '9'),))
+WORD_CHARACTERS = CharacterSet(chars=frozenset('_'), ranges=(('a', 'z'), ('A', 'Z'), ('0', '9')))
+WHITESPACES = CharacterSet(chars=frozenset(' \t\n\r\f\v'))
+# Escapes of a single character (e.g) \n, and of a character set (e.g) \d
+CHARACTER_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'f': '\f', 'v': '\v', '0': '\0'}
+CHARACTER_SET_ESCAPES = {
+    'd': DIGITS,
+    'D': CharacterSet(DIGITS.chars, DIGITS.ranges, negated=True),
+    'w': WORD_CHARACTERS,
+    'W': CharacterSet(WORD_CHARACTERS.chars, WORD_CHARACTERS.ranges, negated=True),
+    's': WHITESPACES,
+    'S': CharacterSet(WHITESPACES.chars, negated=True),
+}
+
+
+class RegexParser:
+    """A recursive descent parser of the supported subset of regular expressions"""
+
+    def __init__(self, pattern: str):
+        """Parses a regular expression into a tree of tuples
+
+        Supports literals, escapes, character classes, '.', groups, alternations and the quantifiers '*', '+', '?', '{m}', '{m,}' and '{m,n}'. The pattern always matches the whole text, so the anchors '^' and '$' are ignored, and lazy quantifiers are the same as greedy ones. The nodes are ("set", CharacterSet), ("concat", [nodes]), ("alternate", [nodes]) and ("repeat", node, min, max), where max is None if unbounded.
+
+        Args:
+            pattern (str): The regular expression
+        """
+        self.pattern = pattern
+        self.position = 0
+
+    def parse(self) -> tuple:
+        """The tree of the whole pattern, raising a ValueError if it is not a valid regular expression"""
+        node = self.parse_alternation()
+        if self.position != len(self.pattern):
+            raise ValueError(
+                f"Unexpected {self.pattern[self.position]!r} at {self.position} in regex {self.pattern!r}"
+            )
+        return node
+
+    def peek(self) -> Optional[str]:
+        """The next character of the pattern, or None at its end"""
+        return self.pattern[self.position] if self.position < len(self.pattern) else None
+
+    def next(self) -> str:
+        """Consumes the next character of the pattern"""
+        if self.position >= len(self.pattern):
+            raise ValueError(f"Unexpected end of regex {self.pattern!r}")
+        char = self.pattern[self.position]
+        self.position += 1
+        return char
+
+    def parse_alternation(self) -> tuple:
+        """Parses branches separated by '|', up to the end of the pattern or of the group"""
+        branches = [self.parse_concatenation()]
+        while self.peek() == '|':
+            self.next()
+            branches.append(self.parse_concatenation())
+        return branches[0] if len(branches) == 1 else ("alternate", branches)
+
+    def parse_concatenation(self) -> tuple:
+        """Parses a sequence of quantified atoms, up to a '|' or the end of the group"""
+        nodes = []
+        while self.peek() is not None and self.peek() not in '|)':
+            if self.peek() in '^$':
+                self.next()
+                continue
+            nodes.append(self.parse_quantifiers(self.parse_atom()))
+        return ("concat", nodes)
+
+    def parse_quantifiers(self, node: tuple) -> tuple:
+        """Wraps node in a repeat node for each quantifier that follows it"""
+        while self.peek() is not None and self.peek() in '*+?{':
+            char = self.next()
+            if char == '*':
+                node = ("repeat", node, 0, None)
+            elif char == '+':
+                node = ("repeat", node, 1, None)
+            elif char == '?':
+                node = ("repeat", node, 0, 1)
+            else:
+                end = self.pattern.index('}', self.position)
+                bounds = self.pattern[self.position : end].split(',')
+                self.position = end + 1
+                minimum = int(bounds[0]) if bounds[0] else 0
+                if len(bounds) == 1:
+                    maximum = minimum
+                else:
+                    maximum = int(bounds[1]) if bounds[1] else None
+                node = ("repeat", node, minimum, maximum)
+            if self.peek() == '?':
+                # Lazy quantifier
+                self.next()
+        return node
+
+    def parse_atom(self) -> tuple:
+        """Parses a group, a character class, '.', an escape or a literal character"""
+        char = self.next()
+        if char == '(':
+            if self.pattern.startswith('?:', self.position):
+                self.position += 2
+            node = self.parse_alternation()
+            if self.next() != ')':
+                raise ValueError(f"Missing ')' in regex {self.pattern!r}")
+            return node
+        if char == '[':
+            return ("set", self.parse_character_class())
+        if char == '.':
+            return ("set", CharacterSet(chars=frozenset('\n'), negated=True))
+        if char == '\\':
+            escape = self.parse_escape()
+            return (
+                "set",
+                escape if isinstance(escape, CharacterSet) else CharacterSet(frozenset(escape)),
+            )
+        if char in '*+?{':
+            raise ValueError(f"Nothing to repeat at {self.position - 1} in regex {self.pattern!r}")
+        return ("set", CharacterSet(frozenset(char)))
+
+    def parse_escape(self):
+        """The character, or the CharacterSet, of the escape after a backslash"""
+        char = self.next()
+        if char in CHARACTER_SET_ESCAPES:
+            return CHARACTER_SET_ESCAPES[char]
+        if char in CHARACTER_ESCAPES:
+            return CHARACTER_ESCAPES[char]
+        if char in 'xu':
+            num_digits = 2 if char == 'x' else 4
+            code = self.pattern[self.position : self.position + num_digits]
+            self.position += num_digits
+            return chr(int(code, 16))
+        return char
+
+    def parse_character_class(self) -> CharacterSet:
+        """Parses a character class after its '[', up to and including its ']'"""
+        negated = self.peek() == '^'
+        if negated:
+            self.next()
+        chars = set()
+        ranges = []
+        first = True
+        while first or self.peek() != ']':
+            first = False
+            char = self.next()
+            if char == '\\':
+                escape = self.parse_escape()
+                if isinstance(escape, CharacterSet):
+                    assert (
+                        not escape.negated
+                    ), f"Negated escapes in character classes are not supported in regex {self.pattern!r}"
+                    chars |= escape.chars
+                    ranges.extend(escape.ranges)
+                    continue
+                char = escape
+            if self.peek() == '-' and self.pattern[self.position + 1 : self.position + 2] not in (
+                '',
+                ']',
+            ):
+                self.next()
+                high = self.next()
+                if high == '\\':
+                    high = self.parse_escape()
+                ranges.append((char, high))
+            else:
+                chars.add(char)
+        self.next()
+        return CharacterSet(frozenset(chars), tuple(ranges), negated)
+
+
+class RegexAutomaton:
+    """A lazily built deterministic automaton of a regular expression, whose states are integers"""
+
+    def __init__(self, pattern: str):
+        """A deterministic finite automaton that matches a regular expression, one character at a time
+
+        The regular expression is compiled to a nondeterministic automaton (See RegexParser for the supported syntax), and the states of the deterministic automaton, which are sets of states of the nondeterministic automaton, are built lazily as characters are stepped, and memoized.
+
+        Args:
+            pattern (str): The regular expression, which matches the whole text
+        """
+        self.pattern = pattern
+        # The transitions on a character set and the empty transitions of each nondeterministic state
+        self.transitions: List[List[Tuple[CharacterSet, int]]] = []
+        self.empty_transitions: List[List[int]] = []
+        start, self.accept_state = self.build(RegexParser(pattern).parse())
+
+        self.states: List[FrozenSet[int]] = []
+        self.state_ids: Dict[FrozenSet[int], int] = {}
+        self.next_states: Dict[Tuple[int, str], Optional[int]] = {}
+        self.initial_state = self.get_state_id(self.get_closure([start]))
+
+    def new_state(self) -> int:
+        """Adds a state without transitions to the nondeterministic automaton"""
+        self.transitions.append([])
+        self.empty_transitions.append([])
+        return len(self.transitions) - 1
+
+    def build(self, node: tuple) -> Tuple[int, int]:
+        """Builds the nondeterministic automaton of a node of the regular expression
+
+        Returns:
+            Tuple[int, int]: Its start and end states
+        """
+        start, end = self.new_state(), self.new_state()
+        kind = node[0]
+        if kind == "set":
+            self.transitions[start].append((node[1], end))
+        elif kind == "concat":
+            previous = start
+            for child in node[1]:
+                child_start, child_end = self.build(child)
+                self.empty_transitions[previous].append(child_start)
+                previous = child_end
+            self.empty_transitions[previous].append(end)
+        elif kind == "alternate":
+            for child in node[1]:
+                child_start, child_end = self.build(child)
+                self.empty_transitions[start].append(child_start)
+                self.empty_transitions[child_end].append(end)
+        else:
+            _, child, minimum, maximum = node
+            previous = start
+            for _ in range(minimum):
+                child_start, child_end = self.build(child)
+                self.empty_transitions[previous].append(child_start)
+                previous = child_end
+            if maximum is None:
+                child_start, child_end = self.build(child)
+                self.empty_transitions[previous].append(child_start)
+                self.empty_transitions[child_end].append(child_start)
+                self.empty_transitions[child_end].append(end)
+            else:
+                for _ in range(maximum - minimum):
+                    child_start, child_end = self.build(child)
+                    self.empty_transitions[previous].append(child_start)
+                    self.empty_transitions[previous].append(end)
+                    previous = child_end
+            self.empty_transitions[previous].append(end)
+        return start, end
+
+    def get_character_classes(self, chars: List[str]) -> List[int]:
+        """Groups the characters that every character set of the automaton either matches or not, so that each state steps all the characters of a group to the same state
+
+        Args:
+            chars (List[str]): The characters
+
+        Returns:
+            List[int]: The group of each character, numbered in order of first appearance
+        """
+        character_sets = list(
+            {character_set for transitions in self.transitions for character_set, _ in transitions}
+        )
+        classes: Dict[Tuple[bool, ...], int] = {}
+        return [
+            classes.setdefault(
+                tuple(character_set.matches(char) for character_set in character_sets), len(classes)
+            )
+            for char in chars
+        ]
+
+    def get_closure(self, states: List[int]) -> FrozenSet[int]:
+        """The states reachable from states through empty transitions"""
+        closure = set(states)
+        stack = list(states)
+        while len(stack) > 0:
+            for next_state in self.empty_transitions[stack.pop()]:
+                if next_state not in closure:
+                    closure.add(next_state)
+                    stack.append(next_state)
+        return frozenset(closure)
+
+    def get_state_id(self, states: FrozenSet[int]) -> int:
+        """The deterministic state of a set of nondeterministic states, added if it is new"""
+        if states not in self.state_ids:
+            self.state_ids[states] = len(self.states)
+            self.states.append(states)
+        return self.state_ids[states]
+
+    def step(self, state: int, char: str) -> Optional[int]:
+        """The state after a character, or None if no text starting with the characters so far matches"""
+        key = (state, char)
+        if key not in self.next_states:
+            next_states = [
+                next_state
+                for nfa_state in self.states[state]
+                for character_set, next_state in self.transitions[nfa_state]
+                if character_set.matches(char)
+            ]
+            self.next_states[key] = (
+                self.get_state_id(self.get_closure(next_states)) if len(next_states) > 0 else None
+            )
+        return self.next_states[key]
+
+    def is_accepting(self, state: int) -> bool:
+        """Whether the characters so far match the regular expression"""
+        return self.accept_state in self.states[state]
+
+    def matches(self, text: str) -> bool:
+        """Whether the whole text matches the regular expression"""
+        state = self.initial_state
+        for char in text:
+            state = self.step(state, char)
+            if state is None:
+                return False
+        return self.is_accepting(state)
+
+
+# The JSON values, without whitespace
+JSON_STRING_CHARACTER = r'([^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})'
+JSON_INTEGER = r'-?(0|[1-9][0-9]*)'
+JSON_NUMBER = JSON_INTEGER + r'(\.[0-9]+)?([eE][+-]?[0-9]+)?'
+REGEX_SPECIAL_CHARACTERS = frozenset('\\.^$|?*+()[]{}')
+
+
+def escape_regex(text: str) -> str:
+    """A regular expression that matches text literally"""
+    return ''.join('\\' + char if char in REGEX_SPECIAL_CHARACTERS else char for char in text)
+
+
+def json_schema_to_regex(schema: dict, whitespace: str = r'[ ]?') -> str:
+    """A regular expression that matches the JSON values of a JSON schema
+
+    Supports the types "string" (with "minLength" and "maxLength"), "integer", "number", "boolean", "null", "array" (with "items", "minItems" and "maxItems") and "object" (with "properties"), and "enum", "const", "anyOf" and "oneOf". Every property of an object is generated, in the order of the schema, which is valid whether or not the property is required.
+
+    Args:
+        schema (dict): The JSON schema
+        whitespace (str, optional): The regular expression of the whitespace allowed around the separators. Defaults to an optional space.
+
+    Returns:
+        str: The regular expression
+    """
+    if "const" in schema:
+        return escape_regex(json.dumps(schema["const"]))
+    if "enum" in schema:
+        return '(' + '|'.join(escape_regex(json.dumps(value)) for value in schema["enum"]) + ')'
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            return (
+                '('
+                + '|'.join(json_schema_to_regex(option, whitespace) for option in schema[key])
+                + ')'
+            )
+
+    schema_type = schema.get("type")
+    if schema_type == "string":
+        minimum = schema.get("minLength", 0)
+        maximum = schema.get("maxLength")
+        return f'"{JSON_STRING_CHARACTER}{{{minimum},{"" if maximum is None else maximum}}}"'
+    if schema_type == "integer":
+        return JSON_INTEGER
+    if schema_type == "number":
+        return JSON_NUMBER
+    if schema_type == "boolean":
+        return '(true|false)'
+    if schema_type == "null":
+        return 'null'
+    if schema_type == "array":
+        item = json_schema_to_regex(schema.get("items", {"type": "string"}), whitespace)
+        minimum = schema.get("minItems", 0)
+        maximum = schema.get("maxItems")
+        if maximum == 0:
+            return rf'\[{whitespace}\]'
+        repeats = f'{{{max(minimum - 1, 0)},{"" if maximum is None else maximum - 1}}}'
+        items = f'{item}({whitespace},{whitespace}{item}){repeats}'
+        if minimum == 0:
+            items = f'({items})?'
+        return rf'\[{whitespace}{items}{whitespace}\]'
+    if schema_type == "object":
+        properties = [
+            f'{escape_regex(json.dumps(name))}{whitespace}:{whitespace}'
+            + json_schema_to_regex(property_schema, whitespace)
+            for name, property_schema in schema.get("properties", {}).items()
+        ]
+        return (
+            rf'\{{{whitespace}'
+            + f'{whitespace},{whitespace}'.join(properties)
+            + rf'{whitespace}\}}'
+        )
+    raise ValueError(f"Unsupported JSON schema {schema}")
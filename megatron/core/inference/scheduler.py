@@ -1,8 +1,10 @@
 # Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+import heapq
+import math
 import time
 import typing
-from collections import OrderedDict
-from typing import Dict, List
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Tuple
 
 import torch
 
@@ -10,21 +12,47 @@ from megatron.core.inference.common_inference_params import CommonInferenceParam
 from megatron.core.inference.inference_request import InferenceRequest, Status
 from megatron.core.inference.utils import Counter
 
+# The orders in which waiting requests of the same priority are admitted (See Scheduler)
+SCHEDULING_POLICIES = ("fifo", "earliest_deadline", "shortest_remaining_work")
+
 
 class Scheduler:
-    def __init__(self, max_batch_size: int):
+    def __init__(
+        self,
+        max_batch_size: int,
+        scheduling_policy: str = "fifo",
+        max_kv_cache_tokens: int = None,
+        max_queue_time_samples: int = 10000,
+    ):
         """Scheduler for handling requests to inference engine
 
         This class is responsible for handing of all the incomign requests
 
+        Waiting requests are admitted by decreasing priority (See CommonInferenceParams.priority), and within a priority in the order of the scheduling policy: "fifo" admits them in arrival order, "earliest_deadline" by deadline (See CommonInferenceParams.deadline), the requests without a deadline last, and "shortest_remaining_work" by prompt length plus number of tokens to generate. A request is admitted when there is a free kv cache slot, and if max_kv_cache_tokens is set, when the estimated kv cache tokens of the active requests (prompt length plus number of tokens to generate) leave room for its own. Admission never skips the next request in order, so that long requests are not starved by shorter ones.
+
         Args:
             max_batch_size (int): The max batch size that we can pass to the inference engine at a time.
+            scheduling_policy (str, optional): The order of the waiting requests within a priority, one of SCHEDULING_POLICIES. Defaults to "fifo".
+            max_kv_cache_tokens (int, optional): The maximum estimated number of kv cache tokens of the active requests. Defaults to None, in which case only max_batch_size limits admission.
+            max_queue_time_samples (int, optional): The number of most recent queue times kept for the metrics (See get_queue_time_metrics). Defaults to 10000.
         """
+        assert (
+            scheduling_policy in SCHEDULING_POLICIES
+        ), f"Unknown scheduling policy {scheduling_policy}, expected one of {SCHEDULING_POLICIES}"
         self.max_batch_size = max_batch_size
+        self.scheduling_policy = scheduling_policy
+        self.max_kv_cache_tokens = max_kv_cache_tokens
         self.active_request_pool: Dict[int, InferenceRequest] = OrderedDict()
         self.waiting_request_pool: Dict[int, InferenceRequest] = OrderedDict()
         self.completed_request_pool: Dict[int, InferenceRequest] = OrderedDict()
         self.request_counter = Counter()
+        # Each active request gets one of the max_batch_size kv cache slots (used for dynamic batching)
+        self.free_kv_cache_slots: List[int] = list(range(max_batch_size))
+        # The waiting requests ordered by admission key (See get_admission_key)
+        self.waiting_request_heap: List[Tuple[tuple, str]] = []
+        self.active_kv_cache_tokens = 0
+        # The time between the arrival and the admission of the most recently admitted requests
+        self.queue_times: Deque[float] = deque(maxlen=max_queue_time_samples)
 
     def add_request(
         self,
@@ -35,38 +63,60 @@ class Scheduler:
     ):
         """Add an incoming request
 
-        This method will add the request to either the active pool or the waiting pool depending on the batch size.
+        This method will add the request to the waiting pool, and admit the waiting requests to the active pool while there is room for them.
 
         Args:
             prompt (str): Input prompt string
             prompt_tokens (torch.Tensor): A torch tensor having the input prompts tokenized
             inference_parameters (CommonInferenceParams): The inference parameters
             arrival_time (float, optional): The incoming request time. Defaults to None.
+
+        Returns:
+            str: The request id of the added request
         """
         request_id = str(next(self.request_counter))
 
         if arrival_time is None:
             arrival_time = time.time()
 
-        status = (
-            Status.ACTIVE_BUT_NOT_GENERATING_TOKENS
-            if len(self.active_request_pool) < self.max_batch_size
-            else Status.WAITING_IN_QUEUE
-        )
-
         inference_request = InferenceRequest(
             request_id=request_id,
             prompt=prompt,
             inference_parameters=inference_parameters,
             arrival_time=arrival_time,
             prompt_tokens=prompt_tokens,
-            status=status,
+            status=Status.WAITING_IN_QUEUE,
+        )
+        self.waiting_request_pool[request_id] = inference_request
+        heapq.heappush(
+            self.waiting_request_heap, (self.get_admission_key(inference_request), request_id)
         )
+        self.admit_waiting_requests()
 
-        if status == status.ACTIVE_BUT_NOT_GENERATING_TOKENS:
-            self.active_request_pool[request_id] = inference_request
-        else:
-            self.waiting_request_pool[request_id] = inference_request
+        return request_id
+
+    def get_admission_key(self, request: InferenceRequest) -> tuple:
+        """The key by which the waiting requests are admitted, in increasing order
+
+        Args:
+            request (InferenceRequest): A waiting request
+
+        Returns:
+            tuple: The negated priority, then the key of the scheduling policy, then the request id
+        """
+        inference_parameters = request.inference_parameters
+        # The request ids are in arrival order, and unlike the arrival times they are the same on all the ranks
+        policy_key = 0
+        if self.scheduling_policy == "earliest_deadline":
+            deadline = inference_parameters.deadline
+            policy_key = math.inf if deadline is None else deadline
+        elif self.scheduling_policy == "shortest_remaining_work":
+            policy_key = self.get_kv_cache_tokens(request)
+        return (-inference_parameters.priority, policy_key, int(request.request_id))
+
+    def get_kv_cache_tokens(self, request: InferenceRequest) -> int:
+        """The estimated kv cache tokens of a request, which are its prompt plus the tokens to generate"""
+        return len(request.prompt_tokens) + request.inference_parameters.num_tokens_to_generate
 
     def have_requests_pending(self) -> bool:
         """Method to check if there are requests pending
@@ -76,26 +126,37 @@ class Scheduler:
         num_requests_pending = len(self.active_request_pool) + len(self.waiting_request_pool)
         return num_requests_pending > 0
 
-    def add_earliest_waiting_request_to_active_pool(self):
-        """Utility to add the waiting request to active pool
+    def admit_waiting_requests(self):
+        """Adds the waiting requests to the active pool, in the order of their admission keys, while there are free kv cache slots and kv cache tokens
 
-        This method will add the earliest request (FIFO) that is in the waiting request pool to the active request pool.
+        A request that needs more than max_kv_cache_tokens is admitted alone, when there is no active request.
         """
-        assert (
-            len(self.active_request_pool) < self.max_batch_size
-        ), "Active request pool is already full. Cant add any more requests"
-        if len(self.waiting_request_pool) > 0:
-            (earliest_waiting_request_request_id, earliest_waiting_request) = (
-                self.waiting_request_pool.popitem(last=False)
-            )
-            earliest_waiting_request.status = Status.ACTIVE_BUT_NOT_GENERATING_TOKENS
-            self.active_request_pool[earliest_waiting_request_request_id] = earliest_waiting_request
+        while len(self.waiting_request_heap) > 0 and len(self.free_kv_cache_slots) > 0:
+            _, request_id = self.waiting_request_heap[0]
+            request = self.waiting_request_pool[request_id]
+            kv_cache_tokens = self.get_kv_cache_tokens(request)
+            if (
+                self.max_kv_cache_tokens is not None
+                and len(self.active_request_pool) > 0
+                and self.active_kv_cache_tokens + kv_cache_tokens > self.max_kv_cache_tokens
+            ):
+                break
+
+            heapq.heappop(self.waiting_request_heap)
+            del self.waiting_request_pool[request_id]
+            request.status = Status.ACTIVE_BUT_NOT_GENERATING_TOKENS
+            request.kv_cache_slot = self.free_kv_cache_slots.pop(0)
+            request.admission_time = time.time()
+            self.queue_times.append(request.admission_time - request.arrival_time)
+            self.active_kv_cache_tokens += kv_cache_tokens
+            self.active_request_pool[request_id] = request
 
     def update_requests_pools(self, result_dict: typing.OrderedDict[int, InferenceRequest] = None):
         """Update request pool status
 
         This method will full up the active request pool, if it has less than max batch size elements from the waiting request pool.
-        If provided with a request dict, it will put the completed requests into the completed request pool and add waiting request into active pool.
+        If provided with a request dict, it will put the completed requests into the completed request pool, release their kv cache slots and add waiting request into active pool.
+        With dynamic batching this is called after every step, so waiting requests join the batch as soon as a slot is free.
 
         Args:
             result (typing.OrderedDict[int, InferenceRequest], optional): The result returned by the engine. A dictionary with keys as the request ids, and values as the requests. Defaults to None
@@ -106,11 +167,26 @@ class Scheduler:
             # If a request has completed put it into the completed request pool.
             if active_request.status == Status.COMPLETED:
                 completed_request = self.active_request_pool.pop(result_request_id)
+                self.free_kv_cache_slots.append(completed_request.kv_cache_slot)
+                self.active_kv_cache_tokens -= self.get_kv_cache_tokens(completed_request)
                 self.completed_request_pool[result_request_id] = completed_request
 
-        # If the active request pool is not full, add waiting requests in FIFO order
-        while (
-            len(self.active_request_pool) < self.max_batch_size
-            and len(self.waiting_request_pool) > 0
-        ):
-            self.add_earliest_waiting_request_to_active_pool()
+        # Add the waiting requests in the order of the scheduling policy
+        self.admit_waiting_requests()
+
+    def get_queue_time_metrics(self) -> Dict[str, float]:
+        """Statistics of the time between the arrival and the admission of the most recently admitted requests
+
+        Returns:
+            Dict[str, float]: The number of queue times, their mean, median, 90th and 99th percentiles and maximum in seconds, and the number of waiting requests. The statistics are 0 if no request was admitted yet.
+        """
+        metrics = {"num_waiting_requests": len(self.waiting_request_pool)}
+        queue_times = sorted(self.queue_times)
+        metrics["num_samples"] = len(queue_times)
+        if len(queue_times) == 0:
+            queue_times = [0.0]
+        metrics["mean"] = sum(queue_times) / len(queue_times)
+        for name, quantile in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            metrics[name] = queue_times[min(int(quantile * len(queue_times)), len(queue_times) - 1)]
+        metrics["max"] = queue_times[-1]
+        return metrics
@@ -1,20 +1,133 @@
 # Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
-from typing import List, OrderedDict, Tuple
+from concurrent.futures import Future
+from dataclasses import dataclass, field, replace
+from typing import Any, Callable, Dict, List, Optional, OrderedDict, Tuple
 
 import torch
 import torch.nn.functional as F
 
 from megatron.core import parallel_state
 from megatron.core.inference.common_inference_params import CommonInferenceParams
-from megatron.core.inference.communication_utils import broadcast_from_last_pipeline_stage
+from megatron.core.inference.communication_utils import (
+    broadcast_from_last_pipeline_stage,
+    send_recv_pipeline_stages_,
+)
+from megatron.core.inference.detokenizer import DetokenizationWorker
 from megatron.core.inference.inference_request import InferenceRequest, Status
+from megatron.core.inference.kv_cache_block_allocator import (
+    KVCacheBlockAllocator,
+    PrefixCachingKVCacheBlockAllocator,
+)
+from megatron.core.inference.logits_processors import LogitsProcessor
 from megatron.core.inference.model_inference_wrappers.abstract_model_inference_wrapper import (
     AbstractModelInferenceWrapper,
 )
 
 
+@dataclass
+class SamplingParamsPerRow:
+    """The sampling parameters of a batch of requests in per row tensors, with the decisions that depend on them made on the host, so that sampling does not sync with the device"""
+
+    temperature: torch.Tensor
+    """The temperature of each row, with [batch_size] elements"""
+
+    top_k: torch.Tensor
+    """The top_k of each row, with [batch_size] elements. 0 disables top-k filtering."""
+
+    top_p: torch.Tensor
+    """The top_p of each row, with [batch_size] elements. 0 disables top-p filtering."""
+
+    max_top_k: int = 0
+    """The largest top_k of the rows"""
+
+    has_top_p: bool = False
+    """Whether any row has top-p filtering"""
+
+    has_greedy: bool = False
+    """Whether any row is greedy (i.e) has top_k 1"""
+
+    all_greedy: bool = False
+    """Whether all the rows are greedy"""
+
+    @staticmethod
+    def from_inference_params(params: List[CommonInferenceParams]) -> "SamplingParamsPerRow":
+        """Validates the inference parameters of each row, and gathers them in per row tensors
+
+        Args:
+            params (List[CommonInferenceParams]): The inference parameters of each row
+
+        Returns:
+            SamplingParamsPerRow: The sampling parameters of the rows
+        """
+        assert not any(
+            p.top_k > 0 and p.top_p > 0 for p in params
+        ), 'Cannot have top-p and top-k both greater than zero'
+        assert all(p.top_p <= 1.0 for p in params), 'top-p should be in (0,1]'
+        device = torch.cuda.current_device()
+        return SamplingParamsPerRow(
+            temperature=torch.tensor(
+                [p.temperature for p in params], dtype=torch.float32, device=device
+            ),
+            top_k=torch.tensor([p.top_k for p in params], dtype=torch.long, device=device),
+            top_p=torch.tensor([p.top_p for p in params], dtype=torch.float32, device=device),
+            max_top_k=max((p.top_k for p in params), default=0),
+            has_top_p=any(p.top_p > 0.0 for p in params),
+            has_greedy=any(p.top_k == 1 for p in params),
+            all_greedy=all(p.top_k == 1 for p in params),
+        )
+
+    def select(self, rows: torch.Tensor, repeats: int = 1) -> "SamplingParamsPerRow":
+        """The sampling parameters of a subset of the rows, each repeated a number of times
+
+        The host side decisions of the full batch are kept, since they still hold for any subset of its rows, except that all_greedy might be False while the subset is all greedy.
+
+        Args:
+            rows (torch.Tensor): The indices of the rows
+            repeats (int, optional): The number of consecutive copies of each row. Defaults to 1.
+
+        Returns:
+            SamplingParamsPerRow: The sampling parameters of the selected rows
+        """
+        return replace(
+            self,
+            temperature=self.temperature[rows].repeat_interleave(repeats),
+            top_k=self.top_k[rows].repeat_interleave(repeats),
+            top_p=self.top_p[rows].repeat_interleave(repeats),
+        )
+
+
+@dataclass
+class DynamicBatchRequestState:
+    """The state of a request that is being generated with dynamic batching"""
+
+    sequence_length: int = 0
+    """Number of tokens of the request in the kv cache"""
+
+    generated_tokens: List[int] = field(default_factory=list)
+    generated_log_probs: List[float] = field(default_factory=list)
+
+    is_prefilled: bool = False
+    """Whether the prompt of the request is in the kv cache, and the request is generating tokens"""
+
+    block_table: List[int] = field(default_factory=list)
+    """The kv cache blocks of the request, with a paged kv cache"""
+
+    generator: Optional[torch.Generator] = None
+    """The random generator of the request, if it has a seed"""
+
+    logits_processor_state: Any = None
+    """The state of the logits processor of the request, if it has one"""
+
+
 class SimpleTextGenerationController:
-    def __init__(self, inference_wrapped_model: AbstractModelInferenceWrapper, tokenizer):
+    """Generates tokens for batches of requests with a model, in static or dynamic batches"""
+
+    def __init__(
+        self,
+        inference_wrapped_model: AbstractModelInferenceWrapper,
+        tokenizer,
+        detokenize_in_background: bool = False,
+    ):
         """The basic text generation controller
 
         This class is responsible for tokenizing the input , running the inference, sampling and also detokenizing the output
@@ -22,9 +135,11 @@ class SimpleTextGenerationController:
         Args:
             inference_wrapped_model (AbstractModelInferenceWrapper): A model that is wrapped using the specs given in the abstract_model_inference_wrapper.py
             tokenizer (_type_): Tokenizer used for tokenizing and detokenizing the prompts
+            detokenize_in_background (bool, optional): If True, the generated texts of the completed requests are detokenized on a worker thread, which overlaps with the next steps. The texts are only set once synchronize_detokenization returns. Defaults to False.
         """
         self.inference_wrapped_model = inference_wrapped_model
         self.tokenizer = tokenizer
+        self.detokenization_worker = DetokenizationWorker() if detokenize_in_background else None
 
         # For models without pipeline parallelism, is_first_stage and is_last_stage returns True
         self.model_is_pipeline_parallel = not (
@@ -54,6 +169,42 @@ class SimpleTextGenerationController:
         tokens = prompt_tokens_with_generated_tokens.cpu().numpy().tolist()
         return self.tokenizer.detokenize(tokens)
 
+    def run_detokenization(self, job: Callable, *args) -> Future:
+        """Runs a detokenization job on the worker thread with detokenize_in_background, or else right away
+
+        Args:
+            job (Callable): The job, which must only read tokens that are not modified afterwards
+
+        Returns:
+            Future: The future of the result of job(*args)
+        """
+        if self.detokenization_worker is not None:
+            return self.detokenization_worker.submit(job, *args)
+        future = Future()
+        future.set_result(job(*args))
+        return future
+
+    def detokenize_requests(
+        self, requests: List[InferenceRequest], generated_tokens: List[List[int]]
+    ):
+        """Sets the generated texts of completed requests (See run_detokenization)
+
+        Args:
+            requests (List[InferenceRequest]): The completed requests
+            generated_tokens (List[List[int]]): The generated tokens of each request, on the cpu
+        """
+
+        def detokenize():
+            for request, tokens in zip(requests, generated_tokens):
+                request.generated_text = self.tokenizer.detokenize(tokens)
+
+        self.run_detokenization(detokenize)
+
+    def synchronize_detokenization(self):
+        """Waits for the generated texts detokenized on the worker thread"""
+        if self.detokenization_worker is not None:
+            self.detokenization_worker.synchronize()
+
     def sample_from_logits(
         self,
         last_token_logits: torch.Tensor,
@@ -131,6 +282,202 @@ class SimpleTextGenerationController:
                 sampled_logits = torch.clamp(sampled_logits, min=0, max=(vocab_size - 1))
         return sampled_logits
 
+    def get_sampling_generator(
+        self, common_inference_params: CommonInferenceParams
+    ) -> Optional[torch.Generator]:
+        """Returns a random generator seeded with the seed of a request, or None if the request has no seed
+
+        Args:
+            common_inference_params (CommonInferenceParams): The inference parameters of the request
+
+        Returns:
+            Optional[torch.Generator]: The random generator to sample the tokens of the request
+        """
+        seed = getattr(common_inference_params, 'seed', None)
+        if seed is None:
+            return None
+        generator = torch.Generator(device=torch.cuda.current_device())
+        generator.manual_seed(seed)
+        return generator
+
+    def get_logits_processor(self, request: InferenceRequest) -> Optional[LogitsProcessor]:
+        """The logits processor of a request, if it has one (See CommonInferenceParams)"""
+        return getattr(request.inference_parameters, 'logits_processor', None)
+
+    def get_initial_logits_processor_state(self, request: InferenceRequest) -> Any:
+        """The state of the logits processor of a request before its first generated token, or None if it has none"""
+        logits_processor = self.get_logits_processor(request)
+        return None if logits_processor is None else logits_processor.get_initial_state()
+
+    def apply_logits_processors(
+        self,
+        last_token_logits: torch.Tensor,
+        requests: List[InferenceRequest],
+        logits_processor_states: List[Any],
+    ) -> torch.Tensor:
+        """Applies the logits processors of the requests to their rows, with one call per logits processor for all its rows
+
+        Args:
+            last_token_logits (torch.Tensor): The last token logits. A tensor of size [batch_size, vocab_size]
+            requests (List[InferenceRequest]): The request of each row
+            logits_processor_states (List[Any]): The logits processor state of each row
+
+        Returns:
+            torch.Tensor: The processed logits, which are a copy of last_token_logits if any request has a logits processor
+        """
+        # The requests of a processor usually share the same instance
+        rows_per_processor: Dict[int, Tuple[LogitsProcessor, List[int]]] = {}
+        for row, request in enumerate(requests):
+            logits_processor = self.get_logits_processor(request)
+            if logits_processor is None:
+                continue
+            if id(logits_processor) not in rows_per_processor:
+                rows_per_processor[id(logits_processor)] = (logits_processor, [])
+            rows_per_processor[id(logits_processor)][1].append(row)
+        if len(rows_per_processor) == 0:
+            return last_token_logits
+
+        last_token_logits = last_token_logits.clone()
+        for logits_processor, rows in rows_per_processor.values():
+            row_indices = torch.tensor(rows, device=last_token_logits.device)
+            last_token_logits[row_indices] = logits_processor.process_logits(
+                last_token_logits[row_indices], [logits_processor_states[row] for row in rows]
+            )
+        return last_token_logits
+
+    def update_logits_processor_state(
+        self, request: InferenceRequest, logits_processor_state: Any, token: int
+    ) -> Any:
+        """The logits processor state of a request after it generated a token"""
+        logits_processor = self.get_logits_processor(request)
+        if logits_processor is None or token == self.tokenizer.eod:
+            return logits_processor_state
+        return logits_processor.update_state(logits_processor_state, token)
+
+    def get_sampling_params_per_row(self, requests: List[InferenceRequest]) -> SamplingParamsPerRow:
+        """Gathers the sampling parameters of a batch of requests in per row tensors
+
+        Args:
+            requests (List[InferenceRequest]): The request of each row
+
+        Returns:
+            SamplingParamsPerRow: The sampling parameters of the rows
+        """
+        return SamplingParamsPerRow.from_inference_params(
+            [request.inference_parameters for request in requests]
+        )
+
+    def get_probabilities_per_row(
+        self,
+        last_token_logits: torch.Tensor,
+        sampling_params: SamplingParamsPerRow,
+        vocab_size: int = None,
+    ) -> torch.Tensor:
+        """Computes the sampling distribution of each row, with its own sampling parameters
+
+        The logits of each row are divided by its temperature, and filtered with its top-k or top-p. Rows with top_k 1 are greedy, and their distribution is one hot.
+
+        Args:
+            last_token_logits (torch.Tensor): The last token logits. A tensor of size [batch_size, vocab_size]
+            sampling_params (SamplingParamsPerRow): The sampling parameters of each row
+            vocab_size (int): Obtained from the tokenizer. Defaults to None
+
+        Returns:
+            torch.Tensor: The probabilities of shape [batch_size, vocab_size]
+        """
+        top_k, top_p = sampling_params.top_k, sampling_params.top_p
+        logits = last_token_logits / sampling_params.temperature.unsqueeze(1)
+
+        max_top_k = sampling_params.max_top_k
+        if max_top_k > 1:
+            assert max_top_k <= logits.size(1), 'top-k is larger than logit size.'
+            if vocab_size:
+                assert max_top_k < vocab_size, 'top-k is larger than vocab size.'
+            # Set the logits for none top-k values to -inf, for the rows with top-k filtering.
+            top_k_logits = torch.topk(logits, max_top_k)[0]
+            kth_logits = top_k_logits.gather(1, (top_k - 1).clamp(min=0).unsqueeze(1))
+            filter_ = (logits < kth_logits) & (top_k > 1).unsqueeze(1)
+            logits.masked_fill_(filter_, float('-Inf'))
+
+        if sampling_params.has_top_p:
+            # Set the logits for none top-p values to -inf, for the rows with top-p filtering.
+            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+            cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            filter_ = cumulative_probs > top_p.unsqueeze(1)
+            # Same shift by 1 as sample_from_logits.
+            filter_[:, 1:] = filter_[:, :-1].clone()
+            # Make sure we at least have one token to select from.
+            filter_[..., 0] = 0
+            filter_ &= (top_p > 0.0).unsqueeze(1)
+            filter_ = filter_.scatter(1, sorted_indices, filter_)
+            logits.masked_fill_(filter_, float('-Inf'))
+
+        # After filtering, we need to recalculate the distribution.
+        probabilities = logits.softmax(dim=-1)
+
+        if sampling_params.has_greedy:
+            greedy_probabilities = F.one_hot(
+                torch.argmax(last_token_logits, dim=-1), num_classes=probabilities.size(1)
+            ).to(probabilities.dtype)
+            probabilities = torch.where(
+                (top_k == 1).unsqueeze(1), greedy_probabilities, probabilities
+            )
+        return probabilities
+
+    def sample_from_probabilities(
+        self, probabilities: torch.Tensor, generators: List[Optional[torch.Generator]] = None
+    ) -> torch.Tensor:
+        """Samples one token per row with the exponential race (i.e) the argmax of the probabilities divided by exponential noise
+
+        The noise of the rows with a random generator (See get_sampling_generator) is drawn from it, so that the samples of a seeded request do not depend on the other requests of the batch.
+
+        Args:
+            probabilities (torch.Tensor): The probabilities of shape [batch_size, vocab_size]
+            generators (List[Optional[torch.Generator]], optional): The random generator of each row, or None to use the default generator. Defaults to None.
+
+        Returns:
+            torch.Tensor: 1D tensor of the samples with [batch_size] elements
+        """
+        noise = torch.empty_like(probabilities).exponential_()
+        if generators is not None:
+            for row, generator in enumerate(generators):
+                if generator is not None:
+                    noise[row].exponential_(generator=generator)
+        return torch.argmax(probabilities / noise, dim=-1)
+
+    def sample_from_logits_per_row(
+        self,
+        last_token_logits: torch.Tensor,
+        sampling_params: SamplingParamsPerRow,
+        generators: List[Optional[torch.Generator]] = None,
+        vocab_size: int = None,
+    ) -> torch.Tensor:
+        """Samples the logits of a batch of requests, each with its own sampling parameters
+
+        Same as sample_from_logits, with per row tensors of parameters, so that requests with different parameters share a batch. See get_probabilities_per_row and sample_from_probabilities.
+
+        Args:
+            last_token_logits (torch.Tensor): The last token logits. A tensor of size [batch_size, vocab_size]
+            sampling_params (SamplingParamsPerRow): The sampling parameters of each row (See get_sampling_params_per_row)
+            generators (List[Optional[torch.Generator]], optional): The random generator of each row, or None to use the default generator. Defaults to None.
+            vocab_size (int): Obtained from the tokenizer. Defaults to None
+
+        Returns:
+            torch.Tensor: 1D tensor of the sampled logits with [batch_size] elements
+        """
+        if sampling_params.all_greedy:
+            return torch.argmax(last_token_logits, dim=-1)
+
+        probabilities = self.get_probabilities_per_row(
+            last_token_logits, sampling_params, vocab_size
+        )
+        sampled_logits = self.sample_from_probabilities(probabilities, generators)
+
+        # If vocab size is provided, make sure the samples are in in the range [0, vocab-size).
+        if vocab_size:
+            sampled_logits = torch.clamp(sampled_logits, min=0, max=(vocab_size - 1))
+        return sampled_logits
+
     def update_generation_status(
         self,
         updated_prompts_tokens: torch.Tensor,
@@ -188,6 +535,175 @@ class SimpleTextGenerationController:
 
         return torch.tensor(batch_prompt_tokens_list).cuda()
 
+    def prep_model_for_dynamic_batch(
+        self,
+        max_batch_size: int,
+        max_sequence_length: int,
+        num_kv_cache_blocks: int = None,
+        kv_cache_block_size: int = 16,
+        enable_prefix_caching: bool = False,
+        max_cached_prefix_blocks: int = None,
+        max_tokens_per_step: int = None,
+        num_pipelined_decode_steps: int = None,
+    ):
+        """Prepare the model and the controller for generating with dynamic batching
+
+        Args:
+            max_batch_size (int): The maximum number of active requests (i.e) The number of kv cache slots.
+            max_sequence_length (int): The maximum number of prompt plus generated tokens of a request.
+            num_kv_cache_blocks (int, optional): If set, use a paged kv cache with this number of blocks shared by all the requests, instead of a dense kv cache of max_sequence_length tokens per request. Requests get blocks as their sequences grow, and if the pool runs out, the most recent requests are preempted and recomputed later. Defaults to None.
+            kv_cache_block_size (int, optional): The number of tokens per block of the paged kv cache. Defaults to 16.
+            enable_prefix_caching (bool, optional): Reuse the kv cache blocks of the prompt prefixes shared by several requests (e.g.) a common system prompt, so that the prefill of a request starts after its longest cached prefix. Requires the paged kv cache. Defaults to False.
+            max_cached_prefix_blocks (int, optional): The maximum number of cached prefix blocks that are kept when no request uses them, evicted in least recently used order. Defaults to None, in which case they are only evicted when the pool runs out.
+            max_tokens_per_step (int, optional): If set, enables chunked prefill: each step runs one token for each generating request, and fills the rest of this token budget with chunks of the prompts to prefill, in the same forward pass. This bounds the latency of a step while long prompts are admitted. Defaults to None, in which case a step either prefills the whole prompts of the new requests, or generates one token for each request.
+            num_pipelined_decode_steps (int, optional): If set, with a pipeline parallel model and a dense kv cache, the steps without prefill generate up to this number of tokens per request, with groups of requests in flight on all the pipeline stages (See generate_output_tokens_pipelined_decode). The requests that arrive in the meantime join the batch after these steps. Defaults to None, in which case each step generates one token per request.
+        """
+        assert (
+            num_pipelined_decode_steps is None or num_pipelined_decode_steps > 0
+        ), "The number of pipelined decode steps should be positive"
+        self.num_pipelined_decode_steps = num_pipelined_decode_steps
+        assert (
+            max_tokens_per_step is None or max_tokens_per_step > max_batch_size
+        ), "The token budget of a step should leave room for prefill after one token per request"
+        self.max_tokens_per_step = max_tokens_per_step
+        self.kv_cache_block_allocator = None
+        self.enable_prefix_caching = enable_prefix_caching
+        if num_kv_cache_blocks is not None:
+            assert (
+                num_kv_cache_blocks * kv_cache_block_size >= max_sequence_length
+            ), "The paged kv cache should be able to store at least one sequence of max_sequence_length tokens"
+            if enable_prefix_caching:
+                self.kv_cache_block_allocator = PrefixCachingKVCacheBlockAllocator(
+                    num_kv_cache_blocks, kv_cache_block_size, max_cached_prefix_blocks
+                )
+            else:
+                self.kv_cache_block_allocator = KVCacheBlockAllocator(
+                    num_kv_cache_blocks, kv_cache_block_size
+                )
+        else:
+            assert not enable_prefix_caching, "Prefix caching requires a paged kv cache"
+
+        # The rows of a step are padded to the longest row, which can start at another sequence offset
+        if max_tokens_per_step is not None:
+            max_padding_length = max_tokens_per_step
+        elif enable_prefix_caching:
+            max_padding_length = max_sequence_length
+        else:
+            max_padding_length = 0
+
+        self.inference_wrapped_model.prep_model_for_dynamic_inference(
+            max_batch_size=max_batch_size,
+            max_sequence_length=max_sequence_length,
+            num_kv_cache_blocks=num_kv_cache_blocks,
+            kv_cache_block_size=kv_cache_block_size,
+            max_padding_length=max_padding_length,
+        )
+        self.max_sequence_length = max_sequence_length
+        self.dynamic_batch_states: Dict[str, DynamicBatchRequestState] = {}
+
+    def get_dynamic_batch_prefill_tokens(self, request: InferenceRequest) -> List[int]:
+        """The tokens to prefill for a request, which are the prompt tokens, plus the tokens generated before it was preempted except the last one (which is the input of the next decode step)
+
+        Args:
+            request (InferenceRequest): The request to prefill
+
+        Returns:
+            List[int]: The tokens to prefill
+        """
+        state = self.dynamic_batch_states.get(request.request_id)
+        prefill_tokens = list(request.prompt_tokens)
+        if state is not None and len(state.generated_tokens) > 0:
+            prefill_tokens += state.generated_tokens[:-1]
+        return prefill_tokens
+
+    def allocate_kv_cache_blocks_for_prefill(
+        self, requests: List[InferenceRequest]
+    ) -> List[InferenceRequest]:
+        """Allocates the paged kv cache blocks for the prefill of requests, in order, until the pool runs out
+
+        The blocks of the whole prefill are allocated when it starts, so that a chunked prefill always completes. With prefix caching, the block table of a request starts with the cached blocks of its longest cached prefix, and only the blocks of the remaining tokens are allocated.
+
+        Args:
+            requests (List[InferenceRequest]): The requests that need a prefill
+
+        Returns:
+            List[InferenceRequest]: The requests that got their blocks. The others wait for running requests to free blocks.
+        """
+        scheduled_requests = []
+        out_of_blocks = False
+        for request in requests:
+            state = self.dynamic_batch_states.setdefault(
+                request.request_id, DynamicBatchRequestState()
+            )
+            if len(state.block_table) > 0:
+                # The chunked prefill of the request has started
+                scheduled_requests.append(request)
+                continue
+            if out_of_blocks:
+                continue
+
+            prefill_tokens = self.get_dynamic_batch_prefill_tokens(request)
+            if self.enable_prefix_caching:
+                # At least the last token is prefilled, to get the logits of the next token
+                block_hashes = self.kv_cache_block_allocator.get_block_hashes(prefill_tokens[:-1])
+                state.block_table = self.kv_cache_block_allocator.match_prefix(block_hashes)
+                state.sequence_length = (
+                    len(state.block_table) * self.kv_cache_block_allocator.block_size
+                )
+            if not self.kv_cache_block_allocator.extend_block_table(
+                state.block_table, len(prefill_tokens)
+            ):
+                self.kv_cache_block_allocator.free(state.block_table)
+                state.block_table = []
+                state.sequence_length = 0
+                out_of_blocks = True
+                continue
+            scheduled_requests.append(request)
+        return scheduled_requests
+
+    def allocate_kv_cache_blocks_for_decode(
+        self, requests: List[InferenceRequest]
+    ) -> List[InferenceRequest]:
+        """Allocates the paged kv cache blocks for one more token of each request
+
+        If the pool runs out, the most recent requests are preempted: their blocks are freed, and they are prefilled again once there are enough free blocks.
+
+        Args:
+            requests (List[InferenceRequest]): The requests that are generating tokens, from the oldest to the most recent
+
+        Returns:
+            List[InferenceRequest]: The requests that were not preempted
+        """
+        requests = list(requests)
+        scheduled_requests = []
+        while len(requests) > 0:
+            request = requests.pop(0)
+            state = self.dynamic_batch_states[request.request_id]
+            while not self.kv_cache_block_allocator.extend_block_table(
+                state.block_table, state.sequence_length + 1
+            ):
+                if len(requests) == 0:
+                    break
+                self.preempt_dynamic_batch_request(requests.pop())
+            else:
+                scheduled_requests.append(request)
+                continue
+            self.preempt_dynamic_batch_request(request)
+        return scheduled_requests
+
+    def preempt_dynamic_batch_request(self, request: InferenceRequest):
+        """Frees the paged kv cache blocks of a request. It keeps its generated tokens, and its kv cache is recomputed by its next prefill.
+
+        Args:
+            request (InferenceRequest): The request to preempt
+        """
+        state = self.dynamic_batch_states[request.request_id]
+        self.kv_cache_block_allocator.free(state.block_table)
+        state.block_table = []
+        state.sequence_length = 0
+        state.is_prefilled = False
+        request.status = Status.ACTIVE_BUT_NOT_GENERATING_TOKENS
+
     def generate_output_tokens_dynamic_batch(
         self, active_requests: OrderedDict[int, InferenceRequest]
     ) -> OrderedDict[int, InferenceRequest]:
@@ -195,13 +711,412 @@ class SimpleTextGenerationController:
 
         This utility generates the output tokens for a dynamic batch. It will run one forward step at a time, and pass control back to the engine, which will update the request pool and call this method again.
 
+        If some of the active requests have not started generating, the step runs the prefill of their prompts. Otherwise the step generates one token for every active request. With chunked prefill (See max_tokens_per_step in prep_model_for_dynamic_batch), the step instead generates one token for every generating request, and prefills chunks of the prompts in the same forward pass, within the token budget of the step. Each request uses its own kv cache slot (or its own blocks of the paged kv cache), and completes as soon as it reaches its own end condition (end of document, its number of tokens to generate, or the maximum sequence length), so that the scheduler can replace it with a waiting request. Call prep_model_for_dynamic_batch before the first step.
+
         Args:
             active_requests (OrderedDict[int, InferenceRequest]): The input active requests.
 
         Returns:
             OrderedDict[int, InferenceRequest]: The result for each of the incoming requests after running one forward step.
         """
-        raise Exception("Not implemented yet")
+        # Requests that have not started generating, or that were preempted, need a prefill
+        prefill_requests = []
+        decode_requests = []
+        for request_id, request in active_requests.items():
+            state = self.dynamic_batch_states.get(request_id)
+            if state is None:
+                state = DynamicBatchRequestState(
+                    generator=self.get_sampling_generator(request.inference_parameters),
+                    logits_processor_state=self.get_initial_logits_processor_state(request),
+                )
+                self.dynamic_batch_states[request_id] = state
+            if state.is_prefilled:
+                decode_requests.append(request)
+            else:
+                prefill_requests.append(request)
+
+        is_chunked_prefill = self.max_tokens_per_step is not None
+        if self.kv_cache_block_allocator is not None:
+            if is_chunked_prefill:
+                decode_requests = self.allocate_kv_cache_blocks_for_decode(decode_requests)
+                prefill_requests = self.allocate_kv_cache_blocks_for_prefill(prefill_requests)
+            else:
+                prefill_requests = self.allocate_kv_cache_blocks_for_prefill(prefill_requests)
+                if len(prefill_requests) == 0:
+                    decode_requests = self.allocate_kv_cache_blocks_for_decode(decode_requests)
+
+        if (
+            self.num_pipelined_decode_steps is not None
+            and self.model_is_pipeline_parallel
+            and self.kv_cache_block_allocator is None
+            and len(prefill_requests) == 0
+        ):
+            self.generate_output_tokens_pipelined_decode(decode_requests)
+            return active_requests
+
+        if is_chunked_prefill:
+            token_budget = self.max_tokens_per_step - len(decode_requests)
+        elif len(prefill_requests) > 0:
+            decode_requests = []
+
+        # Each row of the batch is either the last generated token of a request, or a chunk of the tokens to prefill
+        requests: List[InferenceRequest] = []
+        new_tokens: List[List[int]] = []
+        prefill_tokens: Dict[int, List[int]] = {}
+        for request in decode_requests:
+            requests.append(request)
+            new_tokens.append(self.dynamic_batch_states[request.request_id].generated_tokens[-1:])
+        for request in prefill_requests:
+            if is_chunked_prefill and token_budget <= 0:
+                break
+            sequence_length = self.dynamic_batch_states[request.request_id].sequence_length
+            request_prefill_tokens = self.get_dynamic_batch_prefill_tokens(request)
+            assert (
+                len(request_prefill_tokens) < self.max_sequence_length
+            ), f"Prompt of length {len(request_prefill_tokens)} does not fit in the maximum sequence length {self.max_sequence_length}"
+            chunk = request_prefill_tokens[sequence_length:]
+            if is_chunked_prefill:
+                chunk = chunk[:token_budget]
+                token_budget -= len(chunk)
+            prefill_tokens[len(requests)] = request_prefill_tokens
+            requests.append(request)
+            new_tokens.append(chunk)
+        assert len(requests) > 0, "No active request can make progress"
+
+        batch_size = len(requests)
+        states = [self.dynamic_batch_states[request.request_id] for request in requests]
+        sequence_offsets = [state.sequence_length for state in states]
+        new_token_lengths = [len(tokens) for tokens in new_tokens]
+        tokens = self.pad_input_prompt_tokens(
+            new_tokens, max_prompt_length_in_batch=max(new_token_lengths), num_tokens_to_generate=0
+        )
+        last_token_positions = torch.tensor(new_token_lengths, device=tokens.device) - 1
+
+        batch_slots = None
+        block_tables = None
+        if self.kv_cache_block_allocator is not None:
+            # Pad the block tables with the padding block, so that the padding tokens of a row do not overwrite the kv cache of another row
+            max_sequence_end = max(sequence_offsets) + tokens.size(1)
+            max_blocks = max(
+                self.kv_cache_block_allocator.get_num_blocks_for_tokens(max_sequence_end),
+                max(len(state.block_table) for state in states),
+            )
+            padding_block = self.kv_cache_block_allocator.num_blocks
+            block_tables_list = []
+            for request in requests:
+                block_table = self.dynamic_batch_states[request.request_id].block_table
+                block_tables_list.append(
+                    block_table + [padding_block] * (max_blocks - len(block_table))
+                )
+            block_tables = torch.tensor(block_tables_list, device=tokens.device)
+        else:
+            batch_slots = torch.tensor(
+                [request.kv_cache_slot for request in requests], device=tokens.device
+            )
+
+        with torch.no_grad():
+            inference_input = self.inference_wrapped_model.get_batch_for_dynamic_step(
+                tokens, batch_slots, sequence_offsets, block_tables, new_token_lengths
+            )
+
+            # Returns the final logits of shape [batch_size, seq_len, vocab_size]
+            # Note: This is returned in all TP ranks or last PP stage in PP models
+            logits = self.inference_wrapped_model.run_one_forward_step(inference_input)
+
+            return_log_probs = any(
+                request.inference_parameters.return_log_probs for request in requests
+            )
+            sampled_logits = None
+            sampled_log_probs = None
+            if parallel_state.is_pipeline_last_stage():
+                last_token_logits = logits[torch.arange(batch_size), last_token_positions, :]
+                # Only the rows that complete their prefill or decode draw from the generator of their request
+                generators = [
+                    (
+                        state.generator
+                        if idx not in prefill_tokens
+                        or (
+                            sequence_offsets[idx] + new_token_lengths[idx]
+                            == len(prefill_tokens[idx])
+                            and len(state.generated_tokens) == 0
+                        )
+                        else None
+                    )
+                    for idx, state in enumerate(states)
+                ]
+                last_token_logits = self.apply_logits_processors(
+                    last_token_logits, requests, [state.logits_processor_state for state in states]
+                )
+                sampled_logits = self.sample_from_logits_per_row(
+                    last_token_logits,
+                    self.get_sampling_params_per_row(requests),
+                    generators=generators,
+                    vocab_size=self.tokenizer.vocab_size,
+                )
+                if return_log_probs:
+                    sampled_log_probs = torch.gather(
+                        F.log_softmax(last_token_logits, dim=1), 1, sampled_logits.unsqueeze(1)
+                    ).squeeze(1)
+
+            if self.model_is_pipeline_parallel:
+                # Only the sampled tokens (and their log probs) leave the last stage, instead of the logits
+                sampled_logits = broadcast_from_last_pipeline_stage(
+                    [batch_size], dtype=torch.int64, tensor=sampled_logits
+                )
+                if return_log_probs:
+                    sampled_log_probs = broadcast_from_last_pipeline_stage(
+                        [batch_size], dtype=torch.float32, tensor=sampled_log_probs
+                    )
+            if return_log_probs:
+                sampled_log_probs = sampled_log_probs.tolist()
+
+        # Update the state of each request, and check its end condition
+        sampled_tokens = sampled_logits.tolist()
+        for idx, request in enumerate(requests):
+            state = states[idx]
+            state.sequence_length += new_token_lengths[idx]
+            if not state.is_prefilled:
+                if self.enable_prefix_caching:
+                    self.kv_cache_block_allocator.cache_blocks(
+                        state.block_table,
+                        self.kv_cache_block_allocator.get_block_hashes(
+                            prefill_tokens[idx][: state.sequence_length]
+                        ),
+                    )
+                if state.sequence_length < len(prefill_tokens[idx]):
+                    # The chunked prefill continues at the next step
+                    continue
+                state.is_prefilled = True
+                if len(state.generated_tokens) > 0:
+                    # A preempted request resumes from its last generated token
+                    request.status = Status.ACTIVE_AND_GENERATING_TOKENS
+                    continue
+
+            self.append_dynamic_batch_sampled_token(
+                request,
+                sampled_tokens[idx],
+                sampled_log_probs[idx] if sampled_log_probs is not None else None,
+            )
+
+        return active_requests
+
+    def generate_output_tokens_pipelined_decode(self, requests: List[InferenceRequest]):
+        """Generates several tokens for each of the decode requests of a pipeline parallel model, keeping all the pipeline stages busy
+
+        With a single batch, each stage waits for the previous stages at every decode step, so only one stage computes at a time. Instead, the requests are split into one group per stage, and the groups go through the stages one after the other, as micro batches: while the last stage computes the logits of a group, the previous stages already compute the next groups. The last stage samples the tokens of a group, and only sends them back to the first stage, which runs the next step of the group with them. The pipeline is filled and drained once per call of num_pipelined_decode_steps steps (See prep_model_for_dynamic_batch), and the sampled tokens are then broadcast from the last stage, so that all the ranks update the requests the same way.
+
+        The number of steps of a call is capped so that no request goes beyond its number of tokens to generate or the maximum sequence length. A request that reaches the end of document completes at the end of the call, and the tokens computed for it after the end of document are discarded.
+
+        Args:
+            requests (List[InferenceRequest]): The requests that are generating tokens, which all have a kv cache slot
+        """
+        pipeline_size = parallel_state.get_pipeline_model_parallel_world_size()
+        stage = parallel_state.get_pipeline_model_parallel_rank()
+        is_first_stage = parallel_state.is_pipeline_first_stage()
+        is_last_stage = parallel_state.is_pipeline_last_stage()
+        device = torch.cuda.current_device()
+
+        states = [self.dynamic_batch_states[request.request_id] for request in requests]
+        num_steps = min(
+            [self.num_pipelined_decode_steps]
+            + [
+                request.inference_parameters.num_tokens_to_generate - len(state.generated_tokens)
+                for request, state in zip(requests, states)
+            ]
+            + [self.max_sequence_length - state.sequence_length for state in states]
+        )
+        num_groups = min(pipeline_size, len(requests))
+        group_rows = [list(range(group, len(requests), num_groups)) for group in range(num_groups)]
+        # A group enters the pipeline again once its tokens are back from the last stage
+        period = max(num_groups, pipeline_size)
+
+        def get_group_and_step(tick: int, stage: int) -> Optional[Tuple[int, int]]:
+            """The group and the step that a stage runs at a tick of the schedule, if any"""
+            index = tick - stage
+            if index < 0 or index % period >= num_groups or index // period >= num_steps:
+                return None
+            return index % period, index // period
+
+        # The input tokens of the next step of each row. Only updated on the first stage.
+        tokens = torch.tensor(
+            [state.generated_tokens[-1:] for state in states], dtype=torch.long, device=device
+        )
+        batch_slots = torch.tensor([request.kv_cache_slot for request in requests], device=device)
+        return_log_probs = any(
+            request.inference_parameters.return_log_probs for request in requests
+        )
+        sampled_tokens = None
+        sampled_log_probs = None
+        if is_last_stage:
+            sampled_tokens = torch.empty(
+                (num_steps, len(requests)), dtype=torch.long, device=device
+            )
+            if return_log_probs:
+                sampled_log_probs = torch.empty(
+                    (num_steps, len(requests)), dtype=torch.float32, device=device
+                )
+            group_sampling_params = [
+                self.get_sampling_params_per_row([requests[row] for row in rows])
+                for rows in group_rows
+            ]
+            # The last stage advances its own copy of the logits processor states as it samples, since the requests are only updated at the end of the call
+            logits_processor_states = [state.logits_processor_state for state in states]
+            has_logits_processors = any(
+                self.get_logits_processor(request) is not None for request in requests
+            )
+
+        input_tensor = None
+        num_ticks = (num_steps - 1) * period + num_groups + pipeline_size - 1
+        with torch.no_grad():
+            for tick in range(num_ticks):
+                group_and_step = get_group_and_step(tick, stage)
+                output_tensor = None
+                if group_and_step is not None:
+                    group, step = group_and_step
+                    rows = group_rows[group]
+                    inference_input = self.inference_wrapped_model.get_batch_for_dynamic_step(
+                        tokens[rows],
+                        batch_slots[rows],
+                        [states[row].sequence_length + step for row in rows],
+                    )
+                    output_tensor = (
+                        self.inference_wrapped_model.run_one_pipeline_stage_forward_step(
+                            inference_input, input_tensor
+                        )
+                    )
+                    if is_last_stage:
+                        last_token_logits = self.apply_logits_processors(
+                            output_tensor[:, -1, :],
+                            [requests[row] for row in rows],
+                            [logits_processor_states[row] for row in rows],
+                        )
+                        output_tensor = self.sample_from_logits_per_row(
+                            last_token_logits,
+                            group_sampling_params[group],
+                            generators=[states[row].generator for row in rows],
+                            vocab_size=self.tokenizer.vocab_size,
+                        )
+                        if has_logits_processors:
+                            for row, token in zip(rows, output_tensor.tolist()):
+                                logits_processor_states[row] = self.update_logits_processor_state(
+                                    requests[row], logits_processor_states[row], token
+                                )
+                        sampled_tokens[step, rows] = output_tensor
+                        if return_log_probs:
+                            sampled_log_probs[step, rows] = torch.gather(
+                                F.log_softmax(last_token_logits, dim=1),
+                                1,
+                                output_tensor.unsqueeze(1),
+                            ).squeeze(1)
+
+                # The activations go to the next stage, and the sampled tokens from the last stage to the first stage, in the same batch of p2p operations
+                next_group_and_step = get_group_and_step(tick + 1, stage)
+                input_tensor = None
+                if not is_first_stage and next_group_and_step is not None:
+                    input_tensor = self.inference_wrapped_model._allocate_recv_buffer(
+                        len(group_rows[next_group_and_step[0]]), 1
+                    )
+                last_stage_group_and_step = get_group_and_step(tick, pipeline_size - 1)
+                sends_tokens = (
+                    last_stage_group_and_step is not None
+                    and last_stage_group_and_step[1] + 1 < num_steps
+                )
+                recv_tokens = None
+                if is_first_stage and sends_tokens:
+                    recv_rows = group_rows[last_stage_group_and_step[0]]
+                    recv_tokens = torch.empty(len(recv_rows), dtype=torch.long, device=device)
+                send_recv_pipeline_stages_(
+                    tensor_send_next=output_tensor if not is_last_stage else None,
+                    tensor_recv_prev=input_tensor,
+                    tensor_send_first=output_tensor if is_last_stage and sends_tokens else None,
+                    tensor_recv_last=recv_tokens,
+                )
+                if recv_tokens is not None:
+                    tokens[recv_rows, 0] = recv_tokens
+
+        sampled_tokens = broadcast_from_last_pipeline_stage(
+            [num_steps, len(requests)], dtype=torch.int64, tensor=sampled_tokens
+        ).tolist()
+        if return_log_probs:
+            sampled_log_probs = broadcast_from_last_pipeline_stage(
+                [num_steps, len(requests)], dtype=torch.float32, tensor=sampled_log_probs
+            ).tolist()
+
+        for step in range(num_steps):
+            for idx, request in enumerate(requests):
+                if request.status == Status.COMPLETED:
+                    continue
+                states[idx].sequence_length += 1
+                self.append_dynamic_batch_sampled_token(
+                    request,
+                    sampled_tokens[step][idx],
+                    sampled_log_probs[step][idx] if return_log_probs else None,
+                )
+
+    def append_dynamic_batch_sampled_token(
+        self, request: InferenceRequest, token: int, log_prob: Optional[float]
+    ):
+        """Appends a sampled token to a request generated with dynamic batching, and completes the request if it reached its end condition
+
+        Args:
+            request (InferenceRequest): A request whose kv cache already includes the input token of the step
+            token (int): The sampled token
+            log_prob (Optional[float]): The log prob of the sampled token, if the step computed them
+        """
+        state = self.dynamic_batch_states[request.request_id]
+        reached_eod = token == self.tokenizer.eod
+        if not reached_eod:
+            state.generated_tokens.append(token)
+            state.logits_processor_state = self.update_logits_processor_state(
+                request, state.logits_processor_state, token
+            )
+            if request.inference_parameters.return_log_probs:
+                state.generated_log_probs.append(log_prob)
+
+        if (
+            reached_eod
+            or len(state.generated_tokens) >= request.inference_parameters.num_tokens_to_generate
+            or state.sequence_length >= self.max_sequence_length
+        ):
+            self.complete_dynamic_batch_request(request)
+        else:
+            request.status = Status.ACTIVE_AND_GENERATING_TOKENS
+
+    def get_dynamic_batch_generated_tokens(self, request: InferenceRequest) -> List[int]:
+        """The tokens generated so far by a request generated with dynamic batching
+
+        Args:
+            request (InferenceRequest): An active or completed request
+
+        Returns:
+            List[int]: The generated tokens, which only grow from one step to the next (a preempted request keeps its generated tokens)
+        """
+        if request.status == Status.COMPLETED:
+            return request.generated_tokens.tolist()
+        state = self.dynamic_batch_states.get(request.request_id)
+        return [] if state is None else list(state.generated_tokens)
+
+    def complete_dynamic_batch_request(self, request: InferenceRequest):
+        """Adds the generated result to a request generated with dynamic batching, and marks it completed
+
+        Args:
+            request (InferenceRequest): The request that reached an end condition
+        """
+        state = self.dynamic_batch_states.pop(request.request_id)
+        if self.kv_cache_block_allocator is not None:
+            self.kv_cache_block_allocator.free(state.block_table)
+        generated_tokens = torch.tensor(
+            state.generated_tokens, dtype=torch.long, device=torch.cuda.current_device()
+        )
+        request.generated_length = len(state.generated_tokens)
+        request.generated_tokens = generated_tokens
+        request.generated_log_probs = (
+            torch.tensor(state.generated_log_probs, device=torch.cuda.current_device())
+            if request.inference_parameters.return_log_probs
+            else None
+        )
+        request.status = Status.COMPLETED
+        self.detokenize_requests([request], [state.generated_tokens])
 
     def generate_all_output_tokens_static_batch(
         self, active_requests: OrderedDict[int, InferenceRequest]
@@ -225,22 +1140,34 @@ class SimpleTextGenerationController:
         max_prompt_length_in_batch = max(prompt_lengths_in_batch)
         min_prompt_length_in_batch = min(prompt_lengths_in_batch)
 
-        # For batch inference the inference params are the same for all request
-        common_inference_params: CommonInferenceParams = list(active_requests.values())[
-            0
-        ].inference_parameters
+        # Each request has its own inference params, gathered in per row tensors
+        requests = list(active_requests.values())
+        sampling_params = self.get_sampling_params_per_row(requests)
+        generators = [self.get_sampling_generator(r.inference_parameters) for r in requests]
+        logits_processor_states = [
+            self.get_initial_logits_processor_state(request) for request in requests
+        ]
+        has_logits_processors = any(
+            self.get_logits_processor(request) is not None for request in requests
+        )
+        num_tokens_to_generate = torch.tensor(
+            [request.inference_parameters.num_tokens_to_generate for request in requests]
+        ).cuda()
+        return_log_probs = any(
+            request.inference_parameters.return_log_probs for request in requests
+        )
 
-        # max_seq_len = max_prompt_length_in_batch + num_tokens_to_generate
+        # max_seq_len = max_prompt_length_in_batch + max num_tokens_to_generate
         batch_prompt_tokens = self.pad_input_prompt_tokens(
             batch_prompt_tokens_list,
             max_prompt_length_in_batch=max_prompt_length_in_batch,
-            num_tokens_to_generate=common_inference_params.num_tokens_to_generate,
+            num_tokens_to_generate=int(num_tokens_to_generate.max()),
         )
         batch_size, max_sequence_length = batch_prompt_tokens.shape
 
         # Pre allocate log probs tensor
         output_log_probs = None
-        if common_inference_params.return_log_probs:
+        if return_log_probs:
             output_log_probs = torch.empty(
                 (batch_size, max_sequence_length - 1), dtype=torch.float32
             ).cuda()
@@ -267,38 +1194,73 @@ class SimpleTextGenerationController:
                 # Returns the final logits of shape [batch_size, context_length, vocab_size]
                 # Note: This is returned in all TP ranks or last PP stage in PP models
                 logits = self.inference_wrapped_model.run_one_forward_step(inference_input)
-                if self.model_is_pipeline_parallel:
-                    context_length = context_end_position - context_start_position
-                    logits = broadcast_from_last_pipeline_stage(
-                        [batch_size, context_length, self.tokenizer.vocab_size],
-                        dtype=torch.float32,
-                        tensor=logits,
-                    )
 
                 # Indicates which of the input prompts have started generating tokens. A 1D boolean tensor with [batch_size] elements (i.e) The shortest prompts will start generating first and so on
                 generation_started = prompt_lengths_in_batch <= context_end_position
-                last_token_logits = logits[:, -1, :]
-                sampled_logits = self.sample_from_logits(
-                    last_token_logits, common_inference_params, self.tokenizer.vocab_size
-                )
+                context_length = context_end_position - context_start_position
+                sampled_logits = None
+                context_log_probs = None
+                if parallel_state.is_pipeline_last_stage():
+                    last_token_logits = self.apply_logits_processors(
+                        logits[:, -1, :], requests, logits_processor_states
+                    )
+                    sampled_logits = self.sample_from_logits_per_row(
+                        last_token_logits,
+                        sampling_params,
+                        # Rows draw from the generator of their request once they generate tokens
+                        generators=(
+                            [
+                                generator if started else None
+                                for generator, started in zip(
+                                    generators, generation_started.tolist()
+                                )
+                            ]
+                            if any(generator is not None for generator in generators)
+                            else None
+                        ),
+                        vocab_size=self.tokenizer.vocab_size,
+                    )
+                    if return_log_probs:
+                        # The next token of each position is the prompt token, or the sampled token at the last position of the rows that started generating
+                        next_tokens = batch_prompt_tokens[
+                            :, (context_start_position + 1) : (context_end_position + 1)
+                        ].clone()
+                        next_tokens[generation_started, -1] = sampled_logits[generation_started]
+                        log_probs = F.log_softmax(logits, dim=2)
+                        context_log_probs = torch.gather(
+                            log_probs, 2, next_tokens.unsqueeze(2)
+                        ).squeeze(2)
+
+                if self.model_is_pipeline_parallel:
+                    # Only the sampled tokens (and the log probs of the context) leave the last stage, instead of the logits
+                    sampled_logits = broadcast_from_last_pipeline_stage(
+                        [batch_size], dtype=torch.int64, tensor=sampled_logits
+                    )
+                    if return_log_probs:
+                        context_log_probs = broadcast_from_last_pipeline_stage(
+                            [batch_size, context_length],
+                            dtype=torch.float32,
+                            tensor=context_log_probs,
+                        )
 
                 # Substitute the sampled logits only for only the prompts that have started generating tokens
                 batch_prompt_tokens[generation_started, context_end_position] = sampled_logits[
                     generation_started
                 ]
-
-                if common_inference_params.return_log_probs:
-                    log_probs = F.log_softmax(logits, dim=2)
-                    indices = torch.unsqueeze(
-                        batch_prompt_tokens[
-                            :, (context_start_position + 1) : (context_end_position + 1)
-                        ],
-                        2,
-                    )
+                if has_logits_processors:
+                    # The rows that generated a token advance the state of their logits processor
+                    is_generating = (generation_started & ~is_generation_done_tensor).tolist()
+                    for row, token in enumerate(sampled_logits.tolist()):
+                        if is_generating[row]:
+                            logits_processor_states[row] = self.update_logits_processor_state(
+                                requests[row], logits_processor_states[row], token
+                            )
+
+                if return_log_probs:
                     # Get the log probabilities for only the prompt tokens
-                    output_log_probs[:, context_start_position:context_end_position] = torch.gather(
-                        log_probs, 2, indices
-                    ).squeeze(2)
+                    output_log_probs[:, context_start_position:context_end_position] = (
+                        context_log_probs
+                    )
 
                 context_start_position = context_end_position
 
@@ -312,6 +1274,8 @@ class SimpleTextGenerationController:
                         generated_sequence_lengths=generated_sequence_lengths,
                     )
                 )
+                # Rows also finish once they generated their own number of tokens
+                is_generation_done_tensor |= generated_sequence_lengths >= num_tokens_to_generate
                 # Boolean flag indicating if all prompts are finished
                 all_prompts_done = torch.all(is_generation_done_tensor)
                 if all_prompts_done:
@@ -319,19 +1283,22 @@ class SimpleTextGenerationController:
 
         # Include all the generated tokens
         batch_prompt_tokens_with_generations = batch_prompt_tokens[:, : (context_end_position + 1)]
-        if common_inference_params.return_log_probs:
+        if return_log_probs:
             output_log_probs = output_log_probs[:, :context_end_position]
 
-        generated_sequence_lengths[
-            generated_sequence_lengths > common_inference_params.num_tokens_to_generate
-        ] = common_inference_params.num_tokens_to_generate
+        generated_sequence_lengths = torch.minimum(
+            generated_sequence_lengths, num_tokens_to_generate
+        )
 
+        # A single copy to the cpu for the detokenization of the whole batch
+        batch_tokens_list = batch_prompt_tokens_with_generations.tolist()
+        prompt_lengths_list = prompt_lengths_in_batch.tolist()
+        generated_sequence_lengths_list = generated_sequence_lengths.long().tolist()
+        generated_tokens_list = []
         for idx, request in enumerate(active_requests.values()):
-            input_prompt_length = int(prompt_lengths_in_batch[idx])
+            input_prompt_length = prompt_lengths_list[idx]
             # Shorter prompts might have generated more than required tokens. So we trim them down
-            required_sequence_length = int(
-                min(generated_sequence_lengths[idx], common_inference_params.num_tokens_to_generate)
-            )
+            required_sequence_length = generated_sequence_lengths_list[idx]
             # Extract only the generated tokens
             required_result_tokens = batch_prompt_tokens_with_generations[
                 idx, input_prompt_length : (input_prompt_length + required_sequence_length)
@@ -341,10 +1308,15 @@ class SimpleTextGenerationController:
             request.generated_tokens = required_result_tokens
             request.generated_log_probs = (
                 None
-                if output_log_probs is None
+                if not request.inference_parameters.return_log_probs
                 else output_log_probs[idx, input_prompt_length:required_sequence_length]
             )
             request.status = Status.COMPLETED
-            request.generated_text = self.detokenize_generations(required_result_tokens)
+            generated_tokens_list.append(
+                batch_tokens_list[idx][
+                    input_prompt_length : (input_prompt_length + required_sequence_length)
+                ]
+            )
+        self.detokenize_requests(list(active_requests.values()), generated_tokens_list)
 
         return active_requests
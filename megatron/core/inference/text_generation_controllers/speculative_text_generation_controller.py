@@ -0,0 +1,386 @@
+# Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+from typing import List, Optional, OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+from megatron.core.inference.communication_utils import broadcast_from_last_pipeline_stage
+from megatron.core.inference.inference_request import InferenceRequest, Status
+from megatron.core.inference.model_inference_wrappers.abstract_model_inference_wrapper import (
+    AbstractModelInferenceWrapper,
+)
+from megatron.core.inference.text_generation_controllers.simple_text_generation_controller import (
+    SamplingParamsPerRow,
+    SimpleTextGenerationController,
+)
+
+
+class SpeculativeTextGenerationController(SimpleTextGenerationController):
+    """Generates tokens with speculative decoding, proposing them with a draft model, in static batches"""
+
+    def __init__(
+        self,
+        inference_wrapped_model: AbstractModelInferenceWrapper,
+        draft_inference_wrapped_model: AbstractModelInferenceWrapper,
+        tokenizer,
+        num_speculative_tokens: int = 4,
+        detokenize_in_background: bool = False,
+    ):
+        """Text generation controller with speculative decoding
+
+        At each step, a small draft model proposes num_speculative_tokens tokens, one forward pass at a time, and the target model verifies all of them in a single forward pass over its kv cache. The longest prefix of draft tokens that passes rejection sampling is accepted, and one more token is sampled from the target model, so each step generates between 1 and num_speculative_tokens + 1 tokens, with the same distribution as sampling from the target model alone.
+
+        Args:
+            inference_wrapped_model (AbstractModelInferenceWrapper): The target model
+            draft_inference_wrapped_model (AbstractModelInferenceWrapper): The draft model, which uses the same tokenizer as the target model
+            tokenizer (_type_): Tokenizer used for tokenizing and detokenizing the prompts
+            num_speculative_tokens (int, optional): The number of tokens proposed by the draft model at each step. Defaults to 4.
+            detokenize_in_background (bool, optional): If True, the generated texts are detokenized on a worker thread (See SimpleTextGenerationController). Defaults to False.
+        """
+        super().__init__(inference_wrapped_model, tokenizer, detokenize_in_background)
+        assert num_speculative_tokens > 0
+        self.draft_inference_wrapped_model = draft_inference_wrapped_model
+        self.num_speculative_tokens = num_speculative_tokens
+
+    def prep_model_for_dynamic_batch(self, *args, **kwargs):
+        """Dynamic batching is not supported with speculative decoding
+
+        The inherited dynamic batch steps would only run the target model, and silently stop speculating.
+
+        Raises:
+            NotImplementedError: Always, use static batching (i.e) MCoreEngine.generate without dynamic_generation
+        """
+        raise NotImplementedError("Dynamic batching is not supported with speculative decoding")
+
+    def generate_output_tokens_dynamic_batch(
+        self, active_requests: OrderedDict[int, InferenceRequest]
+    ) -> OrderedDict[int, InferenceRequest]:
+        """Dynamic batching is not supported with speculative decoding (See prep_model_for_dynamic_batch)
+
+        Raises:
+            NotImplementedError: Always
+        """
+        raise NotImplementedError("Dynamic batching is not supported with speculative decoding")
+
+    def run_dynamic_forward_step(
+        self,
+        inference_wrapped_model: AbstractModelInferenceWrapper,
+        tokens: torch.Tensor,
+        batch_slots: torch.Tensor,
+        sequence_offsets: List[int],
+    ) -> torch.Tensor:
+        """Runs a forward pass in which each row starts at its own offset in its kv cache slot
+
+        Args:
+            inference_wrapped_model (AbstractModelInferenceWrapper): The target or the draft model
+            tokens (torch.Tensor): The input tokens of shape [batch_size, seq_len]. Rows with less than seq_len new tokens are padded at the end.
+            batch_slots (torch.Tensor): The kv cache slot of each row
+            sequence_offsets (List[int]): The number of tokens of each row already in the kv cache
+
+        Returns:
+            torch.Tensor: The logits of shape [batch_size, seq_len, vocab_size]
+        """
+        inference_input = inference_wrapped_model.get_batch_for_dynamic_step(
+            tokens, batch_slots, sequence_offsets
+        )
+        logits = inference_wrapped_model.run_one_forward_step(inference_input)
+        if inference_wrapped_model.model_is_pipeline_parallel:
+            logits = broadcast_from_last_pipeline_stage(
+                [tokens.size(0), tokens.size(1), self.tokenizer.vocab_size],
+                dtype=torch.float32,
+                tensor=logits,
+            )
+        # The target and draft models can have different padded vocab sizes
+        return logits[:, :, : self.tokenizer.vocab_size].float()
+
+    def get_uniform_samples(
+        self, shape: List[int], generators: List[Optional[torch.Generator]]
+    ) -> torch.Tensor:
+        """Samples uniform random numbers, from the random generator of each row if it has one
+
+        Args:
+            shape (List[int]): The shape of the samples, whose first dimension is the batch size
+            generators (List[Optional[torch.Generator]]): The random generator of each row
+
+        Returns:
+            torch.Tensor: The uniform samples
+        """
+        uniform = torch.rand(shape, device=torch.cuda.current_device())
+        for row, generator in enumerate(generators):
+            if generator is not None:
+                uniform[row] = torch.rand(shape[1:], generator=generator, device=uniform.device)
+        return uniform
+
+    def generate_all_output_tokens_static_batch(
+        self, active_requests: OrderedDict[int, InferenceRequest]
+    ) -> OrderedDict[int, InferenceRequest]:
+        """Utility to generate the all the output tokens and probabilities for the prompts, with speculative decoding
+
+        Each request uses its own kv cache slot in the target and draft models, with its own sequence offset (See get_batch_for_dynamic_step), so that the requests of the batch can accept different numbers of draft tokens. The tokens that are rejected are left in the kv caches, they are masked out and overwritten by the next steps. Requests leave the batch as soon as they reach an end condition.
+
+        Args:
+            active_requests (OrderedDict[int, InferenceRequest]): The input active requests.
+
+        Returns:
+            OrderedDict[int, InferenceRequest]: The result for each of the incoming requests
+        """
+        requests = list(active_requests.values())
+        assert all(
+            self.get_logits_processor(request) is None for request in requests
+        ), "Logits processors are not supported with speculative decoding"
+        batch_size = len(requests)
+        num_speculative_tokens = self.num_speculative_tokens
+        vocab_size = self.tokenizer.vocab_size
+
+        sampling_params = self.get_sampling_params_per_row(requests)
+        generators = [self.get_sampling_generator(r.inference_parameters) for r in requests]
+        prompt_lengths = [len(request.prompt_tokens) for request in requests]
+        max_sequence_length = max(
+            prompt_length + request.inference_parameters.num_tokens_to_generate
+            for prompt_length, request in zip(prompt_lengths, requests)
+        )
+        # The last verification can go beyond the last generated token
+        max_sequence_length += num_speculative_tokens + 1
+        for inference_wrapped_model in [
+            self.inference_wrapped_model,
+            self.draft_inference_wrapped_model,
+        ]:
+            inference_wrapped_model.prep_model_for_dynamic_inference(
+                max_batch_size=batch_size,
+                max_sequence_length=max_sequence_length,
+                max_padding_length=num_speculative_tokens + 1,
+            )
+
+        # The prompt plus generated tokens of each request. The last token is not in the target kv cache yet, and the draft kv cache can lag one more token behind.
+        sequences = [list(request.prompt_tokens) for request in requests]
+        generated_lengths = [0] * batch_size
+        generated_log_probs: List[List[float]] = [[] for _ in range(batch_size)]
+        draft_sequence_lengths = list(prompt_lengths)
+        active_rows = []
+
+        with torch.no_grad():
+            # Prefill both models, and sample the first token from the target model
+            tokens = self.pad_input_prompt_tokens(
+                [list(sequence) for sequence in sequences],
+                max_prompt_length_in_batch=max(prompt_lengths),
+                num_tokens_to_generate=0,
+            )
+            batch_slots = torch.arange(batch_size, device=tokens.device)
+            logits = self.run_dynamic_forward_step(
+                self.inference_wrapped_model, tokens, batch_slots, [0] * batch_size
+            )
+            self.run_dynamic_forward_step(
+                self.draft_inference_wrapped_model, tokens, batch_slots, [0] * batch_size
+            )
+            last_token_logits = logits[
+                torch.arange(batch_size), torch.tensor(prompt_lengths, device=tokens.device) - 1
+            ]
+            probabilities = self.get_probabilities_per_row(
+                last_token_logits, sampling_params, vocab_size
+            )
+            sampled_tokens = self.sample_from_probabilities(probabilities, generators)
+            log_probs = torch.gather(
+                F.log_softmax(last_token_logits, dim=1), 1, sampled_tokens.unsqueeze(1)
+            ).squeeze(1)
+            for row, (token, log_prob) in enumerate(
+                zip(sampled_tokens.tolist(), log_probs.tolist())
+            ):
+                if self.append_generated_tokens(
+                    requests[row], sequences[row], generated_log_probs[row], [token], [log_prob]
+                ):
+                    active_rows.append(row)
+                generated_lengths[row] = len(sequences[row]) - prompt_lengths[row]
+
+            while len(active_rows) > 0:
+                active_rows = self.run_speculative_step(
+                    active_rows,
+                    requests,
+                    sequences,
+                    generated_log_probs,
+                    draft_sequence_lengths,
+                    sampling_params,
+                    generators,
+                )
+
+        for row, request in enumerate(requests):
+            generated_tokens = torch.tensor(
+                sequences[row][prompt_lengths[row] :],
+                dtype=torch.long,
+                device=torch.cuda.current_device(),
+            )
+            request.generated_length = len(generated_tokens)
+            request.generated_tokens = generated_tokens
+            request.generated_log_probs = (
+                torch.tensor(generated_log_probs[row], device=torch.cuda.current_device())
+                if request.inference_parameters.return_log_probs
+                else None
+            )
+            request.status = Status.COMPLETED
+        self.detokenize_requests(
+            requests, [sequences[row][prompt_lengths[row] :] for row in range(len(requests))]
+        )
+
+        return active_requests
+
+    def append_generated_tokens(
+        self,
+        request: InferenceRequest,
+        sequence: List[int],
+        generated_log_probs: List[float],
+        tokens: List[int],
+        log_probs: List[float],
+    ) -> bool:
+        """Appends the tokens generated by a step to the sequence of a request, until it reaches an end condition
+
+        Args:
+            request (InferenceRequest): The request
+            sequence (List[int]): The prompt plus generated tokens of the request. It is extended inplace.
+            generated_log_probs (List[float]): The log probs of the generated tokens. It is extended inplace.
+            tokens (List[int]): The tokens generated by the step
+            log_probs (List[float]): The log probs of the tokens generated by the step
+
+        Returns:
+            bool: True if the request has not reached an end condition
+        """
+        num_tokens_to_generate = request.inference_parameters.num_tokens_to_generate
+        for token, log_prob in zip(tokens, log_probs):
+            if token == self.tokenizer.eod:
+                return False
+            sequence.append(token)
+            generated_log_probs.append(log_prob)
+            if len(sequence) - len(request.prompt_tokens) >= num_tokens_to_generate:
+                return False
+        return True
+
+    def run_speculative_step(
+        self,
+        active_rows: List[int],
+        requests: List[InferenceRequest],
+        sequences: List[List[int]],
+        generated_log_probs: List[List[float]],
+        draft_sequence_lengths: List[int],
+        sampling_params: SamplingParamsPerRow,
+        generators: List[Optional[torch.Generator]],
+    ) -> List[int]:
+        """Proposes tokens with the draft model, verifies them with the target model, and appends the accepted tokens to the sequences
+
+        A draft token x sampled from the draft distribution q is accepted with probability min(1, p(x) / q(x)), where p is the target distribution. At the first rejected token, a token is sampled from the normalized residual distribution max(0, p - q) instead, and if all the draft tokens are accepted, one more token is sampled from the target distribution.
+
+        Args:
+            active_rows (List[int]): The rows of the batch that have not reached an end condition
+            requests (List[InferenceRequest]): The requests of the batch
+            sequences (List[List[int]]): The prompt plus generated tokens of each request
+            generated_log_probs (List[List[float]]): The log probs of the generated tokens of each request
+            draft_sequence_lengths (List[int]): The number of tokens of each request in the draft kv cache
+            sampling_params (SamplingParamsPerRow): The sampling parameters of each request
+            generators (List[Optional[torch.Generator]]): The random generator of each request
+
+        Returns:
+            List[int]: The rows that have not reached an end condition after the step
+        """
+        num_speculative_tokens = self.num_speculative_tokens
+        vocab_size = self.tokenizer.vocab_size
+        device = torch.cuda.current_device()
+        batch_size = len(active_rows)
+        rows = torch.tensor(active_rows, device=device)
+        row_sampling_params = sampling_params.select(rows)
+        row_generators = [generators[row] for row in active_rows]
+
+        # Propose the draft tokens. The draft kv cache first catches up with the sequence.
+        draft_tokens = []
+        draft_probabilities = []
+        new_tokens = [sequences[row][draft_sequence_lengths[row] :] for row in active_rows]
+        sequence_offsets = [draft_sequence_lengths[row] for row in active_rows]
+        for _ in range(num_speculative_tokens):
+            new_token_lengths = [len(tokens) for tokens in new_tokens]
+            tokens = self.pad_input_prompt_tokens(
+                new_tokens,
+                max_prompt_length_in_batch=max(new_token_lengths),
+                num_tokens_to_generate=0,
+            )
+            logits = self.run_dynamic_forward_step(
+                self.draft_inference_wrapped_model, tokens, rows, sequence_offsets
+            )
+            last_token_logits = logits[
+                torch.arange(batch_size, device=device),
+                torch.tensor(new_token_lengths, device=device) - 1,
+            ]
+            probabilities = self.get_probabilities_per_row(
+                last_token_logits, row_sampling_params, vocab_size
+            )
+            sampled_tokens = self.sample_from_probabilities(probabilities, row_generators)
+            draft_tokens.append(sampled_tokens)
+            draft_probabilities.append(probabilities)
+
+            sequence_offsets = [
+                offset + length for offset, length in zip(sequence_offsets, new_token_lengths)
+            ]
+            new_tokens = [[token] for token in sampled_tokens.tolist()]
+
+        # [batch_size, num_speculative_tokens] and [batch_size, num_speculative_tokens, vocab_size]
+        draft_tokens = torch.stack(draft_tokens, dim=1)
+        draft_probabilities = torch.stack(draft_probabilities, dim=1)
+
+        # Verify the last token of each sequence followed by the draft tokens in a single forward pass
+        last_tokens = torch.tensor([sequences[row][-1] for row in active_rows], device=device)
+        tokens = torch.cat([last_tokens.unsqueeze(1), draft_tokens], dim=1)
+        logits = self.run_dynamic_forward_step(
+            self.inference_wrapped_model,
+            tokens,
+            rows,
+            [len(sequences[row]) - 1 for row in active_rows],
+        )
+        target_probabilities = self.get_probabilities_per_row(
+            logits.reshape(-1, vocab_size),
+            sampling_params.select(rows, repeats=num_speculative_tokens + 1),
+            vocab_size,
+        ).view(batch_size, num_speculative_tokens + 1, vocab_size)
+
+        # Accept the longest prefix of draft tokens that pass the rejection test
+        target_draft_probabilities = torch.gather(
+            target_probabilities[:, :-1], 2, draft_tokens.unsqueeze(2)
+        ).squeeze(2)
+        draft_draft_probabilities = torch.gather(
+            draft_probabilities, 2, draft_tokens.unsqueeze(2)
+        ).squeeze(2)
+        uniform = self.get_uniform_samples([batch_size, num_speculative_tokens], row_generators)
+        accepted = uniform * draft_draft_probabilities < target_draft_probabilities
+        num_accepted = torch.cumprod(accepted.int(), dim=1).sum(dim=1)
+
+        # Sample the next token from the residual distribution at the first rejected position, or from the target distribution after the last draft token
+        batch_indices = torch.arange(batch_size, device=device)
+        next_target_probabilities = target_probabilities[batch_indices, num_accepted]
+        next_draft_probabilities = F.pad(draft_probabilities, (0, 0, 0, 1))[
+            batch_indices, num_accepted
+        ]
+        residual_probabilities = (next_target_probabilities - next_draft_probabilities).clamp(min=0)
+        residual_sum = residual_probabilities.sum(dim=1, keepdim=True)
+        residual_probabilities = torch.where(
+            residual_sum > 0, residual_probabilities / residual_sum, next_target_probabilities
+        )
+        next_tokens = self.sample_from_probabilities(residual_probabilities, row_generators)
+
+        # The generated tokens of the step, and their log probs under the target model
+        step_tokens = torch.cat([draft_tokens, next_tokens.unsqueeze(1)], dim=1)
+        step_tokens.scatter_(1, num_accepted.unsqueeze(1), next_tokens.unsqueeze(1))
+        step_log_probs = torch.gather(
+            F.log_softmax(logits, dim=2), 2, step_tokens.unsqueeze(2)
+        ).squeeze(2)
+
+        still_active_rows = []
+        for idx, (row, step_row_tokens, step_row_log_probs, row_num_accepted) in enumerate(
+            zip(active_rows, step_tokens.tolist(), step_log_probs.tolist(), num_accepted.tolist())
+        ):
+            # The draft kv cache has the tokens of the sequence, and the accepted draft tokens except the last one
+            draft_sequence_lengths[row] = len(sequences[row]) + min(
+                row_num_accepted, num_speculative_tokens - 1
+            )
+            if self.append_generated_tokens(
+                requests[row],
+                sequences[row],
+                generated_log_probs[row],
+                step_row_tokens[: row_num_accepted + 1],
+                step_row_log_probs[: row_num_accepted + 1],
+            ):
+                still_active_rows.append(row)
+        return still_active_rows
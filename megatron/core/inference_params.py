@@ -1,4 +1,9 @@
 # Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+import torch
+
+from megatron.core.inference.quantized_kv_cache import KV_CACHE_QUANTIZATION_MAX, QuantizedKVCache
+
+
 class InferenceParams:
     """Inference parameters that are passed to the main model in order
     to efficienly calculate and store the context during inference."""
@@ -9,23 +14,240 @@ class InferenceParams:
         self.sequence_len_offset = 0
         self.batch_size_offset = 0
         self.key_value_memory_dict = {}
+        # The spare kv cache buffers of swap_key_value_dict(), allocated at the first swap.
+        self.swap_key_value_memory_dict = {}
+
+        # Per row state for dynamic batching, where each row of the batch uses its own
+        # slot of the kv cache and has its own sequence offset. See set_batch_slots().
+        self.batch_slots = None
+        self.sequence_offsets = None
+        self.max_sequence_end = None
+        # The number of input tokens of each row, the others being padding. Used by the Mamba
+        # layers, which keep the states of each row in its slot (See MambaMixer.dynamic_batch_forward).
+        self.new_token_lengths = None
+
+        # Paged kv cache, where each row stores its tokens in blocks of a shared pool
+        # through a block table. See enable_paged_kv_cache() and set_block_tables().
+        self.kv_cache_block_size = None
+        self.num_kv_cache_blocks = None
+        self.block_tables = None
+
+        # Quantized kv cache. See enable_kv_cache_quantization().
+        self.kv_cache_quantization = None
+        self.kv_cache_quantization_block_size = None
+
+        # Sliding window kv cache, which only keeps the sink tokens and the last tokens of the
+        # sequence in a ring buffer. See enable_sliding_window_kv_cache().
+        self.kv_cache_window_size = None
+        self.kv_cache_num_sink_tokens = 0
+        self.sliding_window_kv_cache_layout_key = None
+        self.sliding_window_kv_cache_layout = None
+
+    def enable_paged_kv_cache(self, num_blocks, block_size):
+        """Use a paged kv cache of num_blocks blocks of block_size tokens, instead of a dense
+        [max_sequence_length, max_batch_size] kv cache. Must be called before the first forward pass.
+        One more block, with id num_blocks, is allocated to pad the block tables: the tokens of
+        padded positions are written there instead of overwriting the blocks of another row.
+
+        Args:
+            num_blocks (int): The number of blocks of the kv cache of each layer.
+            block_size (int): The number of tokens per block.
+        """
+        assert len(self.key_value_memory_dict) == 0, "kv cache is already allocated"
+        self.num_kv_cache_blocks = num_blocks
+        self.kv_cache_block_size = block_size
+
+    def enable_kv_cache_quantization(self, quantization, block_size=None):
+        """Store the keys and values of the kv cache quantized, with a scale per block of block_size
+        channels of each head of each token (See QuantizedKVCache). Must be called before the first
+        forward pass.
+
+        Args:
+            quantization (str): "int8" for int8 values, or "fp8" for float8 (e4m3) values stored in int8.
+            block_size (int, optional): The number of channels per scale. Defaults to the head dim.
+        """
+        assert len(self.key_value_memory_dict) == 0, "kv cache is already allocated"
+        assert (
+            quantization in KV_CACHE_QUANTIZATION_MAX
+        ), f"Unknown kv cache quantization {quantization}"
+        self.kv_cache_quantization = quantization
+        self.kv_cache_quantization_block_size = block_size
+
+    def enable_sliding_window_kv_cache(self, window_size, num_sink_tokens=0):
+        """Only keep the first num_sink_tokens tokens (the attention sinks) and the last window_size
+        tokens of the sequence in the kv cache, which is a ring buffer of num_sink_tokens + window_size
+        tokens instead of max_sequence_length tokens. Each query attends to the sink tokens and to
+        the window_size tokens up to itself. The keys are stored before the rotary embedding, which
+        is applied at their positions in the sequence, so max_sequence_length still bounds the
+        positions. Only for batches with a single sequence offset (i.e.) not with dynamic batching.
+        Must be called before the first forward pass.
+
+        Args:
+            window_size (int): The number of most recent tokens attended to.
+            num_sink_tokens (int, optional): The number of first tokens always attended to. Defaults to 0.
+        """
+        assert len(self.key_value_memory_dict) == 0, "kv cache is already allocated"
+        assert window_size > 0 and num_sink_tokens >= 0
+        self.kv_cache_window_size = window_size
+        self.kv_cache_num_sink_tokens = num_sink_tokens
+
+    def get_sliding_window_kv_cache_slots(self, positions):
+        """The slots of the ring buffer of a sliding window kv cache that store the tokens at the given positions"""
+        num_sink_tokens = self.kv_cache_num_sink_tokens
+        return torch.where(
+            positions < num_sink_tokens,
+            positions,
+            num_sink_tokens + (positions - num_sink_tokens) % self.kv_cache_window_size,
+        )
+
+    def get_sliding_window_kv_cache_layout(self, num_new_tokens, device):
+        """The kv cache reads and writes of the next forward pass with a sliding window kv cache.
+
+        Computed once per forward pass (i.e.) for the current sequence_len_offset, and shared by all
+        the layers. The keys attended to are the tokens retained in the kv cache, followed by the
+        new tokens. Only the new tokens that are retained after the forward pass are written.
+
+        Args:
+            num_new_tokens (int): The number of input tokens of the forward pass.
+            device (torch.device): The device of the kv cache.
+
+        Returns:
+            Tuple: The slots of the retained tokens, of shape [num_retained_tokens]. The slots of the
+            new tokens to write and their indices among the new tokens, of shape [num_written_tokens].
+            The positions of the keys, of shape [num_retained_tokens + num_new_tokens]. The attention
+            mask, of shape [1, 1, num_new_tokens, num_retained_tokens + num_new_tokens], where True
+            means masked out.
+        """
+        sequence_start = self.sequence_len_offset
+        layout_key = (sequence_start, num_new_tokens)
+        if self.sliding_window_kv_cache_layout_key == layout_key:
+            return self.sliding_window_kv_cache_layout
+
+        num_sink_tokens = self.kv_cache_num_sink_tokens
+        window_size = self.kv_cache_window_size
+        sequence_end = sequence_start + num_new_tokens
+        retained_positions = torch.cat(
+            [
+                torch.arange(min(num_sink_tokens, sequence_start), device=device),
+                torch.arange(
+                    max(num_sink_tokens, sequence_start - window_size),
+                    max(num_sink_tokens, sequence_start),
+                    device=device,
+                ),
+            ]
+        )
+        new_positions = torch.arange(sequence_start, sequence_end, device=device)
+        # The new tokens that are sink tokens or among the last window_size tokens
+        write_indices = torch.nonzero(
+            (new_positions < num_sink_tokens) | (new_positions >= sequence_end - window_size)
+        ).squeeze(1)
+        key_positions = torch.cat([retained_positions, new_positions])
+        query_positions = new_positions.unsqueeze(1)
+        attention_mask = (key_positions > query_positions) | (
+            (key_positions >= num_sink_tokens) & (key_positions <= query_positions - window_size)
+        )
+        layout = (
+            self.get_sliding_window_kv_cache_slots(retained_positions),
+            self.get_sliding_window_kv_cache_slots(new_positions[write_indices]),
+            write_indices,
+            key_positions,
+            attention_mask.view(1, 1, num_new_tokens, -1),
+        )
+        self.sliding_window_kv_cache_layout_key = layout_key
+        self.sliding_window_kv_cache_layout = layout
+        return layout
+
+    def set_block_tables(self, block_tables, sequence_offsets, max_sequence_end):
+        """Set the block table and sequence offset of each row of the next forward pass (paged kv cache).
+
+        Args:
+            block_tables (torch.Tensor): Int tensor of shape [batch_size, max_blocks] with the kv cache blocks of each row, where max_blocks * block_size >= max_sequence_end. Entries beyond the blocks of a row must be the padding block num_kv_cache_blocks, whose tokens are masked out.
+            sequence_offsets (torch.Tensor): Int tensor of shape [batch_size] with the number of tokens of each row already in the kv cache.
+            max_sequence_end (int): The maximum over rows of the sequence offset plus the number of input tokens.
+        """
+        assert self.kv_cache_block_size is not None, "paged kv cache is not enabled"
+        assert self.kv_cache_window_size is None, "dynamic batching needs a full kv cache"
+        assert max_sequence_end <= self.max_sequence_length
+        assert block_tables.size(1) * self.kv_cache_block_size >= max_sequence_end
+        self.block_tables = block_tables
+        self.sequence_offsets = sequence_offsets
+        self.max_sequence_end = max_sequence_end
+
+    def set_batch_slots(
+        self, batch_slots, sequence_offsets, max_sequence_end, new_token_lengths=None
+    ):
+        """Set the kv cache slot and sequence offset of each row of the next forward pass.
+
+        Args:
+            batch_slots (torch.Tensor): Int tensor of shape [batch_size] with the kv cache slot of each row (i.e.) an index in [0, max_batch_size).
+            sequence_offsets (torch.Tensor): Int tensor of shape [batch_size] with the number of tokens of each row already in the kv cache.
+            max_sequence_end (int): The maximum over rows of the sequence offset plus the number of input tokens.
+            new_token_lengths (torch.Tensor, optional): Int tensor of shape [batch_size] with the number of input tokens of each row, when rows are padded at the end. Defaults to None, in which case no row is padded.
+        """
+        assert max_sequence_end <= self.max_sequence_length
+        assert self.kv_cache_window_size is None, "dynamic batching needs a full kv cache"
+        self.batch_slots = batch_slots
+        self.sequence_offsets = sequence_offsets
+        self.max_sequence_end = max_sequence_end
+        self.new_token_lengths = new_token_lengths
+
+    def reset_batch_slots(self):
+        "go back to a single sequence offset for the whole batch"
+        self.batch_slots = None
+        self.block_tables = None
+        self.sequence_offsets = None
+        self.max_sequence_end = None
+        self.new_token_lengths = None
 
     def swap_key_value_dict(self, batch_idx):
-        "swap between batches"
+        """Reorder the rows of the kv cache of each layer (e.g. to follow the beams of beam search).
+
+        Only the first sequence_len_offset tokens, which are already in the kv cache, are gathered
+        into a second buffer of the same size, which becomes the kv cache. The previous kv cache is
+        kept as the buffer of the next reorder, so that no memory is allocated after the first one.
+
+        Args:
+            batch_idx (torch.Tensor): Int tensor of shape [max_batch_size] with the row of the current kv cache that each row of the reordered kv cache is copied from.
+        """
         if len(self.key_value_memory_dict) == 0:
             raise ValueError("should not swap when dict in empty")
 
+        sequence_end = self.sequence_len_offset
         for layer_number in self.key_value_memory_dict.keys():
             inference_key_memory, inference_value_memory = self.key_value_memory_dict[layer_number]
             assert (
                 len(batch_idx) == inference_key_memory.shape[1]
             )  # make sure batch size is the same
-            new_inference_key_memory = inference_key_memory[:, batch_idx]
-            new_inference_value_memory = inference_value_memory[:, batch_idx]
+            if layer_number not in self.swap_key_value_memory_dict:
+                self.swap_key_value_memory_dict[layer_number] = tuple(
+                    (
+                        memory.empty_like()
+                        if isinstance(memory, QuantizedKVCache)
+                        else torch.empty_like(memory)
+                    )
+                    for memory in (inference_key_memory, inference_value_memory)
+                )
+            new_inference_key_memory, new_inference_value_memory = self.swap_key_value_memory_dict[
+                layer_number
+            ]
+            for memory, new_memory in (
+                (inference_key_memory, new_inference_key_memory),
+                (inference_value_memory, new_inference_value_memory),
+            ):
+                if isinstance(memory, QuantizedKVCache):
+                    memory.index_select(batch_idx, sequence_end, out=new_memory)
+                else:
+                    torch.index_select(
+                        memory[:sequence_end], 1, batch_idx, out=new_memory[:sequence_end]
+                    )
             self.key_value_memory_dict[layer_number] = (
                 new_inference_key_memory,
                 new_inference_value_memory,
             )
+            self.swap_key_value_memory_dict[layer_number] = (
+                inference_key_memory,
+                inference_value_memory,
+            )
 
     def __str__(self):
         return f"InferenceParams(max_seq_len = {self.max_sequence_length}, max_batch_size = {self.max_batch_size}, sequence_len_offset = {self.sequence_len_offset}, batch_size_offset = {self.batch_size_offset}, key_value_memory_dict = {self.key_value_memory_dict.keys()})"
@@ -238,7 +238,8 @@ def apply_rotary_pos_emb(
                 " is not included in Apex. Try upgrading to the latest version"
             )
             apply_rotary_pos_emb.printed_fused_warning = True
-    if config.apply_rope_fusion:
+    # The fused kernels require freqs shared across the batch. [s, 1, 1, dim]
+    if config.apply_rope_fusion and freqs.size(1) == 1:
         if cu_seqlens is None:
             return fused_apply_rotary_pos_emb(t, freqs, transpose_output_memory=True)
         else:
@@ -222,6 +222,11 @@ class MambaMixer(MegatronModule):
         conv_state, ssm_state = None, None
         if inference_params is not None:
             assert not self.config.sequence_parallel
+            if (
+                inference_params.batch_slots is not None
+                or inference_params.block_tables is not None
+            ):
+                return self.dynamic_batch_forward(hidden_states, inference_params)
             conv_state, ssm_state = self._get_states_from_cache(inference_params, batch)
             if inference_params.seqlen_offset > 0:
                 # The states are updated inplace
@@ -349,6 +354,159 @@ class MambaMixer(MegatronModule):
 
         return out, out_bias
 
+    def dynamic_batch_forward(self, hidden_states, inference_params):
+        """
+        Forward pass for dynamic batching, where each row is a request with its own sequence
+        offset and its own kv cache slot (See InferenceParams.set_batch_slots). The conv and ssm
+        states of the layer are a pool of one state per kv cache slot, so requests join and leave
+        the batch at every step along with their kv cache slot: the states of the slots of the
+        batch are gathered, updated, and scattered back. The state of a slot is reset when a new
+        request starts (i.e.) at sequence offset 0.
+
+        hidden_states: (L, B, D). Rows with fewer new tokens are padded at the end
+            (See InferenceParams.new_token_lengths)
+        Returns: same shape as hidden_states
+        """
+        assert (
+            inference_params.block_tables is None
+        ), "Mamba layers keep their states in the kv cache slots, which a paged kv cache does not use"
+        batch_start = inference_params.batch_size_offset
+        batch_end = batch_start + hidden_states.size(1)
+        batch_slots = inference_params.batch_slots[batch_start:batch_end]
+        sequence_offsets = inference_params.sequence_offsets[batch_start:batch_end]
+
+        conv_state_pool, ssm_state_pool = self._get_states_from_cache(
+            inference_params, inference_params.max_batch_size
+        )
+        conv_state = conv_state_pool[batch_slots]
+        ssm_state = ssm_state_pool[batch_slots]
+        is_new_request = sequence_offsets == 0
+        conv_state.masked_fill_(is_new_request.view(-1, 1, 1), 0)
+        ssm_state.masked_fill_(is_new_request.view(-1, 1, 1, 1), 0)
+
+        if hidden_states.size(0) == 1:
+            # Batched step of the gathered states, which are updated in place
+            out, out_bias, _, _ = self.step(hidden_states, conv_state, ssm_state)
+        else:
+            new_token_lengths = inference_params.new_token_lengths
+            if new_token_lengths is None:
+                new_token_lengths = torch.full_like(sequence_offsets, hidden_states.size(0))
+            else:
+                new_token_lengths = new_token_lengths[batch_start:batch_end]
+            out, out_bias = self._chunk_forward(
+                hidden_states, conv_state, ssm_state, new_token_lengths
+            )
+
+        conv_state_pool[batch_slots] = conv_state
+        ssm_state_pool[batch_slots] = ssm_state
+        return out, out_bias
+
+    def _chunk_forward(self, hidden_states, conv_state, ssm_state, new_token_lengths):
+        """
+        Runs chunks of tokens that continue from the given states, which are updated in place
+        with the states after the last new token of each row. The padding tokens get a zero
+        time step, so that they leave the ssm state unchanged, and the conv state ends at the
+        last new token.
+
+        hidden_states: (L, B, D)
+        conv_state: (B, D_conv, W), ssm_state: (B, H, P, N)
+        new_token_lengths: (B), the number of new tokens of each row, the others being padding
+        Returns: same shape as hidden_states
+        """
+        seqlen = hidden_states.size(0)
+
+        # (nheads_local)
+        A = -torch.exp(self.A_log.float())
+
+        xz, _ = self.in_proj(hidden_states)
+
+        # transpose: l b pd --> b l pd
+        xz = rearrange(xz, "l b d -> b l d").contiguous()
+
+        z, xBC, dt = torch.split(
+            xz,
+            [
+                self.d_inner_local,
+                self.d_inner_local + 2 * self.ngroups_local * self.d_state,
+                self.nheads_local,
+            ],
+            dim=-1,
+        )
+
+        # transpose: b l pd --> b pd l, after the last inputs of the conv state
+        xBC = torch.cat(
+            [conv_state[..., 1:].to(dtype=xBC.dtype), rearrange(xBC, "b l d -> b d l")], dim=-1
+        )
+
+        # The conv state becomes the last d_conv inputs up to the last new token of each row
+        conv_state_indices = (
+            new_token_lengths.view(-1, 1, 1)
+            - 1
+            + torch.arange(self.d_conv, device=xBC.device).view(1, 1, -1)
+        )
+        conv_state.copy_(xBC.gather(2, conv_state_indices.expand(-1, xBC.size(1), -1)))
+
+        # Compute short convolution, without padding since the inputs start with the conv state
+        xBC = self.act(
+            F.conv1d(xBC, self.conv1d.weight, self.conv1d.bias, groups=self.conv1d.groups)
+        )
+
+        # transpose b pd l --> b l pd
+        xBC = rearrange(xBC, "b d l ->  b l d").contiguous()
+
+        x, B, C = torch.split(
+            xBC,
+            [
+                self.d_inner_local,
+                self.ngroups_local * self.d_state,
+                self.ngroups_local * self.d_state,
+            ],
+            dim=-1,
+        )
+
+        # A time step of softplus(-1e4) = 0 for the padding tokens
+        is_padding = torch.arange(seqlen, device=dt.device).unsqueeze(
+            0
+        ) >= new_token_lengths.unsqueeze(1)
+        dt = dt.masked_fill(is_padding.unsqueeze(-1), -1e4)
+
+        x = rearrange(x, "b l (h p) -> b l h p", p=self.headdim).contiguous()
+        dt = dt.contiguous()
+        B = rearrange(B, "b l (g n) -> b l g n", n=self.d_state).contiguous()
+        C = rearrange(C, "b l (g n) -> b l g n", n=self.d_state).contiguous()
+        z = rearrange(z, "b l (h p) -> b l h p", p=self.headdim).contiguous()
+        y, last_state = mamba_chunk_scan_combined(
+            x,
+            dt,
+            A,
+            B,
+            C,
+            self.chunk_size,
+            D=(
+                rearrange(self.D.float(), "(h p) -> h p", p=self.headdim)
+                if self.D_has_hdim
+                else self.D
+            ),
+            z=z if not self.rmsnorm else None,
+            dt_bias=self.dt_bias.float(),
+            dt_softplus=True,
+            initial_states=ssm_state,
+            return_final_states=True,
+        )
+        ssm_state.copy_(last_state)
+
+        if self.rmsnorm:
+            y = rearrange(y, "b l h p -> b l (h p)").contiguous()
+            z = rearrange(z, "b l h p -> b l (h p)").contiguous()
+            y = self.norm(y, z)
+        else:
+            y = rearrange(y, "b l h p -> b l (h p)").contiguous()
+
+        y = rearrange(y, "b l d -> l b d").contiguous()
+        out, out_bias = self.out_proj(y)
+
+        return out, out_bias
+
     def step(self, hidden_states, conv_state, ssm_state):
         # assert self.ngroups_local == 1, "Only support ngroups=1 for inference for now"
         dtype = hidden_states.dtype
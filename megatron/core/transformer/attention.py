@@ -8,6 +8,7 @@ import torch
 from pkg_resources import packaging
 
 from megatron.core import parallel_state, tensor_parallel
+from megatron.core.inference.quantized_kv_cache import QuantizedKVCache
 from megatron.core.models.common.embeddings.rotary_pos_embedding import apply_rotary_pos_emb
 from megatron.core.parallel_state import (
     get_data_parallel_group,
@@ -154,17 +155,34 @@ class Attention(MegatronModule, ABC):
 
         return hidden_states
 
-    def _allocate_memory(self, inference_max_sequence_length, batch_size, dtype):
-        """Allocate memory to store kv cache during inference."""
+    def _allocate_memory(
+        self,
+        inference_max_sequence_length,
+        batch_size,
+        dtype,
+        quantization=None,
+        quantization_block_size=None,
+    ):
+        """Allocate memory to store kv cache during inference.
+        With quantization, the kv cache is stored quantized (See QuantizedKVCache)."""
 
-        return torch.empty(
+        shape = (
             inference_max_sequence_length,
             batch_size,
             self.num_query_groups_per_partition,
             self.hidden_size_per_attention_head,
-            dtype=dtype,
-            device=torch.cuda.current_device(),
         )
+        if quantization is not None:
+            return QuantizedKVCache(
+                shape,
+                dtype,
+                quantization,
+                block_size=quantization_block_size,
+                device=torch.cuda.current_device(),
+            )
+        # Zero initialized, since with dynamic batching or a paged kv cache the positions beyond
+        # the sequence of a row are read and masked out, and must not hold nans.
+        return torch.zeros(*shape, dtype=dtype, device=torch.cuda.current_device())
 
     def _adjust_key_value_for_inference(self, inference_params, key, value, rotary_pos_emb):
         """
@@ -185,11 +203,29 @@ class Attention(MegatronModule, ABC):
         if self.layer_number not in inference_params.key_value_memory_dict:
             inf_max_seq_length = inference_params.max_sequence_length
             inf_max_batch_size = inference_params.max_batch_size
+            if inference_params.kv_cache_block_size is not None:
+                # Paged kv cache: [block_size, num_blocks + padding block, ...]
+                inf_max_seq_length = inference_params.kv_cache_block_size
+                inf_max_batch_size = inference_params.num_kv_cache_blocks + 1
+            elif inference_params.kv_cache_window_size is not None:
+                # Sliding window kv cache: a ring buffer of the sink tokens and the window
+                inf_max_seq_length = (
+                    inference_params.kv_cache_num_sink_tokens
+                    + inference_params.kv_cache_window_size
+                )
             inference_key_memory = self._allocate_memory(
-                inf_max_seq_length, inf_max_batch_size, key.dtype
+                inf_max_seq_length,
+                inf_max_batch_size,
+                key.dtype,
+                inference_params.kv_cache_quantization,
+                inference_params.kv_cache_quantization_block_size,
             )
             inference_value_memory = self._allocate_memory(
-                inf_max_seq_length, inf_max_batch_size, value.dtype
+                inf_max_seq_length,
+                inf_max_batch_size,
+                value.dtype,
+                inference_params.kv_cache_quantization,
+                inference_params.kv_cache_quantization_block_size,
             )
             inference_params.key_value_memory_dict[self.layer_number] = (
                 inference_key_memory,
@@ -201,6 +237,26 @@ class Attention(MegatronModule, ABC):
                 self.layer_number
             ]
 
+        if inference_params.batch_slots is not None or inference_params.block_tables is not None:
+            return self._adjust_key_value_for_dynamic_batch_inference(
+                inference_params,
+                key,
+                value,
+                rotary_pos_emb,
+                inference_key_memory,
+                inference_value_memory,
+            )
+
+        if inference_params.kv_cache_window_size is not None:
+            return self._adjust_key_value_for_sliding_window_inference(
+                inference_params,
+                key,
+                value,
+                rotary_pos_emb,
+                inference_key_memory,
+                inference_value_memory,
+            )
+
         if inference_params.sequence_len_offset > 0:
             # This should mean that we are past the prompt forward_step
             # and so we need to turn off masking
@@ -229,6 +285,122 @@ class Attention(MegatronModule, ABC):
 
         return key, value, rotary_pos_emb, attn_mask_type
 
+    def _adjust_key_value_for_dynamic_batch_inference(
+        self,
+        inference_params,
+        key,
+        value,
+        rotary_pos_emb,
+        inference_key_memory,
+        inference_value_memory,
+    ):
+        """
+        Same as _adjust_key_value_for_inference, for batches in which each row has its own
+        sequence offset, and either its own kv cache slot (see InferenceParams.set_batch_slots)
+        or its own block table in a paged kv cache (see InferenceParams.set_block_tables). The
+        keys and values of all rows are returned up to the longest sequence, so the attention
+        mask passed to the model must mask the positions beyond the sequence of each row.
+
+        Returns a tuple: (key, value, rotary_pos_emb, attn_mask_type)
+
+        """
+        batch_start = inference_params.batch_size_offset
+        batch_end = batch_start + key.size(1)
+        sequence_offsets = inference_params.sequence_offsets[batch_start:batch_end]
+        sequence_end = inference_params.max_sequence_end
+
+        if inference_params.block_tables is not None:
+            # Paged kv cache of shape [block_size, num_blocks, ...]
+            block_size = inference_key_memory.size(0)
+            block_tables = inference_params.block_tables[batch_start:batch_end].t()
+
+            def get_kv_cache_indices(positions):
+                return positions % block_size, block_tables.gather(0, positions // block_size)
+
+        else:
+            assert sequence_end <= inference_key_memory.size(0)
+            batch_slots = inference_params.batch_slots[batch_start:batch_end]
+
+            def get_kv_cache_indices(positions):
+                return positions, batch_slots.unsqueeze(0).expand_as(positions)
+
+        # Positions of the new tokens in the sequence of each row. [sq, b]
+        positions = sequence_offsets.unsqueeze(0) + torch.arange(
+            key.size(0), device=key.device
+        ).unsqueeze(1)
+
+        # Copy key and values.
+        new_indices = get_kv_cache_indices(positions)
+        inference_key_memory[new_indices] = key
+        inference_value_memory[new_indices] = value
+
+        # Gather the keys and values of each row up to the longest sequence. [sk, b, ...]
+        all_positions = (
+            torch.arange(sequence_end, device=key.device).unsqueeze(1).expand(-1, key.size(1))
+        )
+        all_indices = get_kv_cache_indices(all_positions)
+        key = inference_key_memory[all_indices]
+        value = inference_value_memory[all_indices]
+
+        attn_mask_type = AttnMaskType.arbitrary
+        if rotary_pos_emb is None:
+            return key, value, rotary_pos_emb, attn_mask_type
+
+        # The query rotary positional embedding differs per row. [sq, b, 1, dim]
+        q_pos_emb, k_pos_emb = rotary_pos_emb
+        q_pos_emb = q_pos_emb[positions, 0]
+        k_pos_emb = k_pos_emb[:sequence_end, :, :, :]
+        rotary_pos_emb = (q_pos_emb, k_pos_emb)
+
+        return key, value, rotary_pos_emb, attn_mask_type
+
+    def _adjust_key_value_for_sliding_window_inference(
+        self,
+        inference_params,
+        key,
+        value,
+        rotary_pos_emb,
+        inference_key_memory,
+        inference_value_memory,
+    ):
+        """
+        Same as _adjust_key_value_for_inference, with a sliding window kv cache (see
+        InferenceParams.enable_sliding_window_kv_cache). The keys and values are the tokens
+        retained in the kv cache followed by the new tokens, and the rotary positional embedding
+        of each key is the one of its position in the sequence. The attention mask passed to the
+        model is replaced by the one of InferenceParams.get_sliding_window_kv_cache_layout.
+
+        Returns a tuple: (key, value, rotary_pos_emb, attn_mask_type)
+
+        """
+        read_slots, write_slots, write_indices, key_positions, _ = (
+            inference_params.get_sliding_window_kv_cache_layout(key.size(0), key.device)
+        )
+        batch_start = inference_params.batch_size_offset
+        batch_end = batch_start + key.size(1)
+        assert batch_end <= inference_key_memory.size(1)
+        sequence_start = inference_params.sequence_len_offset
+        sequence_end = sequence_start + key.size(0)
+
+        # Read the retained keys and values before the new ones overwrite their slots.
+        retained_key = inference_key_memory[read_slots, batch_start:batch_end, ...]
+        retained_value = inference_value_memory[read_slots, batch_start:batch_end, ...]
+        inference_key_memory[write_slots, batch_start:batch_end, ...] = key[write_indices]
+        inference_value_memory[write_slots, batch_start:batch_end, ...] = value[write_indices]
+        key = torch.cat([retained_key, key])
+        value = torch.cat([retained_value, value])
+
+        attn_mask_type = AttnMaskType.arbitrary
+        if rotary_pos_emb is None:
+            return key, value, rotary_pos_emb, attn_mask_type
+
+        q_pos_emb, k_pos_emb = rotary_pos_emb
+        q_pos_emb = q_pos_emb[sequence_start:sequence_end, :, :, :]
+        k_pos_emb = k_pos_emb[key_positions]
+        rotary_pos_emb = (q_pos_emb, k_pos_emb)
+
+        return key, value, rotary_pos_emb, attn_mask_type
+
     @abstractmethod
     def get_query_key_value_tensors(self, hidden_states, key_value_states):
         """
@@ -264,6 +436,10 @@ class Attention(MegatronModule, ABC):
         key, value, rotary_pos_emb, attn_mask_type = self._adjust_key_value_for_inference(
             inference_params, key, value, rotary_pos_emb
         )
+        if inference_params is not None and inference_params.kv_cache_window_size is not None:
+            attention_mask = inference_params.get_sliding_window_kv_cache_layout(
+                query.size(0), query.device
+            )[-1]
 
         if packed_seq_params is not None:
             query = query.squeeze(1)
@@ -110,7 +110,7 @@ class DotProductAttention(MegatronModule):
         # creates a view that has the keys and values virtually repeated along their dimension to
         # match the number of queries.
 
-        # attn_mask_type is not used.
+        # attn_mask_type is only used for arbitrary masks.
         if self.num_attention_heads_per_partition // self.num_query_groups_per_partition > 1:
             key = key.repeat_interleave(
                 self.num_attention_heads_per_partition // self.num_query_groups_per_partition, dim=2
@@ -152,7 +152,14 @@ class DotProductAttention(MegatronModule):
         # ===========================
 
         # attention scores and attention mask [b, np, sq, sk]
-        attention_probs: Tensor = self.scale_mask_softmax(attention_scores, attention_mask)
+        if attn_mask_type == AttnMaskType.arbitrary:
+            # Per row masks (e.g.) with dynamic batching, where the queries of a row start at
+            # its own offset in the kv cache, cannot use the fused causal kernel.
+            attention_probs: Tensor = self.scale_mask_softmax.forward_torch_softmax(
+                attention_scores, attention_mask
+            )
+        else:
+            attention_probs: Tensor = self.scale_mask_softmax(attention_scores, attention_mask)
 
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
@@ -4,4 +4,5 @@
 from .api import (
     generate,
     generate_and_post_process,
+    score_and_post_process,
     beam_search_and_post_process)
@@ -10,6 +10,7 @@ from .communication import broadcast_float_list
 from .generation import (
         generate_tokens_probs_and_return_on_first_stage,
         score_and_return_on_first_stage,
+        score_in_micro_batches_and_return_on_first_stage,
         beam_search_and_return_on_first_stage)
 from .tokenization import (
     tokenize_prompts,
@@ -32,7 +33,8 @@ def generate_and_post_process(model,
                               stop_on_eol=False,
                               prevent_newline_after_colon=False,
                               random_seed=-1,
-                              return_logits=False):
+                              return_logits=False,
+                              stream_callback=None):
     """Run inference and post-process outputs, i.e., detokenize,
     move to cpu and convert to list."""
 
@@ -53,7 +55,8 @@ def generate_and_post_process(model,
         stop_on_double_eol=stop_on_double_eol,
         stop_on_eol=stop_on_eol,
         prevent_newline_after_colon=prevent_newline_after_colon,
-        random_seed=random_seed)
+        random_seed=random_seed,
+        stream_callback=stream_callback)
 
     # Only post-process on first stage.
     if mpu.is_pipeline_first_stage():
@@ -91,13 +94,16 @@ def generate(model,
              stop_on_double_eol=False,
              stop_on_eol=False,
              prevent_newline_after_colon=False,
-             random_seed=-1):
+             random_seed=-1,
+             stream_callback=None):
     """Given prompts and input parameters, run inference and return:
        tokens: prompts plus the generated tokens.
        lengths: length of the prompt + generations. Note that we can
            discard tokens in the tokens tensor that are after the
            corresponding length.
        output_log_probs: log probs of the tokens.
+       stream_callback, if set, is called after each generation step on the
+       first stage (See generate_tokens_probs_and_return_on_first_stage).
     """
 
     # Make sure input params are avaialble to all ranks.
@@ -152,7 +158,70 @@ def generate(model,
         use_eod_token_for_early_termination=use_eod_token_for_early_termination,
         stop_on_double_eol=stop_on_double_eol,
         stop_on_eol=stop_on_eol,
-        prevent_newline_after_colon=prevent_newline_after_colon)
+        prevent_newline_after_colon=prevent_newline_after_colon,
+        stream_callback=stream_callback)
+
+def score_and_post_process(model,
+                           prompts=None,
+                           add_BOS=False,
+                           max_tokens_per_micro_batch=0):
+    """Score the prompts and post-process outputs, i.e., detokenize,
+    move to cpu and convert to list."""
+
+    # Main inference.
+    tokens, lengths, output_log_probs = score(
+        model,
+        prompts=prompts,
+        add_BOS=add_BOS,
+        max_tokens_per_micro_batch=max_tokens_per_micro_batch)
+
+    # Only post-process on first stage.
+    if mpu.is_pipeline_first_stage():
+        tokens, prompts_plus_generations, prompts_plus_generations_segments = \
+            detokenize_generations(tokens, lengths, True)
+
+        output_log_probs = output_log_probs.cpu().numpy().tolist()
+        for i, (prob, seg) in enumerate(zip(output_log_probs, prompts_plus_generations_segments)):
+            output_log_probs[i] = prob[:len(seg)-1]
+
+        return prompts_plus_generations, prompts_plus_generations_segments, \
+            output_log_probs
+
+    return None
+
+def score(model,
+          prompts=None,
+          add_BOS=False,
+          max_tokens_per_micro_batch=0):
+    """Given prompts, return:
+       tokens: the tokens of the prompts.
+       lengths: length of the prompts.
+       output_log_probs: log probs of the tokens.
+       Unlike generate with tokens_to_generate=0, the prompts are scored in
+       micro-batches of prompts of similar lengths, of at most
+       max_tokens_per_micro_batch tokens (args.max_tokens_to_oom if 0), and
+       without kv cache (See score_in_micro_batches_and_return_on_first_stage).
+    """
+
+    # Make sure input params are avaialble to all ranks.
+    values = [add_BOS, max_tokens_per_micro_batch]
+    values_float_tensor = broadcast_float_list(len(values), float_list=values)
+    add_BOS = bool(values_float_tensor[0].item())
+    max_tokens_per_micro_batch = int(values_float_tensor[1].item())
+
+    # Tokenize prompts and get the batch.
+    # Note that these tensors are broadcaseted to all ranks.
+    if torch.distributed.get_rank() == 0:
+        assert prompts is not None
+
+    context_tokens_tensor, context_length_tensor = tokenize_prompts(
+        prompts=prompts, tokens_to_generate=0, add_BOS=add_BOS)
+
+    output_log_probs = score_in_micro_batches_and_return_on_first_stage(
+        model, context_tokens_tensor, context_length_tensor,
+        max_tokens_per_micro_batch=max_tokens_per_micro_batch or None)
+
+    return context_tokens_tensor, context_length_tensor, output_log_probs
 
 def beam_search_and_post_process(model,
                                  forward_step=ForwardStep,
@@ -180,7 +249,8 @@ def beam_search_and_post_process(model,
                                  prevent_newline_after_colon=prevent_newline_after_colon)
     # Only post-process on first stage.
     if mpu.is_pipeline_first_stage():
-        lengths = tokens.size(1)*torch.ones(beam_size, dtype=torch.int64, device=torch.cuda.current_device())
+        # The hypotheses of all the prompts, grouped by prompt
+        lengths = tokens.size(1)*torch.ones(tokens.size(0), dtype=torch.int64, device=torch.cuda.current_device())
         tokens, prompts_plus_generations, prompts_plus_generations_segments = detokenize_generations(tokens, lengths, True)
         scores = scores.cpu().numpy().tolist()
         return prompts_plus_generations, prompts_plus_generations_segments, scores
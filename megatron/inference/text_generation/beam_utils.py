@@ -15,51 +15,48 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import torch
 
-## from huggingface beam search
-class BeamHypotheses(object):
-    def __init__(self, num_beams, length_penalty=1.0, early_stopping=False):
+
+## adapted from huggingface beam search
+class BatchedBeamHypotheses(object):
+    def __init__(self, batch_size, num_beams, sequence_length, length_penalty=1.0):
         """
-        Initialize n-best list of hypotheses.
+        Initialize the n-best lists of hypotheses of a batch of prompts. They are
+        kept in tensors, so that adding the hypotheses of a step and checking which
+        prompts are done do not need any host sync.
         """
         self.length_penalty = length_penalty
-        self.early_stopping = early_stopping
         self.num_beams = num_beams
-        self.beams = []
-        self.worst_score = 1e9
-
-    def __len__(self):
-        """
-        Number of hypotheses in the list.
-        """
-        return len(self.beams)
+        # Sorted from the best to the worst hypothesis, -inf for empty entries.
+        self.scores = torch.full((batch_size, num_beams), float('-inf'),
+                                 dtype=torch.float32,
+                                 device=torch.cuda.current_device())
+        self.tokens = torch.zeros((batch_size, num_beams, sequence_length),
+                                  dtype=torch.int64,
+                                  device=torch.cuda.current_device())
 
-    def add(self, hyp, sum_logprobs, length):
-        """
-        Add a new hypothesis to the list.
-        """
-        score = sum_logprobs / length ** self.length_penalty
-        if len(self) < self.num_beams or score > self.worst_score:
-            self.beams.append((score, hyp))
-            if len(self) > self.num_beams:
-                sorted_scores = sorted([(s, idx) for idx, (s, _) in enumerate(self.beams)])
-                del self.beams[sorted_scores[0][1]]
-                self.worst_score = sorted_scores[1][0]
-            else:
-                self.worst_score = min(score, self.worst_score)
+    def add(self, hyps, sum_logprobs, lengths, mask):
+        """
+        Add new hypotheses to the lists, where mask is True, and keep the
+        num_beams best hypotheses of each prompt.
+        hyps: [batch_size, num_new, sequence_length], sum_logprobs and mask:
+        [batch_size, num_new], lengths: [batch_size].
+        """
+        scores = sum_logprobs / lengths.unsqueeze(1).float() ** self.length_penalty
+        scores = scores.masked_fill(~mask, float('-inf'))
+        self.scores, indices = torch.topk(torch.cat([self.scores, scores], dim=1),
+                                          self.num_beams, dim=1)
+        self.tokens = torch.gather(
+            torch.cat([self.tokens, hyps], dim=1), 1,
+            indices.unsqueeze(2).expand(-1, -1, self.tokens.size(2)))
 
     def is_done(self, best_sum_logprobs, cur_len):
         """
-        If there are enough hypotheses and that none of the hypotheses being generated
-        can become better than the worst one in the heap, then we are done with this sentence.
+        A prompt is done if there are enough hypotheses and none of the
+        hypotheses being generated can become better than the worst one.
+        best_sum_logprobs and cur_len: [batch_size].
         """
-
-        if len(self) < self.num_beams:
-            return False
-        elif self.early_stopping:
-            return True
-        else:
-            cur_score = best_sum_logprobs / cur_len ** self.length_penalty
-            ret = self.worst_score >= cur_score
-            return ret
-
+        cur_score = best_sum_logprobs / cur_len.float() ** self.length_penalty
+        worst_score = self.scores[:, -1]
+        return (worst_score > float('-inf')) & (worst_score >= cur_score)
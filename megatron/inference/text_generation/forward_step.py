@@ -18,16 +18,22 @@ class ForwardStep:
     We use a class here to hide the inference parameters
     from the outside caller."""
 
-    def __init__(self, model, max_batch_size, max_sequence_length):
-        """Set values so we don't need to do it multiple times."""
+    def __init__(self, model, max_batch_size, max_sequence_length,
+                 use_kv_cache=True):
+        """Set values so we don't need to do it multiple times.
+        If use_kv_cache is False, the model runs without inference
+        parameters, so it does not allocate a kv cache. This is for
+        scoring, where each sequence goes through the model once."""
         # Make sure model is in eval mode.
         assert not isinstance(model, Iterable), \
             'interleaving schedule is not supported for inference'
         model.eval()
         self.model = model
         # Initialize inference parameters.
-        self.inference_params = InferenceParams(max_batch_size,
-                                                max_sequence_length)
+        self.inference_params = None
+        if use_kv_cache:
+            self.inference_params = InferenceParams(max_batch_size,
+                                                    max_sequence_length)
         # Pipelining arguments.
         args = get_args()
         self.pipeline_size_larger_than_one = (
@@ -87,7 +93,8 @@ class ForwardStep:
         output_tensor = self._forward_step_helper(tokens, position_ids,
                                                   attention_mask, recv_buffer=recv_buffer)
         # Update the sequence length offset.
-        self.inference_params.sequence_len_offset += tokens.size(1)
+        if self.inference_params is not None:
+            self.inference_params.sequence_len_offset += tokens.size(1)
 
         logits = None
         if mpu.is_pipeline_last_stage():
@@ -132,7 +139,8 @@ class ForwardStep:
             output = self._forward_step_helper(tokens2use, position_ids2use, attention_mask, recv_buffer=recv_buffer)
 
             # Adjust the batch size offset to account for the micro-batch.
-            self.inference_params.batch_size_offset += this_micro_batch_size
+            if self.inference_params is not None:
+                self.inference_params.batch_size_offset += this_micro_batch_size
 
             # Copy logits.
             if mpu.is_pipeline_last_stage():
@@ -140,9 +148,10 @@ class ForwardStep:
 
         # Once we are done with all the micro-batches, we can
         # adjust the sequence length offset.
-        self.inference_params.sequence_len_offset += sequence_length
-        # and reset the batch size offset
-        self.inference_params.batch_size_offset = 0
+        if self.inference_params is not None:
+            self.inference_params.sequence_len_offset += sequence_length
+            # and reset the batch size offset
+            self.inference_params.batch_size_offset = 0
 
         return logits
 
@@ -13,8 +13,8 @@ from .communication import (
     broadcast_from_last_pipeline_stage,
     broadcast_from_last_to_first_pipeline_stage)
 from .forward_step import ForwardStep
-from .sampling import sample
-from .beam_utils import BeamHypotheses
+from .sampling import sample, gather_log_probs
+from .beam_utils import BatchedBeamHypotheses
 
 def score_and_return_on_first_stage(model, tokens, lengths):
     """Function for just scoring.
@@ -70,14 +70,11 @@ def score_and_return_on_first_stage(model, tokens, lengths):
         if mpu.is_pipeline_last_stage():
             # Always the last stage should have an output.
             assert logits is not None
-            log_probs = F.log_softmax(logits, dim=2)
-
             # Pick the tokens that we need to get the log
             # probabilities for. Note that next input token is
             # the token which we selected in the current logits,
             # so shift by 1.
-            indices = torch.unsqueeze(tokens[:, 1:], 2)
-            output_log_probs = torch.gather(log_probs, 2, indices).squeeze(2)
+            output_log_probs = gather_log_probs(logits[:, :-1], tokens[:, 1:])
 
     # ======================================
     # Broadcast to the first pipeline stage.
@@ -87,6 +84,98 @@ def score_and_return_on_first_stage(model, tokens, lengths):
 
     return tokens, lengths, output_log_probs, logits
 
+def score_in_micro_batches_and_return_on_first_stage(
+        model, tokens, lengths, max_tokens_per_micro_batch=None):
+    """Function for scoring many sequences.
+
+    The sequences are sorted by length and split into micro-batches of
+    sequences of similar lengths, each with at most max_tokens_per_micro_batch
+    tokens once padded to its longest sequence. The micro-batches go through
+    the model one after the other, without a kv cache.
+
+    Args:
+        model: no interleaving is supported.
+        tokens: prompt tokens extended to be of size [b, max_prompt_length]
+        lengths: original prompt length, size: [b]
+        max_tokens_per_micro_batch: token budget of a micro-batch, including
+            padding. Defaults to args.max_tokens_to_oom. A sequence longer
+            than the budget is scored alone.
+    Note: Outside of model, other parameters only need to be available on
+          rank 0.
+
+    Returns:
+        output_log_probs: log probability of the selected tokens, in the
+            order of the sequences. size: [b, max_prompt_length - 1]. The
+            values after the length of each sequence are to be discarded.
+    """
+
+    args = get_args()
+
+    batch_size = tokens.size(0)
+    max_prompt_length = tokens.size(1)
+    if max_tokens_per_micro_batch is None:
+        max_tokens_per_micro_batch = args.max_tokens_to_oom
+
+    if max_prompt_length > args.max_position_embeddings:
+        raise ValueError("Length of prompt longer than allowed")
+
+    # Longest sequences first, so that the first sequence of each
+    # micro-batch sets its padded length.
+    lengths_list = lengths.tolist()
+    order = sorted(range(batch_size), key=lambda i: -lengths_list[i])
+    micro_batches = []
+    for index in order:
+        if micro_batches and (len(micro_batches[-1]) + 1) * \
+                lengths_list[micro_batches[-1][0]] <= max_tokens_per_micro_batch:
+            micro_batches[-1].append(index)
+        else:
+            micro_batches.append([index])
+
+    # forward step.
+    forward_step = ForwardStep(model, batch_size, max_prompt_length,
+                               use_kv_cache=False)
+
+    # ===================
+    # Pre-allocate memory
+    # ===================
+
+    output_log_probs = None
+    output_log_probs_size = (batch_size, max_prompt_length - 1)
+
+    if mpu.is_pipeline_last_stage():
+        output_log_probs = torch.empty(output_log_probs_size,
+                                       dtype=torch.float32,
+                                       device=torch.cuda.current_device())
+
+    # =============
+    # Run infernece
+    # =============
+    with torch.no_grad():
+        for micro_batch in micro_batches:
+            micro_batch_length = lengths_list[micro_batch[0]]
+            indices = torch.tensor(micro_batch, dtype=torch.long,
+                                   device=tokens.device)
+            tokens2use = tokens[indices, :micro_batch_length]
+            attention_mask, position_ids = \
+                _build_attention_mask_and_position_ids(tokens2use)
+
+            # logits will be meanigful only in the last pipeline stage.
+            logits = forward_step(tokens2use, position_ids, attention_mask)
+
+            if mpu.is_pipeline_last_stage():
+                # Always the last stage should have an output.
+                assert logits is not None
+                output_log_probs[indices, :micro_batch_length - 1] = \
+                    gather_log_probs(logits[:, :-1], tokens2use[:, 1:])
+
+    # ======================================
+    # Broadcast to the first pipeline stage.
+    # ======================================
+    output_log_probs = broadcast_from_last_to_first_pipeline_stage(
+        output_log_probs_size, torch.float32, output_log_probs)
+
+    return output_log_probs
+
 def generate_tokens_probs_and_return_on_first_stage(
         model, forward_step, tokens, lengths,
         return_output_log_probs=False,
@@ -95,7 +184,9 @@ def generate_tokens_probs_and_return_on_first_stage(
         use_eod_token_for_early_termination=True,
         stop_on_double_eol=False,
         stop_on_eol=False,
-        prevent_newline_after_colon=True
+        prevent_newline_after_colon=True,
+        stream_callback=None,
+        check_done_interval=None
         ):
     """Main token generation function.
 
@@ -116,6 +207,16 @@ def generate_tokens_probs_and_return_on_first_stage(
         use_eod_token_for_early_termination: if True, do early termination if
             all the sequences have reached this token.
         prevent_newline_after_colon: if True, it will disable generating new line \n after :
+        stream_callback: if set, it is called on the first stage after each
+            step with the tokens sampled at the step, size: [b], and whether
+            each prompt has started generating, size: [b], so that the
+            tokens can be streamed as they are generated.
+        check_done_interval: number of steps between the checks that all the
+            sequences are done, since each check syncs the host with the
+            device. Defaults to args.inference_check_done_interval. With more
+            than one step, generation can run up to check_done_interval - 1
+            steps after all the sequences are done, and the tokens after the
+            generated sequence lengths are to be discarded.
     Note: Outside of model, other parameters only need to be available on
           rank 0.
 
@@ -140,6 +241,10 @@ def generate_tokens_probs_and_return_on_first_stage(
     if max_sequence_length * batch_size > args.max_tokens_to_oom:
         raise ValueError("Too many tokens.  " + str(max_sequence_length*batch_size)+ " is greater than "+str(args.max_tokens_to_oom))
 
+    if check_done_interval is None:
+        check_done_interval = args.inference_check_done_interval
+    assert check_done_interval >= 1, 'check_done_interval should be positive.'
+
     # forward step.
     forward_step = forward_step(model, batch_size, max_sequence_length)
 
@@ -153,6 +258,9 @@ def generate_tokens_probs_and_return_on_first_stage(
         termination_id = tokenizer.eos_id
     else:
         raise AttributeError('No eod token found in tokenizer or args')
+    if prevent_newline_after_colon:
+        colon_id = tokenizer.tokenize(':')[0]
+        newline_id = tokenizer.tokenize('\n')[0]
 
     # ===================
     # Pre-allocate memory
@@ -197,7 +305,10 @@ def generate_tokens_probs_and_return_on_first_stage(
 
             if mpu.is_pipeline_last_stage():
                 if prevent_newline_after_colon:
-                    logits[tokens2use[:, -1] == tokenizer.tokenize(':')[0], -1, tokenizer.tokenize('\n')[0]] = -1e10 # disable "\n" after ":"
+                    # disable "\n" after ":". Unlike boolean indexing,
+                    # masked_fill_ does not sync the host with the device.
+                    logits[:, -1, newline_id].masked_fill_(
+                        tokens2use[:, -1] == colon_id, -1e10)
                 # Always the last stage should have an output.
                 assert logits is not None
 
@@ -217,29 +328,28 @@ def generate_tokens_probs_and_return_on_first_stage(
                 # length, it means we have started generating tokens
                 started = lengths <= context_length
                 # Update the tokens.
-                tokens[started, context_length] = new_sample[started]
+                tokens[:, context_length] = torch.where(
+                    started, new_sample, tokens[:, context_length])
 
                 # Calculate the log probabilities.
                 if return_output_log_probs:
-                    log_probs = F.log_softmax(logits, dim=2)
-                    if return_output_log_probs:
-                        # Pick the tokens that we need to get the log
-                        # probabilities for. Note that next input token is
-                        # the token which we selected in the current logits,
-                        # so shift by 1.
-                        indices = torch.unsqueeze(
-                            tokens[
-                                :,
-                                (prev_context_length + 1):(context_length + 1)],
-                            2)
-                        output_log_probs[:,
-                                         prev_context_length:context_length] = \
-                            torch.gather(log_probs, 2, indices).squeeze(2)
+                    # Pick the tokens that we need to get the log
+                    # probabilities for. Note that next input token is
+                    # the token which we selected in the current logits,
+                    # so shift by 1.
+                    indices = tokens[
+                        :, (prev_context_length + 1):(context_length + 1)]
+                    output_log_probs[:,
+                                     prev_context_length:context_length] = \
+                        gather_log_probs(logits, indices)
 
             # Update the tokens on the first stage so the next input to
             # the network is correct.
             copy_from_last_to_first_pipeline_stage(batch_size, torch.int64,
                                                    tokens[:, context_length])
+            if stream_callback is not None and mpu.is_pipeline_first_stage():
+                stream_callback(tokens[:, context_length],
+                                lengths <= context_length)
 
             # Update the context length for the next token generation.
             prev_context_length = context_length
@@ -262,14 +372,18 @@ def generate_tokens_probs_and_return_on_first_stage(
                         started.byte()
 
                 just_finished = (done_token & ~is_generation_done).bool()
-                generated_sequence_lengths[just_finished.view(-1)] = \
-                    context_length + 1
+                generated_sequence_lengths.masked_fill_(
+                    just_finished.view(-1), context_length + 1)
                 is_generation_done = is_generation_done | done_token
                 done = torch.all(is_generation_done)
-            done = broadcast_from_last_pipeline_stage(1, torch.uint8,
-                                                      tensor=done)
-            if use_eod_token_for_early_termination and done:
-                break
+            # The check is only done every check_done_interval steps.
+            num_steps = context_length - min_prompt_length + 1
+            if use_eod_token_for_early_termination and \
+                    num_steps % check_done_interval == 0:
+                done = broadcast_from_last_pipeline_stage(1, torch.uint8,
+                                                          tensor=done)
+                if done:
+                    break
 
     # ===================================================
     # Update the length of based on max generated length.
@@ -294,37 +408,55 @@ def generate_tokens_probs_and_return_on_first_stage(
     return tokens, generated_sequence_lengths, output_log_probs, None
 
 def beam_search_and_return_on_first_stage(model, forward_step, tokens, lengths, beam_size, stop_token, num_return_gen, length_penalty, prevent_newline_after_colon=True):
+    """Beam search for a batch of prompts.
+
+    Each prompt has beam_size rows in the batch, and the candidates of all the
+    prompts are selected, and their finished hypotheses are tracked, with
+    tensor ops only. The only host sync per step is the check that all the
+    prompts are done.
+
+    Returns:
+        tokens: the num_return_gen best hypotheses of each prompt, size:
+                [b * num_return_gen, s], grouped by prompt.
+        scores: their scores, size: [b * num_return_gen]
+    """
     args = get_args()
     tokenizer = get_tokenizer()
 
     batch_size = tokens.size(0)
-    assert(batch_size == 1)
-    prompt_length = lengths.item()
+    sequence_length = tokens.size(1)
+    min_prompt_length = lengths.min().item()
+    max_prompt_length = lengths.max().item()
     final_sequence_length = tokens.size(1)
     final_sequence_length = min(final_sequence_length, args.max_position_embeddings)
 
     # If the context is too big, this happens
-    if prompt_length >= final_sequence_length:
+    if max_prompt_length >= final_sequence_length:
         raise ValueError("context length + tokens_to_generate too large")
 
     # forward step.
-    forward_step = forward_step(model, beam_size, final_sequence_length)
+    forward_step = forward_step(model, batch_size * beam_size, final_sequence_length)
 
-    beam_hyp = BeamHypotheses(beam_size, length_penalty)
+    # The beams of prompt i are the rows [i * beam_size, (i + 1) * beam_size).
+    device = torch.cuda.current_device()
     best_batches = None
-    done = torch.zeros(1, dtype=torch.uint8, device=torch.cuda.current_device())
-    scores = torch.zeros(beam_size,
-                         dtype=torch.float32,
-                         device=torch.cuda.current_device()).unsqueeze(1)
+    done = torch.zeros(1, dtype=torch.uint8, device=device)
     scores_size_tensor, tokens_size_tensor = None, None
+    if mpu.is_pipeline_last_stage():
+        beam_hyps = BatchedBeamHypotheses(batch_size, beam_size, sequence_length, length_penalty)
+        prompt_done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        scores = torch.zeros((batch_size, beam_size), dtype=torch.float32, device=device)
+        beam_offsets = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size
+        same_beams = beam_offsets + torch.arange(beam_size, device=device).unsqueeze(0)
+        candidate_ranks = torch.arange(2 * beam_size, device=device).unsqueeze(0)
     # =============
     # Run infernece
     # =============
     with torch.no_grad():
-        tokens = tokens.repeat(beam_size, 1)
+        tokens = tokens.repeat_interleave(beam_size, dim=0)
         attention_mask, position_ids = _build_attention_mask_and_position_ids(tokens)
         prev_context_length = 0
-        for context_length in range(prompt_length, final_sequence_length):
+        for context_length in range(min_prompt_length, final_sequence_length):
 
             # Pick the slice that we need to pass through the network.
             tokens2use = tokens[:, prev_context_length:context_length]
@@ -339,46 +471,45 @@ def beam_search_and_return_on_first_stage(model, forward_step, tokens, lengths,
                 if prevent_newline_after_colon:
                     logits[tokens2use[:, -1] == tokenizer.tokenize(':')[0], -1, tokenizer.tokenize('\n')[0]] = -1e10 # disable "\n" after ":"
                 vocab_size = logits.size(2)
-                log_probs = F.log_softmax(logits, dim=2)
-                new_scores = log_probs[:, -1, :] + scores
+                log_probs = F.log_softmax(logits[:, -1, :], dim=1)
+                new_scores = log_probs.view(batch_size, beam_size, vocab_size) + scores.unsqueeze(2)
 
-                if context_length == prompt_length:  # if this is the first one
-                    sorted_scores, indices = torch.sort(new_scores[0,:], descending=True)
-                else:
-                    sorted_scores, indices = torch.sort(new_scores.view(-1), descending=True)
-
-                best_beam_ids = torch.div(indices[: 2 * beam_size], vocab_size).trunc().long()
-                best_words = indices[:2 * beam_size] % vocab_size
-                best_scores = sorted_scores[: 2 * beam_size]
-
-                next_beams = []
-                for beam_token_rank, (token_id, beam_score, beam_id) in enumerate(
-                    zip(best_words, best_scores, best_beam_ids)
-                ):
-                    if token_id.item() == stop_token:
-                        # if beam_token does not belong to top num_beams tokens, it should not be added
-                        is_beam_token_worse_than_top_num_beams = beam_token_rank >= beam_size
-                        if is_beam_token_worse_than_top_num_beams:
-                            continue
-                        beam_hyp.add(
-                            tokens[beam_id].clone(),
-                            beam_score,
-                            context_length + 1 - prompt_length
-                        )
-                    else:
-                        # add next predicted token since it is not eos_token
-                        next_beams.append((token_id, beam_score, beam_id))
-
-                    if len(next_beams) == beam_size:
-                        break
-
-                if beam_hyp.is_done(best_scores.max().item(), context_length + 1 - prompt_length):
-                    done = torch.ones(1, dtype=torch.uint8, device=torch.cuda.current_device())
-
-                best_batches = tokens.new([item[2] for item in next_beams])
-                tokens = tokens[best_batches,:]
-                tokens[:, context_length] = tokens.new([item[0] for item in next_beams])
-                scores = scores.new([item[1] for item in next_beams]).unsqueeze(1)
+                # Prompts start at their own length, with identical beams, so only
+                # the first beam is expanded at their first step.
+                started = lengths <= context_length
+                new_scores[lengths == context_length, 1:] = float('-inf')
+                generated_lengths = (context_length + 1 - lengths).clamp(min=1)
+
+                best_scores, indices = torch.topk(
+                    new_scores.view(batch_size, -1), 2 * beam_size, dim=1)
+                best_beam_ids = torch.div(indices, vocab_size, rounding_mode='floor')
+                best_words = indices % vocab_size
+                is_stop_token = best_words == stop_token
+
+                # The stop tokens among the top beam_size candidates end hypotheses.
+                generating = started & ~prompt_done
+                beam_hyps.add(
+                    tokens.view(batch_size, beam_size, -1).gather(
+                        1, best_beam_ids.unsqueeze(2).expand(-1, -1, sequence_length)),
+                    best_scores,
+                    generated_lengths,
+                    is_stop_token & (candidate_ranks < beam_size) & generating.unsqueeze(1))
+                prompt_done |= generating & beam_hyps.is_done(best_scores[:, 0], generated_lengths)
+
+                # The next beams are the best beam_size candidates without a stop token.
+                _, next_ranks = torch.topk(
+                    torch.where(is_stop_token, candidate_ranks + 2 * beam_size, candidate_ranks),
+                    beam_size, dim=1, largest=False)
+                generating = started & ~prompt_done
+                best_batches = torch.where(generating.unsqueeze(1),
+                                           beam_offsets + best_beam_ids.gather(1, next_ranks),
+                                           same_beams).view(-1)
+                tokens = tokens[best_batches, :]
+                tokens.view(batch_size, beam_size, -1)[generating, :, context_length] = \
+                    best_words.gather(1, next_ranks)[generating]
+                scores = torch.where(generating.unsqueeze(1),
+                                     best_scores.gather(1, next_ranks), scores)
+                done = prompt_done.all().to(torch.uint8).view(1)
 
             # torch.distributed.barrier()
             done = broadcast_from_last_pipeline_stage(1, torch.uint8, done)
@@ -391,7 +522,8 @@ def beam_search_and_return_on_first_stage(model, forward_step, tokens, lengths,
                                                    tokens)
 
             # set inference key values to make it consistent with best beam index
-            best_batches = broadcast_from_last_pipeline_stage(beam_size, torch.int64, best_batches)
+            best_batches = broadcast_from_last_pipeline_stage(
+                batch_size * beam_size, torch.int64, best_batches)
             forward_step.inference_params.swap_key_value_dict(best_batches)
 
             # Update the context length for the next token generation.
@@ -399,17 +531,15 @@ def beam_search_and_return_on_first_stage(model, forward_step, tokens, lengths,
 
         if mpu.is_pipeline_last_stage():
             # if cannot find stop token, add open beams to hyps
-            if not done:
-                for beam_id in range(beam_size):
-                    beam_hyp.add(tokens[beam_id].clone(), scores[beam_id].squeeze(), context_length + 1 - prompt_length)
-
-            # rank based on scores
-            sorted_hyps = sorted(beam_hyp.beams, key=lambda x: x[0], reverse=True)
-            num_return_gen = min(num_return_gen, len(sorted_hyps))
-            scores = [sorted_hyps[i][0] for i in range(num_return_gen)]
-            tokens = [sorted_hyps[i][1] for i in range(num_return_gen)]
-            scores = torch.stack(scores, dim=0)
-            tokens = torch.stack(tokens, dim=0)
+            beam_hyps.add(tokens.view(batch_size, beam_size, -1),
+                          scores,
+                          (context_length + 1 - lengths).clamp(min=1),
+                          ~prompt_done.unsqueeze(1).expand(-1, beam_size))
+
+            # hypotheses are sorted by scores
+            num_return_gen = min(num_return_gen, beam_size)
+            scores = beam_hyps.scores[:, :num_return_gen].reshape(-1)
+            tokens = beam_hyps.tokens[:, :num_return_gen].reshape(-1, sequence_length)
             scores_size_tensor = torch.tensor(scores.shape, dtype=torch.int64, device=torch.cuda.current_device())
             tokens_size_tensor = torch.tensor(tokens.shape, dtype=torch.int64, device=torch.cuda.current_device())
 
@@ -42,6 +42,29 @@ def modify_logits_for_top_p_filtering(logits, top_p):
 
 
 
+def get_top_p_probs(logits, top_p):
+    """Probabilities of the top-p tokens of each row, sorted in descending
+    order, and their indices in the vocabulary.
+    The tokens filtered out by modify_logits_for_top_p_filtering have a
+    probability of 0, and the probabilities are not normalized again. The
+    filtering is done on the sorted probabilities, so the logits are neither
+    copied nor scattered back, and there is no host synchronization.
+    """
+
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+    probs = sorted_logits.softmax(dim=-1)
+    cumulative_probs = probs.cumsum(dim=-1)
+
+    # Same filtering as modify_logits_for_top_p_filtering, including its
+    # shift by 1, which always keeps the first token.
+    filter_ = torch.zeros_like(cumulative_probs, dtype=torch.bool)
+    filter_[:, 1:] = cumulative_probs[:, :-1] > top_p
+    probs.masked_fill_(filter_, 0.0)
+
+    return probs, sorted_indices
+
+
+
 def sample(logits, top_k=0, top_p=0.0, temperature=1.0, vocab_size=None):
     """ Sample and generate a token.
     Note: logits has the dimension [b, v] where b is the batch size
@@ -49,6 +72,9 @@ def sample(logits, top_k=0, top_p=0.0, temperature=1.0, vocab_size=None):
     If vocab_size is provided, we will make sure the sample that is
     generated is in [0, vocab-size). This will avoid out of vocabulary
     generations due to padding.
+    Top-k sampling only samples from the top-k tokens, top-p sampling samples
+    from the sorted probabilities (see get_top_p_probs), and the logits are
+    not copied.
     """
 
     # Check logits for consistency.
@@ -64,26 +90,39 @@ def sample(logits, top_k=0, top_p=0.0, temperature=1.0, vocab_size=None):
 
     # Top-k or top-p sampling.
     else:
-        # Clone so we do not modify the inputs,
-        logits = logits.clone()
-        # Apply temperature in place.
-        if temperature != 1.0:
-            logits.div_(temperature)
-
+        candidate_indices = None
         if top_k > 1:
             assert top_p == 0.0, 'cannot set both top-k and top-p samplings.'
             assert top_k <= logits.size(1), 'top-k is larger than logit size.'
             if vocab_size:
                 assert top_k < vocab_size, 'top-k is larger than vocab size.'
-            modify_logits_for_top_k_filtering(logits, top_k)
+            # The top-k candidates, sorted.
+            logits, candidate_indices = torch.topk(logits, top_k)
+            if temperature != 1.0:
+                logits = logits / temperature
+            probs = logits.softmax(dim=-1)
 
         elif top_p > 0.0:
             assert top_p <= 1.0, 'top-p should be in (0, 1].'
-            modify_logits_for_top_p_filtering(logits, top_p)
-
-        # After filtering, we need to recalculate the distribution.
-        probs = logits.softmax(dim=-1)
-        samples = torch.multinomial(probs, num_samples=1).view(-1)
+            if temperature != 1.0:
+                logits = logits / temperature
+            if top_p < 1.0:
+                probs, candidate_indices = get_top_p_probs(logits, top_p)
+            else:
+                # Top-p of 1 keeps every token.
+                probs = logits.softmax(dim=-1)
+
+        else:
+            if temperature != 1.0:
+                logits = logits / temperature
+            probs = logits.softmax(dim=-1)
+
+        # multinomial does not need the filtered probabilities to be
+        # normalized.
+        samples = torch.multinomial(probs, num_samples=1)
+        if candidate_indices is not None:
+            samples = torch.gather(candidate_indices, 1, samples)
+        samples = samples.view(-1)
 
     # If vocab size is provided, make sure the samples are in
     # in the range [0, vocab-size).
@@ -91,3 +130,14 @@ def sample(logits, top_k=0, top_p=0.0, temperature=1.0, vocab_size=None):
         samples = torch.clamp(samples, min=0, max=(vocab_size - 1))
 
     return samples
+
+
+
+def gather_log_probs(logits, indices):
+    """Log probabilities of the given tokens.
+    Note: logits has the dimension [b, s, v] and indices [b, s]. Only the
+          log-sum-exp of each row of logits is computed, instead of the
+          [b, s, v] log probabilities of log_softmax.
+    """
+    selected_logits = torch.gather(logits, 2, indices.unsqueeze(2)).squeeze(2)
+    return selected_logits - torch.logsumexp(logits, dim=2)
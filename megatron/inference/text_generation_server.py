@@ -1,22 +1,38 @@
 # Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+import asyncio
+import concurrent.futures
 import datetime
 import torch
 import json
+import queue
 import threading
-from flask import Flask, request, jsonify, current_app
+import time
+import traceback
+from flask import Flask, request, jsonify, current_app, Response, stream_with_context
 from flask_restful import Resource, Api
-from megatron.training import get_args
+from megatron.training import get_args, get_tokenizer
+from megatron.core.inference.common_inference_params import CommonInferenceParams
+from megatron.core.inference.engines.async_mcore_engine import AsyncMCoreEngine
+from megatron.core.inference.inference_request import InferenceRequest, Status
 from megatron.inference.text_generation import generate_and_post_process
 from megatron.inference.text_generation import beam_search_and_post_process
+from megatron.inference.text_generation import score_and_post_process
 
 
 GENERATE_NUM = 0
 BEAM_NUM = 1
+SCORE_NUM = 2
 lock = threading.Lock()
 
 class MegatronGenerate(Resource):
-    def __init__(self, model):
+    def __init__(self, model, async_engine=None, engine_loop=None, request_timeout=None):
         self.model = model
+        # With an inference engine, requests are batched by the engine loop
+        # running on engine_loop instead of being served one at a time
+        self.async_engine = async_engine
+        self.engine_loop = engine_loop
+        # Seconds to wait for the engine to generate a request, or None to wait forever
+        self.request_timeout = request_timeout
 
     @staticmethod
     def send_do_generate():
@@ -27,7 +43,159 @@ class MegatronGenerate(Resource):
     def send_do_beam_search():
         choice = torch.tensor([BEAM_NUM], dtype=torch.long, device='cuda')
         torch.distributed.broadcast(choice, 0)
+
+    def stream_generate(self, prompts, stop_on_double_eol, stop_on_eol, **generate_kwargs):
+        """Generates the prompts in a background thread, and streams the generated
+        text as server-sent events. Each step yields an event with the text
+        generated for each prompt since the previous event, and the last event
+        has the same content as the non streaming response."""
+        args = get_args()
+        tokenizer = get_tokenizer()
+        termination_id = args.eos_id if hasattr(args, 'eos_id') else tokenizer.eod
+        events = queue.Queue()
+
+        def stream_callback(new_tokens, started):
+            events.put((new_tokens.tolist(), started.tolist()))
+
+        def run():
+            with lock:  # Need to get lock to keep multiple threads from hitting code
+                try:
+                    MegatronGenerate.send_do_generate()  # Tell other ranks we're doing generate
+                    response, response_seg, response_logprobs, _ = \
+                        generate_and_post_process(
+                        self.model,
+                        prompts=prompts,
+                        stop_on_double_eol=stop_on_double_eol,
+                        stop_on_eol=stop_on_eol,
+                        stream_callback=stream_callback,
+                        **generate_kwargs)
+                    events.put({"text": response,
+                        "segments": response_seg,
+                        "logprobs": response_logprobs})
+                except ValueError as ve:
+                    events.put({"error": ve.args[0]})
+                print("end time: ", datetime.datetime.now())
+
+        threading.Thread(target=run, daemon=True).start()
+
+        generated_tokens = [[] for _ in prompts]
+        streamed_texts = ["" for _ in prompts]
+        is_done = [False for _ in prompts]
+        while True:
+            event = events.get()
+            if isinstance(event, dict):
+                yield "data: " + json.dumps(event) + "\n\n"
+                return
+            new_tokens, started = event
+            text_deltas = []
+            for i, (token, has_started) in enumerate(zip(new_tokens, started)):
+                if has_started and not is_done[i]:
+                    previous_token = generated_tokens[i][-1] if generated_tokens[i] else None
+                    generated_tokens[i].append(token)
+                    # Same stopping criteria as the generation loop
+                    if stop_on_double_eol:
+                        is_done[i] = token == 628 or (token == 198 and previous_token == 198)
+                    elif stop_on_eol:
+                        is_done[i] = token == 628 or token == 198
+                    else:
+                        is_done[i] = token == termination_id
+                # Wait for the next tokens to complete a partial multi byte character
+                text = tokenizer.detokenize(generated_tokens[i]).rstrip('\ufffd')
+                text_deltas.append(text[len(streamed_texts[i]):])
+                streamed_texts[i] = text
+            yield "data: " + json.dumps({"text": text_deltas}) + "\n\n"
     
+    def engine_response(self, requests, logprobs):
+        """Formats completed engine requests like the response of generate_and_post_process"""
+        tokenizer = get_tokenizer()
+        response, response_seg, response_logprobs = [], [], []
+        for inference_request in requests:
+            tokens = list(inference_request.prompt_tokens) + \
+                inference_request.generated_tokens.tolist()
+            response.append(inference_request.prompt + inference_request.generated_text)
+            response_seg.append([tokenizer.detokenize([token]) for token in tokens])
+            if logprobs:
+                response_logprobs.append(inference_request.generated_log_probs.tolist())
+        return {"text": response,
+            "segments": response_seg,
+            "logprobs": response_logprobs if logprobs else None}
+
+    def engine_generate(self, prompts, common_inference_params):
+        """Queues the prompts in the engine loop, and waits for their results.
+        Either all the prompts are queued, or none of them if one is too long."""
+        async def generate():
+            loop = asyncio.get_running_loop()
+            futures = [loop.create_future() for _ in prompts]
+            self.async_engine.queue_requests(
+                prompts, common_inference_params, futures=futures)
+            return await asyncio.gather(*futures)
+
+        future = asyncio.run_coroutine_threadsafe(generate(), self.engine_loop)
+        try:
+            requests = future.result(timeout=self.request_timeout)
+        except concurrent.futures.TimeoutError:
+            # The requests are dropped once they complete
+            future.cancel()
+            raise
+        return self.engine_response(requests, common_inference_params.return_log_probs)
+
+    def engine_stream_generate(self, prompts, common_inference_params):
+        """Queues the prompts in the engine loop, and streams the generated
+        text as server-sent events, like stream_generate. An event is sent
+        each time a prompt generates tokens, and an error event if the
+        prompts cannot be queued, the engine loop fails, or no event arrives
+        within the request timeout."""
+        events = queue.Queue()
+
+        async def stream_prompt(index, future, stream):
+            try:
+                while True:
+                    delta = await stream.get()
+                    if isinstance(delta, BaseException):
+                        raise delta
+                    events.put((index, delta.generated_text))
+                    if delta.status == Status.COMPLETED:
+                        break
+                events.put((index, await future))
+            except Exception as e:
+                events.put((index, e))
+
+        async def queue_prompts():
+            loop = asyncio.get_running_loop()
+            futures = [loop.create_future() for _ in prompts]
+            streams = [asyncio.Queue() for _ in prompts]
+            try:
+                self.async_engine.queue_requests(
+                    prompts, common_inference_params, futures=futures, streams=streams)
+            except (ValueError, RuntimeError) as e:
+                events.put((None, e))
+                return
+            for index, (future, stream) in enumerate(zip(futures, streams)):
+                loop.create_task(stream_prompt(index, future, stream))
+
+        asyncio.run_coroutine_threadsafe(queue_prompts(), self.engine_loop)
+
+        requests = [None for _ in prompts]
+        num_completed = 0
+        while num_completed < len(prompts):
+            try:
+                index, event = events.get(timeout=self.request_timeout)
+            except queue.Empty:
+                yield "data: " + json.dumps({"error": "request timed out"}) + "\n\n"
+                return
+            if isinstance(event, Exception):
+                yield "data: " + json.dumps({"error": str(event)}) + "\n\n"
+                return
+            if isinstance(event, InferenceRequest):
+                requests[index] = event
+                num_completed += 1
+                continue
+            text_deltas = ["" for _ in prompts]
+            text_deltas[index] = event
+            yield "data: " + json.dumps({"text": text_deltas}) + "\n\n"
+        response = self.engine_response(requests, common_inference_params.return_log_probs)
+        yield "data: " + json.dumps(response) + "\n\n"
+
     def put(self):
         args = get_args()
        
@@ -161,8 +329,6 @@ class MegatronGenerate(Resource):
                 return "beam_width must be integer"
             if beam_width < 1:
                 return "beam_width must be an integer > 1"
-            if len(prompts) > 1:
-                return "When doing beam_search, batch size must be 1"
 
         stop_token=50256
         if "stop_token" in request.get_json():
@@ -175,6 +341,94 @@ class MegatronGenerate(Resource):
             length_penalty = request.get_json()["length_penalty"]
             if not isinstance(length_penalty, float):
                 return "length_penalty must be a float"
+
+        stream = False
+        if "stream" in request.get_json():
+            stream = request.get_json()["stream"]
+            if not isinstance(stream, bool):
+                return "stream must be a boolean value"
+            if stream and beam_width is not None:
+                return "stream is not supported with beam_search"
+            if stream and tokens_to_generate == 0:
+                return "stream requires tokens_to_generate > 0"
+
+        priority = 0
+        if "priority" in request.get_json():
+            priority = request.get_json()["priority"]
+            if not isinstance(priority, int):
+                return "priority must be an integer"
+
+        deadline = None
+        if "deadline" in request.get_json():
+            deadline = request.get_json()["deadline"]
+            if not isinstance(deadline, (int, float)) or deadline <= 0:
+                return "deadline must be a positive number of seconds"
+            # Seconds from now, as a timestamp
+            deadline = time.time() + deadline
+
+        if (priority != 0 or deadline is not None) and self.async_engine is None:
+            return "priority and deadline require the inference engine"
+
+        if self.async_engine is not None:
+            if beam_width is not None or add_BOS or stop_on_double_eol or stop_on_eol or \
+                    prevent_newline_after_colon or top_p_decay > 0.0 or top_p_bound > 0.0:
+                return "beam_width, add_BOS, stop_on_double_eol, stop_on_eol, prevent_newline_after_colon, " \
+                    "top_p_decay and top_p_bound are not supported with the inference engine"
+            if tokens_to_generate == 0:
+                return "tokens_to_generate must be greater than 0 with the inference engine"
+
+            if not no_log:
+                print("request IP: " + str(request.remote_addr))
+                print(json.dumps(request.get_json()),flush=True)
+                print("start time: ", datetime.datetime.now())
+
+            common_inference_params = CommonInferenceParams(
+                temperature=temperature,
+                top_k=int(top_k),
+                top_p=top_p,
+                return_log_probs=logprobs,
+                num_tokens_to_generate=tokens_to_generate,
+                seed=random_seed if random_seed >= 0 else None,
+                priority=priority,
+                deadline=deadline)
+            try:
+                if stream:
+                    return Response(
+                        stream_with_context(self.engine_stream_generate(
+                            prompts, common_inference_params)),
+                        mimetype='text/event-stream')
+                return jsonify(self.engine_generate(prompts, common_inference_params))
+            except concurrent.futures.TimeoutError:
+                return "request timed out", 504
+            except ValueError as ve:
+                return str(ve), 400
+            except Exception as e:
+                # The engine loop failed, or is stopped
+                return str(e), 500
+
+        if stream:
+            if not no_log:
+                print("request IP: " + str(request.remote_addr))
+                print(json.dumps(request.get_json()),flush=True)
+                print("start time: ", datetime.datetime.now())
+
+            return Response(
+                stream_with_context(self.stream_generate(
+                    prompts,
+                    stop_on_double_eol=stop_on_double_eol,
+                    stop_on_eol=stop_on_eol,
+                    tokens_to_generate=tokens_to_generate,
+                    return_output_log_probs=logprobs,
+                    top_k_sampling=top_k,
+                    top_p_sampling=top_p,
+                    top_p_decay=top_p_decay,
+                    top_p_bound=top_p_bound,
+                    temperature=temperature,
+                    add_BOS=add_BOS,
+                    use_eod_token_for_early_termination=True,
+                    prevent_newline_after_colon=prevent_newline_after_colon,
+                    random_seed=random_seed)),
+                mimetype='text/event-stream')
         
         with lock:  # Need to get lock to keep multiple threads from hitting code
             
@@ -231,11 +485,111 @@ class MegatronGenerate(Resource):
             print("end time: ", datetime.datetime.now())
         
 
-class MegatronServer(object):
+class MegatronScore(Resource):
+    """Scores the prompts, i.e. returns the log probs of their tokens.
+    Unlike /api with tokens_to_generate=0, there is no limit on the number
+    of prompts, which are scored in length-bucketed micro-batches (See
+    score_and_post_process)."""
     def __init__(self, model):
+        self.model = model
+
+    @staticmethod
+    def send_do_score():
+        choice = torch.tensor([SCORE_NUM], dtype=torch.long, device='cuda')
+        torch.distributed.broadcast(choice, 0)
+
+    def put(self):
+        if not "prompts" in request.get_json():
+            return "prompts argument required", 400
+
+        prompts = request.get_json()["prompts"]
+        if not isinstance(prompts, list):
+            return "prompts is not a list of strings", 400
+
+        if len(prompts) == 0:
+            return "prompts is empty", 400
+
+        add_BOS = False
+        if "add_BOS" in request.get_json():
+            add_BOS = request.get_json()["add_BOS"]
+            if not isinstance(add_BOS, bool):
+                return "add_BOS must be a boolean value"
+
+        if any([len(prompt) == 0 for prompt in prompts]) and not add_BOS:
+            return "Empty prompts require add_BOS=true"
+
+        max_tokens_per_micro_batch = 0
+        if "max_tokens_per_micro_batch" in request.get_json():
+            max_tokens_per_micro_batch = request.get_json()["max_tokens_per_micro_batch"]
+            if not isinstance(max_tokens_per_micro_batch, int) or max_tokens_per_micro_batch < 1:
+                return "max_tokens_per_micro_batch must be a positive integer"
+
+        no_log = False
+        if "no_log" in request.get_json():
+            no_log = request.get_json()["no_log"]
+            if not isinstance(no_log, bool):
+                return "no_log must be a boolean value"
+
+        with lock:  # Need to get lock to keep multiple threads from hitting code
+
+            if not no_log:
+                print("request IP: " + str(request.remote_addr))
+                print("number of prompts: " + str(len(prompts)), flush=True)
+                print("start time: ", datetime.datetime.now())
+
+            try:
+                MegatronScore.send_do_score()  # Tell other ranks we're doing score
+                response, response_seg, response_logprobs = \
+                    score_and_post_process(
+                    self.model,
+                    prompts=prompts,
+                    add_BOS=add_BOS,
+                    max_tokens_per_micro_batch=max_tokens_per_micro_batch)
+
+                return jsonify({"text": response,
+                    "segments": response_seg,
+                    "logprobs": response_logprobs})
+
+            except ValueError as ve:
+                return ve.args[0]
+            print("end time: ", datetime.datetime.now())
+
+
+class MegatronServer(object):
+    def __init__(self, model, engine=None, request_timeout=None):
+        """If an MCoreEngine is given, the generate requests are served by its
+        engine loop, which batches the concurrent requests together, and the
+        other ranks must run AsyncMCoreEngine(engine).run_worker_loop().
+        Requests that the engine does not complete within request_timeout
+        seconds fail, and if the engine loop fails, the pending and new
+        requests fail with its exception."""
         self.app = Flask(__name__, static_url_path='')
         api = Api(self.app)
-        api.add_resource(MegatronGenerate, '/api', resource_class_args=[model])
+
+        async_engine = None
+        engine_loop = None
+        if engine is not None:
+            async_engine = AsyncMCoreEngine(engine)
+            engine_loop = asyncio.new_event_loop()
+            device = torch.cuda.current_device()
+
+            def run_engine_loop():
+                torch.cuda.set_device(device)
+                asyncio.set_event_loop(engine_loop)
+                try:
+                    engine_loop.run_until_complete(async_engine.run_engine_loop())
+                except Exception:
+                    traceback.print_exc()
+                    # Keep the event loop running, to reject the new requests
+                    engine_loop.run_forever()
+
+            threading.Thread(target=run_engine_loop, daemon=True).start()
+        api.add_resource(MegatronGenerate, '/api',
+                         resource_class_args=[model, async_engine, engine_loop, request_timeout])
+        if engine is None:
+            # With an inference engine, the other ranks run the engine loop
+            api.add_resource(MegatronScore, '/score',
+                             resource_class_args=[model])
         
     def run(self, url, port): 
         self.app.run(url, threaded=True, debug=False, port=port)
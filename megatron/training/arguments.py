@@ -710,6 +710,14 @@ def _add_inference_args(parser):
                        help='Maximum number of tokens during inference'
                        'tokens here is # in prompt + # to generate'
                        'Allows us to throw an error before OOM crashes server')
+    group.add_argument('--inference-check-done-interval',
+                       type=int, default=1,
+                       help='During inference, number of generation steps '
+                       'between the checks that all the sequences are done. '
+                       'Each check syncs the host with the device, so larger '
+                       'values reduce the per-token overhead, at the cost of '
+                       'up to this number of steps minus one after all the '
+                       'sequences are done.')
     group.add_argument('--output-bert-embeddings', action='store_true',
                        help='Output Bert embeddings (via mean pooling) from '
                        'model, rather than its binary head output or entire '
@@ -0,0 +1,38 @@
+# Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+
+import numpy
+
+from tools.openwebtext.find_duplicates_minhash import (
+    find_duplicate_clusters,
+    get_permutations,
+    minhash_signature,
+    shingle_hashes,
+)
+
+
+def get_signatures(texts, num_perm=64, char_ngram=5):
+    permutations = get_permutations(num_perm, seed=1234)
+    return numpy.stack(
+        [minhash_signature(shingle_hashes(text, char_ngram), permutations) for text in texts]
+    )
+
+
+def test_find_duplicate_clusters():
+    text = "the quick brown fox jumps over the lazy dog " * 4
+    texts = [text, "an unrelated document about something else entirely", text + "!"]
+    clusters = find_duplicate_clusters(get_signatures(texts), num_bands=16, threshold=0.7)
+    assert [cluster.tolist() for cluster in clusters] == [[0, 2]]
+
+
+def test_documents_without_shingles_are_not_duplicates():
+    text = "the quick brown fox jumps over the lazy dog"
+    # Documents shorter than the shingle size have no shingles, and the same signature
+    texts = ["", "abc", text, "", "abcd", text]
+    signatures = get_signatures(texts)
+    assert (signatures[0] == signatures[1]).all()
+
+    clusters = find_duplicate_clusters(signatures, num_bands=16, threshold=0.7)
+    assert [cluster.tolist() for cluster in clusters] == [[2, 5]]
+
+    clusters = find_duplicate_clusters(signatures[[0, 1, 3]], num_bands=16, threshold=0.7)
+    assert clusters == []
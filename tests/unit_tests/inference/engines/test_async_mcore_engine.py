@@ -0,0 +1,193 @@
+import asyncio
+import random
+from typing import List
+from unittest import mock
+
+import pytest
+import torch
+
+from megatron.core.inference.common_inference_params import CommonInferenceParams
+from megatron.core.inference.engines.async_mcore_engine import AsyncMCoreEngine
+from megatron.core.inference.engines.mcore_engine import MCoreEngine
+from megatron.core.inference.inference_request import InferenceRequestDelta, Status
+from megatron.core.inference.model_inference_wrappers.gpt.gpt_inference_wrapper import (
+    GPTInferenceWrapper,
+)
+from megatron.core.inference.model_inference_wrappers.inference_wrapper_config import (
+    InferenceWrapperConfig,
+)
+from megatron.core.inference.text_generation_controllers.simple_text_generation_controller import (
+    SimpleTextGenerationController,
+)
+from megatron.core.models.gpt.gpt_layer_specs import get_gpt_layer_local_spec
+from megatron.core.models.gpt.gpt_model import GPTModel
+from megatron.core.tensor_parallel.random import model_parallel_cuda_manual_seed
+from megatron.core.transformer.transformer_config import TransformerConfig
+from tests.unit_tests.test_utilities import Utils
+
+
+class TestAsyncMCoreEngine:
+    def setup_method(self, method):
+        Utils.initialize_model_parallel(
+            tensor_model_parallel_size=1, pipeline_model_parallel_size=1
+        )
+        model_parallel_cuda_manual_seed(123)
+        self.batch_size = 4
+        self.hidden_size = 12
+        self.vocab_size = 100
+        self.sequence_length = 64
+        transformer_config = TransformerConfig(
+            num_layers=4,
+            hidden_size=self.hidden_size,
+            num_attention_heads=4,
+            use_cpu_initialization=True,
+        )
+
+        gpt_model = GPTModel(
+            config=transformer_config,
+            transformer_layer_spec=get_gpt_layer_local_spec(),
+            vocab_size=self.vocab_size,
+            max_sequence_length=self.sequence_length,
+            parallel_output=True,
+        ).cuda()
+
+        inference_wrapper_config = InferenceWrapperConfig(
+            hidden_size=self.hidden_size,
+            inference_batch_times_seqlen_threshold=400,
+            fp32_residual_connection=False,
+            params_dtype=torch.float,
+            padded_vocab_size=self.vocab_size,
+        )
+
+        inference_wrapped_model = GPTInferenceWrapper(gpt_model, inference_wrapper_config)
+        self.mock_tokenizer = mock.Mock()
+        self.mock_tokenizer.vocab_size = self.vocab_size
+        self.mock_tokenizer.eod = self.vocab_size - 1
+        self.mock_tokenizer.tokenize.side_effect = lambda prompt: [
+            random.randint(0, self.vocab_size - 2) for _ in range(len(prompt))
+        ]
+        self.mock_tokenizer.detokenize.side_effect = lambda tokens: ' '.join(map(str, tokens))
+        text_generation_controller = SimpleTextGenerationController(
+            inference_wrapped_model=inference_wrapped_model, tokenizer=self.mock_tokenizer
+        )
+
+        self.mcore_engine = MCoreEngine(
+            text_generation_controller=text_generation_controller,
+            max_batch_size=self.batch_size,
+            max_sequence_length=self.sequence_length,
+        )
+        self.async_engine = AsyncMCoreEngine(self.mcore_engine)
+
+    def teardown_method(self, method):
+        Utils.destroy_model_parallel()
+
+    def test_generate_concurrent_requests(self):
+        step_batch_sizes = []
+        run_engine_step = self.mcore_engine.run_engine_step
+
+        def run_engine_step_wrapper(dynamic_generation):
+            step_batch_sizes.append(len(self.mcore_engine.scheduler.active_request_pool))
+            return run_engine_step(dynamic_generation)
+
+        self.mcore_engine.run_engine_step = run_engine_step_wrapper
+
+        async def client(i):
+            # Clients arrive while the engine loop is running
+            await asyncio.sleep(0)
+            return await self.async_engine.generate(
+                "sample" * (i + 1), CommonInferenceParams(num_tokens_to_generate=i + 2)
+            )
+
+        async def serve():
+            engine_loop = asyncio.create_task(self.async_engine.run_engine_loop())
+            results = await asyncio.gather(*[client(i) for i in range(2 * self.batch_size)])
+            self.async_engine.stop()
+            await engine_loop
+            return results
+
+        results = asyncio.run(serve())
+
+        for i, result in enumerate(results):
+            assert result.prompt == "sample" * (i + 1), "Each future should get its own request"
+            assert (
+                result.status == Status.COMPLETED
+            ), f"Status should be completed but its {result.status}"
+            assert result.generated_length <= i + 2
+        assert (
+            max(step_batch_sizes) == self.batch_size
+        ), "Concurrent requests should be batched together"
+        assert len(self.mcore_engine.scheduler.completed_request_pool) == 0
+        assert sorted(self.mcore_engine.scheduler.free_kv_cache_slots) == list(
+            range(self.batch_size)
+        ), "All the kv cache slots should be free once all requests are completed"
+
+    def test_generate_stream(self):
+        async def client(i):
+            deltas: List[InferenceRequestDelta] = []
+            async for delta in self.async_engine.generate_stream(
+                "sample" * (i + 1), CommonInferenceParams(num_tokens_to_generate=10)
+            ):
+                deltas.append(delta)
+            return deltas
+
+        async def serve():
+            engine_loop = asyncio.create_task(self.async_engine.run_engine_loop())
+            streams = await asyncio.gather(*[client(i) for i in range(self.batch_size)])
+            self.async_engine.stop()
+            await engine_loop
+            return streams
+
+        streams = asyncio.run(serve())
+
+        for deltas in streams:
+            assert len({delta.request_id for delta in deltas}) == 1
+            assert deltas[-1].status == Status.COMPLETED, "The last delta should be completed"
+            generated_tokens = [token for delta in deltas for token in delta.generated_tokens]
+            assert len(generated_tokens) <= 10
+            assert ''.join(delta.generated_text for delta in deltas) == ' '.join(
+                map(str, generated_tokens)
+            )
+
+    def test_queue_requests_too_long(self):
+        prompts = ["sample", "sample" * self.sequence_length]
+        with pytest.raises(ValueError):
+            self.async_engine.queue_requests(
+                prompts, CommonInferenceParams(num_tokens_to_generate=10)
+            )
+        assert len(self.async_engine.queued_requests) == 0, "No prompt should be queued"
+        assert len(self.async_engine.queued_outputs) == 0
+
+    def test_engine_loop_failure(self):
+        def run_engine_step(dynamic_generation):
+            raise RuntimeError("step failed")
+
+        self.mcore_engine.run_engine_step = run_engine_step
+
+        async def stream_client():
+            async for _ in self.async_engine.generate_stream(
+                "sample", CommonInferenceParams(num_tokens_to_generate=10)
+            ):
+                pass
+
+        async def serve():
+            engine_loop = asyncio.create_task(self.async_engine.run_engine_loop())
+            results = await asyncio.gather(
+                self.async_engine.generate(
+                    "sample", CommonInferenceParams(num_tokens_to_generate=10)
+                ),
+                stream_client(),
+                return_exceptions=True,
+            )
+            with pytest.raises(RuntimeError, match="step failed"):
+                await engine_loop
+            return results
+
+        results = asyncio.run(serve())
+
+        assert all(
+            isinstance(result, RuntimeError) and str(result) == "step failed" for result in results
+        ), "The pending requests should fail with the exception of the engine loop"
+        with pytest.raises(RuntimeError, match="engine loop failed"):
+            self.async_engine.queue_request(
+                "sample", CommonInferenceParams(num_tokens_to_generate=10)
+            )
@@ -1,13 +1,20 @@
+import asyncio
 import random
 import string
 from typing import List
 from unittest import mock
 
+import pytest
 import torch
 
 from megatron.core.inference.common_inference_params import CommonInferenceParams
+from megatron.core.inference.detokenizer import DetokenizationWorker
 from megatron.core.inference.engines.mcore_engine import MCoreEngine
-from megatron.core.inference.inference_request import InferenceRequest, Status
+from megatron.core.inference.inference_request import (
+    InferenceRequest,
+    InferenceRequestDelta,
+    Status,
+)
 from megatron.core.inference.model_inference_wrappers.gpt.gpt_inference_wrapper import (
     GPTInferenceWrapper,
 )
@@ -70,7 +77,12 @@ class TestMCoreEngine:
     def teardown_method(self, method):
         Utils.destroy_model_parallel()
 
-    def test_generate(self):
+    @pytest.mark.parametrize("detokenize_in_background", [False, True])
+    def test_generate(self, detokenize_in_background):
+        if detokenize_in_background:
+            self.mcore_engine.text_generation_controller.detokenization_worker = (
+                DetokenizationWorker()
+            )
         self.mock_tokenizer.vocab_size = self.vocab_size
         self.mock_tokenizer.eod = self.vocab_size - 1
         # Generating random length integer prompts
@@ -93,3 +105,166 @@ class TestMCoreEngine:
             ), f"Status should be completed but its {result.status}"
             assert result.generated_length > 0, f"Generated length should be greater than zero"
             assert result.generated_text is not None, f'Generated text should not be None'
+
+    def test_generate_dynamic_batching(self):
+        self.mock_tokenizer.vocab_size = self.vocab_size
+        self.mock_tokenizer.eod = self.vocab_size - 1
+        # Generating random length integer prompts
+        self.mock_tokenizer.tokenize.return_value = [
+            random.randint(0, self.vocab_size - 1) for _ in range(random.randint(5, 10))
+        ]
+        # Generates some random string
+        self.mock_tokenizer.detokenize.return_value = ''.join(
+            random.choices(string.ascii_letters, k=random.randint(4, 10))
+        )
+
+        # More prompts than the max batch size, so waiting requests join the batch as others complete
+        prompts = ["sample" * (i + 1) for i in range(3 * self.batch_size)]
+        results: List[InferenceRequest] = self.mcore_engine.generate(
+            prompts,
+            common_inference_params=CommonInferenceParams(num_tokens_to_generate=10),
+            dynamic_generation=True,
+        )
+
+        assert len(results) == len(
+            prompts
+        ), f"Expected {len(prompts)} results but got {len(results)}"
+        for prompt, result in zip(prompts, results):
+            assert result.prompt == prompt, "Results should be in the order of the prompts"
+            assert (
+                result.status == Status.COMPLETED
+            ), f"Status should be completed but its {result.status}"
+            assert result.generated_text is not None, f'Generated text should not be None'
+
+        assert sorted(self.mcore_engine.scheduler.free_kv_cache_slots) == list(
+            range(self.batch_size)
+        ), "All the kv cache slots should be free once all requests are completed"
+
+    @pytest.mark.parametrize("enable_prefix_caching", [False, True])
+    def test_generate_dynamic_batching_paged_kv_cache(self, enable_prefix_caching):
+        self.mock_tokenizer.vocab_size = self.vocab_size
+        self.mock_tokenizer.eod = self.vocab_size - 1
+        self.mock_tokenizer.tokenize.return_value = [
+            random.randint(0, self.vocab_size - 1) for _ in range(random.randint(5, 10))
+        ]
+        self.mock_tokenizer.detokenize.return_value = ''.join(
+            random.choices(string.ascii_letters, k=random.randint(4, 10))
+        )
+
+        # A pool that cannot hold all the active requests, so that some of them are preempted
+        mcore_engine = MCoreEngine(
+            text_generation_controller=self.mcore_engine.text_generation_controller,
+            max_batch_size=self.batch_size,
+            max_sequence_length=24,
+            num_kv_cache_blocks=8,
+            kv_cache_block_size=4,
+            enable_prefix_caching=enable_prefix_caching,
+        )
+        prompts = ["sample" * (i + 1) for i in range(3 * self.batch_size)]
+        results: List[InferenceRequest] = mcore_engine.generate(
+            prompts,
+            common_inference_params=CommonInferenceParams(num_tokens_to_generate=10),
+            dynamic_generation=True,
+        )
+
+        assert len(results) == len(
+            prompts
+        ), f"Expected {len(prompts)} results but got {len(results)}"
+        for prompt, result in zip(prompts, results):
+            assert result.prompt == prompt, "Results should be in the order of the prompts"
+            assert (
+                result.status == Status.COMPLETED
+            ), f"Status should be completed but its {result.status}"
+
+        kv_cache_block_allocator = mcore_engine.text_generation_controller.kv_cache_block_allocator
+        assert (
+            kv_cache_block_allocator.num_free_blocks == 8
+        ), "All the kv cache blocks should be free once all requests are completed"
+        if enable_prefix_caching:
+            # The mock tokenizer returns the same prompt tokens for every prompt
+            assert kv_cache_block_allocator.num_hit_blocks > 0, "Prompt prefixes should be reused"
+
+    def test_generate_dynamic_batching_chunked_prefill(self):
+        self.mock_tokenizer.vocab_size = self.vocab_size
+        self.mock_tokenizer.eod = self.vocab_size - 1
+        self.mock_tokenizer.tokenize.return_value = [
+            random.randint(0, self.vocab_size - 1) for _ in range(random.randint(20, 30))
+        ]
+        self.mock_tokenizer.detokenize.return_value = ''.join(
+            random.choices(string.ascii_letters, k=random.randint(4, 10))
+        )
+
+        # The prompts are longer than the token budget, so they are prefilled in several steps
+        max_tokens_per_step = 8
+        mcore_engine = MCoreEngine(
+            text_generation_controller=self.mcore_engine.text_generation_controller,
+            max_batch_size=self.batch_size,
+            max_tokens_per_step=max_tokens_per_step,
+        )
+        inference_wrapped_model = mcore_engine.text_generation_controller.inference_wrapped_model
+        step_num_tokens = []
+        get_batch_for_dynamic_step = inference_wrapped_model.get_batch_for_dynamic_step
+
+        def get_batch_for_dynamic_step_wrapper(tokens, *args):
+            step_num_tokens.append((tokens != self.mock_tokenizer.eod).sum().item())
+            return get_batch_for_dynamic_step(tokens, *args)
+
+        inference_wrapped_model.get_batch_for_dynamic_step = get_batch_for_dynamic_step_wrapper
+        prompts = ["sample" * (i + 1) for i in range(2 * self.batch_size)]
+        results: List[InferenceRequest] = mcore_engine.generate(
+            prompts,
+            common_inference_params=CommonInferenceParams(num_tokens_to_generate=10),
+            dynamic_generation=True,
+        )
+        del inference_wrapped_model.get_batch_for_dynamic_step
+
+        for prompt, result in zip(prompts, results):
+            assert result.prompt == prompt, "Results should be in the order of the prompts"
+            assert (
+                result.status == Status.COMPLETED
+            ), f"Status should be completed but its {result.status}"
+            assert result.generated_text is not None, f'Generated text should not be None'
+        assert (
+            max(step_num_tokens) <= max_tokens_per_step
+        ), f"A step should run at most {max_tokens_per_step} tokens but ran {max(step_num_tokens)}"
+
+    @pytest.mark.parametrize("detokenize_in_background", [False, True])
+    def test_generate_stream(self, detokenize_in_background):
+        if detokenize_in_background:
+            self.mcore_engine.text_generation_controller.detokenization_worker = (
+                DetokenizationWorker()
+            )
+        self.mock_tokenizer.vocab_size = self.vocab_size
+        self.mock_tokenizer.eod = self.vocab_size - 1
+        self.mock_tokenizer.tokenize.return_value = [
+            random.randint(0, self.vocab_size - 1) for _ in range(random.randint(5, 10))
+        ]
+        self.mock_tokenizer.detokenize.side_effect = lambda tokens: ' '.join(map(str, tokens))
+
+        async def collect_deltas(prompts):
+            deltas: List[InferenceRequestDelta] = []
+            async for delta in self.mcore_engine.generate_stream(
+                prompts, common_inference_params=CommonInferenceParams(num_tokens_to_generate=10)
+            ):
+                deltas.append(delta)
+            return deltas
+
+        prompts = ["sample" * (i + 1) for i in range(2 * self.batch_size)]
+        deltas = asyncio.run(collect_deltas(prompts))
+
+        request_ids = {delta.request_id for delta in deltas}
+        assert len(request_ids) == len(prompts), "Every prompt should stream at least one delta"
+        for request_id in request_ids:
+            request_deltas = [delta for delta in deltas if delta.request_id == request_id]
+            assert (
+                all(delta.status != Status.COMPLETED for delta in request_deltas[:-1])
+                and request_deltas[-1].status == Status.COMPLETED
+            ), "Only the last delta should be completed"
+            # The deltas add up to the final result of the request
+            result = self.mcore_engine.scheduler.completed_request_pool[request_id]
+            assert [
+                token for delta in request_deltas for token in delta.generated_tokens
+            ] == result.generated_tokens.tolist()
+            assert (
+                ''.join(delta.generated_text for delta in request_deltas) == result.generated_text
+            )
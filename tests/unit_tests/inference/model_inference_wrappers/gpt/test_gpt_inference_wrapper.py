@@ -122,3 +122,57 @@ class TestGPTInferenceWrapper:
             5,
             self.vocab_size,
         ), f"Shape mismatch . Expected {(self.batch_size, 5, self.vocab_size)}, but got {logits.shape}"
+
+    def test_inference_decode_step_without_attention_mask(self):
+        self.setup_model(tensor_parallel_size=2, pipeline_parallel_size=1)
+
+        batch_prompt_tokens = (
+            torch.randint(low=0, high=self.vocab_size, size=(self.batch_size, self.sequence_length))
+            .int()
+            .cuda()
+        )
+        self.inference_wrapped_model.prep_model_for_inference(prompts_tokens=batch_prompt_tokens)
+        full_logits = self.inference_wrapped_model.run_one_forward_step(
+            self.inference_wrapped_model.get_batch_for_context_window(0, 6)
+        )
+
+        # The mask and position ids of the previous generation are reused
+        attention_mask = self.inference_wrapped_model.attention_mask
+        self.inference_wrapped_model.prep_model_for_inference(prompts_tokens=batch_prompt_tokens)
+        assert self.inference_wrapped_model.attention_mask.data_ptr() == attention_mask.data_ptr()
+
+        self.inference_wrapped_model.run_one_forward_step(
+            self.inference_wrapped_model.get_batch_for_context_window(0, 5)
+        )
+        inference_input = self.inference_wrapped_model.get_batch_for_context_window(5, 6)
+        assert inference_input[2] is None, "Decode steps should not build an attention mask"
+        logits = self.inference_wrapped_model.run_one_forward_step(inference_input)
+
+        assert torch.allclose(logits[:, -1], full_logits[:, -1], atol=1e-5)
+
+    def test_inference_dynamic_decode_step(self):
+        self.setup_model(tensor_parallel_size=2, pipeline_parallel_size=1)
+        self.inference_wrapped_model.prep_model_for_dynamic_inference(
+            max_batch_size=self.batch_size, max_sequence_length=self.sequence_length
+        )
+
+        sequence_offsets = [3, 7, 5]
+        batch_slots = torch.tensor([2, 0, 1]).cuda()
+        tokens = torch.randint(low=0, high=self.vocab_size, size=(3, 1)).cuda()
+        expected_mask = torch.arange(8).cuda().view(1, 1, 1, -1) > torch.tensor(
+            sequence_offsets
+        ).cuda().view(-1, 1, 1, 1)
+
+        inference_inputs = [
+            self.inference_wrapped_model.get_batch_for_dynamic_step(
+                tokens, batch_slots, sequence_offsets
+            )
+            for _ in range(2)
+        ]
+        for inference_input in inference_inputs:
+            _, position_ids, attention_mask = inference_input
+            assert position_ids.squeeze(1).tolist() == sequence_offsets
+            assert torch.equal(attention_mask, expected_mask)
+        # The decode steps update the same preallocated buffers
+        assert inference_inputs[0][1].data_ptr() == inference_inputs[1][1].data_ptr()
+        assert inference_inputs[0][2].data_ptr() == inference_inputs[1][2].data_ptr()
@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+
+from megatron.core.inference.detokenizer import DetokenizationWorker, IncrementalDetokenizer
+
+
+class ByteTokenizer:
+    """Each token is a byte of the utf-8 encoding of the text"""
+
+    def __init__(self):
+        self.num_detokenized_tokens = 0
+
+    def detokenize(self, tokens):
+        self.num_detokenized_tokens += len(tokens)
+        return bytes(tokens).decode('utf-8', errors='replace')
+
+
+class TestIncrementalDetokenizer:
+
+    def test_multi_byte_characters(self):
+        text = "héllo wörld ✓ 🤖!"
+        tokens = list(text.encode('utf-8'))
+        detokenizer = IncrementalDetokenizer(ByteTokenizer())
+
+        deltas = []
+        for start in range(0, len(tokens), 3):
+            deltas.append(detokenizer.add_tokens("0", tokens[start : start + 3]))
+        deltas.append(detokenizer.finish("0"))
+        assert all('�' not in delta for delta in deltas), "Partial characters are held back"
+        assert ''.join(deltas) == text
+        assert "0" not in detokenizer.states
+
+    def test_incomplete_character_is_flushed(self):
+        detokenizer = IncrementalDetokenizer(ByteTokenizer())
+        tokens = list("ab✓".encode('utf-8'))
+        assert detokenizer.add_tokens("0", tokens[:1]) == "a"
+        # The text is held back until the character is complete
+        assert detokenizer.add_tokens("0", tokens[1:3]) == ""
+        assert detokenizer.finish("0") == 'b�'
+
+    def test_only_new_tokens_are_detokenized(self):
+        tokenizer = ByteTokenizer()
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        for _ in range(1000):
+            assert detokenizer.add_tokens("0", [ord('a')]) == 'a'
+        # Each token is detokenized with at most the previous token as prefix
+        assert tokenizer.num_detokenized_tokens <= 3 * 1000
+
+
+class TestDetokenizationWorker:
+
+    def test_jobs_run_in_order_on_worker_thread(self):
+        worker = DetokenizationWorker()
+        results = []
+        futures = [
+            worker.submit(lambda i: results.append((i, threading.current_thread())), i)
+            for i in range(10)
+        ]
+        worker.synchronize()
+        assert all(future.done() for future in futures)
+        assert [i for i, _ in results] == list(range(10))
+        assert all(thread is not threading.main_thread() for _, thread in results)
+
+    def test_synchronize_raises(self):
+        worker = DetokenizationWorker()
+
+        def fail():
+            raise ValueError("detokenization failed")
+
+        worker.submit(fail).exception()
+        # A failed job is kept until synchronize, even once it is done
+        worker.submit(lambda: None).result()
+        with pytest.raises(ValueError):
+            worker.synchronize()
+        worker.synchronize()
@@ -0,0 +1,37 @@
+import torch
+
+from megatron.core.inference_params import InferenceParams
+
+
+class TestInferenceParams:
+
+    def test_swap_key_value_dict(self):
+        max_batch_size, max_sequence_length = 4, 8
+        inference_params = InferenceParams(max_batch_size, max_sequence_length)
+        for layer_number in (1, 2):
+            inference_params.key_value_memory_dict[layer_number] = (
+                torch.randn(max_sequence_length, max_batch_size, 2, 3),
+                torch.randn(max_sequence_length, max_batch_size, 2, 3),
+            )
+        inference_params.sequence_len_offset = 5
+        batch_idx = torch.tensor([2, 2, 0, 1])
+        expected = {
+            layer_number: (key[:5, batch_idx].clone(), value[:5, batch_idx].clone())
+            for layer_number, (key, value) in inference_params.key_value_memory_dict.items()
+        }
+        first_buffers = {
+            layer_number: key.data_ptr()
+            for layer_number, (key, _) in inference_params.key_value_memory_dict.items()
+        }
+
+        inference_params.swap_key_value_dict(batch_idx)
+        for layer_number, (key, value) in inference_params.key_value_memory_dict.items():
+            assert torch.equal(key[:5], expected[layer_number][0])
+            assert torch.equal(value[:5], expected[layer_number][1])
+
+        # The second swap goes back to the first buffers instead of allocating new ones
+        inference_params.swap_key_value_dict(torch.tensor([3, 2, 1, 0]))
+        for layer_number, (key, value) in inference_params.key_value_memory_dict.items():
+            assert key.data_ptr() == first_buffers[layer_number]
+            assert torch.equal(key[:5], expected[layer_number][0].flip(1))
+            assert torch.equal(value[:5], expected[layer_number][1].flip(1))
@@ -0,0 +1,108 @@
+from megatron.core.inference.kv_cache_block_allocator import (
+    KVCacheBlockAllocator,
+    PrefixCachingKVCacheBlockAllocator,
+)
+
+
+class TestKVCacheBlockAllocator:
+
+    def setup_method(self, method):
+        self.num_blocks = 8
+        self.block_size = 4
+        self.allocator = KVCacheBlockAllocator(self.num_blocks, self.block_size)
+
+    def test_allocate_and_free(self):
+        assert self.allocator.num_free_blocks == self.num_blocks
+        assert self.allocator.get_num_blocks_for_tokens(0) == 0
+        assert self.allocator.get_num_blocks_for_tokens(4) == 1
+        assert self.allocator.get_num_blocks_for_tokens(5) == 2
+
+        blocks = self.allocator.allocate(3)
+        assert len(set(blocks)) == 3, "Allocated blocks should be distinct"
+        assert self.allocator.num_free_blocks == self.num_blocks - 3
+        assert not self.allocator.can_allocate(self.num_blocks - 2)
+
+        self.allocator.free(blocks)
+        assert self.allocator.num_free_blocks == self.num_blocks
+
+    def test_extend_block_table(self):
+        block_table = []
+        assert self.allocator.extend_block_table(block_table, 5)
+        assert len(block_table) == 2
+
+        # No new block until the last block is full
+        assert self.allocator.extend_block_table(block_table, 8)
+        assert len(block_table) == 2
+        assert self.allocator.extend_block_table(block_table, 9)
+        assert len(block_table) == 3
+
+        other_block_table = []
+        assert self.allocator.extend_block_table(other_block_table, 20)
+        assert set(block_table).isdisjoint(other_block_table)
+        assert self.allocator.num_free_blocks == 0
+
+        # Not enough free blocks, the block table is unchanged
+        assert not self.allocator.extend_block_table(block_table, 13)
+        assert len(block_table) == 3
+
+        self.allocator.free(other_block_table)
+        assert self.allocator.extend_block_table(block_table, 13)
+        assert len(block_table) == 4
+
+
+class TestPrefixCachingKVCacheBlockAllocator:
+
+    def setup_method(self, method):
+        self.num_blocks = 6
+        self.block_size = 2
+        self.allocator = PrefixCachingKVCacheBlockAllocator(
+            self.num_blocks, self.block_size, max_cached_blocks=3
+        )
+
+    def test_block_hashes(self):
+        block_hashes = self.allocator.get_block_hashes([1, 2, 3, 4, 5])
+        assert len(block_hashes) == 2, "Only full blocks are hashed"
+        assert self.allocator.get_block_hashes([1, 2, 3, 4]) == block_hashes
+        # The hash of a block depends on the tokens before it
+        assert self.allocator.get_block_hashes([0, 0, 3, 4])[1] != block_hashes[1]
+
+    def test_match_prefix(self):
+        tokens = [1, 2, 3, 4, 5]
+        block_hashes = self.allocator.get_block_hashes(tokens)
+        assert self.allocator.match_prefix(block_hashes) == []
+
+        block_table = []
+        assert self.allocator.extend_block_table(block_table, len(tokens))
+        self.allocator.cache_blocks(block_table, block_hashes)
+
+        # A request with the same prefix shares the cached blocks
+        other_block_table = self.allocator.match_prefix(
+            self.allocator.get_block_hashes([1, 2, 3, 6])
+        )
+        assert other_block_table == block_table[:1]
+        assert self.allocator.num_hit_blocks == 1
+
+        # Cached blocks stay in the cache once they are not used anymore
+        self.allocator.free(block_table)
+        self.allocator.free(other_block_table)
+        assert self.allocator.num_free_blocks == self.num_blocks
+        assert len(self.allocator.evictable_blocks) == 2
+        assert self.allocator.match_prefix(block_hashes) == block_table[:2]
+        self.allocator.free(block_table[:2])
+
+        # Allocating the whole pool evicts the cached blocks
+        blocks = self.allocator.allocate(self.num_blocks)
+        assert len(set(blocks)) == self.num_blocks
+        assert len(self.allocator.cached_blocks) == 0
+        assert self.allocator.match_prefix(block_hashes) == []
+
+    def test_max_cached_blocks(self):
+        block_table = []
+        tokens = list(range(10))
+        assert self.allocator.extend_block_table(block_table, len(tokens))
+        self.allocator.cache_blocks(block_table, self.allocator.get_block_hashes(tokens))
+        self.allocator.free(block_table)
+
+        # The least recently used blocks are evicted
+        assert list(self.allocator.evictable_blocks) == block_table[2:]
+        assert self.allocator.num_free_blocks == self.num_blocks
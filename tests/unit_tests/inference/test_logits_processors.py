@@ -0,0 +1,234 @@
+import json
+import random
+import re
+from unittest import mock
+
+import pytest
+import torch
+
+from megatron.core.inference.common_inference_params import CommonInferenceParams
+from megatron.core.inference.engines.mcore_engine import MCoreEngine
+from megatron.core.inference.inference_request import Status
+from megatron.core.inference.logits_processors import (
+    RegexLogitsProcessor,
+    get_json_schema_logits_processor,
+    get_regex_logits_processor,
+)
+from megatron.core.inference.model_inference_wrappers.gpt.gpt_inference_wrapper import (
+    GPTInferenceWrapper,
+)
+from megatron.core.inference.model_inference_wrappers.inference_wrapper_config import (
+    InferenceWrapperConfig,
+)
+from megatron.core.inference.regex_automaton import RegexAutomaton, json_schema_to_regex
+from megatron.core.inference.text_generation_controllers.simple_text_generation_controller import (
+    SimpleTextGenerationController,
+)
+from megatron.core.models.gpt.gpt_layer_specs import get_gpt_layer_local_spec
+from megatron.core.models.gpt.gpt_model import GPTModel
+from megatron.core.tensor_parallel.random import model_parallel_cuda_manual_seed
+from megatron.core.transformer.transformer_config import TransformerConfig
+from tests.unit_tests.test_utilities import Utils
+
+# Single characters, and a few multi character tokens. The last token is the end of document.
+TOKEN_STRINGS = list('0123456789abc-_{}[]":, ') + ['12', 'ab', '"a', '-1', 'true', 'false', '']
+
+
+def get_mock_tokenizer():
+    tokenizer = mock.Mock()
+    tokenizer.vocab_size = len(TOKEN_STRINGS)
+    tokenizer.eod = len(TOKEN_STRINGS) - 1
+    tokenizer.detokenize.side_effect = lambda tokens: ''.join(TOKEN_STRINGS[t] for t in tokens)
+    return tokenizer
+
+
+class TestRegexAutomaton:
+
+    @pytest.mark.parametrize(
+        "pattern",
+        [
+            r'a|b*c',
+            r'\d{2,4}-[A-Fa-f0-9]+',
+            r'(foo|bar)?baz.x',
+            r'[^"\\]*',
+            r'x{3}',
+            r'(?:ab){1,}',
+            r'[a-c\d_-]+',
+            r'^\x41\.$',
+        ],
+    )
+    def test_matches_like_re(self, pattern):
+        texts = ['', 'a', 'c', 'bbc', '12-ff', '1234-0', '12345-a', 'baz1x', 'foobazzx']
+        texts += ['barbaz\nx', 'xxx', 'xx', 'abab', 'ab', 'a-_9', 'A.', 'a"b', 'ab c']
+        automaton = RegexAutomaton(pattern)
+        for text in texts:
+            assert automaton.matches(text) == (re.fullmatch(pattern, text) is not None), text
+
+    def test_json_schema(self):
+        schema = {
+            "type": "object",
+            "properties": {
+                "name": {"type": "string", "maxLength": 5},
+                "age": {"type": "integer"},
+                "tags": {"type": "array", "items": {"enum": ["a", "b"]}, "maxItems": 2},
+                "score": {"type": "number"},
+                "valid": {"type": "boolean"},
+                "parent": {"anyOf": [{"type": "null"}, {"type": "string"}]},
+            },
+        }
+        automaton = RegexAutomaton(json_schema_to_regex(schema))
+        value = {"name": "bob", "age": 3, "tags": ["a", "b"], "score": -1.5e3, "valid": True}
+        for parent in [None, "alice"]:
+            value["parent"] = parent
+            assert automaton.matches(json.dumps(value))
+            assert automaton.matches(json.dumps(value, separators=(',', ':')))
+        assert not automaton.matches(json.dumps(dict(value, name="robert")))
+        assert not automaton.matches(json.dumps(dict(value, tags=["a", "b", "a"])))
+        assert not automaton.matches(json.dumps(dict(value, age=1.5)))
+
+
+class TestRegexLogitsProcessor:
+
+    def test_allowed_tokens(self):
+        tokenizer = get_mock_tokenizer()
+        processor = RegexLogitsProcessor(r'-?[0-9]+', tokenizer)
+        eod = tokenizer.eod
+        allowed = {
+            token for token, text in enumerate(TOKEN_STRINGS) if re.fullmatch(r'-?[0-9]+', text)
+        } | {TOKEN_STRINGS.index('-')}
+
+        state = processor.get_initial_state()
+        mask = processor.get_allowed_tokens([state], torch.device('cpu'))[0]
+        assert set(mask.nonzero().squeeze(1).tolist()) == allowed
+
+        # After a minus sign, only digits. After a digit, digits or the end of document.
+        state = processor.update_state(state, TOKEN_STRINGS.index('-'))
+        mask = processor.get_allowed_tokens([state], torch.device('cpu'))[0]
+        assert (
+            not mask[eod]
+            and not mask[TOKEN_STRINGS.index('-1')]
+            and mask[TOKEN_STRINGS.index('12')]
+        )
+        state = processor.update_state(state, TOKEN_STRINGS.index('12'))
+        mask = processor.get_allowed_tokens([state], torch.device('cpu'))[0]
+        assert mask[eod] and mask[TOKEN_STRINGS.index('7')] and not mask[TOKEN_STRINGS.index('-')]
+
+        # A token that is not allowed only allows the end of document
+        end_state = processor.update_state(state, TOKEN_STRINGS.index('a'))
+        mask = processor.get_allowed_tokens([end_state], torch.device('cpu'))[0]
+        assert mask.nonzero().squeeze(1).tolist() == [eod]
+
+    def test_process_logits(self):
+        tokenizer = get_mock_tokenizer()
+        processor = RegexLogitsProcessor(r'(ab|c)+', tokenizer)
+        states = [
+            processor.get_initial_state(),
+            processor.update_state(0, TOKEN_STRINGS.index('c')),
+        ]
+        # Logits of a padded vocabulary
+        logits = torch.zeros(2, len(TOKEN_STRINGS) + 3)
+        processor.process_logits(logits, states)
+        allowed = [set(torch.isfinite(row).nonzero().squeeze(1).tolist()) for row in logits]
+        tokens = {TOKEN_STRINGS.index('a'), TOKEN_STRINGS.index('ab'), TOKEN_STRINGS.index('c')}
+        assert allowed == [tokens, tokens | {tokenizer.eod}]
+
+    def test_cached_processors(self):
+        tokenizer = get_mock_tokenizer()
+        processor = get_regex_logits_processor(r'(ab|c)+', tokenizer)
+        assert get_regex_logits_processor(r'(ab|c)+', tokenizer) is processor
+        assert get_regex_logits_processor(r'(ab|c)*', tokenizer) is not processor
+        assert get_regex_logits_processor(r'(ab|c)+', get_mock_tokenizer()) is not processor
+
+        schema = {"type": "string", "minLength": 1, "maxLength": 64}
+        processor = get_json_schema_logits_processor(schema, tokenizer)
+        assert (
+            get_json_schema_logits_processor(dict(reversed(schema.items())), tokenizer) is processor
+        )
+        # A bounded string has a state per character
+        assert len(processor.transitions) > 64
+        state = processor.get_initial_state()
+        for token in ['"', 'ab'] + ['c'] * 62:
+            state = processor.update_state(state, TOKEN_STRINGS.index(token))
+        mask = processor.get_allowed_tokens([state], torch.device('cpu'))[0]
+        assert set(mask.nonzero().squeeze(1).tolist()) == {TOKEN_STRINGS.index('"')}
+
+
+class TestConstrainedGeneration:
+
+    def setup_method(self, method):
+        Utils.initialize_model_parallel(
+            tensor_model_parallel_size=1, pipeline_model_parallel_size=1
+        )
+        model_parallel_cuda_manual_seed(123)
+        self.vocab_size = len(TOKEN_STRINGS)
+        transformer_config = TransformerConfig(
+            num_layers=2, hidden_size=16, num_attention_heads=4, use_cpu_initialization=True
+        )
+        gpt_model = GPTModel(
+            config=transformer_config,
+            transformer_layer_spec=get_gpt_layer_local_spec(),
+            vocab_size=self.vocab_size,
+            max_sequence_length=64,
+            parallel_output=True,
+        ).cuda()
+        inference_wrapper_config = InferenceWrapperConfig(
+            hidden_size=16,
+            inference_batch_times_seqlen_threshold=400,
+            fp32_residual_connection=False,
+            params_dtype=torch.float,
+            padded_vocab_size=self.vocab_size,
+        )
+        self.tokenizer = get_mock_tokenizer()
+        self.tokenizer.tokenize.side_effect = lambda prompt: [
+            random.randint(0, self.vocab_size - 2) for _ in range(len(prompt))
+        ]
+        text_generation_controller = SimpleTextGenerationController(
+            inference_wrapped_model=GPTInferenceWrapper(gpt_model, inference_wrapper_config),
+            tokenizer=self.tokenizer,
+        )
+        self.mcore_engine = MCoreEngine(
+            text_generation_controller=text_generation_controller,
+            max_batch_size=4,
+            max_sequence_length=64,
+        )
+
+    def teardown_method(self, method):
+        Utils.destroy_model_parallel()
+
+    @pytest.mark.parametrize("dynamic_generation", [False, True])
+    def test_generated_text_matches(self, dynamic_generation):
+        regex_processor = get_regex_logits_processor(r'[0-9]{2,3}-(ab|c)+', self.tokenizer)
+        schema = {"type": "array", "items": {"type": "boolean"}, "minItems": 1, "maxItems": 2}
+        json_processor = get_json_schema_logits_processor(schema, self.tokenizer)
+        prompts = ["sample" * (i + 1) for i in range(6)]
+        parameters = [
+            CommonInferenceParams(
+                temperature=2.0,
+                num_tokens_to_generate=20,
+                logits_processor=regex_processor if i % 3 == 0 else json_processor,
+            )
+            for i in range(4)
+        ]
+        # Some requests have no logits processor
+        parameters += [CommonInferenceParams(num_tokens_to_generate=20)] * 2
+        for prompt, inference_parameters in zip(prompts, parameters):
+            self.mcore_engine.scheduler.add_request(
+                prompt, self.tokenizer.tokenize(prompt), inference_parameters
+            )
+        self.mcore_engine.run_engine(dynamic_generation=dynamic_generation)
+
+        for request in self.mcore_engine.scheduler.completed_request_pool.values():
+            assert request.status == Status.COMPLETED
+            logits_processor = request.inference_parameters.logits_processor
+            if logits_processor is None:
+                continue
+            automaton = RegexAutomaton(logits_processor.pattern)
+            text = request.generated_text
+            if request.generated_length < request.inference_parameters.num_tokens_to_generate:
+                # The request generated the end of document, which is only allowed after a match
+                assert automaton.matches(text), text
+            else:
+                state = automaton.initial_state
+                for char in text:
+                    state = automaton.step(state, char)
+                    assert state is not None, f"{text} is not the prefix of a match"
@@ -0,0 +1,145 @@
+import pytest
+import torch
+
+from megatron.core.inference.model_inference_wrappers.gpt.gpt_inference_wrapper import (
+    GPTInferenceWrapper,
+)
+from megatron.core.inference.model_inference_wrappers.inference_wrapper_config import (
+    InferenceWrapperConfig,
+)
+from megatron.core.inference.quantized_kv_cache import QuantizedKVCache, dequantize_kv, quantize_kv
+from megatron.core.inference_params import InferenceParams
+from megatron.core.models.gpt.gpt_layer_specs import get_gpt_layer_local_spec
+from megatron.core.models.gpt.gpt_model import GPTModel
+from megatron.core.tensor_parallel.random import model_parallel_cuda_manual_seed
+from megatron.core.transformer.transformer_config import TransformerConfig
+from tests.unit_tests.test_utilities import Utils
+
+
+class TestQuantizedKVCache:
+
+    @pytest.mark.parametrize("quantization", ["int8", "fp8"])
+    @pytest.mark.parametrize("block_size", [None, 4])
+    def test_quantize_dequantize(self, quantization, block_size):
+        tensor = torch.randn(6, 3, 2, 8, dtype=torch.bfloat16)
+        tensor[0, 0, 0] = 0
+        block_size = block_size or tensor.size(-1)
+        data, scales = quantize_kv(tensor, quantization, block_size)
+        assert data.dtype == torch.int8 and data.shape == tensor.shape
+        assert scales.shape == (6, 3, 2, 8 // block_size)
+
+        assert dequantize_kv(data, scales, quantization, torch.bfloat16).dtype == torch.bfloat16
+        dequantized = dequantize_kv(data, scales, quantization, torch.float)
+        # Blocks of zeros stay zeros
+        assert torch.all(dequantized[0, 0, 0] == 0)
+        # The error is at most half a step of int8, or a relative error of 2^-4 for fp8
+        block_max = tensor.float().abs().unflatten(-1, (-1, block_size)).amax(-1, keepdim=True)
+        error = (dequantized - tensor.float()).abs().unflatten(-1, (-1, block_size))
+        max_error = block_max / 254 if quantization == "int8" else block_max / 16
+        assert torch.all(error <= max_error * 1.001)
+
+    def test_indexing(self):
+        kv_cache = QuantizedKVCache((8, 4, 2, 6), torch.float, "int8")
+        assert kv_cache.size() == (8, 4, 2, 6) and kv_cache.size(0) == 8
+        assert torch.all(kv_cache[:8] == 0), "The kv cache should be zero initialized"
+
+        # Dense kv cache writes and reads
+        keys = torch.randn(3, 2, 2, 6)
+        kv_cache[2:5, 1:3, ...] = keys
+        assert torch.allclose(kv_cache[2:5, 1:3, ...], keys, atol=0.05)
+
+        # Dynamic batching writes and reads, with one index tensor per leading dimension
+        positions = torch.tensor([[5, 6], [6, 7]])
+        slots = torch.tensor([[0, 3], [0, 3]])
+        kv_cache[positions, slots] = keys[:2]
+        assert torch.allclose(kv_cache[positions, slots], keys[:2], atol=0.05)
+
+        # Rows are reordered without dequantizing them
+        reordered = kv_cache.empty_like()
+        kv_cache.index_select(torch.tensor([3, 1, 2, 0]), 7, out=reordered)
+        assert torch.equal(reordered.data[:7], kv_cache.data[:7, [3, 1, 2, 0]])
+        assert torch.equal(reordered.scales[:7], kv_cache.scales[:7, [3, 1, 2, 0]])
+
+    def test_swap_key_value_dict(self):
+        inference_params = InferenceParams(4, 8)
+        inference_params.enable_kv_cache_quantization("int8")
+        key = QuantizedKVCache((8, 4, 2, 3), torch.float, "int8")
+        value = QuantizedKVCache((8, 4, 2, 3), torch.float, "int8")
+        key[:5] = torch.randn(5, 4, 2, 3)
+        value[:5] = torch.randn(5, 4, 2, 3)
+        expected_key, expected_value = key[:5][:, [2, 2, 0, 1]], value[:5][:, [2, 2, 0, 1]]
+        inference_params.key_value_memory_dict[1] = (key, value)
+        inference_params.sequence_len_offset = 5
+
+        inference_params.swap_key_value_dict(torch.tensor([2, 2, 0, 1]))
+        key, value = inference_params.key_value_memory_dict[1]
+        assert isinstance(key, QuantizedKVCache)
+        assert torch.equal(key[:5], expected_key)
+        assert torch.equal(value[:5], expected_value)
+
+
+class TestQuantizedKVCacheAccuracy:
+    """Compares the logits of a model with a quantized kv cache against the logits with the kv cache in the dtype of the model"""
+
+    def setup_method(self, method):
+        Utils.initialize_model_parallel(
+            tensor_model_parallel_size=1, pipeline_model_parallel_size=1
+        )
+        model_parallel_cuda_manual_seed(123)
+        self.vocab_size = 100
+        self.hidden_size = 32
+        transformer_config = TransformerConfig(
+            num_layers=2,
+            hidden_size=self.hidden_size,
+            num_attention_heads=4,
+            use_cpu_initialization=True,
+        )
+        self.gpt_model = GPTModel(
+            config=transformer_config,
+            transformer_layer_spec=get_gpt_layer_local_spec(),
+            vocab_size=self.vocab_size,
+            max_sequence_length=64,
+            parallel_output=True,
+            position_embedding_type='rope',
+        ).cuda()
+
+    def teardown_method(self, method):
+        Utils.destroy_model_parallel()
+
+    def get_logits(self, prompts_tokens, prompt_length, kv_cache_quantization):
+        inference_wrapper_config = InferenceWrapperConfig(
+            hidden_size=self.hidden_size,
+            inference_batch_times_seqlen_threshold=1000,
+            fp32_residual_connection=False,
+            params_dtype=torch.float,
+            padded_vocab_size=self.vocab_size,
+            kv_cache_quantization=kv_cache_quantization,
+        )
+        inference_wrapped_model = GPTInferenceWrapper(self.gpt_model, inference_wrapper_config)
+        inference_wrapped_model.prep_model_for_inference(prompts_tokens=prompts_tokens)
+        # The prompt, then one token at a time
+        all_logits = []
+        context_start_position = 0
+        for context_end_position in range(prompt_length, prompts_tokens.size(1) + 1):
+            inference_input = inference_wrapped_model.get_batch_for_context_window(
+                context_start_position, context_end_position
+            )
+            logits = inference_wrapped_model.run_one_forward_step(inference_input)
+            all_logits.append(logits[:, -1])
+            context_start_position = context_end_position
+        if kv_cache_quantization is not None:
+            key_memory, _ = inference_wrapped_model.inference_params.key_value_memory_dict[1]
+            assert isinstance(key_memory, QuantizedKVCache)
+        return torch.stack(all_logits, dim=1)
+
+    @pytest.mark.parametrize("kv_cache_quantization", ["int8", "fp8"])
+    def test_logits_match_unquantized_kv_cache(self, kv_cache_quantization):
+        prompts_tokens = torch.randint(0, self.vocab_size, (4, 24)).cuda()
+        expected_logits = self.get_logits(prompts_tokens, 8, None)
+        logits = self.get_logits(prompts_tokens, 8, kv_cache_quantization)
+
+        relative_error = (logits - expected_logits).norm() / expected_logits.norm()
+        max_relative_error = 0.01 if kv_cache_quantization == "int8" else 0.05
+        assert (
+            relative_error < max_relative_error
+        ), f"Relative error of the logits {relative_error} with a {kv_cache_quantization} kv cache"
@@ -1,5 +1,7 @@
+import time
 from typing import Dict
 
+import pytest
 import torch
 
 from megatron.core.inference.common_inference_params import CommonInferenceParams
@@ -33,6 +35,13 @@ class TestScheduler:
                 len(self.scheduler.active_request_pool) == i + 1
             ), f"Active request pool should have {i+1} requests, but it has only {len(self.scheduler.active_request_pool)}"
 
+        active_kv_cache_slots = [
+            request.kv_cache_slot for request in self.scheduler.active_request_pool.values()
+        ]
+        assert sorted(active_kv_cache_slots) == list(
+            range(self.max_batch_size)
+        ), f"Each active request should have its own kv cache slot, but they have {active_kv_cache_slots}"
+
         self.scheduler.add_request(prompt, prompt_tokens, inference_parameters)
         assert (
             len(self.scheduler.waiting_request_pool) == 1
@@ -66,6 +75,10 @@ class TestScheduler:
             len(self.scheduler.completed_request_pool) == 2
         ), f"Completed request pool should have 2 requests but it has {len(self.scheduler.completed_request_pool)} requests "
 
+        assert (
+            len(self.scheduler.free_kv_cache_slots) == 1
+        ), f"One kv cache slot should be free, but {self.scheduler.free_kv_cache_slots} are free"
+
         active_request_dict: Dict[int, InferenceRequest] = self.scheduler.active_request_pool
         for request_id, request in active_request_dict.items():
             # Mark all requests compelted
@@ -87,3 +100,90 @@ class TestScheduler:
         assert (
             self.scheduler.have_requests_pending() == False
         ), "Scheduler should not have any requests pending"
+
+    def add_requests(self, scheduler, requests):
+        # Each request is (prompt length, number of tokens to generate, priority, deadline)
+        return [
+            scheduler.add_request(
+                "sample prompt",
+                torch.randn(prompt_length),
+                CommonInferenceParams(
+                    num_tokens_to_generate=num_tokens_to_generate,
+                    priority=priority,
+                    deadline=deadline,
+                ),
+            )
+            for prompt_length, num_tokens_to_generate, priority, deadline in requests
+        ]
+
+    def complete_requests(self, scheduler, request_ids):
+        for request_id in request_ids:
+            scheduler.active_request_pool[request_id].status = Status.COMPLETED
+        scheduler.update_requests_pools(scheduler.active_request_pool.copy())
+
+    @pytest.mark.parametrize(
+        "scheduling_policy, expected_order",
+        [
+            ("fifo", ["2", "4", "1", "3"]),
+            ("earliest_deadline", ["4", "2", "3", "1"]),
+            ("shortest_remaining_work", ["2", "4", "3", "1"]),
+        ],
+    )
+    def test_scheduling_policies(self, scheduling_policy, expected_order):
+        scheduler = Scheduler(max_batch_size=1, scheduling_policy=scheduling_policy)
+        request_ids = self.add_requests(
+            scheduler,
+            [
+                (5, 10, 0, None),
+                (8, 10, 0, None),
+                (9, 10, 1, 200.0),
+                (3, 10, 0, 300.0),
+                (4, 20, 1, 100.0),
+            ],
+        )
+        # The first request is admitted on arrival, then the others by priority and policy
+        assert list(scheduler.active_request_pool) == ["0"]
+        admitted = []
+        while scheduler.have_requests_pending():
+            self.complete_requests(scheduler, list(scheduler.active_request_pool))
+            admitted += list(scheduler.active_request_pool)
+        assert admitted == expected_order
+        assert len(scheduler.completed_request_pool) == len(request_ids)
+
+    def test_kv_cache_token_admission(self):
+        scheduler = Scheduler(max_batch_size=4, max_kv_cache_tokens=50)
+        request_ids = self.add_requests(
+            scheduler, [(10, 10, 0, None), (10, 20, 0, None), (30, 30, 0, None), (5, 5, 0, None)]
+        )
+        # The third request does not fit, and the fourth one does not skip it
+        assert list(scheduler.active_request_pool) == request_ids[:2]
+        assert scheduler.active_kv_cache_tokens == 50
+
+        self.complete_requests(scheduler, request_ids[:1])
+        assert list(scheduler.active_request_pool) == request_ids[1:2]
+
+        # A request larger than the budget is admitted alone
+        self.complete_requests(scheduler, request_ids[1:2])
+        assert list(scheduler.active_request_pool) == request_ids[2:3]
+        self.complete_requests(scheduler, request_ids[2:3])
+        assert list(scheduler.active_request_pool) == request_ids[3:]
+        assert scheduler.active_kv_cache_tokens == 10
+
+    def test_queue_time_metrics(self):
+        scheduler = Scheduler(max_batch_size=1)
+        metrics = scheduler.get_queue_time_metrics()
+        assert metrics["num_samples"] == 0 and metrics["max"] == 0
+
+        for arrival_time in (time.time() - 4, time.time() - 2):
+            scheduler.add_request(
+                "sample prompt", torch.randn(5), CommonInferenceParams(), arrival_time
+            )
+        metrics = scheduler.get_queue_time_metrics()
+        assert metrics["num_waiting_requests"] == 1 and metrics["num_samples"] == 1
+        assert 4 <= metrics["p50"] == metrics["max"] < 5
+
+        self.complete_requests(scheduler, list(scheduler.active_request_pool))
+        metrics = scheduler.get_queue_time_metrics()
+        assert metrics["num_waiting_requests"] == 0 and metrics["num_samples"] == 2
+        assert 2 <= min(scheduler.queue_times) < 3
+        assert 3 <= metrics["mean"] < 4
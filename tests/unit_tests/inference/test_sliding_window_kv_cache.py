@@ -0,0 +1,116 @@
+import pytest
+import torch
+
+from megatron.core.inference_params import InferenceParams
+from megatron.core.models.gpt.gpt_layer_specs import get_gpt_layer_local_spec
+from megatron.core.models.gpt.gpt_model import GPTModel
+from megatron.core.tensor_parallel.random import model_parallel_cuda_manual_seed
+from megatron.core.transformer.transformer_config import TransformerConfig
+from tests.unit_tests.test_utilities import Utils
+
+
+class TestSlidingWindowKVCacheLayout:
+
+    def test_layout(self):
+        inference_params = InferenceParams(2, 32)
+        inference_params.enable_sliding_window_kv_cache(window_size=4, num_sink_tokens=2)
+
+        # Prompt longer than the window: only the sink tokens and the last 4 tokens are written
+        read_slots, write_slots, write_indices, key_positions, attention_mask = (
+            inference_params.get_sliding_window_kv_cache_layout(9, torch.device("cpu"))
+        )
+        assert read_slots.numel() == 0
+        assert write_indices.tolist() == [0, 1, 5, 6, 7, 8]
+        assert write_slots.tolist() == [0, 1, 5, 2, 3, 4]
+        assert key_positions.tolist() == list(range(9))
+        assert attention_mask.shape == (1, 1, 9, 9)
+        # The last query sees the sink tokens and the last 4 tokens
+        assert (~attention_mask[0, 0, -1]).nonzero().squeeze(1).tolist() == [0, 1, 5, 6, 7, 8]
+
+        # The layout is computed once per forward pass
+        assert (
+            inference_params.get_sliding_window_kv_cache_layout(9, torch.device("cpu"))[0]
+            is read_slots
+        )
+
+        # One new token: the retained tokens are the sink tokens and the last 4 tokens
+        inference_params.sequence_len_offset = 9
+        read_slots, write_slots, write_indices, key_positions, attention_mask = (
+            inference_params.get_sliding_window_kv_cache_layout(1, torch.device("cpu"))
+        )
+        assert key_positions.tolist() == [0, 1, 5, 6, 7, 8, 9]
+        assert read_slots.tolist() == [0, 1, 5, 2, 3, 4]
+        # Token 9 overwrites token 5, which is out of its window
+        assert write_slots.tolist() == [5]
+        assert attention_mask[0, 0, 0].tolist() == [False, False, True, False, False, False, False]
+
+    def test_no_dynamic_batching(self):
+        inference_params = InferenceParams(2, 32)
+        inference_params.enable_sliding_window_kv_cache(window_size=4)
+        with pytest.raises(AssertionError):
+            inference_params.set_batch_slots(torch.tensor([0, 1]), torch.tensor([0, 0]), 4)
+
+
+class TestSlidingWindowKVCacheAccuracy:
+    """Compares the logits of a model with a sliding window kv cache against the logits of a full forward pass with a sliding window attention mask"""
+
+    def setup_method(self, method):
+        Utils.initialize_model_parallel(
+            tensor_model_parallel_size=1, pipeline_model_parallel_size=1
+        )
+        model_parallel_cuda_manual_seed(123)
+        self.vocab_size = 100
+        transformer_config = TransformerConfig(
+            num_layers=2, hidden_size=32, num_attention_heads=4, use_cpu_initialization=True
+        )
+        self.gpt_model = GPTModel(
+            config=transformer_config,
+            transformer_layer_spec=get_gpt_layer_local_spec(),
+            vocab_size=self.vocab_size,
+            max_sequence_length=64,
+            parallel_output=True,
+            position_embedding_type='rope',
+        ).cuda()
+        self.gpt_model.eval()
+
+    def teardown_method(self, method):
+        Utils.destroy_model_parallel()
+
+    @pytest.mark.parametrize("num_sink_tokens", [0, 3])
+    def test_logits_match_sliding_window_attention(self, num_sink_tokens):
+        window_size = 5
+        batch_size, sequence_length = 2, 24
+        tokens = torch.randint(0, self.vocab_size, (batch_size, sequence_length)).cuda()
+        position_ids = torch.arange(sequence_length).cuda().unsqueeze(0).expand(batch_size, -1)
+
+        positions = torch.arange(sequence_length).cuda()
+        query_positions, key_positions = positions.unsqueeze(1), positions.unsqueeze(0)
+        attention_mask = (key_positions > query_positions) | (
+            (key_positions >= num_sink_tokens) & (key_positions <= query_positions - window_size)
+        )
+        with torch.no_grad():
+            expected_logits = self.gpt_model(
+                tokens, position_ids, attention_mask.view(1, 1, sequence_length, sequence_length)
+            )
+
+        inference_params = InferenceParams(batch_size, sequence_length)
+        inference_params.enable_sliding_window_kv_cache(window_size, num_sink_tokens)
+        # A prompt longer than the window, a chunk of several tokens, then one token at a time
+        boundaries = [0, 8, 11] + list(range(12, sequence_length + 1))
+        all_logits = []
+        with torch.no_grad():
+            for start, end in zip(boundaries[:-1], boundaries[1:]):
+                all_logits.append(
+                    self.gpt_model(
+                        tokens[:, start:end],
+                        position_ids[:, start:end],
+                        None,
+                        inference_params=inference_params,
+                    )
+                )
+                inference_params.sequence_len_offset = end
+        logits = torch.cat(all_logits, dim=1)
+
+        key_memory, _ = inference_params.key_value_memory_dict[1]
+        assert key_memory.size(0) == num_sink_tokens + window_size
+        assert torch.allclose(logits, expected_logits, atol=1e-5)
@@ -0,0 +1,39 @@
+# Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+
+import pytest
+import torch
+
+from megatron.inference.text_generation.sampling import (
+    get_top_p_probs,
+    modify_logits_for_top_p_filtering,
+)
+
+
+class TestTopPSampling:
+
+    @pytest.mark.parametrize("top_p", [0.01, 0.5, 0.9, 0.999])
+    def test_matches_top_p_filtering(self, top_p):
+        # A local generator, to leave the global random state of later tests unchanged
+        generator = torch.Generator().manual_seed(0)
+        logits = torch.randn(8, 1000, generator=generator) * 3
+        # Ties, and a row with a single dominant token
+        logits[1, :500] = logits[1, 500:]
+        logits[2, 7] = 100.0
+
+        filtered_logits = logits.clone()
+        modify_logits_for_top_p_filtering(filtered_logits, top_p)
+        expected_probs = filtered_logits.softmax(dim=-1)
+
+        sorted_probs, sorted_indices = get_top_p_probs(logits, top_p)
+        probs = torch.zeros_like(logits).scatter(1, sorted_indices, sorted_probs)
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+
+        assert torch.equal(probs > 0, expected_probs > 0)
+        torch.testing.assert_close(probs, expected_probs)
+
+    def test_sorted_indices(self):
+        logits = torch.tensor([[0.0, 3.0, 1.0, 2.0]])
+        probs, indices = get_top_p_probs(logits, 0.7)
+        assert indices.tolist() == [[1, 3, 2, 0]]
+        # The first token alone covers less than top-p, so the second one is kept
+        assert (probs > 0).tolist() == [[True, True, False, False]]
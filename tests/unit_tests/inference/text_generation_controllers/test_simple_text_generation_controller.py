@@ -17,6 +17,7 @@ from megatron.core.inference.model_inference_wrappers.inference_wrapper_config i
     InferenceWrapperConfig,
 )
 from megatron.core.inference.text_generation_controllers.simple_text_generation_controller import (
+    SamplingParamsPerRow,
     SimpleTextGenerationController,
 )
 from megatron.core.models.gpt.gpt_layer_specs import get_gpt_layer_local_spec
@@ -135,6 +136,102 @@ class TestTextGenerationController:
             sampled_logits >= expected_min_value
         ), f"The sampled logits should all be greater than {expected_min_value} but its {sampled_logits}"
 
+    def test_sample_from_logits_per_row(self):
+        with pytest.raises(AssertionError) as aerror:
+            SamplingParamsPerRow.from_inference_params(
+                [CommonInferenceParams(top_k=2, top_p=0.4), CommonInferenceParams()]
+            )
+        assert str(aerror.value) == 'Cannot have top-p and top-k both greater than zero'
+
+        last_token_logits = (
+            torch.arange(0, self.vocab_size).repeat(self.batch_size, 1).float().cuda()
+        )
+        l = last_token_logits[0]
+        top_p = 0.3
+        expected_min_value = l[l.softmax(dim=-1).cumsum(dim=-1) > top_p][0].item()
+
+        # Greedy, top-k, top-p and unfiltered rows in the same batch
+        sampling_params = SamplingParamsPerRow.from_inference_params(
+            [
+                CommonInferenceParams(top_k=1),
+                CommonInferenceParams(top_k=2),
+                CommonInferenceParams(top_p=top_p),
+                CommonInferenceParams(),
+            ]
+        )
+        assert sampling_params.max_top_k == 2
+        assert sampling_params.has_top_p and sampling_params.has_greedy
+        assert not sampling_params.all_greedy
+        sampled_logits = self.text_generation_controller.sample_from_logits_per_row(
+            last_token_logits, sampling_params, vocab_size=self.vocab_size
+        )
+        assert sampled_logits[0] == self.vocab_size - 1, "The first row should be greedy"
+        assert (
+            sampled_logits[1] >= self.vocab_size - 2
+        ), f"The second row should be in the top 2 but its {sampled_logits[1]}"
+        assert (
+            sampled_logits[2] >= expected_min_value
+        ), f"The third row should be greater than {expected_min_value} but its {sampled_logits[2]}"
+        assert 0 <= sampled_logits[3] < self.vocab_size
+
+        # Rows with the same seed get the same samples
+        sampling_params = SamplingParamsPerRow.from_inference_params(
+            [CommonInferenceParams() for _ in range(self.batch_size)]
+        )
+        generators = [
+            self.text_generation_controller.get_sampling_generator(CommonInferenceParams(seed=1))
+            for _ in range(self.batch_size)
+        ]
+        sampled_logits = self.text_generation_controller.sample_from_logits_per_row(
+            last_token_logits, sampling_params, generators=generators
+        )
+        assert torch.all(
+            sampled_logits == sampled_logits[0]
+        ), f"Rows with the same seed should have the same samples but got {sampled_logits}"
+
+    def test_generate_all_output_tokens_static_batch_per_request_params(self):
+        self.mock_tokenizer.vocab_size = self.vocab_size
+        self.mock_tokenizer.eod = self.vocab_size - 1
+        self.mock_tokenizer.detokenize.return_value = ''.join(
+            random.choices(string.ascii_letters, k=random.randint(4, 10))
+        )
+
+        active_requests: Dict[int, InferenceRequest] = OrderedDict()
+        for i in range(self.batch_size):
+            prompt = "sample" * (i + 1)
+            inference_request = InferenceRequest(
+                request_id=i,
+                prompt=prompt,
+                inference_parameters=CommonInferenceParams(
+                    temperature=1.0 + i,
+                    top_k=i,
+                    num_tokens_to_generate=i + 2,
+                    return_log_probs=i % 2 == 0,
+                    seed=i,
+                ),
+                arrival_time=time.time(),
+                prompt_tokens=torch.randint(
+                    low=0, high=self.vocab_size - 1, size=(len(prompt),)
+                ).tolist(),
+                status=Status.ACTIVE_BUT_NOT_GENERATING_TOKENS,
+            )
+            active_requests[i] = inference_request
+
+        requests = self.text_generation_controller.generate_all_output_tokens_static_batch(
+            active_requests
+        )
+
+        for request_id, request in requests.items():
+            assert (
+                request.status == Status.COMPLETED
+            ), f"Status should be completed but its {request.status}"
+            assert (
+                request.generated_length <= request_id + 2
+            ), f"Generated length should be at most {request_id + 2} but its {request.generated_length}"
+            assert (request.generated_log_probs is not None) == (
+                request_id % 2 == 0
+            ), "Only the requests that asked for log probs should have them"
+
     def test_generate_all_output_tokens_static_batch(self):
         self.mock_tokenizer.vocab_size = self.vocab_size
         self.mock_tokenizer.eod = self.vocab_size - 1
@@ -170,3 +267,114 @@ class TestTextGenerationController:
             ), f"Status should be completed but its {request.status}"
             assert request.generated_length > 0, f"Generated length should be greater than zero"
             assert request.generated_text is not None, "Generated text should not be None"
+
+    def test_generate_output_tokens_dynamic_batch(self):
+        self.mock_tokenizer.vocab_size = self.vocab_size
+        self.mock_tokenizer.eod = self.vocab_size - 1
+        self.mock_tokenizer.detokenize.return_value = ''.join(
+            random.choices(string.ascii_letters, k=random.randint(4, 10))
+        )
+
+        self.text_generation_controller.prep_model_for_dynamic_batch(
+            max_batch_size=self.batch_size, max_sequence_length=self.sequence_length
+        )
+
+        active_requests: Dict[int, InferenceRequest] = OrderedDict()
+        for i in range(self.batch_size):
+            prompt = "sample" * (i + 1)
+            inference_request = InferenceRequest(
+                request_id=i,
+                prompt=prompt,
+                inference_parameters=CommonInferenceParams(num_tokens_to_generate=i + 2),
+                arrival_time=time.time(),
+                prompt_tokens=torch.randint(
+                    low=0, high=self.vocab_size - 1, size=(len(prompt),)
+                ).tolist(),
+                status=Status.ACTIVE_BUT_NOT_GENERATING_TOKENS,
+                kv_cache_slot=self.batch_size - 1 - i,
+            )
+            active_requests[i] = inference_request
+
+        # The first step runs the prefill of all the prompts
+        requests = self.text_generation_controller.generate_output_tokens_dynamic_batch(
+            active_requests
+        )
+        for request in requests.values():
+            assert request.status in (
+                Status.ACTIVE_AND_GENERATING_TOKENS,
+                Status.COMPLETED,
+            ), f"Status should be generating or completed but its {request.status}"
+
+        # Every other step generates one token per request, until each request completes
+        for _ in range(self.batch_size + 1):
+            active_requests = OrderedDict(
+                (request_id, request)
+                for request_id, request in active_requests.items()
+                if request.status != Status.COMPLETED
+            )
+            if len(active_requests) == 0:
+                break
+            self.text_generation_controller.generate_output_tokens_dynamic_batch(active_requests)
+
+        for request_id, request in requests.items():
+            assert (
+                request.status == Status.COMPLETED
+            ), f"Status should be completed but its {request.status}"
+            # The request can sample the end of document token first, and generate no token
+            assert (
+                request.generated_length <= request_id + 2
+            ), f"Generated length should be at most {request_id + 2} but its {request.generated_length}"
+            assert request.generated_text is not None, "Generated text should not be None"
+
+    def test_generate_output_tokens_pipelined_decode(self):
+        self.mock_tokenizer.vocab_size = self.vocab_size
+        self.mock_tokenizer.eod = self.vocab_size - 1
+        self.mock_tokenizer.detokenize.return_value = ''.join(
+            random.choices(string.ascii_letters, k=random.randint(4, 10))
+        )
+        prompts_tokens = [
+            torch.randint(low=0, high=self.vocab_size - 1, size=(4 + i,)).tolist()
+            for i in range(self.batch_size)
+        ]
+
+        def generate(num_pipelined_decode_steps):
+            self.text_generation_controller.prep_model_for_dynamic_batch(
+                max_batch_size=self.batch_size,
+                max_sequence_length=self.sequence_length,
+                num_pipelined_decode_steps=num_pipelined_decode_steps,
+            )
+            active_requests: Dict[int, InferenceRequest] = OrderedDict()
+            for i, prompt_tokens in enumerate(prompts_tokens):
+                active_requests[i] = InferenceRequest(
+                    request_id=i,
+                    prompt="sample",
+                    inference_parameters=CommonInferenceParams(
+                        num_tokens_to_generate=2 * i + 3, top_k=1
+                    ),
+                    arrival_time=time.time(),
+                    prompt_tokens=prompt_tokens,
+                    status=Status.ACTIVE_BUT_NOT_GENERATING_TOKENS,
+                    kv_cache_slot=i,
+                )
+            requests = active_requests.copy()
+            num_steps = 0
+            while len(active_requests) > 0:
+                self.text_generation_controller.generate_output_tokens_dynamic_batch(
+                    active_requests
+                )
+                active_requests = OrderedDict(
+                    (request_id, request)
+                    for request_id, request in active_requests.items()
+                    if request.status != Status.COMPLETED
+                )
+                num_steps += 1
+            return [request.generated_tokens.tolist() for request in requests.values()], num_steps
+
+        generated_tokens, num_steps = generate(num_pipelined_decode_steps=None)
+        pipelined_generated_tokens, pipelined_num_steps = generate(num_pipelined_decode_steps=3)
+
+        assert (
+            pipelined_generated_tokens == generated_tokens
+        ), "Pipelined decode steps should generate the same tokens as single decode steps"
+        # Each pipelined step generates up to 3 tokens per request
+        assert pipelined_num_steps < num_steps
@@ -0,0 +1,162 @@
+import copy
+import random
+import string
+import time
+from collections import OrderedDict
+from typing import Dict
+from unittest import mock
+
+import pytest
+import torch
+
+from megatron.core.inference.common_inference_params import CommonInferenceParams
+from megatron.core.inference.inference_request import InferenceRequest, Status
+from megatron.core.inference.model_inference_wrappers.gpt.gpt_inference_wrapper import (
+    GPTInferenceWrapper,
+)
+from megatron.core.inference.model_inference_wrappers.inference_wrapper_config import (
+    InferenceWrapperConfig,
+)
+from megatron.core.inference.text_generation_controllers.simple_text_generation_controller import (
+    SimpleTextGenerationController,
+)
+from megatron.core.inference.text_generation_controllers.speculative_text_generation_controller import (
+    SpeculativeTextGenerationController,
+)
+from megatron.core.models.gpt.gpt_layer_specs import get_gpt_layer_local_spec
+from megatron.core.models.gpt.gpt_model import GPTModel
+from megatron.core.tensor_parallel.random import model_parallel_cuda_manual_seed
+from megatron.core.transformer.transformer_config import TransformerConfig
+from tests.unit_tests.test_utilities import Utils
+
+
+class TestSpeculativeTextGenerationController:
+
+    def setup_method(self, method):
+        Utils.initialize_model_parallel(
+            tensor_model_parallel_size=2, pipeline_model_parallel_size=2
+        )
+        model_parallel_cuda_manual_seed(123)
+        self.batch_size = 4
+        self.hidden_size = 12
+        self.vocab_size = 100
+        self.sequence_length = 64
+
+        inference_wrapper_config = InferenceWrapperConfig(
+            hidden_size=self.hidden_size,
+            inference_batch_times_seqlen_threshold=20,
+            fp32_residual_connection=False,
+            params_dtype=torch.float,
+            padded_vocab_size=self.vocab_size,
+        )
+        inference_wrapped_models = []
+        for num_layers in [4, 2]:
+            transformer_config = TransformerConfig(
+                num_layers=num_layers,
+                hidden_size=self.hidden_size,
+                num_attention_heads=4,
+                use_cpu_initialization=True,
+            )
+            gpt_model = GPTModel(
+                config=transformer_config,
+                transformer_layer_spec=get_gpt_layer_local_spec(),
+                vocab_size=self.vocab_size,
+                max_sequence_length=self.sequence_length,
+                parallel_output=True,
+            ).cuda()
+            inference_wrapped_models.append(
+                GPTInferenceWrapper(gpt_model, inference_wrapper_config)
+            )
+        target_inference_wrapped_model, draft_inference_wrapped_model = inference_wrapped_models
+
+        self.mock_tokenizer = mock.Mock()
+        self.mock_tokenizer.vocab_size = self.vocab_size
+        self.mock_tokenizer.eod = self.vocab_size - 1
+        self.mock_tokenizer.detokenize.return_value = ''.join(
+            random.choices(string.ascii_letters, k=random.randint(4, 10))
+        )
+
+        self.text_generation_controller = SimpleTextGenerationController(
+            inference_wrapped_model=target_inference_wrapped_model, tokenizer=self.mock_tokenizer
+        )
+        self.speculative_text_generation_controller = SpeculativeTextGenerationController(
+            inference_wrapped_model=target_inference_wrapped_model,
+            draft_inference_wrapped_model=draft_inference_wrapped_model,
+            tokenizer=self.mock_tokenizer,
+            num_speculative_tokens=3,
+        )
+
+    def teardown_method(self, method):
+        Utils.destroy_model_parallel()
+
+    def get_active_requests(self, **inference_parameters) -> Dict[int, InferenceRequest]:
+        active_requests: Dict[int, InferenceRequest] = OrderedDict()
+        for i in range(self.batch_size):
+            prompt = "sample" * (i + 1)
+            inference_request = InferenceRequest(
+                request_id=i,
+                prompt=prompt,
+                inference_parameters=CommonInferenceParams(
+                    num_tokens_to_generate=2 * i + 3, **inference_parameters
+                ),
+                arrival_time=time.time(),
+                prompt_tokens=torch.randint(
+                    low=0, high=self.vocab_size - 1, size=(len(prompt),)
+                ).tolist(),
+                status=Status.ACTIVE_BUT_NOT_GENERATING_TOKENS,
+            )
+            active_requests[i] = inference_request
+        return active_requests
+
+    def test_generate_all_output_tokens_static_batch_greedy(self):
+        active_requests = self.get_active_requests(top_k=1)
+        expected_requests = self.text_generation_controller.generate_all_output_tokens_static_batch(
+            copy.deepcopy(active_requests)
+        )
+
+        requests = (
+            self.speculative_text_generation_controller.generate_all_output_tokens_static_batch(
+                active_requests
+            )
+        )
+
+        # With greedy sampling, speculative decoding generates the same tokens as the target model alone
+        for request_id, request in requests.items():
+            assert (
+                request.status == Status.COMPLETED
+            ), f"Status should be completed but its {request.status}"
+            assert (
+                request.generated_tokens.tolist()
+                == expected_requests[request_id].generated_tokens.tolist()
+            ), f"Generated tokens {request.generated_tokens} should be {expected_requests[request_id].generated_tokens}"
+
+    def test_generate_all_output_tokens_static_batch(self):
+        active_requests = self.get_active_requests(top_p=0.9, return_log_probs=True, seed=0)
+
+        requests = (
+            self.speculative_text_generation_controller.generate_all_output_tokens_static_batch(
+                active_requests
+            )
+        )
+
+        for request_id, request in requests.items():
+            assert (
+                request.status == Status.COMPLETED
+            ), f"Status should be completed but its {request.status}"
+            assert (
+                request.generated_length <= 2 * request_id + 3
+            ), f"Generated length should be at most {2 * request_id + 3} but its {request.generated_length}"
+            assert (
+                len(request.generated_log_probs) == request.generated_length
+            ), "There should be one log prob per generated token"
+            assert request.generated_text is not None, "Generated text should not be None"
+
+    def test_dynamic_batch_not_supported(self):
+        with pytest.raises(NotImplementedError):
+            self.speculative_text_generation_controller.prep_model_for_dynamic_batch(
+                max_batch_size=self.batch_size, max_sequence_length=self.sequence_length
+            )
+        with pytest.raises(NotImplementedError):
+            self.speculative_text_generation_controller.generate_output_tokens_dynamic_batch(
+                self.get_active_requests()
+            )
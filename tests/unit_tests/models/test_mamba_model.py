@@ -116,6 +116,75 @@ class TestMambaModel:
             assert logits.shape[1] == sequence_length
             assert logits.shape[2] == self.model.vocab_size
 
+    def test_dynamic_batch_inference(self):
+        self.model.cuda()
+        self.model.eval()
+        sequences = [torch.randint(0, 100, (n,)).cuda() for n in (5, 3, 4)]
+        # Requests 0 and 1 start in slots 0 and 1, then request 2 takes the slot of request 1
+        slots = [0, 1, 1]
+
+        def forward(inference_params, rows, new_token_lengths):
+            # One dynamic batching step, where each row is a request with its own slot
+            # (i.e.) its own mamba states and kv cache, and its own number of new tokens
+            sequence_length = max(new_token_lengths)
+            input_ids = torch.zeros((len(rows), sequence_length), dtype=torch.int64).cuda()
+            for row, ((request, offset), length) in enumerate(zip(rows, new_token_lengths)):
+                input_ids[row, :length] = sequences[request][offset : offset + length]
+            sequence_offsets = torch.tensor([offset for _, offset in rows]).cuda()
+            max_sequence_end = sequence_offsets.max().item() + sequence_length
+            inference_params.set_batch_slots(
+                torch.tensor([slots[request] for request, _ in rows]).cuda(),
+                sequence_offsets,
+                max_sequence_end,
+                torch.tensor(new_token_lengths).cuda(),
+            )
+            position_ids = sequence_offsets.unsqueeze(1) + torch.arange(sequence_length).cuda()
+            attention_mask = torch.arange(max_sequence_end).cuda().view(
+                1, 1, 1, -1
+            ) > position_ids.view(-1, 1, sequence_length, 1)
+            logits = self.model.forward(
+                input_ids=input_ids,
+                position_ids=position_ids,
+                attention_mask=attention_mask,
+                inference_params=inference_params,
+            )
+            return [logits[row, :length] for row, length in enumerate(new_token_lengths)]
+
+        # Each request alone, with its whole sequence in one forward pass
+        expected_logits = []
+        for sequence in sequences:
+            inference_params = InferenceParams(max_batch_size=1, max_sequence_length=8)
+            attention_mask = torch.ones((len(sequence), len(sequence)), dtype=bool).cuda()
+            attention_mask = torch.triu(attention_mask, diagonal=1).view(
+                1, 1, *attention_mask.shape
+            )
+            expected_logits.append(
+                self.model.forward(
+                    input_ids=sequence.unsqueeze(0),
+                    position_ids=torch.arange(len(sequence)).cuda().unsqueeze(0),
+                    attention_mask=attention_mask,
+                    inference_params=inference_params,
+                )[0]
+            )
+
+        inference_params = InferenceParams(max_batch_size=2, max_sequence_length=8)
+        logits = [[] for _ in sequences]
+        for rows, new_token_lengths in (
+            ([(0, 0), (1, 0)], [2, 3]),
+            ([(0, 2), (2, 0)], [1, 2]),
+            ([(0, 3), (2, 2)], [1, 2]),
+            ([(0, 4)], [1]),
+        ):
+            for (request, _), row_logits in zip(
+                rows, forward(inference_params, rows, new_token_lengths)
+            ):
+                logits[request].append(row_logits)
+
+        for request_logits, request_expected_logits in zip(logits, expected_logits):
+            assert torch.allclose(
+                torch.cat(request_logits), request_expected_logits, atol=1e-3, rtol=1e-3
+            )
+
     def test_save_load(self, tmp_path):
         path = tmp_path / "model.pt"
         torch.save(self.model.state_dict(), path)
@@ -1,5 +1,6 @@
 # Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import numpy as np
 import os
@@ -67,11 +68,82 @@ def collate_batch(samples):
     return batch
 
 
-def get_data_loader(dataset, batch_size):
+def collate_window(samples):
+    """Collate a window of samples as a list, for length bucketing."""
+    return samples
+
+
+class EmbeddingThroughputMetrics:
+    '''Accumulate time & throughput of each embedding stage.
+
+    Stages are 'tokenize' (time spent waiting on the tokenizing data loader
+    workers), 'forward' (Bert forward, including the copy to host), and
+    'write' (saving blocks to disk). Metrics accumulate until 'reset()'.
+    '''
+
+    stages = ("tokenize", "forward", "write")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds = { stage:0. for stage in self.stages }
+        self.n_samples = 0
+        self.n_tokens = 0
+        self.n_padded_tokens = 0
+
+    def add_time(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def add_batch(self, n_samples, n_tokens, n_padded_tokens):
+        self.n_samples += n_samples
+        self.n_tokens += n_tokens
+        self.n_padded_tokens += n_padded_tokens
+
+    def get_summary(self):
+        '''Samples/sec & tokens/sec of each stage, and padding efficiency.'''
+        summary = {
+            "n_samples" : self.n_samples,
+            "n_tokens" : self.n_tokens,
+            "padding_efficiency" : \
+                self.n_tokens / max(1, self.n_padded_tokens),
+        }
+        for stage in self.stages:
+            seconds = self.seconds[stage]
+            summary[stage] = {
+                "seconds" : seconds,
+                "samples_per_sec" : self.n_samples / seconds if seconds else None,
+                "tokens_per_sec" : self.n_tokens / seconds if seconds else None,
+            }
+        return summary
+
+    def log(self, tag=None, label="cumulative"):
+        '''Log the metrics accumulated since the last reset.'''
+        summary = self.get_summary()
+        print_rank_0("  embed%s / %s / %d samples, %d tokens, padding eff %.3f." % (
+            "" if tag is None else " / '%s'" % tag,
+            label,
+            summary["n_samples"],
+            summary["n_tokens"],
+            summary["padding_efficiency"],
+        ))
+        for stage in self.stages:
+            if summary[stage]["samples_per_sec"] is not None:
+                print_rank_0("    %s: %.1f sec, %.1f samples/sec, %.1f tokens/sec." % (
+                    stage,
+                    summary[stage]["seconds"],
+                    summary[stage]["samples_per_sec"],
+                    summary[stage]["tokens_per_sec"],
+                ))
+
+
+def get_data_loader(dataset, window_size):
     """Build data loader over data subset.
 
-    Get a subset of the dataset (from start_idx -> end_idx), and wrap it in
-    a sequential sampler and data loader.
+    Wrap the dataset in a sequential sampler and data loader, that yields
+    windows (lists) of tokenized samples. Tokenization runs in the data loader
+    worker processes, which prefetch the next windows while the current window
+    is being embedded.
     """
 
     args = get_args()
@@ -79,22 +151,39 @@ def get_data_loader(dataset, batch_size):
     # Sequential & batch samplers.
     batch_sampler = BatchSampler(
         sampler=SequentialSampler(dataset),
-        batch_size=batch_size,
+        batch_size=window_size,
         drop_last=False,
     )
 
-    # Data loader.
+    # Data loader. Memory is not pinned, since windows are lists of numpy
+    # samples, which are collated into batches in the main process, and
+    # copied to the GPU from a new tensor by 'get_batch()'.
     data_loader = DataLoader(dataset,
                              batch_sampler=batch_sampler,
                              num_workers=args.num_workers,
-                             pin_memory=True,
-                             collate_fn=collate_batch)
+                             collate_fn=collate_window)
 
     return data_loader
 
 
-def embed_data_loader(models, data_loader, tag):
-    '''Iterate data loader and compute embeddings.'''
+def get_length_bucketed_batches(samples, batch_size):
+    """Group a window of samples into batches of similar lengths.
+
+    Sorting the samples by length minimizes the padding added by
+    'collate_batch()'. Returns a list of arrays of sample indexes.
+    """
+    lengths = np.array([ len(sample["text"]) for sample in samples ])
+    order = np.argsort(lengths, kind="stable")
+    return [ order[i:i+batch_size] for i in range(0, len(order), batch_size) ]
+
+
+def embed_data_loader(models, data_loader, batch_size, tag, metrics=None):
+    '''Iterate data loader and compute embeddings.
+
+    Each window of samples from the data loader is split into length-bucketed
+    batches. Embeddings stay on the GPU until the whole window is embedded,
+    and are then copied to host and restored to their original order.
+    '''
 
     # Verify no model parallelism.
     args = get_args()
@@ -104,25 +193,51 @@ def embed_data_loader(models, data_loader, tag):
 
     # Data iterator.
     data_iterator = iter(data_loader)
+    if metrics is None:
+        metrics = EmbeddingThroughputMetrics()
 
     # Eval mode.
     for m in models:
         m.eval()
 
     # Embed.
-    embeddings = []
+    embeddings = None
+    start_idx = 0
     for _ in tqdm(
         range(len(data_loader)),
         "  embed%s" % ("" if tag is None else " / '%s'" % tag),
         miniters=len(data_loader) // 10,
         disable=torch.distributed.get_rank() != 0,
     ):
-        with torch.no_grad():
-            result = forward_step(data_iterator, models[0])
-            embeddings.append(result[0].detach().cpu().numpy())
 
-    # Concatenate embeddings.
-    embeddings = np.concatenate(embeddings, axis=0)
+        # Next window of tokenized samples.
+        t = time.time()
+        samples = next(data_iterator)
+        metrics.add_time("tokenize", time.time() - t)
+
+        # Embed length-bucketed batches.
+        t = time.time()
+        batch_idxs = get_length_bucketed_batches(samples, batch_size)
+        window_embeddings = []
+        for idxs in batch_idxs:
+            batch = collate_batch([ samples[i] for i in idxs ])
+            metrics.add_batch(len(idxs),
+                              int(batch["padding_mask"].sum()),
+                              batch["padding_mask"].numel())
+            with torch.no_grad():
+                result = forward_step(iter([ batch ]), models[0])
+                window_embeddings.append(result[0].detach())
+
+        # Copy to host (single sync per window), and restore sample order.
+        window_embeddings = torch.cat(window_embeddings, dim=0).cpu().numpy()
+        if embeddings is None:
+            embeddings = np.zeros(
+                (len(data_loader.dataset), window_embeddings.shape[1]),
+                dtype=window_embeddings.dtype)
+        order = np.concatenate(batch_idxs)
+        embeddings[start_idx + order] = window_embeddings
+        start_idx += len(samples)
+        metrics.add_time("forward", time.time() - t)
 
     return embeddings
 
@@ -146,7 +261,8 @@ class TextDataset(torch.utils.data.Dataset):
 class BertEmbedder:
     '''Compute Bert embeddings, from a text dataset.'''
 
-    def __init__(self, batch_size, max_bert_seq_length, embedder_type, warmup=True):
+    def __init__(self, batch_size, max_bert_seq_length, embedder_type, warmup=True,
+                 n_batches_per_window=16):
 
         args = get_args()
 
@@ -157,6 +273,8 @@ class BertEmbedder:
                                       ModelType.encoder_or_decoder)
         self.batch_size = batch_size
         self.max_bert_seq_length = max_bert_seq_length
+        self.n_batches_per_window = n_batches_per_window
+        self.metrics = EmbeddingThroughputMetrics()
 
         # Init Huggingface, if in use.
         if embedder_type == "megatron":
@@ -197,8 +315,10 @@ class BertEmbedder:
                                             self.max_bert_seq_length)
 
         # Embed.
-        data_loader = get_data_loader(bert_dataset, self.batch_size)
-        embeddings = embed_data_loader(self.models, data_loader, tag)
+        data_loader = get_data_loader(bert_dataset,
+                                      self.batch_size * self.n_batches_per_window)
+        embeddings = embed_data_loader(self.models, data_loader,
+                                       self.batch_size, tag, self.metrics)
 
         return embeddings
 
@@ -217,44 +337,81 @@ class BertEmbedder:
 
 
 class DiskDataParallelBertEmbedder:
-    '''Process embeddings in blocks & save to disk.'''
+    '''Process embeddings in blocks & save to disk.
+
+    Blocks are saved by a background thread, such that saving a block overlaps
+    with embedding the next block.
+    '''
 
     def __init__(self, embedder, block_size):
         assert isinstance(embedder, BertEmbedder)
         self.embedder = embedder
         self.block_size = block_size
 
+    @classmethod
+    def save_block(cls, path, embeddings, metrics):
+        '''Save block embeddings (via temporary file, to avoid partial blocks).'''
+        t = time.time()
+        tmp_path = path + ".tmp"
+        f = h5py.File(tmp_path, "w")
+        f.create_dataset("data", data=embeddings)
+        f.close()
+        os.replace(tmp_path, path)
+        metrics.add_time("write", time.time() - t)
+
     def embed_text_blocks(self, name, dirname, text_dataset,
                           missing_embedding_blocks):
         '''Process a text dataset in blocks.'''
 
-        # Iterate blocks.
-        for block_index, block_info in enumerate(missing_embedding_blocks):
-
-            # Missing block lists are extended with None to have equal-length
-            # lists. Skip the Nones.
-            if block_info is not None:
-
-                # Progress. (*note*: move world progress to here.)
-                print_rank_0("embed '%s' block %d / %d ... %s." % (
-                    name,
-                    block_index,
-                    len(missing_embedding_blocks),
-                    block_info["path"],
-                ))
-
-                # Embed block.
-                sub_dataset = Subset(text_dataset, range(*block_info["range"]))
-                embeddings = self.embedder.embed_text_dataset(sub_dataset)
-
-                # Save embeddings.
-                f = h5py.File(block_info["path"], "w")
-                f.create_dataset("data", data=embeddings)
-                f.close()
+        metrics = self.embedder.metrics
+        metrics.reset()
 
-            # Synchronize progress across all ranks. (for easier observation)
-            print_rank_0(" > waiting for other ranks to finish block.")
-            torch.distributed.barrier()
+        # Iterate blocks.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            save_future = None
+            for block_index, block_info in enumerate(missing_embedding_blocks):
+
+                # Missing block lists are extended with None to have equal-length
+                # lists. Skip the Nones.
+                if block_info is not None:
+
+                    # Progress. (*note*: move world progress to here.)
+                    print_rank_0("embed '%s' block %d / %d ... %s." % (
+                        name,
+                        block_index,
+                        len(missing_embedding_blocks),
+                        block_info["path"],
+                    ))
+
+                    # Embed block.
+                    sub_dataset = Subset(text_dataset, range(*block_info["range"]))
+                    embeddings = self.embedder.embed_text_dataset(sub_dataset)
+
+                    # Save embeddings, after the previous block is saved.
+                    if save_future is not None:
+                        save_future.result()
+                    save_future = executor.submit(self.save_block,
+                                                  block_info["path"],
+                                                  embeddings,
+                                                  metrics)
+
+                    # Throughput per stage, over the blocks embedded so far. The
+                    # write time excludes the block being saved in the background.
+                    metrics.log(name)
+
+                # Synchronize progress across all ranks. (for easier observation)
+                print_rank_0(" > waiting for other ranks to finish block.")
+                torch.distributed.barrier()
+
+            # Wait for last block to be saved.
+            if save_future is not None:
+                save_future.result()
+
+        # Throughput per stage, over all the blocks.
+        metrics.log(name, label="total")
+
+        # Ensure all blocks are saved on all ranks.
+        torch.distributed.barrier()
 
     def embed_text_dataset(self, name, dirname, text_dataset):
         '''Embed a text dataset.'''
@@ -4,6 +4,11 @@
 Deduplicate downstream tasks from training dataset. 13-grams have been used.
 All split documents with less than 200 characters got filtered. Any document
 with more than 10 splits got filtered as well.
+
+The ngrams are compiled into a word level Aho-Corasick automaton, so each
+document is scanned once, and the dataset is processed in parallel over byte
+range shards of the file. The matched ngrams of each document can be saved to
+a separate file with --matches-output.
 """
 
 import argparse
@@ -12,6 +17,7 @@ import json
 import multiprocessing
 import nltk
 import pickle
+import os
 import re
 import string
 import sys
@@ -25,150 +31,213 @@ def get_words(text):
         positions.append(match.start())
     return words, positions
 
-# splits the text
-def split_text(text, start_position, remove_char_each_side, seq):
+class NgramAutomaton:
+    """Word level Aho-Corasick automaton over a set of ngrams.
+
+    Each ngram is a string of space separated words. The automaton finds all
+    occurrences of all ngrams in a list of words with a single linear scan.
+    """
+
+    def __init__(self, ngrams):
+        self.vocab = {}
+        # Per state: transitions (word id -> state), failure link, ngram ending
+        # at the state (None if none), and the nearest state on the failure
+        # chain at which an ngram ends (0 if none).
+        self.goto = [{}]
+        self.fail = [0]
+        self.ngram = [None]
+        self.ngram_len = [0]
+        self.output_link = [0]
+
+        for ngram in ngrams:
+            state = 0
+            words = ngram.split()
+            for word in words:
+                word_id = self.vocab.setdefault(word, len(self.vocab))
+                next_state = self.goto[state].get(word_id)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][word_id] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.ngram.append(None)
+                    self.ngram_len.append(0)
+                    self.output_link.append(0)
+                state = next_state
+            self.ngram[state] = ngram
+            self.ngram_len[state] = len(words)
+
+        # breadth first construction of the failure and output links, the
+        # failure links of the depth one states point to the root
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for word_id, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail > 0 and word_id not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(word_id, 0)
+                self.fail[next_state] = fail
+                self.output_link[next_state] = fail if self.ngram[fail] \
+                    is not None else self.output_link[fail]
+
+    def __len__(self):
+        return sum(ngram is not None for ngram in self.ngram)
+
+    def search(self, words):
+        # returns all matches as (start word, end word (exclusive), ngram)
+        matches = []
+        state = 0
+        for i, word in enumerate(words):
+            word_id = self.vocab.get(word)
+            if word_id is None:
+                state = 0
+                continue
+            while state > 0 and word_id not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(word_id, 0)
+            match_state = state if self.ngram[state] is not None else \
+                self.output_link[state]
+            while match_state > 0:
+                matches.append((i + 1 - self.ngram_len[match_state], i + 1,
+                                self.ngram[match_state]))
+                match_state = self.output_link[match_state]
+        return matches
+
+# splits the text around the match [start_position, end_position) and returns
+# the end of the first part and the start of the second part
+def split_text(text, segment_start, start_position, end_position, \
+    remove_char_each_side):
     # first part of the text
     punctuations = ".!?"
     pos = start_position - remove_char_each_side
-    text_first = ""
-    while pos > 0 and not text[pos] in punctuations:
+    first_end = segment_start
+    while pos > segment_start and not text[pos] in punctuations:
         pos -= 1
-    if pos > 0:
-        text_first = text[0:pos+1]
+    if pos > segment_start:
+        first_end = pos + 1
 
-    # add length of seq and remove_char_each_side
-    pos = start_position + len(seq) + remove_char_each_side
+    # add length of the match and remove_char_each_side
+    pos = end_position + remove_char_each_side
 
     # last part of the text
-    text_second = ""
     while pos < len(text) and not text[pos] in punctuations:
         pos += 1
-    if pos + 1 < len(text):
-        text_second = text[pos+1:len(text)]
-
-    return text_first, text_second
+    second_start = min(pos + 1, len(text))
 
-def check_and_clean_text(args, words, ngrams, text, start_position, \
-    text_buf_ngram_free, text_buf, local_ngram):
+    return first_end, second_start
 
-    seq = " ".join(words)
-    if seq in ngrams:
-        print(" [matched]: {}".format(seq), flush=True)
-
-        if args.get_ngram_freq_only:
-            # increase freq of this seq and then only consider the later part
-            # of the text for further processing
-            if seq in local_ngram:
-                local_ngram[seq] += 1
-            else:
-                local_ngram[seq] = 1
-            #print(" [increased]: {} {}".format(seq, ngrams[seq]), flush=True)
-            if (start_position + len(seq) + 1) < len(text):
-                text_buf.append(text[start_position + len(seq) + 1:len(text)])
-            return False            
-
-        # split the text
-        text_first, text_second = split_text(text, start_position, \
-            args.remove_char_each_side, seq)
-
-        # first part of ngrams free
-        if len(text_first) > args.filter_text_char_len:
-            text_buf_ngram_free.append(text_first)
+# automaton of the ngrams, set in each worker by init_worker
+automaton = None
 
-        # add second part for further processing
-        if len(text_second) > args.filter_text_char_len:
-            text_buf.append(text_second)
+def init_worker(ngrams_automaton):
+    global automaton
+    automaton = ngrams_automaton
 
-        return False # not ngram free
-
-    # ngram free
-    return True
-
-
-def free_ngram(line, args, key, ngrams, ngrams_freq_sorted):
+def find_matches(text):
+    # find all the ngrams in the text with a single scan, as character spans
+    words, positions = get_words(text)
+    matches = []
+    for start, end, seq in automaton.search(words):
+        matches.append((positions[start], positions[end - 1] + \
+            len(words[end - 1]), seq))
+    matches.sort()
+    return matches
+
+def free_ngram(line, args, key):
     # remove all the ngrams
 
     try:
         myjson = json.loads(line)
-        text_buf = [myjson[key]]
+        text = myjson[key]
     except Exception as e:
         print("Error: {}".format(e), flush=True)
-        text_buf = []
+        return [], 0, None, {}, []
 
-    text_buf_ngram_free = []
-    local_ngram = {}
-    while len(text_buf) > 0:
-
-        # get the first one from the buffer
-        text = text_buf.pop(0)
-        words, positions = get_words(text)
-        
-        ngram_free = True
-        # find each max n-grams and check dictionary
-        for i in range(len(words) - args.max_ngram_size + 1):
-            check_ngram_free = check_and_clean_text(args, words[i:\
-                i+args.max_ngram_size], ngrams, text, positions[i], \
-                text_buf_ngram_free, text_buf, local_ngram)
-
-            # the seq is ngram free? if yes, break
-            if not check_ngram_free:
-                ngram_free = False
-                break
-
-            # if max ngrams doesn't match, check if any other lower n-grams
-            # within max ngram macthes
-            for ngram_len, _ in ngrams_freq_sorted:
-                check_ngram_free = check_and_clean_text(args, words[i:\
-                    i+ngram_len], ngrams, text, positions[i], \
-                    text_buf_ngram_free, text_buf, local_ngram)
+    matches = find_matches(text)
+    if args.print_matches:
+        for _, _, seq in matches:
+            print(" [matched]: {}".format(seq), flush=True)
 
-                # same check as above
-                if not check_ngram_free:
-                    ngram_free = False
-                    break
-
-            # check break from lower than max ngram loop above
-            if not ngram_free:
-                break
-
-        # for the last max n-gram, check all the lower ngrams in it
-        if ngram_free and len(words) - args.max_ngram_size > 0:
-            # get the last words of the lax max ngram
-            last_seq_words = words[(len(words)-args.max_ngram_size):len(words)]
-            last_seq_start_position = len(words) - args.max_ngram_size
-
-            # check all n-grams lower than the max
-            for pos, (ngram_len, _) in enumerate(ngrams_freq_sorted):
-
-                # ignore the max ngram as has been considered already
-                if ngram_len == args.max_ngram_size:
-                    continue
+    # only get the frequency of each ngram
+    if args.get_ngram_freq_only:
+        local_ngram = {}
+        for _, _, seq in matches:
+            local_ngram[seq] = local_ngram.get(seq, 0) + 1
+        return [], 0, myjson, local_ngram, matches
 
-                # find each ngram of ngram_len in max n-grams and check
-                for i in range(len(last_seq_words) - ngram_len + 1):
-                    check_ngram_free = check_and_clean_text(args, \
-                        last_seq_words[i:i+ngram_len], ngrams, text,\
-                        positions[last_seq_start_position+i], \
-                        text_buf_ngram_free, text_buf, local_ngram)
+    # walk the matches in order and split the text around each one. Matches
+    # that start in a part of the text that was already removed are ignored.
+    text_buf_ngram_free = []
+    segment_start = 0
+    for match_start, match_end, _ in matches:
+        if match_start < segment_start:
+            continue
+        first_end, second_start = split_text(text, segment_start, \
+            match_start, match_end, args.remove_char_each_side)
 
-                    if not check_ngram_free:
-                        ngram_free = False
-                        break
+        # first part of ngrams free
+        if first_end - segment_start > args.filter_text_char_len:
+            text_buf_ngram_free.append(text[segment_start:first_end])
 
-                if not ngram_free:
-                    break
+        # keep the second part for further processing
+        if len(text) - second_start > args.filter_text_char_len:
+            segment_start = second_start
+        else:
+            segment_start = None
+            break
 
-        # texts are ngram free
-        if ngram_free and not args.get_ngram_freq_only:
-            text_buf_ngram_free.append(text)
+    # the rest of the text is ngram free
+    if segment_start is not None:
+        text_buf_ngram_free.append(text[segment_start:])
 
     # check if the text has only been trimmed
     trimmed = 0
-    if not args.get_ngram_freq_only and len(text_buf_ngram_free) == 1 and \
-        len(text_buf_ngram_free[0]) < len(myjson[key]):
+    if len(text_buf_ngram_free) == 1 and \
+        len(text_buf_ngram_free[0]) < len(text):
         trimmed = 1
 
-    return text_buf_ngram_free, trimmed, myjson, local_ngram
+    return text_buf_ngram_free, trimmed, myjson, {}, matches
+
+def get_shard_ranges(input_file, shard_size):
+    # split a file into byte ranges, a line belongs to the shard in which it
+    # starts
+    size = os.path.getsize(input_file)
+    return [(start, min(start + shard_size, size)) for start in \
+        range(0, size, shard_size)]
+
+def free_ngram_shard(shard, args, key, input_file):
+    # remove all the ngrams from the documents that start within a shard
+    start, end = shard
+    results = []
+    with open(input_file, 'rb') as fin:
+        if start > 0:
+            # skip the partial line, it belongs to the previous shard
+            fin.seek(start - 1)
+            fin.readline()
+        while fin.tell() < end:
+            line = fin.readline()
+            if not line:
+                break
+            results.append(free_ngram(line, args, key))
+    return results
+
+def free_ngram_file(args, ngrams, dedup_file, dedup_key):
+    # compile the ngrams and process the shards of the file in parallel,
+    # yielding the results of each document in order
+    ngrams_automaton = NgramAutomaton(ngrams.keys())
+    print(" Automaton with {} ngrams and {} states".format(\
+        len(ngrams_automaton), len(ngrams_automaton.goto)), flush=True)
+    pool = multiprocessing.Pool(args.num_threads, initializer=init_worker, \
+        initargs=(ngrams_automaton,))
+    shards = get_shard_ranges(dedup_file, args.shard_size_mb * 1024 * 1024)
+    free_ngram_shard_partial = partial(free_ngram_shard, args=args, \
+        key=dedup_key, input_file=dedup_file)
+    for results in pool.imap(free_ngram_shard_partial, shards):
+        for result in results:
+            yield result
+    pool.close()
+    pool.join()
 
 # insert word sequence into dictionary
 def insert_dict(words, ngrams, pos):
@@ -284,22 +353,17 @@ def compute_ngram_freq_sorted(args, ngrams):
     return ngrams_freq_sorted
 
 def get_ngrams_below_threshold(args, ngrams, ngrams_below_threshold, \
-    dedup_file, dedup_key, ngrams_freq_sorted):
+    dedup_file, dedup_key):
 
     start_time = time.time()
     # get the ngrams frequency
     args.get_ngram_freq_only = True
- 
-    # Open the large file to process in parallel
-    num_workers = args.num_threads 
-    pool = multiprocessing.Pool(num_workers)
-    fin = open(dedup_file, 'r', encoding='utf-8')
-    free_ngram_abt_partial=partial(free_ngram, args=args, key=dedup_key, \
-        ngrams=ngrams, ngrams_freq_sorted=ngrams_freq_sorted)
-    free_ngrams_abt = pool.imap(free_ngram_abt_partial, fin, 500)
- 
+
+    # Process the shards of the large file in parallel
+    free_ngrams_abt = free_ngram_file(args, ngrams, dedup_file, dedup_key)
+
     counter = 0
-    for _, _, _, local_ngram in free_ngrams_abt:
+    for _, _, _, local_ngram, _ in free_ngrams_abt:
         counter += 1
         if counter % 1000 == 0:
             print(' [compute_stat]> processed {} documents in {:.2f} seconds ...'.
@@ -307,12 +371,9 @@ def get_ngrams_below_threshold(args, ngrams, ngrams_below_threshold, \
         for local_key in local_ngram:
             if local_key in ngrams:
                 ngrams[local_key] += 1
-        local_ngram = {}
 
     print(' Time taken to compute statistics {:.2f} seconds'.format(time.time() - \
         start_time), flush=True)
-    pool.close()
-    pool.join()
 
     start_time = time.time()
     counter_threshold = 0
@@ -324,7 +385,6 @@ def get_ngrams_below_threshold(args, ngrams, ngrams_below_threshold, \
             ngrams_below_threshold[local_key] = 1
             
     print(' Ngrams below threshold {}'.format(counter_threshold), flush=True)
-    fin.close()
 
 def clean_ngrams_below_threshold(args, ngrams_below_threshold, dedup_file, \
     dedup_key):
@@ -336,23 +396,32 @@ def clean_ngrams_below_threshold(args, ngrams_below_threshold, dedup_file, \
     id_prefix = '-'.join(args.tasks[::1])
 
     # get the range of the size of the ngrams
-    ngrams_freq_sorted = compute_ngram_freq_sorted(args, ngrams_below_threshold)
+    compute_ngram_freq_sorted(args, ngrams_below_threshold)
 
-    # Open the large file to process in parallel
+    # Process the shards of the large file in parallel
     counter = splitted = ignored = split_mt_thld = trimmed_count = 0
-    num_workers = args.num_threads
-    pool = multiprocessing.Pool(num_workers)
-    fin = open(dedup_file, 'r', encoding='utf-8')
-    free_ngram_clean_partial=partial(free_ngram, args=args, key=dedup_key, \
-        ngrams=ngrams_below_threshold, ngrams_freq_sorted=ngrams_freq_sorted)
-    free_ngrams_clean = pool.imap(free_ngram_clean_partial, fin, 500)
- 
+    free_ngrams_clean = free_ngram_file(args, ngrams_below_threshold, \
+        dedup_file, dedup_key)
+
     out_f = open(args.output, 'wb')
+    matches_f = open(args.matches_output, 'wb') \
+        if args.matches_output is not None else None
 
-    for text_buf_ngram_free, trimmed, myjson, _ in free_ngrams_clean:
+    for text_buf_ngram_free, trimmed, myjson, _, matches in free_ngrams_clean:
         counter += 1
+        if myjson is None:
+            continue
         try:
 
+            # write the contamination matches of the document
+            if matches_f is not None and len(matches) > 0:
+                matchjson = json.dumps({"document": counter,
+                    "split_id": myjson.get("split_id"),
+                    "matches": [{"ngram": seq, "start": start, "end": end} \
+                        for start, end, seq in matches]}, ensure_ascii=False)
+                matches_f.write(matchjson.encode('utf-8'))
+                matches_f.write('\n'.encode('utf-8'))
+
             trimmed_count += trimmed
 
             if len(text_buf_ngram_free) > 1:
@@ -395,11 +464,9 @@ def clean_ngrams_below_threshold(args, ngrams_below_threshold, dedup_file, \
         ' {}'.format(counter, splitted, ignored, split_mt_thld, trimmed_count)\
         , flush=True)
 
-    pool.close()
-    pool.join()
-
     out_f.close()
-    fin.close()
+    if matches_f is not None:
+        matches_f.close()
 
 if __name__ == '__main__':
 
@@ -439,6 +506,13 @@ if __name__ == '__main__':
                        help='Remove any documents more than this many splits')
     parser.add_argument('--remove-char-each-side', type=int, default=200,
                        help='Maximum size of ngram to use.')
+    parser.add_argument('--shard-size-mb', type=int, default=16,
+                       help='Size of the file shards processed by each worker')
+    parser.add_argument('--matches-output', type=str, default=None,
+                       help='Output file name to save the matched ngrams of '
+                       'each contaminated document, one json per line')
+    parser.add_argument('--print-matches', action='store_true',
+                       help='Print every matched ngram')
 
     args = parser.parse_args()
 
@@ -455,13 +529,13 @@ if __name__ == '__main__':
         compute_tasks_ngrams(args, ngrams)
 
         # get the range of the size of the ngrams
-        ngrams_freq_sorted = compute_ngram_freq_sorted(args, ngrams)
+        compute_ngram_freq_sorted(args, ngrams)
 
         # get ngram freq from large file in parallel
         # get ngrams below threshold
         ngrams_below_threshold = {}
         get_ngrams_below_threshold(args, ngrams, ngrams_below_threshold, \
-            dedup_file, dedup_key, ngrams_freq_sorted)
+            dedup_file, dedup_key)
 
         # save the dictionary if needed
         if args.save_dictionary is not None:
@@ -0,0 +1,330 @@
+# Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+
+"""
+Find near-duplicate documents with vectorized MinHash and banded LSH.
+
+This is a faster alternative to `find_duplicates.py` followed by
+`group_duplicate_url.py`. Shingles are hashed to uint64 with NumPy, MinHash
+signatures are computed in parallel over byte-range shards of the inputs,
+LSH buckets are found by sorting band keys, the Jaccard similarity of
+candidate pairs is estimated from their signatures, and duplicate clusters are
+found with a union-find. The output has the same format as the output of
+`group_duplicate_url.py`, i.e. one json per line `{cluster_id: [urls]}`, and
+can be passed directly to `remove_group_duplicates.py`.
+"""
+
+import argparse
+from functools import partial
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+# All ones uint64, and the multiplier of the polynomial shingle hash.
+_MASK64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+_SHINGLE_BASE = np.uint64(0x100000001B3)
+
+
+def splitmix64(x):
+    # Finalizer of the splitmix64 generator, used as a uint64 mixing function.
+    # NumPy uint64 arithmetic wraps around on overflow.
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def shingle_hashes(text, char_ngram=5):
+    # Hash all character n-grams of the text to unique uint64 values.
+    code_points = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    code_points = code_points.astype(np.uint64)
+    num_shingles = len(code_points) - char_ngram + 1
+    if num_shingles < 1:
+        return np.zeros(0, dtype=np.uint64)
+    hashes = np.zeros(num_shingles, dtype=np.uint64)
+    for offset in range(char_ngram):
+        hashes = hashes * _SHINGLE_BASE + code_points[offset:offset + num_shingles]
+    return np.unique(splitmix64(hashes))
+
+
+def get_permutations(num_perm, seed):
+    # Parameters (a, b) of the hash functions h(x) = a * x + b (mod 2^64),
+    # with odd a, so that each h is a permutation of uint64.
+    rng = np.random.RandomState(seed)
+    a = rng.randint(0, 2**63, size=num_perm, dtype=np.int64).astype(np.uint64)
+    b = rng.randint(0, 2**63, size=num_perm, dtype=np.int64).astype(np.uint64)
+    a = (a << np.uint64(1)) | np.uint64(1)
+    return a, b
+
+
+def minhash_signature(hashes, permutations, max_shingles_per_step=8192):
+    # MinHash signature (num_perm,) of a set of uint64 shingle hashes.
+    # Documents without shingles (shorter than char-ngram) get a signature of
+    # all ones, and are excluded from the clustering (see has_shingles).
+    a, b = permutations
+    signature = np.full(len(a), _MASK64, dtype=np.uint64)
+    for start in range(0, len(hashes), max_shingles_per_step):
+        chunk = hashes[start:start + max_shingles_per_step]
+        permuted = a[:, None] * chunk[None, :] + b[:, None]
+        signature = np.minimum(signature, permuted.min(axis=1))
+    return signature
+
+
+def get_shard_ranges(input_file, num_shards):
+    # Split a file into byte ranges of roughly equal size. A line belongs to
+    # the shard in which it starts.
+    size = os.path.getsize(input_file)
+    bounds = [size * i // num_shards for i in range(num_shards + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(num_shards)
+            if bounds[i] < bounds[i + 1]]
+
+
+def compute_shard_signatures(shard, key, permutations, char_ngram):
+    # Compute the signatures of all documents that start within a shard.
+    input_file, (start, end) = shard
+    urls, signatures = [], []
+    num_errors = 0
+    with open(input_file, 'rb') as fin:
+        if start > 0:
+            # Skip the partial line; it belongs to the previous shard.
+            fin.seek(start - 1)
+            fin.readline()
+        while fin.tell() < end:
+            line = fin.readline()
+            if not line:
+                break
+            try:
+                myjson = json.loads(line)
+                url = myjson[key]
+                text = myjson['text']
+            except Exception as e:
+                num_errors += 1
+                continue
+            urls.append(url)
+            signatures.append(minhash_signature(
+                shingle_hashes(text, char_ngram), permutations))
+    num_perm = len(permutations[0])
+    signatures = np.stack(signatures) if len(signatures) > 0 else \
+        np.zeros((0, num_perm), dtype=np.uint64)
+    return urls, signatures, num_errors
+
+
+def has_shingles(signatures):
+    # Documents whose signature is all ones have no shingles. Their signatures
+    # are all equal, so they would otherwise all be clustered together, while
+    # their Jaccard similarity with any document is 0.
+    return ~(signatures == _MASK64).all(axis=1)
+
+
+def get_band_keys(signatures, num_bands):
+    # Hash each band of rows of the signatures to a single uint64 key.
+    num_docs, num_perm = signatures.shape
+    assert num_perm % num_bands == 0, \
+        'number of permutations should be divisible by number of bands'
+    rows = num_perm // num_bands
+    bands = signatures.reshape(num_docs, num_bands, rows)
+    keys = np.zeros((num_docs, num_bands), dtype=np.uint64)
+    for row in range(rows):
+        keys = splitmix64(keys ^ bands[:, :, row])
+    return keys
+
+
+def get_candidate_pairs(band_keys):
+    # Documents that share a key in any band are candidates. Within each
+    # bucket, every document is paired with the first document of the bucket.
+    pairs = []
+    for band in range(band_keys.shape[1]):
+        keys = band_keys[:, band]
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        is_bucket_start = np.ones(len(keys), dtype=bool)
+        is_bucket_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        bucket_first = order[np.maximum.accumulate(
+            np.where(is_bucket_start, np.arange(len(keys)), 0))]
+        in_bucket = ~is_bucket_start
+        pairs.append(np.stack([bucket_first[in_bucket], order[in_bucket]], axis=1))
+    pairs = np.concatenate(pairs, axis=0) if len(pairs) > 0 else \
+        np.zeros((0, 2), dtype=np.int64)
+    return np.unique(pairs, axis=0)
+
+
+def estimated_jaccard(signatures, pairs, max_pairs_per_step=1 << 20):
+    # Fraction of equal signature entries is an unbiased estimate of the
+    # Jaccard similarity of the shingle sets.
+    similarities = np.zeros(len(pairs), dtype=np.float32)
+    for start in range(0, len(pairs), max_pairs_per_step):
+        chunk = pairs[start:start + max_pairs_per_step]
+        similarities[start:start + len(chunk)] = (
+            signatures[chunk[:, 0]] == signatures[chunk[:, 1]]).mean(axis=1)
+    return similarities
+
+
+class UnionFind:
+
+    def __init__(self, size):
+        self.parent = np.arange(size)
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x, y):
+        root_x, root_y = self.find(x), self.find(y)
+        if root_x != root_y:
+            # Keep the smaller index as the root, so the first document of a
+            # cluster in input order is kept.
+            self.parent[max(root_x, root_y)] = min(root_x, root_y)
+
+    def roots(self):
+        return np.array([self.find(x) for x in range(len(self.parent))])
+
+
+def find_duplicate_clusters(signatures, num_bands, threshold):
+    # Returns a list of clusters (arrays of document indices) of size > 1.
+    start_time = time.time()
+    doc_indices = np.nonzero(has_shingles(signatures))[0]
+    if len(doc_indices) < len(signatures):
+        print(' skipped {} documents without shingles'.format(
+            len(signatures) - len(doc_indices)), flush=True)
+    band_keys = get_band_keys(signatures[doc_indices], num_bands)
+    pairs = doc_indices[get_candidate_pairs(band_keys)]
+    print(' found {} candidate pairs in {:.2f} seconds'.format(
+        len(pairs), time.time() - start_time), flush=True)
+
+    similarities = estimated_jaccard(signatures, pairs)
+    pairs = pairs[similarities >= threshold]
+    print(' found {} duplicate pairs in {:.2f} seconds'.format(
+        len(pairs), time.time() - start_time), flush=True)
+
+    union_find = UnionFind(len(signatures))
+    for x, y in pairs:
+        union_find.union(x, y)
+    roots = union_find.roots()
+
+    order = np.argsort(roots, kind='stable')
+    sorted_roots = roots[order]
+    split_points = np.nonzero(sorted_roots[1:] != sorted_roots[:-1])[0] + 1
+    clusters = [c for c in np.split(order, split_points) if len(c) > 1]
+    print(' found {} duplicate clusters in {:.2f} seconds'.format(
+        len(clusters), time.time() - start_time), flush=True)
+    return clusters
+
+
+if __name__ == '__main__':
+
+    print('parsing the arguments ...')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=1234,
+                        help='Random seed used for the minhash permutations')
+    parser.add_argument('--inputs', nargs='*', default=None, help=
+                        'Pairwise list of the input files and keys, '
+                        'e.g. --inputs cc.json cc_id news.json news_id')
+    parser.add_argument('--load-signatures', nargs='*', default=None,
+                        help='Load signatures from a list of npz files, '
+                        'e.g. cc.npz news.npz')
+    parser.add_argument('--save-signatures', type=str, default=None,
+                        help='Save the signatures of the inputs (npz file).')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Output file name with one json per line, '
+                        'containing the urls of each duplicate cluster')
+    parser.add_argument('--char-ngram', type=int, default=5,
+                        help='Number of characters per shingle')
+    parser.add_argument('--num-perm', type=int, default=128,
+                        help='Number of minhash permutations. Note that this '
+                        'value should be divisible by num-bands')
+    parser.add_argument('--num-bands', type=int, default=16,
+                        help='Number of LSH bands')
+    parser.add_argument('--jaccard-threshold', type=float, default=0.7,
+                        help='Estimated jaccard similarity above which '
+                        'documents are duplicates')
+    parser.add_argument('--num-workers', type=int, default=40,
+                        help='Number of worker processes')
+    parser.add_argument('--num-shards-per-input', type=int, default=None,
+                        help='Number of byte-range shards per input file. '
+                        'Defaults to 4 x num-workers.')
+    args = parser.parse_args()
+
+    print('finding possible duplicate content ...')
+
+    permutations = get_permutations(args.num_perm, args.seed)
+    all_urls = []
+    all_signatures = []
+
+    # load signatures from npz files if needed
+    if args.load_signatures is not None:
+        for sig_file_name in args.load_signatures:
+            print('Loading signatures from npz file {}'.format(sig_file_name),
+                  flush=True)
+            data = np.load(sig_file_name, allow_pickle=False)
+            assert data['signatures'].shape[1] == args.num_perm
+            assert int(data['seed']) == args.seed
+            all_urls.extend(data['urls'].tolist())
+            all_signatures.append(data['signatures'])
+
+    # compute signatures of the inputs if any, in parallel over shards
+    start_time = time.time()
+    if args.inputs is not None:
+        print('Computing signatures', flush=True)
+        assert len(args.inputs) % 2 == 0
+        num_shards = args.num_shards_per_input or 4 * args.num_workers
+        pool = multiprocessing.Pool(args.num_workers)
+        for input_file, key in zip(args.inputs[::2], args.inputs[1::2]):
+            print(' document processing {} with key {}'.format(input_file, key),
+                  flush=True)
+            shards = [(input_file, r) for r in
+                      get_shard_ranges(input_file, num_shards)]
+            compute_partial = partial(compute_shard_signatures, key=key,
+                                      permutations=permutations,
+                                      char_ngram=args.char_ngram)
+            num_docs = 0
+            for urls, signatures, num_errors in pool.imap(compute_partial,
+                                                          shards):
+                all_urls.extend(urls)
+                all_signatures.append(signatures)
+                num_docs += len(urls)
+                if num_errors > 0:
+                    print(' skipped {} invalid documents'.format(num_errors),
+                          flush=True)
+                print(' [read]> processed {} documents in {:.2f} '
+                      'seconds ...'.format(num_docs, time.time() - start_time),
+                      flush=True)
+        pool.close()
+        pool.join()
+
+    all_signatures = np.concatenate(all_signatures, axis=0) \
+        if len(all_signatures) > 0 else \
+        np.zeros((0, args.num_perm), dtype=np.uint64)
+    assert len(all_urls) == len(all_signatures)
+
+    # Save the signatures if needed
+    if args.save_signatures is not None:
+        print('Saving signatures to npz file {}'.format(args.save_signatures),
+              flush=True)
+        np.savez(args.save_signatures, urls=np.array(all_urls),
+                 signatures=all_signatures, seed=args.seed)
+
+    # find duplicate clusters and write to file if needed
+    if args.output is not None:
+        print('Finding duplicate clusters among {} documents'.format(
+            len(all_urls)), flush=True)
+        clusters = find_duplicate_clusters(all_signatures, args.num_bands,
+                                           args.jaccard_threshold)
+        num_remove = 0
+        with open(args.output, 'wb') as f:
+            for i, cluster in enumerate(clusters):
+                num_remove += len(cluster) - 1
+                myjson = json.dumps({str(i): [all_urls[x] for x in cluster]},
+                                    ensure_ascii=False)
+                f.write(myjson.encode('utf-8'))
+                f.write('\n'.encode('utf-8'))
+        print('out of {} urls, {} should be removed'.format(
+            len(all_urls), num_remove))
+
+    print('done :-)')
@@ -17,6 +17,13 @@ from megatron.training.yaml_arguments import core_transformer_config_from_yaml
 from megatron.inference.text_generation_server import MegatronServer
 from megatron.inference.text_generation import generate_and_post_process
 from megatron.inference.text_generation import beam_search_and_post_process
+from megatron.inference.text_generation import score_and_post_process
+from megatron.training import get_tokenizer
+from megatron.core.inference.engines.async_mcore_engine import AsyncMCoreEngine
+from megatron.core.inference.engines.mcore_engine import MCoreEngine
+from megatron.core.inference.model_inference_wrappers.gpt.gpt_inference_wrapper import GPTInferenceWrapper
+from megatron.core.inference.model_inference_wrappers.inference_wrapper_config import InferenceWrapperConfig
+from megatron.core.inference.text_generation_controllers.simple_text_generation_controller import SimpleTextGenerationController
 from megatron.core.transformer.spec_utils import import_module
 from megatron.core.models.gpt.gpt_layer_specs import (
     get_gpt_layer_local_spec,
@@ -92,9 +99,65 @@ def add_text_generate_args(parser):
     group = parser.add_argument_group(title='text generation')
     group.add_argument("--port", type=int, default=5000,
                        help='port for text generation server to run on')
+    group.add_argument("--use-inference-engine", action='store_true',
+                       help='Serve the generate requests with the megatron core '
+                       'inference engine, which batches concurrent requests '
+                       'together with dynamic batching. Requires a core model.')
+    group.add_argument("--inference-max-batch-size", type=int, default=8,
+                       help='Maximum number of requests batched together by '
+                       'the inference engine.')
+    group.add_argument("--inference-max-sequence-length", type=int, default=None,
+                       help='Maximum number of prompt plus generated tokens of '
+                       'a request with the inference engine. Defaults to '
+                       '--max-position-embeddings.')
+    group.add_argument("--inference-pipelined-decode-steps", type=int, default=None,
+                       help='With pipeline parallelism, number of tokens the '
+                       'inference engine generates per request at once, with '
+                       'groups of requests in flight on all the pipeline stages.')
+    group.add_argument("--inference-kv-cache-quantization", type=str, default=None,
+                       choices=['int8', 'fp8'],
+                       help='Store the kv cache of the inference engine in int8, '
+                       'as int8 values or as fp8 values, with a scale per head '
+                       'and token. Halves the kv cache memory of a 16-bit model.')
+    group.add_argument("--inference-scheduling-policy", type=str, default='fifo',
+                       choices=['fifo', 'earliest_deadline', 'shortest_remaining_work'],
+                       help='Order in which the inference engine admits the waiting '
+                       'requests of the same priority.')
+    group.add_argument("--inference-max-kv-cache-tokens", type=int, default=None,
+                       help='Only admit waiting requests while the prompt lengths plus '
+                       'tokens to generate of the active requests fit in this '
+                       'number of kv cache tokens.')
+    group.add_argument("--inference-request-timeout", type=float, default=None,
+                       help='Seconds to wait for the inference engine to generate '
+                       'a request, or between two events of a streamed request, '
+                       'before failing it. Defaults to waiting forever.')
     return parser
 
 
+def get_inference_engine(args, model) -> MCoreEngine:
+    """Builds the engine that serves the requests with --use-inference-engine"""
+    inference_wrapper_config = InferenceWrapperConfig(
+        hidden_size=args.hidden_size,
+        inference_batch_times_seqlen_threshold=args.inference_batch_times_seqlen_threshold,
+        fp32_residual_connection=args.fp32_residual_connection,
+        params_dtype=args.params_dtype,
+        padded_vocab_size=args.padded_vocab_size,
+        kv_cache_quantization=args.inference_kv_cache_quantization
+    )
+    inference_wrapped_model = GPTInferenceWrapper(model, inference_wrapper_config)
+    text_generation_controller = SimpleTextGenerationController(
+        inference_wrapped_model=inference_wrapped_model, tokenizer=get_tokenizer())
+    max_sequence_length = args.inference_max_sequence_length
+    if max_sequence_length is None:
+        max_sequence_length = args.max_position_embeddings
+    return MCoreEngine(text_generation_controller=text_generation_controller,
+                       max_batch_size=args.inference_max_batch_size,
+                       max_sequence_length=max_sequence_length,
+                       num_pipelined_decode_steps=args.inference_pipelined_decode_steps,
+                       scheduling_policy=args.inference_scheduling_policy,
+                       max_kv_cache_tokens=args.inference_max_kv_cache_tokens)
+
+
 if __name__ == "__main__":
     initialize_megatron(extra_args_provider=add_text_generate_args,
                         args_defaults={'tokenizer_type': 'GPT2BPETokenizer',
@@ -122,6 +185,19 @@ if __name__ == "__main__":
 
     assert len(model) == 1, "Above condition should have caught this"
     model = model[0]
+
+    if args.use_inference_engine:
+        assert not args.use_legacy_models, "--use-inference-engine requires a core model"
+        engine = get_inference_engine(args, model)
+        # The engine loop of the server on rank 0 drives the other ranks
+        if torch.distributed.get_rank() == 0:
+            server = MegatronServer(model, engine=engine,
+                                    request_timeout=args.inference_request_timeout)
+            server.run("0.0.0.0",port=args.port)
+        else:
+            AsyncMCoreEngine(engine).run_worker_loop()
+        exit()
+
     if mpu.is_pipeline_first_stage() and mpu.get_tensor_model_parallel_rank() == 0:
         server = MegatronServer(model)
         server.run("0.0.0.0",port=args.port)
@@ -139,3 +215,8 @@ if __name__ == "__main__":
                 beam_search_and_post_process(model)
             except ValueError as ve:
                 pass
+        elif choice.item() == 2:
+            try:
+                score_and_post_process(model)
+            except ValueError as ve:
+                pass